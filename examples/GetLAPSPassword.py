@@ -27,7 +27,7 @@ from __future__ import unicode_literals
 from datetime import datetime
 from impacket import version
 from impacket.dcerpc.v5 import transport
-from impacket.dcerpc.v5.epm import hept_map
+from impacket.dcerpc.v5.epm import hept_map, EPM_CACHE
 from impacket.dcerpc.v5.gkdi import MSRPC_UUID_GKDI, GkdiGetKey, GroupKeyEnvelope
 from impacket.dcerpc.v5.rpcrt import RPC_C_AUTHN_LEVEL_PKT_INTEGRITY, RPC_C_AUTHN_LEVEL_PKT_PRIVACY
 from impacket.dpapi_ng import EncryptedPasswordBlob, KeyIdentifier, compute_kek, create_sd, decrypt_plaintext, unwrap_cek
@@ -113,7 +113,7 @@ class GetLAPSPassword:
             gke = self.__KDSCache[key_id['RootKeyId']]
         else:
             # Connect on RPC over TCP to MS-GKDI to call opnum 0 GetKey 
-            stringBinding = hept_map(destHost=self.__target, remoteIf=MSRPC_UUID_GKDI, protocol = 'ncacn_ip_tcp')
+            stringBinding = hept_map(destHost=self.__target, remoteIf=MSRPC_UUID_GKDI, protocol = 'ncacn_ip_tcp', cache=EPM_CACHE)
             rpctransport = transport.DCERPCTransportFactory(stringBinding)
             if hasattr(rpctransport, 'set_credentials'):
                 rpctransport.set_credentials(username=self.__username, password=self.__password, domain=self.__domain, lmhash=self.__lmhash, nthash=self.__nthash)
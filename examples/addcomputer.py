@@ -126,9 +126,9 @@ class ADDCOMPUTER:
 
     def run_samr(self):
         if self.__targetIp is not None:
-            stringBinding = epm.hept_map(self.__targetIp, samr.MSRPC_UUID_SAMR, protocol = 'ncacn_np')
+            stringBinding = epm.hept_map(self.__targetIp, samr.MSRPC_UUID_SAMR, protocol = 'ncacn_np', cache=epm.EPM_CACHE)
         else:
-            stringBinding = epm.hept_map(self.__target, samr.MSRPC_UUID_SAMR, protocol = 'ncacn_np')
+            stringBinding = epm.hept_map(self.__target, samr.MSRPC_UUID_SAMR, protocol = 'ncacn_np', cache=epm.EPM_CACHE)
         rpctransport = transport.DCERPCTransportFactory(stringBinding)
         rpctransport.set_dport(self.__port)
 
@@ -569,7 +569,7 @@ class SamrPassword(PasswordHandler):
 
 class RpcPassword(SamrPassword):
     def rpctransport(self):
-        stringBinding = epm.hept_map(self.address, samr.MSRPC_UUID_SAMR, protocol="ncacn_ip_tcp")
+        stringBinding = epm.hept_map(self.address, samr.MSRPC_UUID_SAMR, protocol="ncacn_ip_tcp", cache=epm.EPM_CACHE)
         rpctransport = transport.DCERPCTransportFactory(stringBinding)
         rpctransport.setRemoteHost(self.address)
         return rpctransport
@@ -34,8 +34,10 @@ def dumpPage(ese, pageNum):
     data = ese.getPage(pageNum)
     data.dump()
 
-def exportTable(ese, tableName):
-    cursor = ese.openTable(tableName)
+def exportTable(ese, tableName, columns=None):
+    if columns is not None:
+        columns = [column.encode('utf-8') for column in columns.split(',')]
+    cursor = ese.openTable(tableName, columns=columns)
     if cursor is None:
         logging.error('Can"t get a cursor for table: %s' % tableName)
         return
@@ -81,6 +83,8 @@ def main():
     # export page
     export_parser = subparsers.add_parser('export', help='dumps the catalog info for the DB')
     export_parser.add_argument('-table', action='store', required=True, help='table to dump')
+    export_parser.add_argument('-columns', action='store', help='comma separated list of columns to dump (default all). '
+                               'Only these columns are decoded')
 
     if len(sys.argv)==1:
         parser.print_help()
@@ -103,7 +107,7 @@ def main():
         elif options.action.upper() == 'DUMP':
             dumpPage(ese, int(options.page))
         elif options.action.upper() == 'EXPORT':
-            exportTable(ese, options.table)
+            exportTable(ese, options.table, options.columns)
         else:
             raise Exception('Unknown action %s ' % options.action)
     except Exception as e:
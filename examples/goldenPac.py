@@ -844,7 +844,7 @@ class MS14_068:
     def getDomainControllers(self):
         logging.debug('Calling DRSDomainControllerInfo()')
 
-        stringBinding = epm.hept_map(self.__domain, MSRPC_UUID_DRSUAPI, protocol = 'ncacn_ip_tcp')
+        stringBinding = epm.hept_map(self.__domain, MSRPC_UUID_DRSUAPI, protocol = 'ncacn_ip_tcp', cache=epm.EPM_CACHE)
 
         rpctransport = transport.DCERPCTransportFactory(stringBinding)
 
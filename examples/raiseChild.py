@@ -643,7 +643,7 @@ class RAISECHILD:
         else:
             machineNameOrIp = gethostbyname(domainName)
         stringBinding = epm.hept_map(machineNameOrIp, drsuapi.MSRPC_UUID_DRSUAPI,
-                                     protocol='ncacn_ip_tcp')
+                                     protocol='ncacn_ip_tcp', cache=epm.EPM_CACHE)
         rpc = transport.DCERPCTransportFactory(stringBinding)
         if hasattr(rpc, 'set_credentials'):
             # This method exists only for selected protocol sequences.
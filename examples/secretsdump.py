@@ -98,6 +98,8 @@ class DumpSecrets:
         self.__securityHive = options.security
         self.__samHive = options.sam
         self.__ntdsFile = options.ntds
+        self.__workers = options.workers
+        self.__ntdsIndex = options.ntds_index
         self.__skipSam = options.skip_sam
         self.__skipSecurity = options.skip_security
         self.__history = options.history
@@ -320,7 +322,8 @@ class DumpSecrets:
                                                pwdLastSet=self.__pwdLastSet, resumeSession=self.__resumeFileName,
                                                outputFileName=self.__outputFileName, justUser=self.__justUser, 
                                                skipUser=self.__skipUser, ldapFilter=self.__ldapFilter,
-                                               printUserStatus=self.__printUserStatus)
+                                               printUserStatus=self.__printUserStatus, workers=self.__workers,
+                                               indexFile=self.__ntdsIndex)
                 try:
                     self.__NTDSHashes.dump()
                 except Exception as e:
@@ -403,6 +406,11 @@ if __name__ == '__main__':
     parser.add_argument('-security', action='store', help='SECURITY hive to parse')
     parser.add_argument('-sam', action='store', help='SAM hive to parse')
     parser.add_argument('-ntds', action='store', help='NTDS.DIT file to parse')
+    parser.add_argument('-workers', action='store', type=int, default=1, help='Number of processes used to decrypt '
+                         'the NTDS.DIT file given with -ntds (default 1)')
+    parser.add_argument('-ntds-index', action='store', metavar='INDEXFILE', help='File where the catalog and the '
+                         'datatable layout of the NTDS.DIT file given with -ntds are kept, so the next runs don\'t '
+                         'walk them again. It is rebuilt when the NTDS.DIT file changes')
     parser.add_argument('-resumefile', action='store', help='resume file name to resume NTDS.DIT session dump (only '
                          'available to DRSUAPI approach). This file will also be used to keep updating the session\'s '
                          'state')
@@ -427,8 +435,9 @@ if __name__ == '__main__':
 
     group = parser.add_argument_group('display options')
     group.add_argument('-just-dc-user', action='store', metavar='USERNAME',
-                       help='Extract only NTDS.DIT data for the user specified. Only available for DRSUAPI approach. '
-                            'Implies also -just-dc switch')
+                       help='Extract only NTDS.DIT data for the user specified. When parsing a NTDS.DIT file, a SID '
+                            '(S-1-5-...) is looked up through the objectSid index, while account names need a scan '
+                            'of the whole datatable. Implies also -just-dc switch')
     group.add_argument('-ldapfilter', action='store', metavar='LDAPFILTER',
                        help='Extract only NTDS.DIT data for specific users based on an LDAP filter. '
                             'Only available for DRSUAPI approach. Implies also -just-dc switch')
@@ -480,14 +489,14 @@ if __name__ == '__main__':
     domain, username, password, remoteName = parse_target(options.target)
 
     if options.just_dc_user is not None or options.ldapfilter is not None:
-        if options.use_vss is True:
-            logging.error('-just-dc-user switch is not supported in VSS mode')
+        if options.ldapfilter is not None and options.use_vss is True:
+            logging.error('-ldapfilter switch is not supported in VSS mode')
             sys.exit(1)
         elif options.resumefile is not None:
             logging.error('resuming a previous NTDS.DIT dump session not compatible with -just-dc-user switch')
             sys.exit(1)
-        elif remoteName.upper() == 'LOCAL' and username == '':
-            logging.error('-just-dc-user not compatible in LOCAL mode')
+        elif options.ldapfilter is not None and remoteName.upper() == 'LOCAL' and username == '':
+            logging.error('-ldapfilter not compatible in LOCAL mode')
             sys.exit(1)
         else:
             # Having this switch on implies not asking for anything else.
@@ -497,6 +506,10 @@ if __name__ == '__main__':
         logging.error('resuming a previous NTDS.DIT dump session is not supported in VSS mode')
         sys.exit(1)
 
+    if options.ntds_index is not None and options.ntds is None:
+        logging.error('-ntds-index requires a NTDS.DIT file given with -ntds')
+        sys.exit(1)
+
     if options.use_keylist is True and (options.rodcNo is None or options.rodcKey is None):
         logging.error('Both the RODC ID number and the RODC key are required for the Kerb-Key-List approach')
         sys.exit(1)
@@ -45,6 +45,13 @@ if __name__ == '__main__':
     parser.add_argument('-ip', '--interface-address', action='store', default='0.0.0.0', help='ip address of listening interface')
     parser.add_argument('-port', action='store', default='445', help='TCP port for listening incoming connections (default 445)')
     parser.add_argument('-smb2support', action='store_true', default=False, help='SMB2 Support (experimental!)')
+    parser.add_argument('-smb3support', action='store_true', default=False, help='SMB 3.0 and multichannel Support, '
+                                                                                    'needs -smb2support (experimental!)')
+    parser.add_argument('-event-loops', action='store', type=int, default=0, metavar='N',
+                        help='Serve the connections from N event loops instead of a thread per connection, for '
+                             'many clients at once (default 0)')
+    parser.add_argument('-stats', action='store', type=int, default=0, metavar='SECONDS',
+                        help='Log the connection count and the request rate every SECONDS seconds')
     parser.add_argument('-outputfile', action='store', default=None, help='Output file to log smbserver output messages')
 
     if len(sys.argv)==1:
@@ -79,6 +86,11 @@ if __name__ == '__main__':
 
     server.addShare(options.shareName.upper(), options.sharePath, comment)
     server.setSMB2Support(options.smb2support)
+    server.setSMB3Support(options.smb3support)
+    if options.event_loops > 0:
+        server.setEventLoops(options.event_loops)
+    if options.stats > 0:
+        server.setStatsInterval(options.stats)
 
     # If a user was specified, let's add it to the credentials for the SMBServer. If no user is specified, anonymous
     # connections will be allowed
@@ -0,0 +1,947 @@
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   [MS-SMB2] asyncio client (SMB2 and SMB3)
+#   Same packets and authentication code than smb3.SMB3, signing, encryption
+#   and key derivation come from the helpers there. But every method is a
+#   coroutine and nothing blocks: a single event loop can keep tens of
+#   thousands of sessions going at once. Each connection has a reader task
+#   handing the answers to whoever is waiting for their MessageID, so several
+#   requests can be in flight on the same session (e.g. retrieveFile() and
+#   listPath() running at the same time).
+#
+#   Only the direct TCP transport (port 445) is supported. Encryption is
+#   used like smb3.SMB3 does, compression is not negotiated.
+#
+#   Example:
+#
+#       async with AsyncSMB3(target, target) as smb:
+#           await smb.login(user, password, domain)
+#           for f in await smb.listPath('C$', '*'):
+#               print(f.get_longname())
+#
+
+import copy
+import errno
+import ntpath
+import struct
+import string
+import asyncio
+import hashlib
+from collections import deque
+from binascii import a2b_hex
+
+from pyasn1.type.univ import noValue
+
+from impacket import nmb, ntlm
+from impacket.smb3 import SessionError, ENCRYPTION_ALGORITHMS, SIGNING_ALGORITHMS, TRANSFER_WINDOW_SIZE, WIN_VERSIONS, \
+    TREE_CONNECT, rand, negotiateContextList, processContextList, signSMB, encryptSMB, decryptSMB, deriveSigningKey, \
+    deriveCipherKeys
+from impacket.smb3structs import *
+from impacket.nt_errors import STATUS_SUCCESS, STATUS_MORE_PROCESSING_REQUIRED, STATUS_INVALID_PARAMETER, \
+    STATUS_NO_MORE_FILES, STATUS_PENDING, STATUS_END_OF_FILE
+from impacket.spnego import SPNEGO_NegTokenInit, TypesMech, SPNEGO_NegTokenResp, ASN1_OID, asn1encode, ASN1_AID
+from impacket.krb5.gssapi import KRB5_AP_REQ
+
+# Credits asked for in every request once the session is up
+CREDITS_REQUESTED = 127
+
+
+class AsyncSMB3:
+    def __init__(self, remote_name, remote_host, sess_port=445, timeout=60, preferredDialect=None, clientGuid=None):
+        self.RequireMessageSigning = False
+        if clientGuid is None:
+            self.ClientGuid = ''.join([rand.choice(string.ascii_letters) for i in range(16)])
+        else:
+            self.ClientGuid = clientGuid
+        # Only for SMB 3.1.1
+        self.EncryptionAlgorithmList = list(ENCRYPTION_ALGORITHMS)
+        self.SigningAlgorithmList = list(SIGNING_ALGORITHMS)
+
+        self._Connection = {
+            # Indexed by MessageID, futures for the answers not received yet
+            'OutstandingRequests'      : {},
+            'SequenceWindow'           : 0,
+            'Credits'                  : 1,
+            'MaxTransactSize'          : 0,
+            'MaxReadSize'              : 0,
+            'MaxWriteSize'             : 0,
+            'ServerGuid'               : '',
+            'RequireSigning'           : False,
+            'ServerName'               : remote_name,
+            'ServerIP'                 : remote_host,
+            'ClientName'               : '',
+            'Dialect'                  : 0,
+            'SupportsMultiCredit'      : False,
+            'SupportsEncryption'       : False,
+            'Capabilities'             : 0,
+            'ServerCapabilities'       : 0,
+            'ClientSecurityMode'       : 0,
+            'ServerSecurityMode'       : 0,
+            'PreauthIntegrityHashValue': a2b_hex(b'0'*128),
+            'CipherId'                 : 0,
+            'SigningAlgorithmId'       : SMB2_SIGNING_AES_CMAC,
+        }
+
+        self._Session = {
+            'SessionID'                : 0,
+            'TreeConnectTable'         : {},
+            'OpenTable'                : {},
+            'SessionKey'               : b'',
+            'SigningRequired'          : False,
+            'SigningActivated'         : False,
+            'SigningKey'               : b'',
+            'EncryptionKey'            : b'',
+            'DecryptionKey'            : b'',
+            'ApplicationKey'           : b'',
+            'SessionFlags'             : 0,
+            'ServerName'               : '',
+            'ServerDomain'             : '',
+            'ServerDNSDomainName'      : '',
+            'ServerDNSHostName'        : '',
+            'ServerOS'                 : '',
+            'PreauthIntegrityHashValue': a2b_hex(b'0'*128),
+        }
+
+        self.SMB_PACKET = SMB2Packet
+
+        self._timeout = timeout
+        self._sess_port = sess_port
+        self._preferredDialect = preferredDialect
+        self._transferWindow = TRANSFER_WINDOW_SIZE
+        self._doKerberos = False
+
+        self._reader = None
+        self._writer = None
+        self._readerTask = None
+        self._error = None
+        # Set every time the server grants credits
+        self._creditsGranted = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close_session()
+
+    async def connect(self):
+        # Opens the TCP connection and negotiates the dialect
+        self._creditsGranted = asyncio.Event()
+        self._reader, self._writer = await asyncio.wait_for(asyncio.open_connection(self._Connection['ServerIP'],
+                                                                                    self._sess_port), self._timeout)
+        self._readerTask = asyncio.ensure_future(self.__readLoop())
+        await self.negotiateSession(self._preferredDialect)
+
+    async def close_session(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        self._readerTask.cancel()
+        try:
+            await self._readerTask
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
+
+    def getDialect(self):
+        return self._Connection['Dialect']
+
+    def getKerberos(self):
+        return self._doKerberos
+
+    def getServerName(self):
+        return self._Session['ServerName']
+
+    def getServerDomain(self):
+        return self._Session['ServerDomain']
+
+    def getServerDNSDomainName(self):
+        return self._Session['ServerDNSDomainName']
+
+    def getServerDNSHostName(self):
+        return self._Session['ServerDNSHostName']
+
+    def getServerOS(self):
+        return self._Session['ServerOS']
+
+    def getSessionKey(self):
+        if self.getDialect() >= SMB2_DIALECT_30:
+            return self._Session['ApplicationKey']
+        return self._Session['SessionKey']
+
+    def isGuestSession(self):
+        return self._Session['SessionFlags'] & SMB2_SESSION_FLAG_IS_GUEST
+
+    def setTimeout(self, timeout):
+        self._timeout = timeout
+
+    def setTransferWindow(self, windowSize):
+        # Bytes that retrieveFile() and storeFile() keep in flight
+        self._transferWindow = windowSize
+
+    def __updateConnectionPreAuthHash(self, data):
+        self._Connection['PreauthIntegrityHashValue'] = hashlib.sha512(self._Connection['PreauthIntegrityHashValue']
+                                                                       + data).digest()
+
+    def __updatePreAuthHash(self, data):
+        self._Session['PreauthIntegrityHashValue'] = hashlib.sha512(self._Session['PreauthIntegrityHashValue']
+                                                                    + data).digest()
+
+    async def __readLoop(self):
+        # Reads frames until the connection goes away, and hands every answer in them to the future
+        # waiting for its MessageID
+        try:
+            while True:
+                header = await self._reader.readexactly(4)
+                data = await self._reader.readexactly(struct.unpack('>L', header)[0] & 0xffffff)
+                # Anything but session messages (e.g. keep alives) is ignored
+                if header[0] == nmb.NETBIOS_SESSION_MESSAGE:
+                    self.__processFrame(data)
+        except asyncio.IncompleteReadError:
+            self._error = nmb.NetBIOSError('Error while reading from remote', nmb.ERRCLASS_OS, None)
+        except (ConnectionError, OSError) as e:
+            self._error = nmb.NetBIOSError('Error occurs while reading from remote', nmb.ERRCLASS_OS, e.errno)
+        except SessionError as e:
+            # Frames we can't decrypt or decompress, there's no way to tell who they were for
+            self._error = e
+        except asyncio.CancelledError:
+            self._error = nmb.NetBIOSError('Connection closed', nmb.ERRCLASS_OS, errno.ECONNABORTED)
+            raise
+        finally:
+            outstandingRequests = self._Connection['OutstandingRequests']
+            self._Connection['OutstandingRequests'] = {}
+            for future in outstandingRequests.values():
+                if future.done() is False:
+                    future.set_exception(self._error)
+            self._creditsGranted.set()
+
+    def __processFrame(self, data):
+        if data.startswith(b'\xfdSMB'):
+            data = decryptSMB(self._Connection, self._Session, data)
+
+        while True:
+            packet = SMB2Packet(data)
+            if packet['NextCommand'] != 0:
+                packet = SMB2Packet(data[:packet['NextCommand']])
+                data = data[packet['NextCommand']:]
+            else:
+                data = b''
+            self._Connection['Credits'] += packet['CreditRequestResponse']
+            # Interim answers only grant credits, the final one comes later on
+            if packet['Status'] != STATUS_PENDING or (packet['Flags'] & SMB2_FLAGS_ASYNC_COMMAND) == 0:
+                future = self._Connection['OutstandingRequests'].pop(packet['MessageID'], None)
+                # Nobody is waiting for it if the request was cancelled
+                if future is not None and future.done() is False:
+                    future.set_result(packet)
+            if len(data) == 0:
+                break
+        self._creditsGranted.set()
+
+    def signSMB(self, packet):
+        signSMB(self._Connection, self._Session, packet)
+
+    def __isEncryptionRequired(self, treeId):
+        return (self._Session['SessionFlags'] & SMB2_SESSION_FLAG_ENCRYPT_DATA) or (
+                treeId in self._Session['TreeConnectTable'] and
+                self._Session['TreeConnectTable'][treeId]['EncryptData'] is True)
+
+    def __creditCharge(self, length):
+        if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
+            return 1 + (max(length, 1) - 1) // 65536
+        return 1
+
+    def __getChunkSize(self, maxSize):
+        # Biggest READ/WRITE we can send in a single request
+        if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
+            return maxSize
+        return min(65536, maxSize)
+
+    async def sendSMB(self, packet):
+        # Sends a request and returns the future its answer will be set on. Waits for the server to grant
+        # the credits it needs while other requests are in flight
+        if self._error is not None:
+            raise self._error
+
+        if ('CreditCharge' in packet.fields) is False:
+            packet['CreditCharge'] = 1
+        creditCharge = max(packet['CreditCharge'], 1)
+        if self._Connection['Dialect'] == SMB2_DIALECT_002:
+            creditCharge = 1
+        while self._Connection['Credits'] < creditCharge and len(self._Connection['OutstandingRequests']) > 0:
+            self._creditsGranted.clear()
+            await self._creditsGranted.wait()
+            if self._error is not None:
+                raise self._error
+
+        # Nothing below awaits until the request is written, so MessageIDs go out in order
+        packet['MessageID'] = self._Connection['SequenceWindow']
+        self._Connection['SequenceWindow'] += creditCharge
+        self._Connection['Credits'] -= creditCharge
+        packet['SessionID'] = self._Session['SessionID']
+        if self._Connection['SequenceWindow'] > 3:
+            packet['CreditRequestResponse'] = CREDITS_REQUESTED
+        else:
+            packet['CreditRequestResponse'] = creditCharge
+
+        encrypt = self.__isEncryptionRequired(packet['TreeID'])
+        if self._Session['SigningActivated'] is True and encrypt is False:
+            if ('Flags' in packet.fields) is False:
+                packet['Flags'] = 0
+            packet['Flags'] |= SMB2_FLAGS_SIGNED
+            self.signSMB(packet)
+
+        data = packet.getData()
+        if encrypt:
+            data = encryptSMB(self._Connection, self._Session, data)
+
+        future = asyncio.get_running_loop().create_future()
+        self._Connection['OutstandingRequests'][packet['MessageID']] = future
+        self._writer.write(struct.pack('>L', len(data)) + data)
+        await self._writer.drain()
+        return future
+
+    async def recvSMB(self, future):
+        # Waits for the answer to a request sent with sendSMB()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self._timeout)
+        except asyncio.TimeoutError:
+            # Whatever comes later on for it is dropped
+            for messageId, outstandingRequest in list(self._Connection['OutstandingRequests'].items()):
+                if outstandingRequest is future:
+                    del(self._Connection['OutstandingRequests'][messageId])
+            raise nmb.NetBIOSTimeout
+
+    async def sendRecv(self, packet):
+        return await self.recvSMB(await self.sendSMB(packet))
+
+    def processContextList(self, contextCount, contextList):
+        # Compression is not offered
+        processContextList(self._Connection, contextCount, contextList, self.EncryptionAlgorithmList,
+                           self.SigningAlgorithmList, [])
+
+    async def negotiateSession(self, preferredDialect=None):
+        self._Connection['ClientSecurityMode'] = SMB2_NEGOTIATE_SIGNING_ENABLED
+        if self.RequireMessageSigning is True:
+            self._Connection['ClientSecurityMode'] |= SMB2_NEGOTIATE_SIGNING_REQUIRED
+        self._Connection['Capabilities'] = SMB2_GLOBAL_CAP_ENCRYPTION
+
+        packet = self.SMB_PACKET()
+        packet['Command'] = SMB2_NEGOTIATE
+        negSession = SMB2Negotiate()
+        negSession['SecurityMode'] = self._Connection['ClientSecurityMode']
+        negSession['Capabilities'] = self._Connection['Capabilities']
+        negSession['ClientGuid'] = self.ClientGuid
+        if preferredDialect is not None:
+            negSession['Dialects'] = [preferredDialect]
+            if preferredDialect == SMB2_DIALECT_311:
+                contextData = SMB311ContextData()
+                contextData['NegotiateContextOffset'] = 64+38+2
+                contextData['NegotiateContextCount'], negSession['NegotiateContextList'] = \
+                    negotiateContextList(self.EncryptionAlgorithmList, self.SigningAlgorithmList, [])
+                negSession['ClientStartTime'] = contextData.getData()
+                negSession['Padding'] = b'\xFF\xFF'
+        else:
+            negSession['Dialects'] = [SMB2_DIALECT_002, SMB2_DIALECT_21, SMB2_DIALECT_30]
+        negSession['DialectCount'] = len(negSession['Dialects'])
+        packet['Data'] = negSession
+
+        future = await self.sendSMB(packet)
+        self.__updateConnectionPreAuthHash(packet.getData())
+        ans = await self.recvSMB(future)
+        ans.isValidAnswer(STATUS_SUCCESS)
+        negResp = SMB2Negotiate_Response(ans['Data'])
+
+        self._Connection['MaxTransactSize'] = min(0x100000, negResp['MaxTransactSize'])
+        self._Connection['MaxReadSize'] = min(0x100000, negResp['MaxReadSize'])
+        self._Connection['MaxWriteSize'] = min(0x100000, negResp['MaxWriteSize'])
+        self._Connection['ServerGuid'] = negResp['ServerGuid']
+        self._Connection['Dialect'] = negResp['DialectRevision']
+
+        if (negResp['SecurityMode'] & SMB2_NEGOTIATE_SIGNING_REQUIRED) == SMB2_NEGOTIATE_SIGNING_REQUIRED:
+            self._Connection['RequireSigning'] = True
+        if self._Connection['Dialect'] == SMB2_DIALECT_311:
+            self.__updateConnectionPreAuthHash(ans.rawData)
+            # Always Sign
+            self._Connection['RequireSigning'] = True
+            if negResp['NegotiateContextCount'] > 0:
+                self.processContextList(negResp['NegotiateContextCount'], negResp['NegotiateContextList'])
+
+        if (negResp['Capabilities'] & SMB2_GLOBAL_CAP_LARGE_MTU) == SMB2_GLOBAL_CAP_LARGE_MTU:
+            self._Connection['SupportsMultiCredit'] = True
+
+        if self._Connection['Dialect'] >= SMB2_DIALECT_30:
+            self.SMB_PACKET = SMB3Packet
+            if (negResp['Capabilities'] & SMB2_GLOBAL_CAP_ENCRYPTION) == SMB2_GLOBAL_CAP_ENCRYPTION:
+                self._Connection['SupportsEncryption'] = True
+            self._Connection['ServerCapabilities'] = negResp['Capabilities']
+            self._Connection['ServerSecurityMode'] = negResp['SecurityMode']
+
+    def __sessionSetupPacket(self, securityBlob):
+        sessionSetup = SMB2SessionSetup()
+        if self.RequireMessageSigning is True:
+            sessionSetup['SecurityMode'] = SMB2_NEGOTIATE_SIGNING_REQUIRED
+        else:
+            sessionSetup['SecurityMode'] = SMB2_NEGOTIATE_SIGNING_ENABLED
+        sessionSetup['Flags'] = 0
+        sessionSetup['SecurityBufferLength'] = len(securityBlob)
+        sessionSetup['Buffer'] = securityBlob
+
+        packet = self.SMB_PACKET()
+        packet['Command'] = SMB2_SESSION_SETUP
+        packet['Data'] = sessionSetup
+        return packet
+
+    def __deriveKeys(self, user):
+        # Signing and encryption keys, from Session.SessionKey
+        if self._Connection['Dialect'] >= SMB2_DIALECT_30:
+            self._Session['SigningKey'] = deriveSigningKey(self._Connection, self._Session, self._Session['SessionKey'])
+
+        # Do not encrypt anonymous connections
+        if user == '' or self.isGuestSession():
+            self._Connection['SupportsEncryption'] = False
+
+        if self._Session['SigningRequired'] is True:
+            self._Session['SigningActivated'] = True
+        if self._Connection['Dialect'] >= SMB2_DIALECT_30 and self._Connection['SupportsEncryption'] is True:
+            self._Session['SessionFlags'] |= SMB2_SESSION_FLAG_ENCRYPT_DATA
+            self._Session['ApplicationKey'], self._Session['EncryptionKey'], self._Session['DecryptionKey'] = \
+                deriveCipherKeys(self._Connection, self._Session, self._Session['SessionKey'])
+
+    def __resetSession(self):
+        self._Session['SessionID'] = 0
+        self._Session['SessionKey'] = b''
+        self._Session['SigningKey'] = b''
+        self._Session['SigningRequired'] = False
+        self._Session['SigningActivated'] = False
+        self._Session['SessionFlags'] = 0
+        self._Session['PreauthIntegrityHashValue'] = a2b_hex(b'0'*128)
+
+    def __parseChallenge(self, ntlmChallenge):
+        # Let's parse some data and keep it to ourselves in case it is asked
+        if ntlmChallenge['TargetInfoFields_len'] > 0:
+            av_pairs = ntlm.AV_PAIRS(ntlmChallenge['TargetInfoFields'][:ntlmChallenge['TargetInfoFields_len']])
+            for avId, key in ((ntlm.NTLMSSP_AV_HOSTNAME, 'ServerName'), (ntlm.NTLMSSP_AV_DOMAINNAME, 'ServerDomain'),
+                              (ntlm.NTLMSSP_AV_DNS_DOMAINNAME, 'ServerDNSDomainName'),
+                              (ntlm.NTLMSSP_AV_DNS_HOSTNAME, 'ServerDNSHostName')):
+                if av_pairs[avId] is not None:
+                    try:
+                        self._Session[key] = av_pairs[avId][1].decode('utf-16le')
+                    except UnicodeDecodeError:
+                        pass
+        if 'Version' in ntlmChallenge.fields and len(ntlmChallenge['Version']) >= 4:
+            version = ntlmChallenge['Version']
+            build = struct.unpack('<H', version[2:4])[0]
+            if build in WIN_VERSIONS:
+                self._Session['ServerOS'] = WIN_VERSIONS[build] + " Build %d" % build
+            else:
+                self._Session['ServerOS'] = "Windows %d.%d Build %d" % (version[0], version[1], build)
+
+    async def login(self, user, password, domain='', lmhash='', nthash=''):
+        # If we have hashes, normalize them
+        if lmhash != '' or nthash != '':
+            if len(lmhash) % 2:     lmhash = '0%s' % lmhash
+            if len(nthash) % 2:     nthash = '0%s' % nthash
+            try: # just in case they were converted already
+                lmhash = a2b_hex(lmhash)
+                nthash = a2b_hex(nthash)
+            except:
+                pass
+
+        blob = SPNEGO_NegTokenInit()
+        blob['MechTypes'] = [TypesMech['NTLMSSP - Microsoft NTLM Security Support Provider']]
+        auth = ntlm.getNTLMSSPType1(self._Connection['ClientName'], domain, self._Connection['RequireSigning'])
+        blob['MechToken'] = auth.getData()
+        packet = self.__sessionSetupPacket(blob.getData())
+
+        self._Session['PreauthIntegrityHashValue'] = self._Connection['PreauthIntegrityHashValue']
+        try:
+            future = await self.sendSMB(packet)
+            self.__updatePreAuthHash(packet.getData())
+            ans = await self.recvSMB(future)
+            self.__updatePreAuthHash(ans.rawData)
+            ans.isValidAnswer(STATUS_MORE_PROCESSING_REQUIRED)
+
+            self._Session['SessionID'] = ans['SessionID']
+            self._Session['SigningRequired'] = self._Connection['RequireSigning']
+            respToken = SPNEGO_NegTokenResp(SMB2SessionSetup_Response(ans['Data'])['Buffer'])
+            self.__parseChallenge(ntlm.NTLMAuthChallenge(respToken['ResponseToken']))
+
+            type3, exportedSessionKey = ntlm.getNTLMSSPType3(auth, respToken['ResponseToken'], user, password, domain,
+                                                             lmhash, nthash)
+            respToken2 = SPNEGO_NegTokenResp()
+            respToken2['ResponseToken'] = type3.getData()
+            packet = self.__sessionSetupPacket(respToken2.getData())
+            future = await self.sendSMB(packet)
+            self.__updatePreAuthHash(packet.getData())
+            ans = await self.recvSMB(future)
+            ans.isValidAnswer(STATUS_SUCCESS)
+
+            self._Session['SessionFlags'] = SMB2SessionSetup_Response(ans['Data'])['SessionFlags']
+            self._Session['SessionID'] = ans['SessionID']
+            if exportedSessionKey is not None:
+                self._Session['SessionKey'] = exportedSessionKey
+            self.__deriveKeys(user)
+            return True
+        except:
+            # We clean the stuff we used in case we want to authenticate again
+            # within the same connection
+            self.__resetSession()
+            raise
+
+    async def kerberosLogin(self, user, password, domain='', lmhash='', nthash='', aesKey='', kdcHost='', TGT=None,
+                            TGS=None, useCache=True):
+        # Same as smb3.SMB3.kerberosLogin(). Talking to the KDC blocks, that's done in the loop's executor
+        if lmhash != '' or nthash != '':
+            if len(lmhash) % 2:     lmhash = '0%s' % lmhash
+            if len(nthash) % 2:     nthash = '0%s' % nthash
+            try: # just in case they were converted already
+                lmhash = a2b_hex(lmhash)
+                nthash = a2b_hex(nthash)
+            except:
+                pass
+
+        # Importing down here so pyasn1 is not required if kerberos is not used.
+        from impacket.krb5.asn1 import AP_REQ, Authenticator, TGS_REP, seq_set
+        from impacket.krb5.ccache import CCache
+        from impacket.krb5.kerberosv5 import getKerberosTGT, getKerberosTGS
+        from impacket.krb5 import constants
+        from impacket.krb5.types import Principal, KerberosTime, Ticket
+        from pyasn1.codec.der import decoder, encoder
+        import datetime
+
+        self._doKerberos = True
+        loop = asyncio.get_running_loop()
+        if TGT is None and TGS is None and useCache is True:
+            domain, user, TGT, TGS = CCache.parseFile(domain, user, 'cifs/%s' % self._Connection['ServerName'])
+
+        userName = Principal(user, type=constants.PrincipalNameType.NT_PRINCIPAL.value)
+        if TGS is None:
+            if TGT is None:
+                tgt, cipher, oldSessionKey, sessionKey = await loop.run_in_executor(None, getKerberosTGT, userName,
+                                                                                    password, domain, lmhash, nthash,
+                                                                                    aesKey, kdcHost)
+            else:
+                tgt = TGT['KDC_REP']
+                cipher = TGT['cipher']
+                sessionKey = TGT['sessionKey']
+            serverName = Principal('cifs/%s' % self._Connection['ServerName'],
+                                   type=constants.PrincipalNameType.NT_SRV_INST.value)
+            tgs, cipher, oldSessionKey, sessionKey = await loop.run_in_executor(None, getKerberosTGS, serverName,
+                                                                                domain, kdcHost, tgt, cipher,
+                                                                                sessionKey)
+        else:
+            tgs = TGS['KDC_REP']
+            cipher = TGS['cipher']
+            sessionKey = TGS['sessionKey']
+
+        # Let's build a NegTokenInit with a Kerberos REQ_AP
+        blob = SPNEGO_NegTokenInit()
+        blob['MechTypes'] = [TypesMech['MS KRB5 - Microsoft Kerberos 5']]
+
+        tgs = decoder.decode(tgs, asn1Spec=TGS_REP())[0]
+        ticket = Ticket()
+        ticket.from_asn1(tgs['ticket'])
+
+        apReq = AP_REQ()
+        apReq['pvno'] = 5
+        apReq['msg-type'] = int(constants.ApplicationTagNumbers.AP_REQ.value)
+        apReq['ap-options'] = constants.encodeFlags([])
+        seq_set(apReq, 'ticket', ticket.to_asn1)
+
+        authenticator = Authenticator()
+        authenticator['authenticator-vno'] = 5
+        authenticator['crealm'] = domain
+        seq_set(authenticator, 'cname', userName.components_to_asn1)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        authenticator['cusec'] = now.microsecond
+        authenticator['ctime'] = KerberosTime.to_asn1(now)
+
+        # Key Usage 11
+        # AP-REQ Authenticator (includes application authenticator
+        # subkey), encrypted with the application session key
+        # (Section 5.5.1)
+        encryptedEncodedAuthenticator = cipher.encrypt(sessionKey, 11, encoder.encode(authenticator), None)
+
+        apReq['authenticator'] = noValue
+        apReq['authenticator']['etype'] = cipher.enctype
+        apReq['authenticator']['cipher'] = encryptedEncodedAuthenticator
+
+        blob['MechToken'] = struct.pack('B', ASN1_AID) + asn1encode(struct.pack('B', ASN1_OID) + asn1encode(
+            TypesMech['KRB5 - Kerberos 5']) + KRB5_AP_REQ + encoder.encode(apReq))
+
+        packet = self.__sessionSetupPacket(blob.getData())
+        self._Session['PreauthIntegrityHashValue'] = self._Connection['PreauthIntegrityHashValue']
+        try:
+            future = await self.sendSMB(packet)
+            self.__updatePreAuthHash(packet.getData())
+            ans = await self.recvSMB(future)
+            ans.isValidAnswer(STATUS_SUCCESS)
+
+            self._Session['SessionFlags'] = SMB2SessionSetup_Response(ans['Data'])['SessionFlags']
+            self._Session['SessionID'] = ans['SessionID']
+            self._Session['SigningRequired'] = self._Connection['RequireSigning']
+            self._Session['SessionKey'] = sessionKey.contents[:16]
+            self.__deriveKeys(user)
+            return True
+        except:
+            self.__resetSession()
+            raise
+
+    async def logoff(self):
+        packet = self.SMB_PACKET()
+        packet['Command'] = SMB2_LOGOFF
+        packet['Data'] = SMB2Logoff()
+        ans = await self.sendRecv(packet)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            self.__resetSession()
+            self._Session['TreeConnectTable'] = {}
+            self._Session['OpenTable'] = {}
+            return True
+
+    async def connectTree(self, share):
+        share = share.split('\\')[-1]
+        path = '\\\\' + self._Connection['ServerIP'] + '\\' + share
+
+        treeConnect = SMB2TreeConnect()
+        treeConnect['Buffer'] = path.encode('utf-16le')
+        treeConnect['PathLength'] = len(path)*2
+
+        packet = self.SMB_PACKET()
+        packet['Command'] = SMB2_TREE_CONNECT
+        packet['Data'] = treeConnect
+        ans = await self.sendRecv(packet)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            treeConnectResponse = SMB2TreeConnect_Response(ans['Data'])
+            # Trees are not shared among callers, several tasks might be connecting to the same share
+            treeEntry = copy.deepcopy(TREE_CONNECT)
+            treeEntry['ShareName'] = share
+            treeEntry['TreeConnectId'] = ans['TreeID']
+            treeEntry['Session'] = ans['SessionID']
+            treeEntry['NumberOfUses'] = 1
+            if (treeConnectResponse['Capabilities'] & SMB2_SHARE_CAP_DFS) == SMB2_SHARE_CAP_DFS:
+                treeEntry['IsDfsShare'] = True
+            if self._Connection['Dialect'] >= SMB2_DIALECT_30 and self._Connection['SupportsEncryption'] is True and \
+                    (treeConnectResponse['ShareFlags'] & SMB2_SHAREFLAG_ENCRYPT_DATA) == SMB2_SHAREFLAG_ENCRYPT_DATA:
+                treeEntry['EncryptData'] = True
+            self._Session['TreeConnectTable'][ans['TreeID']] = treeEntry
+            return ans['TreeID']
+
+    async def disconnectTree(self, treeId):
+        if (treeId in self._Session['TreeConnectTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+
+        packet = self.SMB_PACKET()
+        packet['Command'] = SMB2_TREE_DISCONNECT
+        packet['TreeID'] = treeId
+        packet['Data'] = SMB2TreeDisconnect()
+        ans = await self.sendRecv(packet)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            del(self._Session['TreeConnectTable'][treeId])
+            for fileId in [fileId for fileId, openFile in self._Session['OpenTable'].items()
+                           if openFile['TreeConnect'] == treeId]:
+                del(self._Session['OpenTable'][fileId])
+            return True
+
+    async def create(self, treeId, fileName, desiredAccess, shareMode, creationOptions, creationDisposition,
+                     fileAttributes, impersonationLevel=SMB2_IL_IMPERSONATION, securityFlags=0,
+                     oplockLevel=SMB2_OPLOCK_LEVEL_NONE, createContexts=None):
+        if (treeId in self._Session['TreeConnectTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+
+        fileName = fileName.replace('/', '\\')
+        if len(fileName) > 0:
+            fileName = ntpath.normpath(fileName)
+            if fileName[0] == '\\':
+                fileName = fileName[1:]
+
+        packet = self.SMB_PACKET()
+        packet['Command'] = SMB2_CREATE
+        packet['TreeID'] = treeId
+        if self._Session['TreeConnectTable'][treeId]['IsDfsShare'] is True:
+            packet['Flags'] = SMB2_FLAGS_DFS_OPERATIONS
+
+        smb2Create = SMB2Create()
+        smb2Create['SecurityFlags'] = 0
+        smb2Create['RequestedOplockLevel'] = oplockLevel
+        smb2Create['ImpersonationLevel'] = impersonationLevel
+        smb2Create['DesiredAccess'] = desiredAccess
+        smb2Create['FileAttributes'] = fileAttributes
+        smb2Create['ShareAccess'] = shareMode
+        smb2Create['CreateDisposition'] = creationDisposition
+        smb2Create['CreateOptions'] = creationOptions
+        smb2Create['NameLength'] = len(fileName)*2
+        if fileName != '':
+            smb2Create['Buffer'] = fileName.encode('utf-16le')
+        else:
+            smb2Create['Buffer'] = b'\x00'
+
+        if createContexts is not None:
+            contextsBuf = b''.join(x.getData() for x in createContexts)
+            smb2Create['CreateContextsOffset'] = len(SMB2Packet()) + SMB2Create.SIZE + len(smb2Create['Buffer'])
+            # pad offset to 8-byte align
+            if smb2Create['CreateContextsOffset'] % 8:
+                smb2Create['Buffer'] += b'\x00'*(8-(smb2Create['CreateContextsOffset'] % 8))
+                smb2Create['CreateContextsOffset'] = len(SMB2Packet()) + SMB2Create.SIZE + len(smb2Create['Buffer'])
+            smb2Create['CreateContextsLength'] = len(contextsBuf)
+            smb2Create['Buffer'] += contextsBuf
+        else:
+            smb2Create['CreateContextsOffset'] = 0
+            smb2Create['CreateContextsLength'] = 0
+
+        packet['Data'] = smb2Create
+        ans = await self.sendRecv(packet)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            createResponse = SMB2Create_Response(ans['Data'])
+            fileId = createResponse['FileID'].getData()
+            self._Session['OpenTable'][fileId] = {
+                'FileID'      : fileId,
+                'TreeConnect' : treeId,
+                'FileName'    : fileName,
+                'EndOfFile'   : createResponse['EndOfFile'],
+            }
+            return fileId
+
+    async def close(self, treeId, fileId):
+        if (treeId in self._Session['TreeConnectTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+        if (fileId in self._Session['OpenTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+
+        packet = self.SMB_PACKET()
+        packet['Command'] = SMB2_CLOSE
+        packet['TreeID'] = treeId
+        smbClose = SMB2Close()
+        smbClose['Flags'] = 0
+        smbClose['FileID'] = fileId
+        packet['Data'] = smbClose
+        ans = await self.sendRecv(packet)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            del(self._Session['OpenTable'][fileId])
+            return True
+
+    async def read(self, treeId, fileId, offset=0, bytesToRead=0, singleCall=False):
+        # Reads up to bytesToRead bytes, in as many requests as needed. Less data is returned if the end of
+        # file is reached, STATUS_END_OF_FILE is raised if nothing could be read. With singleCall only one
+        # request is sent (e.g. for named pipes, where every read returns what's there)
+        if (treeId in self._Session['TreeConnectTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+        if (fileId in self._Session['OpenTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+
+        data = []
+        readOffset = offset
+        while readOffset - offset < bytesToRead:
+            length = min(self.__getChunkSize(self._Connection['MaxReadSize']), bytesToRead - (readOffset - offset))
+            packet = self.SMB_PACKET()
+            packet['Command'] = SMB2_READ
+            packet['TreeID'] = treeId
+            packet['CreditCharge'] = self.__creditCharge(length)
+            smbRead = SMB2Read()
+            smbRead['Padding'] = 0x50
+            smbRead['FileID'] = fileId
+            smbRead['Length'] = length
+            smbRead['Offset'] = readOffset
+            packet['Data'] = smbRead
+            ans = await self.sendRecv(packet)
+            try:
+                ans.isValidAnswer(STATUS_SUCCESS)
+            except SessionError as e:
+                if e.get_error_code() != STATUS_END_OF_FILE or len(data) == 0:
+                    raise
+                break
+            chunk = SMB2Read_Response(ans['Data'])['Buffer']
+            if len(chunk) == 0:
+                break
+            data.append(chunk)
+            readOffset += len(chunk)
+            if singleCall is True:
+                break
+        return b''.join(data)
+
+    async def write(self, treeId, fileId, data, offset=0):
+        # Writes all of data, in as many requests as needed. Returns the amount of bytes written
+        if (treeId in self._Session['TreeConnectTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+        if (fileId in self._Session['OpenTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+
+        written = 0
+        while written < len(data):
+            length = min(self.__getChunkSize(self._Connection['MaxWriteSize']), len(data) - written)
+            packet = self.SMB_PACKET()
+            packet['Command'] = SMB2_WRITE
+            packet['TreeID'] = treeId
+            packet['CreditCharge'] = self.__creditCharge(length)
+            smbWrite = SMB2Write()
+            smbWrite['FileID'] = fileId
+            smbWrite['Length'] = length
+            smbWrite['Offset'] = offset + written
+            smbWrite['WriteChannelInfoOffset'] = 0
+            smbWrite['Buffer'] = data[written:written+length]
+            packet['Data'] = smbWrite
+            ans = await self.sendRecv(packet)
+            ans.isValidAnswer(STATUS_SUCCESS)
+            count = SMB2Write_Response(ans['Data'])['Count']
+            if count == 0:
+                break
+            written += count
+        return written
+
+    async def queryDirectory(self, treeId, fileId, searchString='*', resumeIndex=0,
+                             informationClass=FILENAMES_INFORMATION, maxBufferSize=None):
+        if (treeId in self._Session['TreeConnectTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+        if (fileId in self._Session['OpenTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
+
+        packet = self.SMB_PACKET()
+        packet['Command'] = SMB2_QUERY_DIRECTORY
+        packet['TreeID'] = treeId
+
+        queryDirectory = SMB2QueryDirectory()
+        queryDirectory['FileInformationClass'] = informationClass
+        if resumeIndex != 0:
+            queryDirectory['Flags'] = SMB2_INDEX_SPECIFIED
+        queryDirectory['FileIndex'] = resumeIndex
+        queryDirectory['FileID'] = fileId
+        if maxBufferSize is None:
+            maxBufferSize = self._Connection['MaxReadSize']
+        queryDirectory['OutputBufferLength'] = maxBufferSize
+        queryDirectory['FileNameLength'] = len(searchString)*2
+        queryDirectory['Buffer'] = searchString.encode('utf-16le')
+        packet['Data'] = queryDirectory
+        packet['CreditCharge'] = self.__creditCharge(maxBufferSize)
+
+        ans = await self.sendRecv(packet)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            return SMB2QueryDirectory_Response(ans['Data'])['Buffer']
+
+    def __normalizePath(self, path):
+        path = ntpath.normpath(path.replace('/', '\\'))
+        if len(path) > 0 and path[0] == '\\':
+            path = path[1:]
+        return path
+
+    async def listPath(self, shareName, path):
+        # Same as smb3.SMB3.listPath(), returns a list of smb.SharedFile
+        from impacket import smb
+        path = self.__normalizePath(path)
+        treeId = await self.connectTree(shareName)
+        fileId = None
+        try:
+            fileId = await self.create(treeId, ntpath.dirname(path), FILE_READ_ATTRIBUTES | FILE_READ_DATA,
+                                       FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+                                       FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_OPEN, 0)
+            files = []
+            while True:
+                try:
+                    res = await self.queryDirectory(treeId, fileId, ntpath.basename(path), maxBufferSize=65535,
+                                                    informationClass=FILE_FULL_DIRECTORY_INFORMATION)
+                except SessionError as e:
+                    if e.get_error_code() != STATUS_NO_MORE_FILES:
+                        raise
+                    break
+                nextOffset = 1
+                while nextOffset != 0:
+                    fileInfo = smb.SMBFindFileFullDirectoryInfo(smb.SMB.FLAGS2_UNICODE)
+                    fileInfo.fromString(res)
+                    files.append(smb.SharedFile(fileInfo['CreationTime'], fileInfo['LastAccessTime'],
+                                                fileInfo['LastChangeTime'], fileInfo['EndOfFile'],
+                                                fileInfo['AllocationSize'], fileInfo['ExtFileAttributes'],
+                                                fileInfo['FileName'].decode('utf-16le'),
+                                                fileInfo['FileName'].decode('utf-16le')))
+                    nextOffset = fileInfo['NextEntryOffset']
+                    res = res[nextOffset:]
+        finally:
+            if fileId is not None:
+                await self.close(treeId, fileId)
+            await self.disconnectTree(treeId)
+        return files
+
+    async def __readChunk(self, treeId, fileId, offset, length):
+        try:
+            return await self.read(treeId, fileId, offset, length)
+        except SessionError as e:
+            if e.get_error_code() != STATUS_END_OF_FILE:
+                raise
+            return b''
+
+    async def __cancelTasks(self, pending):
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def retrieveFile(self, shareName, path, callback, mode=FILE_OPEN, offset=0, shareAccessMode=FILE_SHARE_READ):
+        # Hands the file contents to callback, in order. Several READ requests are kept in flight, up to
+        # the transfer window
+        path = self.__normalizePath(path)
+        treeId = await self.connectTree(shareName)
+        fileId = None
+        pending = deque()
+        try:
+            fileId = await self.create(treeId, path, FILE_READ_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, mode,
+                                       0)
+            endOffset = self._Session['OpenTable'][fileId]['EndOfFile']
+            chunkSize = self.__getChunkSize(self._Connection['MaxReadSize'])
+            while True:
+                while offset < endOffset and (len(pending) + 1) * chunkSize <= max(self._transferWindow, chunkSize):
+                    length = min(chunkSize, endOffset - offset)
+                    pending.append((asyncio.ensure_future(self.__readChunk(treeId, fileId, offset, length)), length))
+                    offset += length
+                if len(pending) == 0:
+                    break
+                task, length = pending.popleft()
+                data = await task
+                if len(data) > 0:
+                    callback(data)
+                if len(data) < length:
+                    # The file got shorter since it was opened, nothing else to read
+                    break
+        finally:
+            await self.__cancelTasks([task for task, length in pending])
+            if fileId is not None:
+                await self.close(treeId, fileId)
+            await self.disconnectTree(treeId)
+
+    async def storeFile(self, shareName, path, callback, mode=FILE_OVERWRITE_IF, offset=0,
+                        shareAccessMode=FILE_SHARE_WRITE):
+        # Writes the data returned by callback(size) until it returns nothing. Several WRITE requests are
+        # kept in flight, up to the transfer window
+        path = self.__normalizePath(path)
+        treeId = await self.connectTree(shareName)
+        fileId = None
+        pending = deque()
+        try:
+            fileId = await self.create(treeId, path, FILE_WRITE_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, mode,
+                                       0)
+            chunkSize = self.__getChunkSize(self._Connection['MaxWriteSize'])
+            finished = False
+            while True:
+                while finished is False and (len(pending) + 1) * chunkSize <= max(self._transferWindow, chunkSize):
+                    data = callback(chunkSize)
+                    if len(data) == 0:
+                        finished = True
+                        break
+                    pending.append(asyncio.ensure_future(self.write(treeId, fileId, data, offset)))
+                    offset += len(data)
+                if len(pending) == 0:
+                    break
+                await pending.popleft()
+        finally:
+            await self.__cancelTasks(list(pending))
+            if fileId is not None:
+                await self.close(treeId, fileId)
+            await self.disconnectTree(treeId)
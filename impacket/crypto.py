@@ -27,6 +27,7 @@ from __future__ import print_function
 from impacket import LOG
 try:
     from Cryptodome.Cipher import DES, AES
+    from Cryptodome.Hash import CMAC
 except Exception:
     LOG.error("Warning: You don't have any crypto installed. You need pycryptodomex")
     LOG.error("See https://pypi.org/project/pycryptodomex/")
@@ -99,6 +100,8 @@ def PAD(N):
 
 def AES_CMAC(K, M, length):
 
+#   [RFC 4493] AES-CMAC, for reference only: pycryptodomex does all of it below, Generate_Subkey()
+#   included. The helpers above are kept for the code importing them
 #   +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 #   +                   Algorithm AES-CMAC                              +
 #   +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -144,39 +147,15 @@ def AES_CMAC(K, M, length):
 #   +   Step 7.  return T;                                              +
 #   +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-    const_Bsize = 16
-    const_Zero  = bytearray(16)
+    # Walking the blocks in python made signing large SMB3 messages really slow
+    return CMAC.new(K, bytes(bytearray(M[:length])), ciphermod=AES).digest()
 
-    AES_128= AES.new(K, AES.MODE_ECB)
-    M      = bytearray(M[:length])
-    K1, K2 = Generate_Subkey(K)
-    n      = len(M)//const_Bsize
-
-    if n == 0:
-        n = 1
-        flag = False
-    else:
-        if (length % const_Bsize) == 0:
-            flag = True
-        else:
-            n += 1
-            flag = False
-
-    M_n = M[(n-1)*const_Bsize:]
-    if flag is True:
-        M_last = XOR_128(M_n,K1)
-    else:
-        M_last = XOR_128(PAD(M_n),K2)
-
-    X = const_Zero
-    for i in range(n-1):
-        M_i = M[(i)*const_Bsize:][:16]
-        Y   = XOR_128(X, M_i)
-        X   = bytearray(AES_128.encrypt(bytes(Y)))
-    Y = XOR_128(M_last, X)
-    T = AES_128.encrypt(bytes(Y))
-
-    return T
+def AES_GMAC(K, nonce, M):
+    # [MS-SMB2] 3.1.4.1 AES-GMAC is AES-GCM with an empty plaintext, M goes as additional
+    # authenticated data and the tag is the MAC
+    cipher = AES.new(K, AES.MODE_GCM, nonce=nonce)
+    cipher.update(M)
+    return cipher.digest()
 
 def AES_CMAC_PRF_128(VK, M, VKlen, Mlen):
 #   +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
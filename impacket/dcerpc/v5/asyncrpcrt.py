@@ -0,0 +1,235 @@
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   [C706] Remote Procedure Call Protocol Elements, asyncio client
+#   Same PDUs, authentication, signing and sealing code than rpcrt.DCERPC_v5,
+#   but bind() and request() are coroutines and nothing blocks: a single event
+#   loop can keep thousands of associations going at once. Several tasks can
+#   make calls on the same association at the same time, the responses are
+#   matched to their calls by call_id (up to the pipeline window of calls in
+#   flight, like DCERPC_v5.submit() does).
+#
+#   The NDRCALL classes are used like with DCERPC_v5. So are the h*() helpers
+#   that return dce.request() right away, their result just has to be awaited.
+#   The transports are the ones in asynctransport.
+#
+#   Example:
+#
+#       rpctransport = AsyncDCERPCTransportFactory(r'ncacn_np:%s[\pipe\srvsvc]' % target)
+#       rpctransport.set_credentials(username, password, domain)
+#       async with rpctransport.get_dce_rpc() as dce:
+#           await dce.bind(srvs.MSRPC_UUID_SRVS)
+#           resp = await srvs.hNetrShareEnum(dce, 1)
+#
+import asyncio
+from collections import deque
+from struct import unpack
+
+from impacket.uuid import bin_to_uuidtup
+from impacket.dcerpc.v5.rpcrt import DCERPC_v5, DCERPC_RawCall, MSRPCHeader, MSRPCRespHeader, PFC_LAST_FRAG, \
+    RPC_C_AUTHN_GSS_NEGOTIATE, RPC_C_AUTHN_LEVEL_NONE
+
+
+class AsyncDCERPC_v5(DCERPC_v5):
+    def __init__(self, transport):
+        DCERPC_v5.__init__(self, transport)
+        # Shared with the contexts opened with alter_ctx(), they write to and read from the same stream
+        self._association.update({
+            # Created once there's an event loop running
+            'SendLock': None,
+            # The task reading the next response fragment, every task waiting for a response waits for it
+            'Reading' : None,
+            # Set when the association can't be used anymore
+            'Error'   : None,
+        })
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.disconnect()
+
+    def __getSendLock(self):
+        if self._association['SendLock'] is None:
+            self._association['SendLock'] = asyncio.Lock()
+        return self._association['SendLock']
+
+    async def __recvPDU(self):
+        # A whole PDU: the common header first, the rest once we know its length
+        data = await self._transport.recv(count=MSRPCHeader._SIZE)
+        frag_len = unpack('<H', data[8:10])[0]
+        if frag_len > len(data):
+            data += await self._transport.recv(count=frag_len - len(data))
+        return data
+
+    async def bind(self, iface_uuid, alter = 0, bogus_binds = 0, transfer_syntax = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')):
+        if self.get_auth_type() == RPC_C_AUTHN_GSS_NEGOTIATE and self.get_auth_level() != RPC_C_AUTHN_LEVEL_NONE:
+            # Getting the Kerberos tickets blocks, that's done in the loop's executor
+            bind, packet = await asyncio.get_running_loop().run_in_executor(None, self._bind_request, iface_uuid,
+                                                                            alter, bogus_binds, transfer_syntax)
+        else:
+            bind, packet = self._bind_request(iface_uuid, alter, bogus_binds, transfer_syntax)
+
+        async with self.__getSendLock():
+            # The bind response is read right away, the calls in flight on other contexts are answered first
+            while self._calls_in_flight() > 0:
+                await self.__readResponse()
+            await self._transport.send(packet.get_packet())
+            resp = MSRPCHeader(await self.__recvPDU())
+
+            packet, answered = self._bind_response(bind, resp, bogus_binds)
+            if packet is not None:
+                await self._transport.send(packet.get_packet(), forceWriteAndx = 1)
+                if answered is True:
+                    await self.recv()
+
+        return resp
+
+    async def alter_ctx(self, newUID, bogus_binds = 0):
+        answer = self._alter_ctx_instance()
+        await answer.bind(newUID, alter = 1, bogus_binds = bogus_binds, transfer_syntax = bin_to_uuidtup(self.transfer_syntax))
+        return answer
+
+    def __sealFragments(self, data):
+        # Every fragment of a call is signed or sealed before any is written, nothing else can be sent in between
+        return [(self._seal_packet(fragment), forceWriteAndx, forceRecv) for fragment, forceWriteAndx, forceRecv in
+                self._fragments(data)]
+
+    async def __write(self, fragments):
+        for fragment, forceWriteAndx, forceRecv in fragments:
+            await self._transport.send(fragment, forceWriteAndx = forceWriteAndx, forceRecv = forceRecv)
+
+    async def send(self, data):
+        async with self.__getSendLock():
+            await self.__write(self.__sealFragments(data))
+
+    async def recv(self):
+        # The response of a call made with call(). Only when no call made with request() is in flight
+        retAnswer = []
+        while True:
+            response_data = await self.__recvPDU()
+            response_header = MSRPCRespHeader(response_data)
+            retAnswer.append(self._open_answer(response_header, response_data))
+            if response_header['flags'] & PFC_LAST_FRAG:
+                break
+
+        if len(retAnswer) == 1:
+            return bytes(retAnswer[0])
+        return b''.join(retAnswer)
+
+    async def __sendCall(self, future, request, isNDR64, checkError, uuid):
+        async with self.__getSendLock():
+            # With NTLM without extended session security and Netlogon the window is 1, requests wait
+            # for the previous response
+            while self._calls_in_flight() >= self.get_pipeline_window():
+                await self.__readResponse()
+            if future.cancelled():
+                return
+            if self._association['Error'] is not None:
+                raise self._association['Error']
+
+            fragments = self.__sealFragments(DCERPC_RawCall(request.opnum, request.getData(), uuid))
+            # Tracked before being written, its response might be read by someone else right away
+            self._add_call(future, request, isNDR64, checkError)
+            try:
+                await self.__write(fragments)
+            except Exception as e:
+                self._association['Error'] = e
+                self._fail_calls(e)
+                raise
+
+    async def __recvResponse(self):
+        try:
+            response_data = await self.__recvPDU()
+            self._process_fragment(MSRPCRespHeader(response_data), response_data)
+        except Exception as e:
+            self._association['Error'] = e
+            self._fail_calls(e)
+            raise
+
+    async def __readResponse(self):
+        # Reads the next response fragment, or waits for the task already reading it. If the waiting task
+        # is cancelled, the reading goes on, so the stream is never left in the middle of a PDU
+        reading = self._association['Reading']
+        if reading is None or reading.done():
+            if self._association['Error'] is not None:
+                raise self._association['Error']
+            reading = self._association['Reading'] = asyncio.ensure_future(self.__recvResponse())
+            reading.add_done_callback(_retrieve)
+        await asyncio.shield(reading)
+
+    async def request(self, request, uuid=None, checkError=True):
+        isNDR64 = self._prepare_request(request)
+        future = asyncio.get_running_loop().create_future()
+        sending = asyncio.ensure_future(self.__sendCall(future, request, isNDR64, checkError, uuid))
+        sending.add_done_callback(_retrieve)
+        try:
+            await asyncio.shield(sending)
+            while not future.done():
+                try:
+                    await self.__readResponse()
+                except Exception:
+                    # Every call in flight failed with it, this one included
+                    if not future.done():
+                        raise
+        except asyncio.CancelledError:
+            # Its response is dropped when it comes
+            future.cancel()
+            raise
+        return future.result()
+
+    def submit(self, request, uuid=None, checkError=True):
+        """
+        makes a call in its own task.
+
+        :return: an asyncio Task whose result is the response, or raises like request() would
+        """
+        return asyncio.ensure_future(self.request(request, uuid, checkError))
+
+    async def request_many(self, requests, uuid=None, checkError=True, returnExceptions=False):
+        """
+        makes every call in requests, keeping up to the pipeline window of them in flight, and yields their
+        responses in the same order. Calls still in flight when the generator is closed are cancelled.
+
+        :param requests: an iterable of NDRCALL, it can be a generator
+        :param uuid: the object UUID, if any
+        :param bool checkError: if the error code at the end of the responses has to raise an exception
+        :param bool returnExceptions: yield the exception of a failed call instead of raising it
+
+        :return: an asynchronous generator of responses
+        """
+        tasks = deque()
+        try:
+            for request in requests:
+                tasks.append(self.submit(request, uuid, checkError))
+                if len(tasks) >= self.get_pipeline_window():
+                    yield await self.__taskResult(tasks.popleft(), returnExceptions)
+            while tasks:
+                yield await self.__taskResult(tasks.popleft(), returnExceptions)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    async def __taskResult(task, returnExceptions):
+        try:
+            return await task
+        except Exception as e:
+            if returnExceptions is True:
+                return e
+            raise
+
+
+def _retrieve(task):
+    # Nobody might be waiting for the task anymore, its exception is not worth a warning
+    if not task.cancelled():
+        task.exception()
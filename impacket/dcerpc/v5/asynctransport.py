@@ -0,0 +1,190 @@
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   asyncio transports for the asyncrpcrt DCE/RPC client: ncacn_ip_tcp and
+#   ncacn_np (over an asyncsmb3 connection). Configured like the ones in
+#   transport, but connect(), disconnect(), send() and recv() are coroutines.
+#
+import asyncio
+
+from impacket.asyncsmb3 import AsyncSMB3
+from impacket.smb3structs import FILE_READ_DATA, FILE_WRITE_DATA, FILE_SHARE_READ, FILE_NON_DIRECTORY_FILE, \
+    FILE_OPEN, FILE_ATTRIBUTE_NORMAL
+from impacket.dcerpc.v5.rpcrt import DCERPCException
+from impacket.dcerpc.v5.asyncrpcrt import AsyncDCERPC_v5
+from impacket.dcerpc.v5.transport import DCERPCStringBinding, DCERPCTransport
+
+# Bytes asked for in every READ on a named pipe, more than any fragment
+PIPE_READ_SIZE = 65536
+
+
+def AsyncDCERPCTransportFactory(stringbinding):
+    sb = DCERPCStringBinding(stringbinding)
+
+    na = sb.get_network_address()
+    ps = sb.get_protocol_sequence()
+    if 'ncacn_ip_tcp' == ps:
+        port = sb.get_endpoint()
+        if port:
+            rpctransport = AsyncTCPTransport(na, int(port))
+        else:
+            rpctransport = AsyncTCPTransport(na)
+    elif 'ncacn_np' == ps:
+        named_pipe = sb.get_endpoint()
+        if named_pipe:
+            named_pipe = named_pipe[len(r'\pipe'):]
+            rpctransport = AsyncSMBTransport(na, filename = named_pipe)
+        else:
+            rpctransport = AsyncSMBTransport(na)
+    else:
+        raise DCERPCException("Unsupported protocol sequence for asyncio: %s" % ps)
+
+    rpctransport.set_stringbinding(sb)
+    return rpctransport
+
+
+class AsyncTCPTransport(DCERPCTransport):
+    """asyncio implementation of ncacn_ip_tcp protocol sequence"""
+
+    DCERPC_class = AsyncDCERPC_v5
+
+    def __init__(self, remoteName, dstport = 135):
+        DCERPCTransport.__init__(self, remoteName, dstport)
+        self.__reader = None
+        self.__writer = None
+        self.set_connect_timeout(30)
+
+    async def connect(self):
+        try:
+            self.__reader, self.__writer = await asyncio.wait_for(
+                asyncio.open_connection(self.getRemoteHost(), self.get_dport()), self.get_connect_timeout())
+        except (OSError, asyncio.TimeoutError) as msg:
+            raise DCERPCException("Could not connect: %s" % msg)
+        return 1
+
+    async def disconnect(self):
+        if self.__writer is None:
+            return 0
+        self.__writer.close()
+        try:
+            await self.__writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        self.__writer = None
+        return 1
+
+    async def send(self, data, forceWriteAndx = 0, forceRecv = 0):
+        if self._max_send_frag:
+            for offset in range(0, len(data), self._max_send_frag):
+                self.__writer.write(data[offset:offset+self._max_send_frag])
+        else:
+            self.__writer.write(data)
+        await self.__writer.drain()
+
+    async def recv(self, forceRecv = 0, count = 0):
+        # The connect timeout applies to every read, like TCPTransport's socket timeout
+        try:
+            if count:
+                return await asyncio.wait_for(self.__reader.readexactly(count), self.get_connect_timeout())
+            buffer = await asyncio.wait_for(self.__reader.read(8192), self.get_connect_timeout())
+        except asyncio.IncompleteReadError:
+            raise DCERPCException('Connection closed by the remote end')
+        if len(buffer) == 0:
+            raise DCERPCException('Connection closed by the remote end')
+        return buffer
+
+    def get_socket(self):
+        return self.__writer.get_extra_info('socket')
+
+    def get_dce_rpc(self):
+        return AsyncDCERPC_v5(self)
+
+
+class AsyncSMBTransport(DCERPCTransport):
+    """asyncio implementation of ncacn_np protocol sequence"""
+
+    DCERPC_class = AsyncDCERPC_v5
+
+    def __init__(self, remoteName, dstport=445, filename='', username='', password='', domain='', lmhash='', nthash='',
+                 aesKey='', TGT=None, TGS=None, remote_host='', smb_connection=None, doKerberos=False, kdcHost=None):
+        DCERPCTransport.__init__(self, remoteName, dstport)
+        self.__tid = 0
+        self.__filename = filename
+        self.__handle = None
+        # What was read from the pipe and not asked for yet
+        self.__buffer = b''
+        self.set_credentials(username, password, domain, lmhash, nthash, aesKey, TGT, TGS)
+        self._doKerberos = doKerberos
+        self._kdcHost = kdcHost
+
+        if remote_host != '':
+            self.setRemoteHost(remote_host)
+
+        # An AsyncSMB3 connection already logged in can be used, it's left open when disconnecting
+        self.__existing_smb = smb_connection is not None
+        self.__prefDialect = None
+        self.__smb_connection = smb_connection
+        self.set_connect_timeout(30)
+
+    def preferred_dialect(self, dialect):
+        self.__prefDialect = dialect
+
+    async def connect(self):
+        if self.__smb_connection is None:
+            self.__smb_connection = AsyncSMB3(self.getRemoteName(), self.getRemoteHost(), sess_port=self.get_dport(),
+                                              timeout=self.get_connect_timeout(), preferredDialect=self.__prefDialect)
+            await self.__smb_connection.connect()
+            if self._doKerberos is False:
+                await self.__smb_connection.login(self._username, self._password, self._domain, self._lmhash,
+                                                  self._nthash)
+            else:
+                await self.__smb_connection.kerberosLogin(self._username, self._password, self._domain, self._lmhash,
+                                                          self._nthash, self._aesKey, kdcHost=self._kdcHost,
+                                                          TGT=self._TGT, TGS=self._TGS)
+        self.__tid = await self.__smb_connection.connectTree('IPC$')
+        self.__handle = await self.__smb_connection.create(self.__tid, self.__filename, FILE_READ_DATA | FILE_WRITE_DATA,
+                                                           FILE_SHARE_READ, FILE_NON_DIRECTORY_FILE, FILE_OPEN,
+                                                           FILE_ATTRIBUTE_NORMAL)
+        return 1
+
+    async def disconnect(self):
+        await self.__smb_connection.close(self.__tid, self.__handle)
+        await self.__smb_connection.disconnectTree(self.__tid)
+        # If we created the SMB connection, we close it, otherwise
+        # that's up for the caller
+        if self.__existing_smb is False:
+            await self.__smb_connection.logoff()
+            await self.__smb_connection.close_session()
+
+    async def send(self, data, forceWriteAndx = 0, forceRecv = 0):
+        if self._max_send_frag:
+            for offset in range(0, len(data), self._max_send_frag):
+                await self.__smb_connection.write(self.__tid, self.__handle, data[offset:offset+self._max_send_frag])
+        else:
+            await self.__smb_connection.write(self.__tid, self.__handle, data)
+
+    async def recv(self, forceRecv = 0, count = 0):
+        # The pipe is read like a stream: exactly count bytes are returned, whatever the READs brought
+        while len(self.__buffer) < max(count, 1):
+            data = await self.__smb_connection.read(self.__tid, self.__handle, 0, PIPE_READ_SIZE, singleCall=True)
+            if len(data) == 0:
+                raise DCERPCException('Connection closed by the remote end')
+            self.__buffer += data
+        if count == 0:
+            count = len(self.__buffer)
+        data, self.__buffer = self.__buffer[:count], self.__buffer[count:]
+        return data
+
+    def get_smb_connection(self):
+        return self.__smb_connection
+
+    def get_dce_rpc(self):
+        return AsyncDCERPC_v5(self)
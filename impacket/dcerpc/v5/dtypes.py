@@ -67,6 +67,16 @@ class PCHAR(NDRPOINTER):
 
 class WIDESTR(NDRUniFixedArray):
     def getDataLen(self, data, offset=0):
+        if isinstance(data, memoryview):
+            # Zero-copy unmarshalling, look for the terminator in growing windows
+            window = 256
+            while True:
+                pos = bytes(data[offset:offset+window]).find(b'\x00\x00\x00')
+                if pos >= 0:
+                    return pos+3
+                if offset+window >= len(data):
+                    return 2-offset
+                window *= 4
         return data.find(b'\x00\x00\x00', offset)+3-offset
 
     def __setitem__(self, key, value):
@@ -24,6 +24,8 @@
 #   Alberto Solino (@agsolino)
 #
 import socket
+import threading
+import time
 from struct import unpack
 from six import b
 
@@ -1204,6 +1206,76 @@ class ept_mapResponse(NDRCALL):
 # HELPER FUNCTIONS
 ################################################################################
 
+class EPMCache:
+    """
+    Endpoints resolved by hept_map() and hept_map_many(), by host, interface and protocol sequence. They are
+    kept for ttl seconds, dynamic endpoints change when the server is restarted. Can be shared by threads
+    """
+    def __init__(self, ttl=600, maxEntries=4096):
+        self.__ttl = ttl
+        self.__maxEntries = maxEntries
+        self.__lock = threading.Lock()
+        # (expiration time, string binding) by key, the oldest first
+        self.__entries = {}
+        self.__hits = 0
+        self.__misses = 0
+        self.__expirations = 0
+
+    @staticmethod
+    def __key(destHost, remoteIf, protocol):
+        return destHost.lower(), bytes(remoteIf), protocol
+
+    def get(self, destHost, remoteIf, protocol):
+        key = self.__key(destHost, remoteIf, protocol)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self.__entries[key]
+                self.__expirations += 1
+                entry = None
+            if entry is None:
+                self.__misses += 1
+                return None
+            self.__hits += 1
+            return entry[1]
+
+    def set(self, destHost, remoteIf, protocol, stringBinding):
+        key = self.__key(destHost, remoteIf, protocol)
+        with self.__lock:
+            self.__entries.pop(key, None)
+            if len(self.__entries) >= self.__maxEntries:
+                now = time.time()
+                for expired in [k for k, entry in self.__entries.items() if entry[0] <= now]:
+                    del self.__entries[expired]
+                    self.__expirations += 1
+                # Still full, the oldest ones go
+                while len(self.__entries) >= self.__maxEntries:
+                    del self.__entries[next(iter(self.__entries))]
+            self.__entries[key] = (time.time() + self.__ttl, stringBinding)
+
+    def invalidate(self, destHost, remoteIf=None, protocol=None):
+        # Forgets the endpoints of destHost (of one interface or protocol sequence only if given), e.g. when
+        # the one resolved can't be connected to anymore
+        destHost = destHost.lower()
+        with self.__lock:
+            for key in list(self.__entries):
+                if key[0] == destHost and (remoteIf is None or key[1] == bytes(remoteIf)) and \
+                        (protocol is None or key[2] == protocol):
+                    del self.__entries[key]
+
+    def clear(self):
+        with self.__lock:
+            self.__entries = {}
+
+    def getStats(self):
+        with self.__lock:
+            return {'hits': self.__hits, 'misses': self.__misses, 'expirations': self.__expirations,
+                    'entries': len(self.__entries)}
+
+# A cache callers can share, e.g. hept_map(..., cache=EPM_CACHE). DCERPCPool, secretsdump, the ntlmrelayx RPC
+# clients and the examples resolving endpoints use it
+EPM_CACHE = EPMCache()
+
 def hept_lookup(destHost, inquiry_type = RPC_C_EP_ALL_ELTS, objectUUID = NULL, ifId = NULL, vers_option = RPC_C_VERS_ALL, dce = None):
     if dce is None:
         stringBinding = r'ncacn_ip_tcp:%s[135]' % destHost
@@ -1252,7 +1324,17 @@ def hept_lookup(destHost, inquiry_type = RPC_C_EP_ALL_ELTS, objectUUID = NULL, i
 
     return entries
 
-def hept_map(destHost, remoteIf, dataRepresentation = uuidtup_to_bin(('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')), protocol = 'ncacn_np', dce=None):
+def hept_map(destHost, remoteIf, dataRepresentation = uuidtup_to_bin(('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')), protocol = 'ncacn_np', dce=None, cache=None):
+    # With a cache (e.g. EPM_CACHE), the endpoint mapper is only asked if the endpoint isn't there
+    if cache is not None:
+        result = cache.get(destHost, remoteIf, protocol)
+        if result is not None:
+            return result
+
+    request = _ept_map_request(destHost, remoteIf, dataRepresentation, protocol)
+    if request is None:
+        LOG.error('%s not support for hetp_map()' % protocol)
+        return None
 
     if dce is None:
         stringBinding = r'ncacn_ip_tcp:%s[135]' % destHost
@@ -1266,6 +1348,71 @@ def hept_map(destHost, remoteIf, dataRepresentation = uuidtup_to_bin(('8a885d04-
 
     dce.bind(MSRPC_UUID_PORTMAP)
 
+    resp = dce.request(request)
+
+    result = _ept_map_result(destHost, protocol, resp)
+    if disconnect is True:
+        dce.disconnect()
+    if cache is not None:
+        cache.set(destHost, remoteIf, protocol, result)
+    return result
+
+def hept_map_many(destHost, remoteIfs, dataRepresentation = uuidtup_to_bin(('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')), protocol = 'ncacn_np', dce=None, cache=None):
+    """
+    hept_map() for several interfaces at once: a single association to the endpoint mapper, with the ept_map
+    calls pipelined. Interfaces the endpoint mapper doesn't know are mapped to None
+
+    :return: a dict with the string binding of every interface in remoteIfs
+    """
+    results = {}
+    missing = []
+    for remoteIf in remoteIfs:
+        if cache is not None:
+            result = cache.get(destHost, remoteIf, protocol)
+            if result is not None:
+                results[remoteIf] = result
+                continue
+        if remoteIf not in missing:
+            missing.append(remoteIf)
+    if len(missing) == 0:
+        return results
+
+    requests = [_ept_map_request(destHost, remoteIf, dataRepresentation, protocol) for remoteIf in missing]
+    if requests[0] is None:
+        LOG.error('%s not support for hetp_map_many()' % protocol)
+        return None
+
+    if dce is None:
+        stringBinding = r'ncacn_ip_tcp:%s[135]' % destHost
+        rpctransport = transport.DCERPCTransportFactory(stringBinding)
+        dce = rpctransport.get_dce_rpc()
+        dce.connect()
+        disconnect = True
+    else:
+        disconnect = False
+
+    try:
+        dce.bind(MSRPC_UUID_PORTMAP)
+        responses = dce.request_many(requests, returnExceptions=True)
+        try:
+            for remoteIf, resp in zip(missing, responses):
+                if isinstance(resp, DCERPCException) and resp.get_error_code() == RPC_NO_MORE_ELEMENTS:
+                    # ept_s_not_registered
+                    results[remoteIf] = None
+                    continue
+                elif isinstance(resp, Exception):
+                    raise resp
+                results[remoteIf] = _ept_map_result(destHost, protocol, resp)
+                if cache is not None:
+                    cache.set(destHost, remoteIf, protocol, results[remoteIf])
+        finally:
+            responses.close()
+    finally:
+        if disconnect is True:
+            dce.disconnect()
+    return results
+
+def _ept_map_request(destHost, remoteIf, dataRepresentation, protocol):
     tower = EPMTower()
     interface = EPMRPCInterface()
 
@@ -1294,7 +1441,6 @@ def hept_map(destHost, remoteIf, dataRepresentation = uuidtup_to_bin(('8a885d04-
         portAddr['IpPort'] = 0
 
         hostAddr = EPMHostAddr()
-        import socket
         hostAddr['Ip4addr'] = socket.inet_aton('0.0.0.0')
         transportData = portAddr.getData() + hostAddr.getData()
     elif protocol == 'ncacn_http':
@@ -1303,14 +1449,10 @@ def hept_map(destHost, remoteIf, dataRepresentation = uuidtup_to_bin(('8a885d04-
         portAddr['IpPort'] = 0
 
         hostAddr = EPMHostAddr()
-        import socket
         hostAddr['Ip4addr'] = socket.inet_aton('0.0.0.0')
         transportData = portAddr.getData() + hostAddr.getData()
 
     else:
-        LOG.error('%s not support for hetp_map()' % protocol)
-        if disconnect is True:
-            dce.disconnect()
         return None
 
     tower['NumberOfFloors'] = 5
@@ -1326,9 +1468,9 @@ def hept_map(destHost, remoteIf, dataRepresentation = uuidtup_to_bin(('8a885d04-
     # otherwise we get a rpc_x_bad_stub_data exception
     request.fields['obj'].fields['ReferentID'] = 1
     request.fields['map_tower'].fields['ReferentID'] = 2
+    return request
 
-    resp = dce.request(request)
-
+def _ept_map_result(destHost, protocol, resp):
     tower = EPMTower(b''.join(resp['ITowers'][0]['Data']['tower_octet_string']))
     # Now let's parse the result and return an stringBinding
     result = None
@@ -1344,8 +1486,6 @@ def hept_map(destHost, remoteIf, dataRepresentation = uuidtup_to_bin(('8a885d04-
         # Port Number should be the 4th floor
         portAddr = EPMPortAddr(tower['Floors'][3].getData())
         result = 'ncacn_http:%s[%s]' % (destHost, portAddr['IpPort'])
-    if disconnect is True:
-        dce.disconnect()
     return result
 
 def PrintStringBinding(floors):
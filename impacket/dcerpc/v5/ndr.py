@@ -29,12 +29,73 @@ from impacket import LOG
 from impacket.dcerpc.v5.enum import Enum
 from impacket.uuid import uuidtup_to_bin
 
+# Zero-copy unmarshalling:
+# fromString() can be handed a memoryview instead of bytes. In that case arrays of bytes (item 'c') are not
+# split into one bytes object per element but kept as a ByteArrayView into the original buffer until someone
+# materializes them (bytes(), tobytes() or b''.join()). The rest of the fields are unpacked as usual.
+
+class ByteArrayView(object):
+    """
+    Read-only view over an unmarshalled array of bytes. It behaves like the list of one-byte bytes objects
+    the regular unmarshalling produces, without copying the receive buffer.
+    """
+    __slots__ = ('_view',)
+
+    def __init__(self, view):
+        self._view = view
+
+    def tobytes(self):
+        return self._view.tobytes()
+
+    def __bytes__(self):
+        return self._view.tobytes()
+
+    def __len__(self):
+        return len(self._view)
+
+    def __iter__(self):
+        view = self._view
+        for i in range(len(view)):
+            yield view[i:i+1].tobytes()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return ByteArrayView(self._view[key])
+        return bytes((self._view[key],))
+
+    def __add__(self, other):
+        if isinstance(other, (bytes, bytearray, memoryview)):
+            return self.tobytes() + bytes(other)
+        return self.tobytes() + b''.join(other)
+
+    def __eq__(self, other):
+        if isinstance(other, ByteArrayView):
+            return self._view == other._view
+        if isinstance(other, (bytes, bytearray, memoryview)):
+            return self._view == other
+        if isinstance(other, (list, tuple)):
+            return self.tobytes() == b''.join(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ByteArrayView(%r)' % self.tobytes()
+
 # Something important to have in mind:
 # Diagrams do not depict the specified alignment gaps, which can appear in the octet stream
 # before an item (see Section 14.2.2 on page 620.)
 # Where necessary, an alignment gap, consisting of octets of unspecified value, *precedes* the
 # representation of a primitive. The gap is of the smallest size sufficient to align the primitive
 
+_MAX_CODECS_PER_CLASS = 64
+
 class NDR(object):
     """
     This will be the base class for all DCERPC NDR Types and represents a NDR Primitive Type
@@ -47,6 +108,9 @@ class NDR(object):
     align          = 4
     item           = None
     _isNDR64       = False
+    # Marshal NDRSTRUCT/NDRCALL instances through generated code (see ndrcodegen). Set it to False in a
+    # subclass (or NDR itself) to force the reflective path
+    generatedCodec = True
 
     def __init__(self, data = None, isNDR64 = False):
         object.__init__(self)
@@ -201,6 +265,32 @@ class NDR(object):
     def getAlignment(self):
         return self.align
 
+    def _getCodec(self):
+        # Returns the generated encode/decode functions for this instance's layout, or None if the
+        # reflective path has to be used
+        if not self.generatedCodec:
+            return None
+        cls = self.__class__
+        codecs = cls.__dict__.get('_ndrCodecs')
+        if codecs is None:
+            codecs = {}
+            setattr(cls, '_ndrCodecs', codecs)
+        # Keyed by contents, classes building their layout per instance (ARRAYDESC, NDRUNION's arms, ...)
+        # get a new tuple every time but share the codec
+        key = (self.commonHdr, self.structure, self._isNDR64)
+        try:
+            codec = codecs.get(key)
+        except TypeError:
+            # Unhashable layout, reflective path
+            return None
+        if codec is None:
+            if len(codecs) >= _MAX_CODECS_PER_CLASS:
+                return None
+            from impacket.dcerpc.v5 import ndrcodegen
+            codec = ndrcodegen.compileCodec(cls, self.commonHdr, self.structure, self._isNDR64)
+            codecs[key] = codec
+        return codec
+
     @staticmethod
     def calculatePad(fieldType, soFar):
         if isinstance(fieldType, str):
@@ -294,6 +384,8 @@ class NDR(object):
         if fieldTypeOrClass[:1] == ':':
             if hasattr(data, 'getData'):
                 return data.getData()
+            if isinstance(data, (memoryview, ByteArrayView)):
+                return data.tobytes()
             return data
 
         # struct like specifier
@@ -314,7 +406,8 @@ class NDR(object):
                 return self.fields[fieldName].fromString(data, offset)
             else:
                 dataLen = self.getDataLen(data, offset)
-                self.fields[fieldName] =  data[offset:offset+dataLen]
+                # Literals are mostly strings, they are always materialized
+                self.fields[fieldName] =  bytes(data[offset:offset+dataLen])
                 return dataLen
 
         # struct like specifier
@@ -746,6 +839,13 @@ class NDRArray(NDRCONSTRUCTEDTYPE):
         two = fieldTypeOrClass.split('*')
         if len(two) == 2:
             answer = b''
+            if isinstance(self.fields[fieldName], ByteArrayView) and self.item == 'c':
+                answer = self.fields[fieldName].tobytes()
+                if isinstance(self, NDRUniConformantArray) or isinstance(self, NDRUniConformantVaryingArray):
+                    self.setArraySize(len(answer))
+                else:
+                    self.fields[two[1]] = len(answer)
+                return answer
             if self.isNDR(self.item):
                 item = ':'
                 dataClass = self.item
@@ -819,6 +919,12 @@ class NDRArray(NDRCONSTRUCTEDTYPE):
             else:
                 numItems = self[two[1]]
 
+            if self.item == 'c' and isinstance(data, memoryview):
+                # Zero-copy mode, keep the bytes where they are
+                numItems = max(0, min(numItems or 0, len(data) - offset))
+                self.fields[fieldName] = ByteArrayView(data[offset:offset+numItems])
+                return numItems
+
             # The item type is determined by self.item
             if self.isNDR(self.item):
                 item = ':'
@@ -988,6 +1094,9 @@ class NDRConformantVaryingString(NDRUniConformantVaryingArray):
 # Structures Containing a Conformant and Varying Array 
 class NDRSTRUCT(NDRCONSTRUCTEDTYPE):
     def getData(self, soFar = 0):
+        codec = self._getCodec()
+        if codec is not None:
+            return codec.encode(self, soFar)
         data = b''
         arrayPadding = b''
         soFar0 = soFar
@@ -1091,6 +1200,9 @@ class NDRSTRUCT(NDRCONSTRUCTEDTYPE):
         return data
 
     def fromString(self, data, offset = 0 ):
+        codec = self._getCodec()
+        if codec is not None:
+            return codec.decode(self, data, offset)
         offset0 = offset
         # 14.3.7.1 Structures Containing a Conformant Array
         # A structure can contain a conformant array only as its last member.
@@ -1637,6 +1749,9 @@ class NDRCALL(NDRCONSTRUCTEDTYPE):
         print('\n\n')
 
     def getData(self, soFar = 0):
+        codec = self._getCodec()
+        if codec is not None:
+            return codec.encode(self, soFar)
         data = b''
         soFar0 = soFar
         for fieldName, fieldTypeOrClass in self.commonHdr+self.structure:
@@ -1685,6 +1800,9 @@ class NDRCALL(NDRCONSTRUCTEDTYPE):
         return data
 
     def fromString(self, data, offset=0):
+        codec = self._getCodec()
+        if codec is not None:
+            return codec.decode(self, data, offset)
         offset0 = offset
         for fieldName, fieldTypeOrClass in self.commonHdr+self.structure:
             try:
@@ -0,0 +1,499 @@
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Code generator for NDR marshallers.
+#
+#   NDRSTRUCT and NDRCALL getData()/fromString() walk the structure tuples, split
+#   format strings and compute alignments on every call. This module turns a class
+#   layout (NDR20 and NDR64 separately) into specialized encode and decode functions:
+#
+#     * the field loop is unrolled,
+#     * primitive members (NDRULONG, NDRENUM, ...) and plain struct formats are
+#       packed/unpacked inline with precompiled struct.Struct objects,
+#     * the structure alignment is computed once when it only depends on the
+#       class definitions,
+#     * everything else (pointers, unions, arrays, literals, ...) goes through the
+#       very same calls the reflective path makes.
+#
+#   Whenever an inline primitive can't be handled (unexpected value, short buffer,
+#   a replaced instance) the generated code falls back to the reflective call for
+#   that field, so errors and default values behave exactly the same.
+#
+#   Codecs are generated the first time a class is marshalled and cached on the class
+#   (see NDR.generatedCodec). Classes the generator doesn't understand keep using the
+#   reflective path. generateSource() returns the code generated for a class.
+#
+from __future__ import division
+from __future__ import print_function
+from struct import Struct, calcsize
+
+from impacket import LOG
+from impacket.dcerpc.v5.ndr import NDR, NDRCONSTRUCTEDTYPE, NDRSTRUCT, NDRCALL, NDRPOINTER, NDRUNION, NDRArray, \
+    NDRUniConformantArray, NDRUniConformantVaryingArray
+
+
+class Unsupported(Exception):
+    pass
+
+
+class NDRCodec(object):
+    def __init__(self, source, encode, decode):
+        self.source = source
+        self.encode = encode
+        self.decode = decode
+
+
+# Methods the generated code assumes are the stock ones
+_PRIMITIVE_HOOKS = ('fromString', 'getData', 'pack', 'unpack', 'calculatePad')
+_STRUCT_HOOKS = ('pack', 'unpack', 'calculatePad', 'calcPackSize')
+_CALL_HOOKS = ('pack', 'unpack', 'calculatePad', 'getArraySize', 'getArrayMaximumSize')
+
+
+def _overrides(cls, base, hooks):
+    for hook in hooks:
+        if getattr(cls, hook) is not getattr(base, hook):
+            return True
+    return False
+
+
+def _customInit(cls):
+    # Classes with their own __init__ usually tweak structure, item, union, ... per instance
+    for klass in cls.__mro__:
+        if '__init__' in klass.__dict__ and klass.__module__ != NDR.__module__ and klass is not object:
+            return True
+    return False
+
+
+def _layout(cls, isNDR64):
+    # What NDR.__init__() ends up using as commonHdr and structure
+    commonHdr = cls.commonHdr
+    structure = cls.structure
+    if isNDR64 is True:
+        if cls.commonHdr64 != ():
+            commonHdr = cls.commonHdr64
+        if cls.structure64 != ():
+            structure = cls.structure64
+    return commonHdr, structure
+
+
+def _isClass(fieldTypeOrClass):
+    return isinstance(fieldTypeOrClass, type)
+
+
+def _structFormat(fieldTypeOrClass):
+    # Returns a Struct if NDR.pack()/unpack() treat fieldTypeOrClass as a plain struct specifier
+    # (with or without code specifier), None otherwise
+    if not isinstance(fieldTypeOrClass, str) or fieldTypeOrClass[:1] in (':', '_') or '*' in fieldTypeOrClass:
+        return None
+    try:
+        compiled = Struct(fieldTypeOrClass.split('=')[0])
+    except Exception:
+        return None
+    if compiled.size == 0:
+        return None
+    return compiled
+
+
+def _primitive(cls, isNDR64):
+    # Returns (structure, Struct) if instances of cls can be marshalled inline
+    if not _isClass(cls) or not issubclass(cls, NDR) or issubclass(cls, NDRCONSTRUCTEDTYPE):
+        return None
+    if _overrides(cls, NDR, _PRIMITIVE_HOOKS) or _customInit(cls):
+        return None
+    if cls.commonHdr != () or cls.commonHdr64 != ():
+        return None
+    structure = _layout(cls, isNDR64)[1]
+    if len(structure) != 1 or structure[0][0] != 'Data':
+        return None
+    compiled = _structFormat(structure[0][1])
+    if compiled is None:
+        return None
+    return structure, compiled
+
+
+def _formatAlignment(fieldTypeOrClass):
+    # NDRCONSTRUCTEDTYPE.calcPackSize(fieldTypeOrClass, b'')
+    if len(fieldTypeOrClass.split('*')) == 2:
+        return 0
+    two = fieldTypeOrClass.split('=')
+    if len(two) >= 2:
+        return _formatAlignment(two[0])
+    if fieldTypeOrClass[:1] == ':':
+        return 0
+    return calcsize(fieldTypeOrClass)
+
+
+def staticAlignment(cls, isNDR64, layout = None, visiting = None):
+    """
+    Alignment instances of cls report, computed from the class definitions alone.
+    Returns None if it depends on anything else (e.g. getAlignment() is overridden).
+    layout optionally replaces the commonHdr+structure of cls.
+    """
+    if visiting is None:
+        visiting = set()
+    if (cls, isNDR64) in visiting:
+        return None
+    visiting.add((cls, isNDR64))
+    try:
+        return _staticAlignment(cls, isNDR64, layout, visiting)
+    except Exception:
+        return None
+    finally:
+        visiting.discard((cls, isNDR64))
+
+
+def _staticAlignment(cls, isNDR64, layout, visiting):
+    if _customInit(cls):
+        return None
+
+    getAlignment = cls.getAlignment
+    if not issubclass(cls, NDRCONSTRUCTEDTYPE):
+        if getAlignment is not NDR.getAlignment:
+            return None
+        if isNDR64 is True and hasattr(cls, 'align64'):
+            return cls.align64
+        return cls.align
+
+    if issubclass(cls, NDRPOINTER):
+        if getAlignment is not NDRPOINTER.getAlignment:
+            return None
+        return 8 if isNDR64 is True else 4
+
+    if cls.calcPackSize is not NDRCONSTRUCTEDTYPE.calcPackSize:
+        return None
+
+    if layout is None:
+        commonHdr, structure = _layout(cls, isNDR64)
+        layout = commonHdr + structure
+    else:
+        commonHdr = None
+
+    if issubclass(cls, NDRArray):
+        if getAlignment is not NDRArray.getAlignment:
+            return None
+        if cls.item is None:
+            return 0
+        if _isClass(cls.item):
+            # NDRArray.getAlignment() instantiates the item with the default transfer syntax
+            return staticAlignment(cls.item, False, visiting = visiting)
+        return _formatAlignment(cls.item)
+
+    if issubclass(cls, NDRUNION):
+        if getAlignment is not NDRUNION.getAlignment:
+            return None
+        if isNDR64 is True:
+            candidates = [fieldTypeOrClass for fieldName, fieldTypeOrClass in layout]
+            for arm in cls.union.values():
+                candidates.append(arm[1])
+        else:
+            if commonHdr is None:
+                return None
+            candidates = [fieldTypeOrClass for fieldName, fieldTypeOrClass in commonHdr]
+    elif issubclass(cls, NDRSTRUCT):
+        if getAlignment is not NDRSTRUCT.getAlignment:
+            return None
+        candidates = [fieldTypeOrClass for fieldName, fieldTypeOrClass in layout + cls.referent]
+    else:
+        return None
+
+    align = 0
+    for fieldTypeOrClass in candidates:
+        if _isClass(fieldTypeOrClass):
+            tmpAlign = staticAlignment(fieldTypeOrClass, isNDR64, visiting = visiting)
+            if tmpAlign is None:
+                return None
+        else:
+            tmpAlign = _formatAlignment(fieldTypeOrClass)
+        if tmpAlign > align:
+            align = tmpAlign
+    return align
+
+
+class _Emitter(object):
+    def __init__(self):
+        self.lines = []
+        self.names = {}
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    def constant(self, prefix, value):
+        # Binds value into the namespace of the generated code, returns its name
+        for name, other in self.names.items():
+            if other is value and name.startswith(prefix):
+                return name
+        name = '%s%d' % (prefix, len(self.names))
+        self.names[name] = value
+        return name
+
+
+def _alignExpression(size, position):
+    return '(%d - (%s %% %d)) %% %d' % (size, position, size, size)
+
+
+def _emitDecodePrimitive(e, indent, fieldName, fieldTypeOrClass, primitive):
+    # Inline NDR.fromString() of a primitive
+    structure, compiled = primitive
+    e.emit(indent, 'child = fields[%r]' % fieldName)
+    e.emit(indent, 'if child.__class__ is %s and child.structure is %s:' % (e.constant('_cls', fieldTypeOrClass),
+                                                                          e.constant('_layout', structure)))
+    if compiled.size > 1:
+        e.emit(indent + 1, 'position = offset + %s' % _alignExpression(compiled.size, 'offset'))
+    else:
+        e.emit(indent + 1, 'position = offset')
+    e.emit(indent + 1, 'try:')
+    e.emit(indent + 2, "child.fields['Data'] = %s(data, position)[0]" % e.constant('_unpack', compiled.unpack_from))
+    e.emit(indent + 2, 'offset = position + %d' % compiled.size)
+    e.emit(indent + 1, 'except Exception:')
+    e.emit(indent + 2, 'offset += child.fromString(data, offset)')
+    e.emit(indent, 'else:')
+    e.emit(indent + 1, 'offset += child.fromString(data, offset)')
+
+
+def _emitEncodePrimitive(e, indent, fieldName, fieldTypeOrClass, primitive):
+    # Inline NDR.getData() of a primitive
+    structure, compiled = primitive
+    e.emit(indent, 'child = fields[%r]' % fieldName)
+    e.emit(indent, 'if child.__class__ is %s and child.structure is %s:' % (e.constant('_cls', fieldTypeOrClass),
+                                                                          e.constant('_layout', structure)))
+    e.emit(indent + 1, 'try:')
+    e.emit(indent + 2, "res = %s(child.fields['Data'])" % e.constant('_pack', compiled.pack))
+    e.emit(indent + 1, 'except Exception:')
+    e.emit(indent + 2, 'res = child.getData(soFar)')
+    if compiled.size > 1:
+        e.emit(indent + 1, 'else:')
+        e.emit(indent + 2, 'pad = %s' % _alignExpression(compiled.size, 'soFar'))
+        e.emit(indent + 2, 'if pad > 0:')
+        e.emit(indent + 3, "res = b'\\xbf'*pad + res")
+    e.emit(indent, 'else:')
+    e.emit(indent + 1, 'res = child.getData(soFar)')
+
+
+def _emitDecodeFormat(e, indent, fieldName, fieldTypeOrClass, compiled):
+    # Inline NDR.unpack() of a struct specifier, no alignment
+    e.emit(indent, 'try:')
+    e.emit(indent + 1, 'fields[%r] = %s(data, offset)[0]' % (fieldName, e.constant('_unpack', compiled.unpack_from)))
+    e.emit(indent + 1, 'offset += %d' % compiled.size)
+    e.emit(indent, 'except Exception:')
+    e.emit(indent + 1, 'offset += self.unpack(%r, %r, data, offset)' % (fieldName, fieldTypeOrClass))
+
+
+def _emitEncodeFormat(e, indent, fieldName, fieldTypeOrClass, compiled):
+    # Inline NDR.pack() of a struct specifier, no alignment
+    e.emit(indent, 'try:')
+    e.emit(indent + 1, 'res = %s(fields[%r])' % (e.constant('_pack', compiled.pack), fieldName))
+    e.emit(indent, 'except Exception:')
+    e.emit(indent + 1, 'res = self.pack(%r, %r, soFar)' % (fieldName, fieldTypeOrClass))
+
+
+def _emitPad(e, indent, filler):
+    e.emit(indent, 'if pad > 0:')
+    e.emit(indent + 1, 'soFar += pad')
+    e.emit(indent + 1, "parts.append(b'\\x%s'*pad)" % filler)
+    e.emit(indent + 1, 'length += pad')
+
+
+def _emitAppend(e, indent):
+    e.emit(indent, 'parts.append(res)')
+    e.emit(indent, 'length += len(res)')
+    e.emit(indent, 'soFar = soFar0 + length')
+
+
+def _emitHeader(e, kind):
+    if kind == 'decode':
+        e.emit(0, 'def decode(self, data, offset=0):')
+        e.emit(1, 'offset0 = offset')
+    else:
+        e.emit(0, 'def encode(self, soFar=0):')
+        e.emit(1, 'soFar0 = soFar')
+        e.emit(1, 'parts = []')
+        e.emit(1, 'length = 0')
+    e.emit(1, 'fields = self.fields')
+    e.emit(1, 'field = 0')
+
+
+def _emitFooter(e, kind, layout):
+    e.emit(1, 'except Exception as e:')
+    e.emit(2, 'LOG.error(str(e))')
+    e.emit(2, 'fieldName, fieldTypeOrClass = %s[field]' % e.constant('_fields', layout))
+    if kind == 'decode':
+        e.emit(2, 'LOG.error("Error unpacking field \'%s | %s | %r\'" % (fieldName, fieldTypeOrClass, '
+                  'data[offset:offset+256]))')
+        e.emit(2, 'raise')
+        e.emit(1, 'return offset - offset0')
+    else:
+        e.emit(2, 'LOG.error("Error packing field \'%s | %s\' in %s" % (fieldName, fieldTypeOrClass, self.__class__))')
+        e.emit(2, 'raise')
+        e.emit(1, "return b''.join(parts)")
+    e.emit(0, '')
+
+
+def _emitStruct(e, cls, isNDR64, layout):
+    # NDRSTRUCT.fromString() and NDRSTRUCT.getData() for structures without a trailing conformant array
+    if len(layout) == 0:
+        raise Unsupported('empty structure')
+    for fieldName, fieldTypeOrClass in layout:
+        if _isClass(fieldTypeOrClass) and issubclass(fieldTypeOrClass, (NDRUniConformantArray,
+                                                                        NDRUniConformantVaryingArray)):
+            raise Unsupported('conformant structure')
+
+    alignment = staticAlignment(cls, isNDR64, layout)
+
+    for kind in ('decode', 'encode'):
+        _emitHeader(e, kind)
+        if alignment is None:
+            e.emit(1, 'alignment = self.getAlignment()')
+            e.emit(1, 'if alignment > 0:')
+            if kind == 'decode':
+                e.emit(2, 'offset += (alignment - (offset % alignment)) % alignment')
+            else:
+                e.emit(2, 'pad = (alignment - (soFar % alignment)) % alignment')
+                _emitPad(e, 2, 'AB')
+        elif alignment > 1:
+            if kind == 'decode':
+                e.emit(1, 'offset += %s' % _alignExpression(alignment, 'offset'))
+            else:
+                e.emit(1, 'pad = %s' % _alignExpression(alignment, 'soFar'))
+                _emitPad(e, 1, 'AB')
+
+        e.emit(1, 'try:')
+        for index, (fieldName, fieldTypeOrClass) in enumerate(layout):
+            e.emit(2, 'field = %d' % index)
+            primitive = _primitive(fieldTypeOrClass, isNDR64)
+            compiled = _structFormat(fieldTypeOrClass)
+            if kind == 'decode':
+                if primitive is not None:
+                    _emitDecodePrimitive(e, 2, fieldName, fieldTypeOrClass, primitive)
+                elif compiled is not None:
+                    _emitDecodeFormat(e, 2, fieldName, fieldTypeOrClass, compiled)
+                else:
+                    e.emit(2, 'offset += self.unpack(%r, %s, data, offset)' % (fieldName,
+                                                                           e.constant('_type', fieldTypeOrClass)))
+            else:
+                if primitive is not None:
+                    _emitEncodePrimitive(e, 2, fieldName, fieldTypeOrClass, primitive)
+                elif compiled is not None:
+                    _emitEncodeFormat(e, 2, fieldName, fieldTypeOrClass, compiled)
+                else:
+                    e.emit(2, 'res = self.pack(%r, %s, soFar)' % (fieldName, e.constant('_type', fieldTypeOrClass)))
+                _emitAppend(e, 2)
+        _emitFooter(e, kind, layout)
+
+
+def _emitCall(e, cls, isNDR64, layout):
+    # NDRCALL.fromString() and NDRCALL.getData()
+    if len(layout) == 0:
+        raise Unsupported('empty call')
+    arrays = e.constant('_arrays', (NDRUniConformantArray, NDRUniConformantVaryingArray))
+    constructed = e.constant('_constructed', NDRCONSTRUCTEDTYPE)
+    if isNDR64 is True:
+        arrayItemSize, arrayPackStr = 8, '<Q'
+    else:
+        arrayItemSize, arrayPackStr = 4, '<L'
+    packArraySize = e.constant('_pack', Struct(arrayPackStr).pack)
+
+    _emitHeader(e, 'decode')
+    e.emit(1, 'try:')
+    for index, (fieldName, fieldTypeOrClass) in enumerate(layout):
+        e.emit(2, 'field = %d' % index)
+        primitive = _primitive(fieldTypeOrClass, isNDR64)
+        compiled = _structFormat(fieldTypeOrClass)
+        if primitive is not None:
+            _emitDecodePrimitive(e, 2, fieldName, fieldTypeOrClass, primitive)
+        elif compiled is not None:
+            _emitDecodeFormat(e, 2, fieldName, fieldTypeOrClass, compiled)
+        else:
+            e.emit(2, 'child = fields[%r]' % fieldName)
+            e.emit(2, 'if isinstance(child, %s):' % arrays)
+            e.emit(3, 'arraySize, advanceStream = self.getArraySize(%r, data, offset)' % fieldName)
+            e.emit(3, 'child.setArraySize(arraySize)')
+            e.emit(3, 'offset += advanceStream')
+            e.emit(2, 'size = self.unpack(%r, %s, data, offset)' % (fieldName, e.constant('_type', fieldTypeOrClass)))
+            e.emit(2, 'if isinstance(child, %s):' % constructed)
+            e.emit(3, 'size += child.fromStringReferents(data, offset+size)')
+            e.emit(3, 'size += child.fromStringReferent(data, offset+size)')
+            e.emit(2, 'offset += size')
+    _emitFooter(e, 'decode', layout)
+
+    _emitHeader(e, 'encode')
+    e.emit(1, 'try:')
+    for index, (fieldName, fieldTypeOrClass) in enumerate(layout):
+        e.emit(2, 'field = %d' % index)
+        primitive = _primitive(fieldTypeOrClass, isNDR64)
+        compiled = _structFormat(fieldTypeOrClass)
+        if primitive is not None:
+            _emitEncodePrimitive(e, 2, fieldName, fieldTypeOrClass, primitive)
+            _emitAppend(e, 2)
+            continue
+        if compiled is not None:
+            if compiled.size > 1:
+                e.emit(2, 'pad = %s' % _alignExpression(compiled.size, 'soFar'))
+                _emitPad(e, 2, 'ab')
+            _emitEncodeFormat(e, 2, fieldName, fieldTypeOrClass, compiled)
+            _emitAppend(e, 2)
+            continue
+        fieldType = e.constant('_type', fieldTypeOrClass)
+        if not _isClass(fieldTypeOrClass):
+            e.emit(2, 'pad = self.calculatePad(%s, soFar)' % fieldType)
+            _emitPad(e, 2, 'ab')
+        e.emit(2, 'child = fields[%r]' % fieldName)
+        e.emit(2, 'if isinstance(child, %s):' % arrays)
+        e.emit(3, 'pad = %s' % _alignExpression(arrayItemSize, 'soFar'))
+        e.emit(3, 'res = self.pack(%r, %s, soFar+pad)' % (fieldName, fieldType))
+        e.emit(3, "res = b'\\xce'*pad + %s(self.getArrayMaximumSize(%r)) + res" % (packArraySize, fieldName))
+        e.emit(2, 'else:')
+        e.emit(3, 'res = self.pack(%r, %s, soFar)' % (fieldName, fieldType))
+        _emitAppend(e, 2)
+        e.emit(2, 'if isinstance(child, %s):' % constructed)
+        e.emit(3, 'res = child.getDataReferents(soFar)')
+        _emitAppend(e, 3)
+        e.emit(3, 'res = child.getDataReferent(soFar)')
+        _emitAppend(e, 3)
+    _emitFooter(e, 'encode', layout)
+
+
+def _generate(cls, commonHdr, structure, isNDR64):
+    e = _Emitter()
+    if issubclass(cls, NDRCALL):
+        if _overrides(cls, NDRCALL, _CALL_HOOKS):
+            raise Unsupported('%s overrides marshalling methods' % cls.__name__)
+        _emitCall(e, cls, isNDR64, commonHdr + structure)
+    elif issubclass(cls, NDRSTRUCT) and not issubclass(cls, NDRPOINTER):
+        if _overrides(cls, NDRSTRUCT, _STRUCT_HOOKS):
+            raise Unsupported('%s overrides marshalling methods' % cls.__name__)
+        _emitStruct(e, cls, isNDR64, commonHdr + structure)
+    else:
+        raise Unsupported('%s is not a structure or a call' % cls.__name__)
+    return '\n'.join(e.lines), e.names
+
+
+def generateSource(cls, isNDR64 = False):
+    """
+    Returns the Python source of the encode and decode functions generated for cls.
+    Raises Unsupported if instances of cls are marshalled reflectively.
+    """
+    commonHdr, structure = _layout(cls, isNDR64)
+    return _generate(cls, commonHdr, structure, isNDR64)[0]
+
+
+def compileCodec(cls, commonHdr, structure, isNDR64):
+    """
+    Returns an NDRCodec for instances of cls laid out as commonHdr+structure, or None if
+    they have to be marshalled reflectively.
+    """
+    try:
+        source, names = _generate(cls, commonHdr, structure, isNDR64)
+    except Unsupported:
+        return None
+    namespace = {'LOG': LOG}
+    namespace.update(names)
+    exec(compile(source, '<ndr %s%s>' % (cls.__name__, ' NDR64' if isNDR64 else ''), 'exec'), namespace)
+    return NDRCodec(source, namespace['encode'], namespace['decode'])
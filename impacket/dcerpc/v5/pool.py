@@ -0,0 +1,379 @@
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   A pool of bound DCE/RPC associations. Tools making many calls against the
+#   same targets (a h*() helper call at a time, RemoteOperations opening svcctl,
+#   winreg and samr, ...) don't go through the TCP connect or the SMB negotiate
+#   and session setup, the endpoint mapping and the authenticated bind every
+#   time:
+#     - Associations are kept by string binding, credentials and authentication
+#       level and type. get() hands out an idle one bound to the interface asked
+#       for, adds the interface to an idle one with alter_ctx(), or makes a new
+#       one.
+#     - Named pipes of a target opened with the same credentials share the SMB
+#       session, when it's SMB 2 or newer (see SMBConnection.enableConcurrentRequests()).
+#     - Idle associations are checked before being handed out again, and closed
+#       once they've been idle for longer than idleTimeout.
+#
+#   An association is handed out to one user at a time. Hand it back with
+#   release(), or use association() in a with statement.
+#
+#   Example:
+#
+#       pool = DCERPCPool()
+#       with pool.association(r'ncacn_np:%s[\pipe\svcctl]' % target, scmr.MSRPC_UUID_SCMR, username,
+#                             password, domain) as dce:
+#           resp = scmr.hROpenSCManagerW(dce)
+#       ...
+#       pool.close()
+#
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+from impacket import LOG
+from impacket.dcerpc.v5 import transport, epm
+from impacket.dcerpc.v5.rpcrt import DCERPCException, RPC_C_AUTHN_LEVEL_NONE, RPC_C_AUTHN_WINNT, \
+    RPC_C_AUTHN_GSS_NEGOTIATE
+from impacket.smbconnection import SMBConnection, SessionError
+
+
+class _SMBSession:
+    # An SMB connection shared by the named pipes of a target
+    def __init__(self, key, connection, shared):
+        self.key = key
+        self.connection = connection
+        # False if only one named pipe can use it (SMB1)
+        self.shared = shared
+        self.users = 0
+        # False once the connection is found broken, nobody joins it anymore
+        self.alive = True
+
+
+class _Association:
+    def __init__(self, key, dce, iface_uuid, smbSession):
+        self.key = key
+        self.smbSession = smbSession
+        # Bound DCERPC_v5 instances, by interface. They all share the transport
+        self.contexts = {iface_uuid: dce}
+        # The last presentation context, new ones are altered from it
+        self.dce = dce
+        self.lastUsed = time.time()
+
+
+class DCERPCPool:
+    def __init__(self, idleTimeout=300, checkInterval=60):
+        """
+        :param int idleTimeout: seconds an association can be idle before being closed
+        :param int checkInterval: seconds an association over named pipe can be idle before the SMB
+            connection is checked (with an echo) when handing it out again. A TCP connection is always
+            checked, that doesn't take a round trip
+        """
+        self.__idleTimeout = idleTimeout
+        self.__checkInterval = checkInterval
+        self.__lock = threading.Lock()
+        # Idle associations by key, the most recently used last
+        self.__idle = {}
+        # The association of every DCERPC_v5 handed out
+        self.__inUse = {}
+        self.__smbSessions = {}
+        self.__closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, stringBinding, iface_uuid, username='', password='', domain='', lmhash='', nthash='', aesKey='',
+            TGT=None, TGS=None, doKerberos=False, kdcHost=None, remoteHost='', dport=None,
+            authLevel=RPC_C_AUTHN_LEVEL_NONE, authType=None):
+        """
+        returns a DCERPC_v5 instance bound to iface_uuid, to be handed back with release(). TGT and TGS aren't
+        part of the key associations are kept by, the username and domain are
+
+        :param string stringBinding: ncacn_np, ncacn_ip_tcp or ncacn_http. Without endpoint, ncacn_ip_tcp ones
+            are resolved through the endpoint mapper (and kept in epm.EPM_CACHE)
+        :param bytes iface_uuid: the interface, as given to DCERPC_v5.bind() (e.g. samr.MSRPC_UUID_SAMR)
+        :param string remoteHost: the address to connect to, if not the one in the string binding
+        :param int dport: the port to connect to, if not the one in the string binding or the default one
+        :param int authLevel: the DCE/RPC authentication level
+        :param int authType: the DCE/RPC authentication type. By default RPC_C_AUTHN_GSS_NEGOTIATE with
+            doKerberos, RPC_C_AUTHN_WINNT otherwise
+
+        :return: a bound DCERPC_v5 instance
+        :raise DCERPCException: if the association can't be made, or the interface bound
+        """
+        sb = transport.DCERPCStringBinding(stringBinding)
+        protocol = sb.get_protocol_sequence()
+        if protocol not in ('ncacn_np', 'ncacn_ip_tcp', 'ncacn_http'):
+            raise DCERPCException("Unsupported protocol sequence for a pool: %s" % protocol)
+        epmHost = None
+        if protocol == 'ncacn_ip_tcp' and not sb.get_endpoint():
+            epmHost = remoteHost or sb.get_network_address()
+            resolved = epm.hept_map(epmHost, iface_uuid, protocol='ncacn_ip_tcp', cache=epm.EPM_CACHE)
+            stringBinding = 'ncacn_ip_tcp:%s[%s]' % (sb.get_network_address(),
+                                                      transport.DCERPCStringBinding(resolved).get_endpoint())
+        if authType is None:
+            authType = RPC_C_AUTHN_GSS_NEGOTIATE if doKerberos else RPC_C_AUTHN_WINNT
+
+        credentials = (username, password, domain, lmhash, nthash, aesKey, doKerberos, kdcHost)
+        key = (str(stringBinding), remoteHost, dport, credentials, authLevel, authType)
+
+        while True:
+            with self.__lock:
+                if self.__closed is True:
+                    raise DCERPCException('The pool is closed')
+                expired = self.__expired()
+                association = self.__checkout(key, iface_uuid)
+            for idle in expired:
+                self.__close(idle)
+            if association is None:
+                break
+            if self.__isAlive(association) is False:
+                LOG.debug('Idle association to %s is gone, closing it' % stringBinding)
+                self.__close(association)
+                continue
+            return self.__handOut(association, iface_uuid)
+
+        rpctransport = transport.DCERPCTransportFactory(stringBinding)
+        rpctransport.set_credentials(username, password, domain, lmhash, nthash, aesKey, TGT, TGS)
+        rpctransport.set_kerberos(doKerberos, kdcHost)
+        if remoteHost != '':
+            rpctransport.setRemoteHost(remoteHost)
+        if dport is not None:
+            rpctransport.set_dport(dport)
+
+        smbSession = None
+        if isinstance(rpctransport, transport.SMBTransport):
+            smbSession = self.__joinSMBSession(rpctransport)
+            rpctransport.set_smb_connection(smbSession.connection)
+
+        dce = rpctransport.get_dce_rpc()
+        dce.set_auth_type(authType)
+        dce.set_auth_level(authLevel)
+        try:
+            dce.connect()
+        except BaseException as e:
+            if smbSession is not None:
+                if self.__isConnectionError(e):
+                    self.__evictSMBSession(smbSession)
+                self.__leaveSMBSession(smbSession)
+            elif epmHost is not None:
+                # The server might have been restarted since the endpoint was resolved
+                epm.EPM_CACHE.invalidate(epmHost, iface_uuid, 'ncacn_ip_tcp')
+            raise
+        try:
+            dce.bind(iface_uuid)
+        except:
+            dce.disconnect()
+            if smbSession is not None:
+                self.__leaveSMBSession(smbSession)
+            raise
+
+        with self.__lock:
+            self.__inUse[dce] = _Association(key, dce, iface_uuid, smbSession)
+        return dce
+
+    def release(self, dce, discard=False):
+        """
+        hands back a DCERPC_v5 instance returned by get(). Its association is kept for the next get(), unless
+        discard is set or calls are still in flight
+
+        :param DCERPC_v5 dce: the instance
+        :param bool discard: close the association, e.g. if it can't be trusted after an error
+        """
+        with self.__lock:
+            association = self.__inUse.pop(dce)
+            # With calls in flight, the next one would read their responses
+            if discard is False and self.__closed is False and dce._calls_in_flight() == 0:
+                association.lastUsed = time.time()
+                self.__idle.setdefault(association.key, []).append(association)
+                return
+        self.__close(association)
+
+    @contextmanager
+    def association(self, stringBinding, iface_uuid, *args, **kwargs):
+        """
+        get() for a with statement, the instance is released at the end. If something other than a
+        DCERPCException is raised, the association is discarded
+        """
+        dce = self.get(stringBinding, iface_uuid, *args, **kwargs)
+        try:
+            yield dce
+        except DCERPCException:
+            self.release(dce)
+            raise
+        except Exception as e:
+            if self.__isConnectionError(e):
+                with self.__lock:
+                    smbSession = self.__inUse[dce].smbSession
+                if smbSession is not None:
+                    self.__evictSMBSession(smbSession)
+            self.release(dce, discard=True)
+            raise
+        except:
+            self.release(dce, discard=True)
+            raise
+        else:
+            self.release(dce)
+
+    def close(self):
+        """
+        closes the idle associations. The ones handed out are closed when released
+        """
+        with self.__lock:
+            self.__closed = True
+            idle = [association for associations in self.__idle.values() for association in associations]
+            self.__idle = {}
+        for association in idle:
+            self.__close(association)
+
+    def __expired(self):
+        # Called with the lock held, takes out the associations idle for too long
+        expired = []
+        limit = time.time() - self.__idleTimeout
+        for key in list(self.__idle):
+            associations = self.__idle[key]
+            while associations and associations[0].lastUsed <= limit:
+                expired.append(associations.pop(0))
+            if not associations:
+                del self.__idle[key]
+        return expired
+
+    def __checkout(self, key, iface_uuid):
+        # Called with the lock held. An idle association bound to the interface already if there's one,
+        # the most recently used otherwise
+        associations = self.__idle.get(key)
+        if not associations:
+            return None
+        for association in reversed(associations):
+            if iface_uuid in association.contexts:
+                break
+        else:
+            association = associations[-1]
+        associations.remove(association)
+        if not associations:
+            del self.__idle[key]
+        return association
+
+    def __isAlive(self, association):
+        try:
+            if association.smbSession is not None:
+                if association.smbSession.alive is False:
+                    return False
+                if time.time() - association.lastUsed < self.__checkInterval:
+                    return True
+                association.smbSession.connection.getSMBServer().echo()
+                return True
+            # Nothing comes from the server between calls: if the socket is readable, the connection was
+            # closed (or the stream isn't where we think it is)
+            readable, _, _ = select.select([association.dce.get_rpc_transport().get_socket()], [], [], 0)
+            return not readable
+        except Exception as e:
+            LOG.debug('Association check failed: %s' % e)
+            if association.smbSession is not None:
+                self.__evictSMBSession(association.smbSession)
+            return False
+
+    @staticmethod
+    def __isConnectionError(e):
+        # Errors answered by the server leave the connection usable, anything else (socket errors, NetBIOS
+        # timeouts, ...) means it's gone
+        return isinstance(e, Exception) and not isinstance(e, (DCERPCException, SessionError))
+
+    def __handOut(self, association, iface_uuid):
+        dce = association.contexts.get(iface_uuid)
+        if dce is None:
+            try:
+                dce = association.dce.alter_ctx(iface_uuid)
+            except DCERPCException:
+                # The endpoint doesn't serve that interface, the association is still good
+                with self.__lock:
+                    self.__idle.setdefault(association.key, []).append(association)
+                raise
+            except:
+                self.__close(association)
+                raise
+            association.contexts[iface_uuid] = dce
+            association.dce = dce
+        with self.__lock:
+            self.__inUse[dce] = association
+        return dce
+
+    def __close(self, association):
+        try:
+            association.dce.disconnect()
+        except Exception as e:
+            LOG.debug('Error closing association: %s' % e)
+        if association.smbSession is not None:
+            self.__leaveSMBSession(association.smbSession)
+
+    def __joinSMBSession(self, rpctransport):
+        username, password, domain, lmhash, nthash, aesKey, TGT, TGS = rpctransport.get_credentials()
+        key = (rpctransport.getRemoteName(), rpctransport.getRemoteHost(), rpctransport.get_dport(), username,
+               password, domain, lmhash, nthash, aesKey, rpctransport.get_kerberos(), rpctransport.get_kdcHost())
+        with self.__lock:
+            for smbSession in self.__smbSessions.get(key, []):
+                if smbSession.shared is True:
+                    smbSession.users += 1
+                    return smbSession
+
+        connection = SMBConnection(rpctransport.getRemoteName(), rpctransport.getRemoteHost(),
+                                   sess_port=rpctransport.get_dport(), timeout=rpctransport.get_connect_timeout())
+        try:
+            if rpctransport.get_kerberos() is False:
+                connection.login(username, password, domain, lmhash, nthash)
+            else:
+                connection.kerberosLogin(username, password, domain, lmhash, nthash, aesKey,
+                                         kdcHost=rpctransport.get_kdcHost(), TGT=TGT, TGS=TGS)
+        except:
+            connection.close()
+            raise
+        try:
+            connection.enableConcurrentRequests()
+            shared = True
+        except SessionError:
+            # SMB1, the session can't be shared
+            shared = False
+
+        smbSession = _SMBSession(key, connection, shared)
+        smbSession.users = 1
+        with self.__lock:
+            self.__smbSessions.setdefault(key, []).append(smbSession)
+        return smbSession
+
+    def __evictSMBSession(self, smbSession):
+        # The SMB connection is broken, later get()s open a new one. It's closed once the associations
+        # still using it are
+        with self.__lock:
+            smbSession.alive = False
+            self.__forgetSMBSession(smbSession)
+
+    def __forgetSMBSession(self, smbSession):
+        # Called with the lock held
+        smbSessions = self.__smbSessions.get(smbSession.key, [])
+        if smbSession in smbSessions:
+            smbSessions.remove(smbSession)
+            if not smbSessions:
+                del self.__smbSessions[smbSession.key]
+
+    def __leaveSMBSession(self, smbSession):
+        with self.__lock:
+            smbSession.users -= 1
+            if smbSession.users > 0:
+                return
+            self.__forgetSMBSession(smbSession)
+        try:
+            smbSession.connection.close()
+        except Exception as e:
+            LOG.debug('Error closing SMB connection: %s' % e)
@@ -25,6 +25,8 @@ import logging
 import socket
 import sys
 from binascii import unhexlify
+from collections import deque
+from concurrent.futures import Future
 from Cryptodome.Cipher import ARC4
 
 from impacket import ntlm, LOG
@@ -794,6 +796,7 @@ class DCERPC:
         self._max_user_frag = None
         self.set_default_max_fragment_size()
         self._ctx = None
+        self._zero_copy = False
 
     def get_rpc_transport(self):
         return self._transport
@@ -844,6 +847,14 @@ class DCERPC:
     def set_idempotent(self, flag):
         pass
 
+    def set_zero_copy(self, flag):
+        # When set, responses are unmarshalled from a memoryview over the received stub, so byte arrays
+        # are returned as ndr.ByteArrayView objects instead of lists of one-byte strings
+        self._zero_copy = flag
+
+    def get_zero_copy(self):
+        return self._zero_copy
+
     def call(self, function, body, uuid=None):
         if hasattr(body, 'getData'):
             return self.send(DCERPC_RawCall(function, body.getData(), uuid))
@@ -851,14 +862,20 @@ class DCERPC:
             return self.send(DCERPC_RawCall(function, body, uuid))
 
     def request(self, request, uuid=None, checkError=True):
+        isNDR64 = self._prepare_request(request)
+        self.call(request.opnum, request, uuid)
+        return self._process_response(request, self.recv(), isNDR64, checkError)
+
+    def _prepare_request(self, request):
         if self.transfer_syntax == self.NDR64Syntax:
             request.changeTransferSyntax(self.NDR64Syntax)
-            isNDR64 = True
+            return True
         else:
-            isNDR64 = False
+            return False
 
-        self.call(request.opnum, request, uuid)
-        answer = self.recv()
+    def _process_response(self, request, answer, isNDR64, checkError=True):
+        if self._zero_copy:
+            answer = memoryview(answer)
 
         __import__(request.__module__)
         module = sys.modules[request.__module__]
@@ -887,6 +904,25 @@ class DCERPC:
 class DCERPC_v4(DCERPC):
     pass
 
+class DCERPCFuture(Future):
+    """
+    The outcome of a call sent with DCERPC_v5.submit(). No thread reads the responses: they are read when
+    the result of a call still in flight is asked for, or when the window of calls in flight is full.
+    The transport's timeout applies, the timeout argument is ignored.
+    """
+    def __init__(self, dce):
+        Future.__init__(self)
+        self.call_id = None
+        self.__dce = dce
+
+    def result(self, timeout=None):
+        self.__dce._wait_call(self)
+        return Future.result(self, 0)
+
+    def exception(self, timeout=None):
+        self.__dce._wait_call(self)
+        return Future.exception(self, 0)
+
 class DCERPC_v5(DCERPC):
     def __init__(self, transport):
         DCERPC.__init__(self, transport)
@@ -913,7 +949,12 @@ class DCERPC_v5(DCERPC):
         self.__sequence = 0   
 
         self.transfer_syntax = uuidtup_to_bin(('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0'))
-        self.__callid = 1
+        # What the presentation contexts opened with alter_ctx() on the same transport share: the next call_id
+        # and the calls sent with submit() whose response is still to be read, by call_id
+        self._association = {
+            'CallId'      : 1,
+            'PendingCalls': {},
+        }
         self._ctx = 0
         self.__sessionKey = None
         self.__max_xmit_size  = 0
@@ -921,6 +962,7 @@ class DCERPC_v5(DCERPC):
         self.__cipher = None
         self.__confounder = b''
         self.__gss = None
+        self.__pipelineWindow = 16
 
     def set_session_key(self, session_key):
         self.__sessionKey = session_key
@@ -931,6 +973,9 @@ class DCERPC_v5(DCERPC):
     def set_auth_level(self, auth_level):
         self.__auth_level = auth_level
 
+    def get_auth_level(self):
+        return self.__auth_level
+
     def set_auth_type(self, auth_type, callback = None):
         self.__auth_type = auth_type
         self.__auth_type_callback = callback
@@ -966,6 +1011,28 @@ class DCERPC_v5(DCERPC):
                 pass
 
     def bind(self, iface_uuid, alter = 0, bogus_binds = 0, transfer_syntax = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')):
+        bind, packet = self._bind_request(iface_uuid, alter, bogus_binds, transfer_syntax)
+
+        self._transport.send(packet.get_packet())
+
+        s = self._transport.recv()
+
+        if s != 0:
+            resp = MSRPCHeader(s)
+        else:
+            return 0 #mmm why not None?
+
+        packet, answered = self._bind_response(bind, resp, bogus_binds)
+        if packet is not None:
+            self._transport.send(packet.get_packet(), forceWriteAndx = 1)
+            if answered is True:
+                self.recv()
+                self.__sequence = 0
+
+        return resp     # means packet is signed, if verifier is wrong it fails
+
+    def _bind_request(self, iface_uuid, alter, bogus_binds, transfer_syntax):
+        # Builds the bind (or alter context) PDU. The MSRPCBind is returned too, _bind_response() needs it
         bind = MSRPCBind()
         #item['TransferSyntax']['Version'] = 1
         ctx = self._ctx
@@ -992,7 +1059,7 @@ class DCERPC_v5(DCERPC):
         packet = MSRPCHeader()
         packet['type'] = MSRPC_BIND
         packet['pduData'] = bind.getData()
-        packet['call_id'] = self.__callid
+        packet['call_id'] = self._association['CallId']
 
         if alter:
             packet['type'] = MSRPC_ALTERCTX
@@ -1030,15 +1097,12 @@ class DCERPC_v5(DCERPC):
             packet['sec_trailer'] = sec_trailer
             packet['auth_data'] = auth
 
-        self._transport.send(packet.get_packet())
-
-        s = self._transport.recv()
-
-        if s != 0:
-            resp = MSRPCHeader(s)
-        else:
-            return 0 #mmm why not None?
+        return bind, packet
 
+    def _bind_response(self, bind, resp, bogus_binds):
+        # Processes the bind answer and completes the authentication. Returns the PDU to send then, if any,
+        # and whether the server answers it
+        packet, answered = None, False
         if resp['type'] == MSRPC_BINDACK or resp['type'] == MSRPC_ALTERCTX_R:
             bindResp = MSRPCBindAck(resp.getData())
         elif resp['type'] == MSRPC_BINDNAK or resp['type'] == MSRPC_FAULT:
@@ -1131,11 +1195,9 @@ class DCERPC_v5(DCERPC):
                     alter_ctx['pduData'] = bind.getData()
                     alter_ctx['sec_trailer'] = sec_trailer
                     alter_ctx['auth_data'] = response
-                    self._transport.send(alter_ctx.get_packet(), forceWriteAndx = 1)
                     self.__gss = gssapi.GSSAPI(self.__cipher)
                     self.__sequence = 0
-                    self.recv()
-                    self.__sequence = 0
+                    packet, answered = alter_ctx, True
                 else:
                     auth3 = MSRPCHeader()
                     auth3['type'] = MSRPC_AUTH3
@@ -1148,15 +1210,19 @@ class DCERPC_v5(DCERPC):
                     auth3['auth_data'] = response.getData()
 
                     # Use the same call_id
-                    self.__callid = resp['call_id']
-                    auth3['call_id'] = self.__callid
-                    self._transport.send(auth3.get_packet(), forceWriteAndx = 1)
+                    self._association['CallId'] = resp['call_id']
+                    auth3['call_id'] = self._association['CallId']
+                    packet, answered = auth3, False
 
-            self.__callid += 1
+            self._association['CallId'] += 1
 
-        return resp     # means packet is signed, if verifier is wrong it fails
+        return packet, answered
 
     def _transport_send(self, rpc_packet, forceWriteAndx = 0, forceRecv = 0):
+        self._transport.send(self._seal_packet(rpc_packet), forceWriteAndx = forceWriteAndx, forceRecv = forceRecv)
+
+    def _seal_packet(self, rpc_packet):
+        # Adds the auth trailer (signing or sealing the PDU if needed), returns the PDU ready to be sent
         rpc_packet['ctx_id'] = self._ctx
         rpc_packet['sec_trailer'] = b''
         rpc_packet['auth_data'] = b''
@@ -1236,9 +1302,15 @@ class DCERPC_v5(DCERPC):
 
             self.__sequence += 1
 
-        self._transport.send(rpc_packet.get_packet(), forceWriteAndx = forceWriteAndx, forceRecv = forceRecv)
+        return rpc_packet.get_packet()
 
     def send(self, data):
+        for fragment, forceWriteAndx, forceRecv in self._fragments(data):
+            self._transport_send(fragment, forceWriteAndx = forceWriteAndx, forceRecv = forceRecv)
+
+    def _fragments(self, data):
+        # Yields the PDUs to send for a call (along with the transport flags), one per fragment. A single
+        # object is yielded every time, it must be used before asking for the next one
         if isinstance(data, MSRPCHeader) is not True:
             # Must be an Impacket, transform to structure
             data = DCERPC_RawCall(data.OP_NUM, data.get_packet())
@@ -1250,7 +1322,7 @@ class DCERPC_v5(DCERPC):
             # Structure doesn't have uuid
             pass
         data['ctx_id'] = self._ctx
-        data['call_id'] = self.__callid
+        data['call_id'] = self._association['CallId']
         data['alloc_hint'] = len(data['pduData'])
         # We should fragment PDUs if:
         # 1) Payload exceeds __max_xmit_size received during BIND response
@@ -1297,41 +1369,18 @@ class DCERPC_v5(DCERPC):
                 else:
                     data['flags'] &= (~PFC_LAST_FRAG)
                 data['pduData'] = toSend
-                self._transport_send(data, forceWriteAndx = 1, forceRecv =data['flags'] & PFC_LAST_FRAG)
+                yield data, 1, data['flags'] & PFC_LAST_FRAG
         else:
-            self._transport_send(data)
-        self.__callid += 1
+            yield data, 0, 0
+        self._association['CallId'] += 1
 
     def recv(self):
         finished = False
         forceRecv = 0
-        retAnswer = b''
+        # The stub of every fragment, joined once the last one arrives
+        retAnswer = []
         while not finished:
-            # At least give me the MSRPCRespHeader, especially important for 
-            # TCP/UDP Transports
-            response_data = self._transport.recv(forceRecv, count=MSRPCRespHeader._SIZE)
-            response_header = MSRPCRespHeader(response_data)
-            # Ok, there might be situation, especially with large packets, that 
-            # the transport layer didn't send us the full packet's contents
-            # So we gotta check we received it all
-            while len(response_data) < response_header['frag_len']:
-               response_data += self._transport.recv(forceRecv, count=(response_header['frag_len']-len(response_data)))
-
-            off = response_header.get_header_size()
-
-            if response_header['type'] == MSRPC_FAULT and response_header['frag_len'] >= off+4:
-                status_code = unpack("<L",response_data[off:off+4])[0]
-                if status_code in rpc_status_codes:
-                    raise DCERPCException(rpc_status_codes[status_code])
-                elif status_code & 0xffff in rpc_status_codes:
-                    raise DCERPCException(rpc_status_codes[status_code & 0xffff])
-                else:
-                    if status_code in hresult_errors.ERROR_MESSAGES:
-                        error_msg_short = hresult_errors.ERROR_MESSAGES[status_code][0]
-                        error_msg_verbose = hresult_errors.ERROR_MESSAGES[status_code][1] 
-                        raise DCERPCException('%s - %s' % (error_msg_short, error_msg_verbose))
-                    else:
-                        raise DCERPCException('Unknown DCE RPC fault status code: %.8x' % status_code)
+            response_header, response_data = self.__recvFragment(forceRecv)
 
             if response_header['flags'] & PFC_LAST_FRAG:
                 # No need to reassembly DCERPC
@@ -1340,87 +1389,306 @@ class DCERPC_v5(DCERPC):
                 # Forcing Read Recv, we need more packets!
                 forceRecv = 1
 
-            answer = response_data[off:]
-            auth_len = response_header['auth_len']
-            if auth_len:
-                auth_len += 8
-                auth_data = answer[-auth_len:]
-                sec_trailer = SEC_TRAILER(data = auth_data)
-                answer = answer[:-auth_len]
-
-                if sec_trailer['auth_level'] == RPC_C_AUTHN_LEVEL_PKT_PRIVACY:
-                    if self.__auth_type == RPC_C_AUTHN_WINNT:
-                        if self.__flags & ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
-                            # TODO: FIX THIS, it's not calculating the signature well
-                            # Since I'm not testing it we don't care... yet
-                            answer, signature =  ntlm.SEAL(self.__flags, 
-                                    self.__serverSigningKey, 
-                                    self.__serverSealingKey,  
-                                    answer, 
-                                    answer, 
-                                    self.__sequence, 
-                                    self.__serverSealingHandle)
-                        else:
-                            answer, signature = ntlm.SEAL(self.__flags, 
-                                    self.__serverSigningKey, 
-                                    self.__serverSealingKey, 
-                                    answer, 
-                                    answer, 
-                                    self.__sequence, 
-                                    self.__serverSealingHandle)
-                            self.__sequence += 1
-                    elif self.__auth_type == RPC_C_AUTHN_NETLOGON:
-                        from impacket.dcerpc.v5 import nrpc
-                        answer, cfounder = nrpc.UNSEAL(answer, 
-                               auth_data[len(sec_trailer):],
-                               self.__sessionKey, 
-                               False)
-                        self.__sequence += 1
-                    elif self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
-                        if self.__sequence > 0:
-                            answer, cfounder = self.__gss.GSS_Unwrap(self.__sessionKey, answer, self.__sequence,
-                                                                     direction='init', authData=auth_data)
-
-                elif sec_trailer['auth_level'] == RPC_C_AUTHN_LEVEL_PKT_INTEGRITY:
-                    if self.__auth_type == RPC_C_AUTHN_WINNT:
-                        ntlmssp = auth_data[12:]
-                        if self.__flags & ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
-                            signature =  ntlm.SIGN(self.__flags, 
-                                    self.__serverSigningKey, 
-                                    answer, 
-                                    self.__sequence, 
-                                    self.__serverSealingHandle)
-                        else:
-                            signature = ntlm.SIGN(self.__flags, 
-                                    self.__serverSigningKey, 
-                                    ntlmssp, 
-                                    self.__sequence, 
-                                    self.__serverSealingHandle)
-                            # Yes.. NTLM2 doesn't increment sequence when receiving
-                            # the packet :P
-                            self.__sequence += 1
-                    elif self.__auth_type == RPC_C_AUTHN_NETLOGON:
-                        from impacket.dcerpc.v5 import nrpc
-                        ntlmssp = auth_data[12:]
-                        signature = nrpc.SIGN(ntlmssp, 
-                               self.__confounder, 
-                               self.__sequence, 
-                               self.__sessionKey, 
-                               False)
-                        self.__sequence += 1
-                    elif self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
-                        # Do NOT increment the sequence number when Signing Kerberos
-                        #self.__sequence += 1
-                        pass
-
-                
-                if sec_trailer['auth_pad_len']:
-                    answer = answer[:-sec_trailer['auth_pad_len']]
-              
-            retAnswer += answer
-        return retAnswer
+            retAnswer.append(self._open_answer(response_header, response_data))
+
+        if len(retAnswer) == 1:
+            return bytes(retAnswer[0])
+        return b''.join(retAnswer)
+
+    def __recvFragment(self, forceRecv):
+        # At least give me the MSRPCRespHeader, especially important for 
+        # TCP/UDP Transports
+        response_data = self._transport.recv(forceRecv, count=MSRPCRespHeader._SIZE)
+        response_header = MSRPCRespHeader(response_data)
+        # Ok, there might be situation, especially with large packets, that 
+        # the transport layer didn't send us the full packet's contents
+        # So we gotta check we received it all
+        if len(response_data) < response_header['frag_len']:
+            chunks = [response_data]
+            received = len(response_data)
+            while received < response_header['frag_len']:
+                chunks.append(self._transport.recv(forceRecv, count=(response_header['frag_len']-received)))
+                received += len(chunks[-1])
+            response_data = b''.join(chunks)
+        return response_header, response_data
+
+    def _open_answer(self, response_header, response_data):
+        # The stub of a response fragment, for the calls made one at a time
+        exception = self.__faultException(response_header, response_data)
+        if exception is not None:
+            raise exception
+        answer, self.__sequence = self.__openFragment(response_header, response_data, self.__sequence)
+        return answer
+
+    def __faultException(self, response_header, response_data):
+        off = response_header.get_header_size()
+        if response_header['type'] == MSRPC_FAULT and response_header['frag_len'] >= off+4:
+            status_code = unpack("<L",response_data[off:off+4])[0]
+            if status_code in rpc_status_codes:
+                return DCERPCException(rpc_status_codes[status_code])
+            elif status_code & 0xffff in rpc_status_codes:
+                return DCERPCException(rpc_status_codes[status_code & 0xffff])
+            else:
+                if status_code in hresult_errors.ERROR_MESSAGES:
+                    error_msg_short = hresult_errors.ERROR_MESSAGES[status_code][0]
+                    error_msg_verbose = hresult_errors.ERROR_MESSAGES[status_code][1] 
+                    return DCERPCException('%s - %s' % (error_msg_short, error_msg_verbose))
+                else:
+                    return DCERPCException('Unknown DCE RPC fault status code: %.8x' % status_code)
+        return None
+
+    def __openFragment(self, response_header, response_data, sequence):
+        # Checks and strips the auth trailer of a response fragment, deciphering its stub if needed. The
+        # sequence number to use is passed, and the one to use for the next fragment returned
+        off = response_header.get_header_size()
+        auth_len = response_header['auth_len']
+        if auth_len:
+            auth_len += 8
+            auth_data = response_data[-auth_len:]
+            sec_trailer = SEC_TRAILER(data = auth_data)
+            answer = response_data[off:-auth_len]
+
+            if sec_trailer['auth_level'] == RPC_C_AUTHN_LEVEL_PKT_PRIVACY:
+                if self.__auth_type == RPC_C_AUTHN_WINNT:
+                    if self.__flags & ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
+                        # TODO: FIX THIS, it's not calculating the signature well
+                        # Since I'm not testing it we don't care... yet
+                        answer, signature =  ntlm.SEAL(self.__flags, 
+                                self.__serverSigningKey, 
+                                self.__serverSealingKey,  
+                                answer, 
+                                answer, 
+                                sequence, 
+                                self.__serverSealingHandle)
+                    else:
+                        answer, signature = ntlm.SEAL(self.__flags, 
+                                self.__serverSigningKey, 
+                                self.__serverSealingKey, 
+                                answer, 
+                                answer, 
+                                sequence, 
+                                self.__serverSealingHandle)
+                        sequence += 1
+                elif self.__auth_type == RPC_C_AUTHN_NETLOGON:
+                    from impacket.dcerpc.v5 import nrpc
+                    answer, cfounder = nrpc.UNSEAL(answer, 
+                           auth_data[len(sec_trailer):],
+                           self.__sessionKey, 
+                           False)
+                    sequence += 1
+                elif self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
+                    if sequence > 0:
+                        answer, cfounder = self.__gss.GSS_Unwrap(self.__sessionKey, answer, sequence,
+                                                                 direction='init', authData=auth_data)
+
+            elif sec_trailer['auth_level'] == RPC_C_AUTHN_LEVEL_PKT_INTEGRITY:
+                if self.__auth_type == RPC_C_AUTHN_WINNT:
+                    ntlmssp = auth_data[12:]
+                    if self.__flags & ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY:
+                        signature =  ntlm.SIGN(self.__flags, 
+                                self.__serverSigningKey, 
+                                answer, 
+                                sequence, 
+                                self.__serverSealingHandle)
+                    else:
+                        signature = ntlm.SIGN(self.__flags, 
+                                self.__serverSigningKey, 
+                                ntlmssp, 
+                                sequence, 
+                                self.__serverSealingHandle)
+                        # Yes.. NTLM2 doesn't increment sequence when receiving
+                        # the packet :P
+                        sequence += 1
+                elif self.__auth_type == RPC_C_AUTHN_NETLOGON:
+                    from impacket.dcerpc.v5 import nrpc
+                    ntlmssp = auth_data[12:]
+                    signature = nrpc.SIGN(ntlmssp, 
+                           self.__confounder, 
+                           sequence, 
+                           self.__sessionKey, 
+                           False)
+                    sequence += 1
+                elif self.__auth_type == RPC_C_AUTHN_GSS_NEGOTIATE:
+                    # Do NOT increment the sequence number when Signing Kerberos
+                    #sequence += 1
+                    pass
+
+
+            if sec_trailer['auth_pad_len']:
+                answer = memoryview(answer)[:-sec_trailer['auth_pad_len']]
+        else:
+            # No copies until the fragments are joined
+            answer = memoryview(response_data)[off:]
+
+        return answer, sequence
+
+    def set_pipeline_window(self, window):
+        # Maximum number of calls sent with submit() (or request_many()) waiting for their response
+        if window < 1:
+            raise DCERPCException('The pipeline window must be at least 1')
+        self.__pipelineWindow = window
+
+    def get_pipeline_window(self):
+        if self.__sharedSequence():
+            return 1
+        return self.__pipelineWindow
+
+    def __sharedSequence(self):
+        # NTLM without extended session security and Netlogon sign and seal the responses with the sequence
+        # number of the requests (and NTLM with the same RC4 handle), so a request can't be sent until the
+        # previous response has been read. Otherwise the sequence number after sending a call is the one
+        # its response is checked with, whatever was sent in between
+        if self.__auth_level not in (RPC_C_AUTHN_LEVEL_PKT_INTEGRITY, RPC_C_AUTHN_LEVEL_PKT_PRIVACY):
+            return False
+        if self.__auth_type == RPC_C_AUTHN_NETLOGON:
+            return True
+        return self.__auth_type == RPC_C_AUTHN_WINNT and not (self.__flags & ntlm.NTLMSSP_NEGOTIATE_EXTENDED_SESSIONSECURITY)
+
+    def request(self, request, uuid=None, checkError=True):
+        if self._calls_in_flight() > 0:
+            # The responses of the calls in flight, on any context, come first
+            return self.submit(request, uuid, checkError).result()
+        return DCERPC.request(self, request, uuid, checkError)
+
+    def submit(self, request, uuid=None, checkError=True):
+        """
+        sends a call without waiting for its response. Responses are matched to the calls by call_id, so many
+        calls can be in flight on the same association (up to the pipeline window, responses are read when
+        it's full).
+
+        :param NDRCALL request: the call, like the ones passed to request()
+        :param uuid: the object UUID, if any
+        :param bool checkError: if the error code at the end of the response has to raise an exception
+
+        :return: a DCERPCFuture whose result() is the response, or raises like request() would
+        """
+        while self._calls_in_flight() >= self.get_pipeline_window():
+            self.__recvResponse()
+
+        isNDR64 = self._prepare_request(request)
+        future = DCERPCFuture(self)
+        self.call(request.opnum, request, uuid)
+        future.call_id = self._add_call(future, request, isNDR64, checkError)
+        return future
+
+    def request_many(self, requests, uuid=None, checkError=True, returnExceptions=False):
+        """
+        sends every call in requests, keeping up to the pipeline window of them in flight, and yields
+        their responses in the same order. Calls still in flight when the generator is closed have their
+        responses read and dropped.
+
+        :param requests: an iterable of NDRCALL, it can be a generator
+        :param uuid: the object UUID, if any
+        :param bool checkError: if the error code at the end of the responses has to raise an exception
+        :param bool returnExceptions: yield the exception of a failed call instead of raising it
+
+        :return: a generator of responses
+        """
+        futures = deque()
+        try:
+            for request in requests:
+                futures.append(self.submit(request, uuid, checkError))
+                while futures and futures[0].done():
+                    yield self.__futureResult(futures.popleft(), returnExceptions)
+            while futures:
+                yield self.__futureResult(futures.popleft(), returnExceptions)
+        finally:
+            for future in futures:
+                future.exception()
+
+    @staticmethod
+    def __futureResult(future, returnExceptions):
+        if returnExceptions is True and future.exception() is not None:
+            return future.exception()
+        return future.result()
+
+    def _wait_call(self, future):
+        while not future.done():
+            try:
+                self.__recvResponse()
+            except Exception:
+                # Every call in flight failed with it, this one included
+                if not future.done():
+                    raise
+
+    def __recvResponse(self):
+        # Reads a response fragment of any of the calls in flight
+        try:
+            response_header, response_data = self.__recvFragment(0)
+            self._process_fragment(response_header, response_data)
+        except Exception as e:
+            self._fail_calls(e)
+            raise
+
+    def _add_call(self, future, request, isNDR64, checkError):
+        # Keeps track of the call just sent, its response will complete the future. Returns its call_id
+        callId = self._association['CallId'] - 1
+        self._association['PendingCalls'][callId] = {
+            # The context that sent it, its security context opens the response
+            'DCE'       : self,
+            'Future'    : future,
+            'Request'   : request,
+            'NDR64'     : isNDR64,
+            'CheckError': checkError,
+            'Sequence'  : self.__sequence,
+            'Stub'      : [],
+        }
+        return callId
+
+    def _calls_in_flight(self):
+        return len(self._association['PendingCalls'])
+
+    def _fail_calls(self, exception):
+        # The stream (or the security context) can't be trusted anymore, every call in flight fails
+        for call in self._association['PendingCalls'].values():
+            if not call['Future'].done():
+                call['Future'].set_exception(exception)
+        self._association['PendingCalls'].clear()
+
+    def _process_fragment(self, response_header, response_data):
+        # Hands a response fragment to its call, completing its future with the last one. Exceptions
+        # raised mean the fragment couldn't be matched or opened
+        call = self._association['PendingCalls'].get(response_header['call_id'])
+        if call is None:
+            raise DCERPCException('Response received for unknown call_id %d' % response_header['call_id'])
+
+        dce = call['DCE']
+        exception = self.__faultException(response_header, response_data)
+        if exception is None:
+            answer, call['Sequence'] = dce.__openFragment(response_header, response_data, call['Sequence'])
+            if dce.__sharedSequence():
+                dce.__sequence = call['Sequence']
+            call['Stub'].append(answer)
+            if not response_header['flags'] & PFC_LAST_FRAG:
+                return
+
+        del self._association['PendingCalls'][response_header['call_id']]
+        if call['Future'].cancelled():
+            return
+        if exception is None:
+            try:
+                if len(call['Stub']) == 1:
+                    answer = bytes(call['Stub'][0])
+                else:
+                    answer = b''.join(call['Stub'])
+                response = dce._process_response(call['Request'], answer, call['NDR64'], call['CheckError'])
+            except Exception as e:
+                exception = e
+        if exception is not None:
+            call['Future'].set_exception(exception)
+        else:
+            call['Future'].set_result(response)
 
     def alter_ctx(self, newUID, bogus_binds = 0):
+        # The alter context response is read right away, the calls in flight are answered first
+        while self._calls_in_flight() > 0:
+            self.__recvResponse()
+        answer = self._alter_ctx_instance()
+        answer.bind(newUID, alter = 1, bogus_binds = bogus_binds, transfer_syntax = bin_to_uuidtup(self.transfer_syntax))
+        return answer
+
+    def _alter_ctx_instance(self):
+        # A new instance on the same transport with the same credentials, for the next presentation context
         answer = self.__class__(self._transport)
 
         answer.set_credentials(self.__username, self.__password, self.__domain, self.__lmhash, self.__nthash,
@@ -1429,8 +1697,7 @@ class DCERPC_v5(DCERPC):
         answer.set_auth_level(self.__auth_level)
 
         answer.set_ctx_id(self._ctx+1)
-        answer.__callid = self.__callid
-        answer.bind(newUID, alter = 1, bogus_binds = bogus_binds, transfer_syntax = bin_to_uuidtup(self.transfer_syntax))
+        answer._association = self._association
         return answer
 
 class DCERPC_RawCall(MSRPCRequestHeader):
@@ -1493,6 +1760,8 @@ class DCERPCServer(Thread):
         self._listenAddress = '127.0.0.1'
         self._listenUUIDS   = {}
         self._boundUUID     = b''
+        # Interface bound to every presentation context of the association, by context id
+        self._contexts      = {}
         self._sock          = None
         self._clientSock    = None
         self._callid        = 1
@@ -1527,9 +1796,11 @@ class DCERPCServer(Thread):
         return self._sock.getsockname()[1]
 
     def recv(self):
+        # Returns the next PDU. A fragmented request comes as all its fragments one after the other,
+        # processRequest() puts their stubs together
         finished = False
-        retAnswer = b''
         response_data = b''
+        fragments = []
         while not finished:
             # At least give me the MSRPCRespHeader, especially important for TCP/UDP Transports
             response_data = self._clientSock.recv(MSRPCRespHeader._SIZE)
@@ -1540,29 +1811,26 @@ class DCERPCServer(Thread):
             # Ok, there might be situation, especially with large packets, 
             # that the transport layer didn't send us the full packet's contents
             # So we gotta check we received it all
-            while len(response_data) < response_header['frag_len']:
-               response_data += self._clientSock.recv(response_header['frag_len']-len(response_data))
-            response_header = MSRPCRespHeader(response_data)
+            if len(response_data) < response_header['frag_len']:
+                chunks = [response_data]
+                received = len(response_data)
+                while received < response_header['frag_len']:
+                    chunk = self._clientSock.recv(response_header['frag_len']-received)
+                    if chunk == b'':
+                        return None
+                    chunks.append(chunk)
+                    received += len(chunk)
+                response_data = b''.join(chunks)
+            fragments.append(response_data)
             if response_header['flags'] & PFC_LAST_FRAG:
-                # No need to reassembly DCERPC
                 finished = True
-            answer = response_header['pduData']
-            auth_len = response_header['auth_len']
-            if auth_len:
-                auth_len += 8
-                auth_data = answer[-auth_len:]
-                sec_trailer = SEC_TRAILER(data = auth_data)
-                answer = answer[:-auth_len]
-                if sec_trailer['auth_pad_len']:
-                    answer = answer[:-sec_trailer['auth_pad_len']]
-              
-            retAnswer += answer
-        return response_data
+        return b''.join(fragments)
     
     def run(self):
         self._sock.listen(10)
         while True:
             self._clientSock, address = self._sock.accept()
+            self._contexts = {}
             try:
                 while True:
                     data = self.recv()
@@ -1610,7 +1878,10 @@ class DCERPCServer(Thread):
         NDRSyntax   = ('8a885d04-1ceb-11c9-9fe8-08002b104860', '2.0')
         resp = MSRPCBindAck()
 
-        resp['type']             = MSRPC_BINDACK
+        if packet['type'] == MSRPC_ALTERCTX:
+            resp['type']         = MSRPC_ALTERCTX_R
+        else:
+            resp['type']         = MSRPC_BINDACK
         resp['flags']            = packet['flags']
         resp['frag_len']         = 0
         resp['auth_len']         = 0
@@ -1623,7 +1894,9 @@ class DCERPCServer(Thread):
 
         data      = bind['ctx_items']
         ctx_items = b''
-        resp['SecondaryAddrLen'] = 0
+        # No secondary address unless an interface is accepted, just the NUL
+        resp['SecondaryAddrLen'] = 1
+        resp['SecondaryAddr']    = ''
         for i in range(bind['ctx_num']):
             result = MSRPC_CONT_RESULT_USER_REJECT
             item   = CtxItem(data)
@@ -1640,13 +1913,14 @@ class DCERPCServer(Thread):
                         resp['SecondaryAddrLen'] = len(resp['SecondaryAddr'])+1
                         reason           = 0
                         self._boundUUID = j
+                        self._contexts[item['ContextID']] = j
             else:
                 # Fail the bind request for this context
                 reason = 2 # Transfer Syntax not supported
             if reason == 0:
                result = MSRPC_CONT_RESULT_ACCEPT
             if reason == 1:
-                LOG.error('Bind request for an unsupported interface %s' % bin_to_uuidtup(item['AbstractSyntax']))
+                LOG.error('Bind request for an unsupported interface %s' % (bin_to_uuidtup(item['AbstractSyntax']),))
 
             resp['ctx_num']             += 1
             itemResult                   = CtxItemResult()
@@ -1664,7 +1938,7 @@ class DCERPCServer(Thread):
 
     def processRequest(self,data):
         packet = MSRPCHeader(data)
-        if packet['type'] == MSRPC_BIND:
+        if packet['type'] in (MSRPC_BIND, MSRPC_ALTERCTX):
             bind   = MSRPCBind(packet['pduData'])
             self.bind(packet, bind)
             packet = None
@@ -1672,13 +1946,22 @@ class DCERPCServer(Thread):
             request          = MSRPCRequestHeader(data)
             response         = MSRPCRespHeader(data)
             response['type'] = MSRPC_RESPONSE
+            response['flags'] = PFC_FIRST_FRAG | PFC_LAST_FRAG
+            boundUUID        = self._contexts.get(request['ctx_id'], self._boundUUID)
+            # The rest of the fragments, if any, follow the first one
+            stub             = [request['pduData']]
+            offset           = request['frag_len']
+            while offset < len(data):
+                fragment = MSRPCRequestHeader(data[offset:])
+                stub.append(fragment['pduData'])
+                offset  += fragment['frag_len']
             # Serve the opnum requested, if not, fails
-            if request['op_num'] in self._listenUUIDS[self._boundUUID]['CallBacks']:
+            if request['op_num'] in self._listenUUIDS[boundUUID]['CallBacks']:
                 # Call the function 
-                returnData          = self._listenUUIDS[self._boundUUID]['CallBacks'][request['op_num']](request['pduData'])
+                returnData          = self._listenUUIDS[boundUUID]['CallBacks'][request['op_num']](b''.join(stub))
                 response['pduData'] = returnData
             else:
-                LOG.error('Unsupported DCERPC opnum %d called for interface %s' % (request['op_num'], bin_to_uuidtup(self._boundUUID)))
+                LOG.error('Unsupported DCERPC opnum %d called for interface %s' % (request['op_num'], bin_to_uuidtup(boundUUID)))
                 response['type']    = MSRPC_FAULT
                 response['pduData'] = pack('<L',0x000006E4)
             response['frag_len'] = len(response)
@@ -379,9 +379,16 @@ class TCPTransport(DCERPCTransport):
 
     def recv(self, forceRecv = 0, count = 0):
         if count:
-            buffer = b''
-            while len(buffer) < count:
-               buffer += self.__socket.recv(count-len(buffer))
+            # Exactly count bytes, straight into a buffer of that size
+            buffer = bytearray(count)
+            view = memoryview(buffer)
+            received = 0
+            while received < count:
+                nbytes = self.__socket.recv_into(view[received:])
+                if nbytes == 0:
+                    raise DCERPCException('Connection closed by the remote end')
+                received += nbytes
+            return bytes(buffer)
         else:
             buffer = self.__socket.recv(8192)
         return buffer
@@ -28,6 +28,10 @@
 
 from __future__ import division
 from __future__ import print_function
+import hashlib
+import json
+import mmap
+import os
 from impacket import LOG
 try:
     from collections import OrderedDict
@@ -37,8 +41,8 @@ except:
     except:
         from ordereddict import OrderedDict
 from impacket.structure import Structure, hexdump
-from struct import unpack
-from binascii import hexlify
+from struct import pack, unpack
+from binascii import hexlify, unhexlify
 from six import b
 
 # Constants
@@ -151,6 +155,24 @@ ColumnTypeSize = {
     JET_coltypMax          : None,
 }
 
+# Index keys. Every column value in a key starts with a prefix byte. Fixed size values are
+# stored big endian, with the sign bit flipped for signed types so keys compare as bytes.
+# Binary values are split in chunks, each one followed by the amount of bytes used in it,
+# or KEY_BINARY_CHUNK+1 if more chunks follow
+KEY_PREFIX_ZERO_LENGTH = 0x40
+KEY_PREFIX_DATA        = 0x7f
+KEY_BINARY_CHUNK       = 8
+
+KeyNormalization = {
+    JET_coltypUnsignedByte : ('>B', False),
+    JET_coltypShort        : ('>h', True),
+    JET_coltypLong         : ('>l', True),
+    JET_coltypCurrency     : ('>q', True),
+    JET_coltypUnsignedLong : ('>L', False),
+    JET_coltypLongLong     : ('>q', True),
+    JET_coltypUnsignedShort: ('>H', False),
+}
+
 # Tagged Data Type Flags
 TAGGED_DATA_TYPE_VARIABLE_SIZE = 1
 TAGGED_DATA_TYPE_COMPRESSED    = 2
@@ -171,11 +193,25 @@ StringCodePages = {
 
 # Structures
 
+# Page cache defaults. The budget is in bytes, read-ahead in pages
+PAGE_CACHE_SIZE = 64*1024*1024
+PAGE_READ_AHEAD = 64
+
+# Sidecar index file format version. Bump it whenever its content changes
+SIDECAR_VERSION = 1
+
 TABLE_CURSOR = {
     'TableData' : b'',
     'FatherDataPageNumber': 0,
     'CurrentPageData' : b'',
+    'CurrentPageNumber' : 0,
     'CurrentTag' : 0,
+    'LeafPages' : None,
+    'LeafPageIndex' : 0,
+    'IndexFatherDataPageNumber' : 0,
+    'SeekLow' : None,
+    'SeekHigh' : None,
+    'Layout' : None,
 }
 
 class ESENT_JET_SIGNATURE(Structure):
@@ -573,16 +609,215 @@ class ESENT_PAGE:
         #return pageFlags, self.data[baseOffset+valueOffset:][:valueSize]
         return pageFlags, tagData
 
+class ESENT_RECORD_LAYOUT:
+    # Where to find a set of columns inside the records of a table, computed once per table
+    # and set of columns. Column kinds:
+    FIXED    = 0
+    VARIABLE = 1
+    TAGGED   = 2
+    def __init__(self, dbHeader, columns, names = None):
+        self.names = []
+        self.columns = []
+        fixedSizeOffset = len(ESENT_DATA_DEFINITION_HEADER())
+        for column in list(columns.keys()):
+            columnRecord = columns[column]['Record']
+            identifier = columnRecord['Identifier']
+            if identifier <= 127:
+                location = (self.FIXED, identifier, fixedSizeOffset, columnRecord['SpaceUsage'])
+                fixedSizeOffset += columnRecord['SpaceUsage']
+            elif identifier <= 255:
+                location = (self.VARIABLE, identifier, identifier - 127 - 1, 0)
+            else:
+                location = (self.TAGGED, identifier, 0, 0)
+
+            if names is not None and column not in names:
+                continue
+            if columnRecord['ColumnType'] == JET_coltypText or columnRecord['ColumnType'] == JET_coltypLongText:
+                decoder = StringCodePages.get(columnRecord['CodePage'], None)
+            else:
+                decoder = None
+            self.names.append(column)
+            self.columns.append(location + (columnRecord['ColumnType'], columnRecord['CodePage'], decoder))
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+        # As of Windows 7 and later ( version 0x620 revision 0x11) the tagged data type flags are always present
+        self.taggedFlagsPresent = dbHeader['Version'] == 0x620 and dbHeader['FileFormatRevision'] >= 17 and \
+                                  dbHeader['PageSize'] > 8192
+
+# Marks the record values not decoded yet
+NOT_DECODED = object()
+
+class ESENT_RECORD(object):
+    # Table record returned by cursors opened with a list of columns. Behaves like a read only
+    # dictionary, but a column is only decoded the first time it's accessed
+    __slots__ = ('__layout', '__data', '__values', '__taggedItems')
+
+    def __init__(self, layout, data):
+        self.__layout = layout
+        self.__data = data
+        self.__values = [NOT_DECODED] * len(layout.names)
+        self.__taggedItems = None
+
+    def __getitem__(self, column):
+        position = self.__layout.positions[column]
+        value = self.__values[position]
+        if value is NOT_DECODED:
+            value = self.__decodeColumn(column, self.__layout.columns[position])
+            self.__values[position] = value
+        return value
+
+    def get(self, column, default = None):
+        if column in self.__layout.positions:
+            return self[column]
+        return default
+
+    def __contains__(self, column):
+        return column in self.__layout.positions
+
+    def __iter__(self):
+        return iter(self.__layout.names)
+
+    def __len__(self):
+        return len(self.__layout.names)
+
+    def keys(self):
+        return list(self.__layout.names)
+
+    def values(self):
+        return [self[column] for column in self.__layout.names]
+
+    def items(self):
+        return [(column, self[column]) for column in self.__layout.names]
+
+    def __repr__(self):
+        return repr(OrderedDict(self.items()))
+
+    def __parseTaggedItems(self, taggedDataOffset):
+        # Tagged items array: identifier, offset (and flags) for every tagged value in the record
+        data = self.__data
+        dataLen = len(data)
+        taggedItems = {}
+        if taggedDataOffset >= dataLen:
+            return taggedItems
+        index = taggedDataOffset
+        firstOffsetTag = (unpack('<H', data[index+2:][:2])[0] & 0x3fff) + taggedDataOffset
+        previous = None
+        while True:
+            taggedIdentifier, taggedOffset = unpack('<HH', data[index:][:4])
+            index += 4
+            if self.__layout.taggedFlagsPresent is True:
+                flagsPresent = 1
+            else:
+                flagsPresent = taggedOffset & 0x4000
+            taggedOffset &= 0x3fff
+            if previous is not None:
+                taggedItems[previous[0]] = (previous[1], taggedOffset - previous[1], previous[2])
+            previous = (taggedIdentifier, taggedOffset, flagsPresent)
+            if index >= firstOffsetTag:
+                break
+        taggedItems[previous[0]] = (previous[1], dataLen, previous[2])
+        return taggedItems
+
+    def __decodeColumn(self, column, location):
+        kind, identifier, offset, size, columnType, codePage, decoder = location
+        data = self.__data
+        lastFixedSize = ord(data[0:1])
+        lastVariableDataType = ord(data[1:2])
+        variableSizeOffset = unpack('<H', data[2:4])[0]
+
+        value = None
+        if kind == ESENT_RECORD_LAYOUT.FIXED:
+            if identifier <= lastFixedSize:
+                value = data[offset:offset+size]
+        elif kind == ESENT_RECORD_LAYOUT.VARIABLE:
+            if identifier <= lastVariableDataType:
+                itemLen = unpack('<H', data[variableSizeOffset+offset*2:][:2])[0]
+                if itemLen & 0x8000 == 0:
+                    if offset > 0:
+                        prevItemLen = unpack('<H', data[variableSizeOffset+(offset-1)*2:][:2])[0] & 0x7fff
+                    else:
+                        prevItemLen = 0
+                    valuesOffset = variableSizeOffset + (lastVariableDataType - 127) * 2
+                    value = data[valuesOffset+prevItemLen:valuesOffset+itemLen]
+        else:
+            # Tagged values start right after the variable size ones
+            taggedDataOffset = variableSizeOffset + (lastVariableDataType - 127) * 2
+            if lastVariableDataType > 127:
+                taggedDataOffset += unpack('<H', data[taggedDataOffset-2:taggedDataOffset])[0] & 0x7fff
+            if self.__taggedItems is None:
+                self.__taggedItems = self.__parseTaggedItems(taggedDataOffset)
+            if identifier in self.__taggedItems:
+                itemOffset, itemSize, flagsPresent = self.__taggedItems[identifier]
+                offsetItem = taggedDataOffset + itemOffset
+                # If item have flags, we should skip them
+                if flagsPresent > 0:
+                    itemFlag = ord(data[offsetItem:offsetItem+1])
+                    offsetItem += 1
+                    itemSize -= 1
+                else:
+                    itemFlag = 0
+
+                if itemFlag & TAGGED_DATA_TYPE_COMPRESSED:
+                    LOG.error('Unsupported tag column: %s, flag:0x%x' % (column, itemFlag))
+                    return None
+                elif itemFlag & TAGGED_DATA_TYPE_MULTI_VALUE:
+                    # ToDo: Parse multi-values properly
+                    LOG.debug('Multivalue detected in column %s, returning raw results' % (column))
+                    return hexlify(data[offsetItem:][:itemSize])
+                value = data[offsetItem:][:itemSize]
+
+        if value is None:
+            return None
+
+        # Same decoding ESENT_DB does for full records
+        if columnType == JET_coltypText or columnType == JET_coltypLongText:
+            if decoder is None:
+                raise Exception('Unknown codepage 0x%x'% codePage)
+            try:
+                return value.decode(decoder)
+            except Exception:
+                LOG.debug("Exception:", exc_info=True)
+                LOG.debug('Fixing Record[%r][%d]: %r' % (column, columnType, value))
+                return value.decode(decoder, "replace")
+        unpackData = ColumnTypeSize[columnType]
+        if unpackData is None:
+            return hexlify(value)
+        return unpack(unpackData[1], value)[0]
+
 class ESENT_DB:
-    def __init__(self, fileName, pageSize = 8192, isRemote = False):
+    def __init__(self, fileName, pageSize = 8192, isRemote = False, cacheSize = PAGE_CACHE_SIZE,
+                 readAhead = PAGE_READ_AHEAD, sidecarFile = None, useMmap = True):
         self.__fileName = fileName
         self.__pageSize = pageSize
         self.__DB = None
+        # Local databases are mapped (unless useMmap is False), pages are then sliced out of it
+        # without any seek()/read()
+        self.__useMmap = useMmap
+        self.__mmap = None
         self.__DBHeader = None
         self.__totalPages = None
         self.__tables = OrderedDict()
         self.__currentTable = None
         self.__isRemote = isRemote
+        # Least recently used pages are evicted once cacheSize bytes worth of pages are cached.
+        # Entries are ESENT_PAGE objects, or the raw page data for pages brought by a read-ahead
+        # and not used yet
+        self.__cacheSize = cacheSize
+        self.__readAhead = readAhead
+        self.__pageCache = OrderedDict()
+        self.__cacheStats = {
+            'Hits'          : 0,
+            'Misses'        : 0,
+            'Evictions'     : 0,
+            'Reads'         : 0,
+            'ReadAheadPages': 0,
+        }
+        # If sidecarFile is specified, the catalog entries and each table leaf pages and row counts
+        # are saved there, and loaded back instead of walking the database the next time. The
+        # sidecar is tied to the database header and size, it's rebuilt when any of them changes
+        self.__sidecarFile = sidecarFile
+        self.__sidecarKey = None
+        self.__catalogEntries = []
+        self.__tableIndex = {}
         self.mountDB()
 
     def mountDB(self):
@@ -592,6 +827,11 @@ class ESENT_DB:
             self.__DB.open()
         else:
             self.__DB = open(self.__fileName,"rb")
+            if self.__useMmap is True:
+                try:
+                    self.__mmap = mmap.mmap(self.__DB.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError) as e:
+                    LOG.debug('Cannot map %s (%s), falling back to file reads' % (self.__fileName, str(e)))
         mainHeader = self.getPage(-1)
         self.__DBHeader = ESENT_DB_HEADER(mainHeader)
         self.__pageSize = self.__DBHeader['PageSize']
@@ -600,7 +840,70 @@ class ESENT_DB:
         LOG.debug("Database Version:0x%x, Revision:0x%x"% (self.__DBHeader['Version'], self.__DBHeader['FileFormatRevision']))
         LOG.debug("Page Size: %d" % self.__pageSize)
         LOG.debug("Total Pages in file: %d" % self.__totalPages)
-        self.parseCatalog(CATALOG_PAGE_NUMBER)
+        self.__sidecarKey = {
+            'Signature' : hexlify(self.__DBHeader['DBSignature'].getData()).decode('utf-8'),
+            'Header'    : hashlib.sha1(mainHeader).hexdigest(),
+            'PageSize'  : self.__pageSize,
+            'TotalPages': self.__totalPages,
+        }
+        if self.__loadSidecar() is False:
+            self.parseCatalog(CATALOG_PAGE_NUMBER)
+            self.__saveSidecar()
+
+    def __loadSidecar(self):
+        if self.__sidecarFile is None:
+            return False
+
+        try:
+            with open(self.__sidecarFile, 'r') as f:
+                sidecar = json.load(f)
+        except (IOError, OSError):
+            LOG.debug('Sidecar index %s not found' % self.__sidecarFile)
+            return False
+        except ValueError:
+            LOG.debug('Sidecar index %s is corrupt, rebuilding it' % self.__sidecarFile)
+            return False
+
+        if not isinstance(sidecar, dict) or sidecar.get('Version') != SIDECAR_VERSION or \
+                sidecar.get('Key') != self.__sidecarKey:
+            LOG.debug('Sidecar index %s belongs to another database version, rebuilding it' % self.__sidecarFile)
+            return False
+
+        try:
+            for flags, data in sidecar['Catalog']:
+                self.__addCatalogEntry(flags, unhexlify(data))
+            for tableName, tableIndex in sidecar['Tables'].items():
+                self.__tableIndex[tableName.encode('latin-1')] = tableIndex
+        except Exception as e:
+            LOG.debug('Sidecar index %s is corrupt (%s), rebuilding it' % (self.__sidecarFile, str(e)))
+            self.__tables = OrderedDict()
+            self.__currentTable = None
+            self.__catalogEntries = []
+            self.__tableIndex = {}
+            return False
+
+        LOG.debug('Catalog loaded from sidecar index %s' % self.__sidecarFile)
+        return True
+
+    def __saveSidecar(self):
+        if self.__sidecarFile is None:
+            return
+
+        sidecar = {
+            'Version': SIDECAR_VERSION,
+            'Key'    : self.__sidecarKey,
+            'Catalog': [(flags, hexlify(data).decode('utf-8')) for flags, data in self.__catalogEntries],
+            'Tables' : dict((tableName.decode('latin-1'), tableIndex) for tableName, tableIndex in
+                            self.__tableIndex.items()),
+        }
+        # Write it aside and move it in place, so a reader never sees half of it
+        tmpFileName = '%s.%d.tmp' % (self.__sidecarFile, os.getpid())
+        try:
+            with open(tmpFileName, 'w') as f:
+                json.dump(sidecar, f)
+            os.replace(tmpFileName, self.__sidecarFile)
+        except (IOError, OSError) as e:
+            LOG.error('Cannot write sidecar index %s: %s' % (self.__sidecarFile, str(e)))
 
     def printCatalog(self):
         indent = '    '
@@ -632,6 +935,7 @@ class ESENT_DB:
             self.__tables[itemName]['Columns']    = OrderedDict()
             self.__tables[itemName]['Indexes']    = OrderedDict()
             self.__tables[itemName]['LongValues'] = OrderedDict()
+            self.__tables[itemName]['Layouts']    = {}
             self.__currentTable = itemName
         elif catalogEntry['Type'] == CATALOG_TYPE_COLUMN:
             self.__tables[self.__currentTable]['Columns'][itemName] = entry
@@ -676,8 +980,12 @@ class ESENT_DB:
                     pass
                 else:
                     # Table Value
-                    leafEntry = ESENT_LEAF_ENTRY(flags, data)
-                    self.__addItem(leafEntry)
+                    self.__addCatalogEntry(flags, data)
+
+    def __addCatalogEntry(self, flags, data):
+        # Catalog entries are kept raw as well, for the sidecar index
+        self.__catalogEntries.append((flags, data))
+        self.__addItem(ESENT_LEAF_ENTRY(flags, data))
 
     def parseCatalog(self, pageNum):
         # Parse all the pages starting at pageNum and commit table data
@@ -695,33 +1003,192 @@ class ESENT_DB:
     def readHeader(self):
         LOG.debug("Reading Boot Sector for %s" % self.__volumeName)
 
-    def getPage(self, pageNum):
-        LOG.debug("Trying to fetch page %d (0x%x)" % (pageNum, (pageNum+1)*self.__pageSize))
+    def __readPages(self, pageNum, count):
+        # Reads count consecutive pages starting at pageNum with a single request
+        LOG.debug("Trying to fetch %d page(s) from %d (0x%x)" % (count, pageNum, (pageNum+1)*self.__pageSize))
+        self.__cacheStats['Reads'] += 1
+        size = count*self.__pageSize
+        if self.__mmap is not None:
+            offset = (pageNum+1)*self.__pageSize
+            end = min(offset + size, len(self.__mmap))
+            pages = [self.__mmap[i:i+self.__pageSize] for i in range(offset, end - self.__pageSize + 1, self.__pageSize)]
+            if len(pages) == 0:
+                raise Exception('Page %d is beyond the end of the file' % pageNum)
+            return pages
+
         self.__DB.seek((pageNum+1)*self.__pageSize, 0)
-        data = self.__DB.read(self.__pageSize)
-        while len(data) < self.__pageSize:
-            remaining = self.__pageSize - len(data)
-            data += self.__DB.read(remaining)
+        data = self.__DB.read(size)
+        while len(data) < size:
+            remaining = self.__DB.read(size - len(data))
+            if len(remaining) == 0:
+                if len(data) < self.__pageSize:
+                    raise Exception('Page %d is beyond the end of the file' % pageNum)
+                # Read-ahead went past the end of the file, keep the complete pages
+                break
+            data += remaining
+        return [data[i:i+self.__pageSize] for i in range(0, len(data) - self.__pageSize + 1, self.__pageSize)]
+
+    def __cachePage(self, pageNum, page):
+        cache = self.__pageCache
+        cache[pageNum] = page
+        cache.move_to_end(pageNum)
+        while len(cache)*self.__pageSize > self.__cacheSize:
+            cache.popitem(last=False)
+            self.__cacheStats['Evictions'] += 1
+
+    def getPage(self, pageNum, readAhead = 1):
         # Special case for the first page
         if pageNum <= 0:
-            return data
-        else:
-            return ESENT_PAGE(self.__DBHeader, data)
+            return self.__readPages(pageNum, 1)[0]
+
+        cache = self.__pageCache
+        page = cache.get(pageNum)
+        if page is not None:
+            self.__cacheStats['Hits'] += 1
+            if isinstance(page, ESENT_PAGE) is False:
+                page = ESENT_PAGE(self.__DBHeader, page)
+                cache[pageNum] = page
+            cache.move_to_end(pageNum)
+            return page
+
+        self.__cacheStats['Misses'] += 1
+        if self.__mmap is not None:
+            # Nothing to save by reading ahead from the mapping, the kernel already does it
+            readAhead = 1
+        # Don't read ahead more than what the cache can hold, nor past the end of the file
+        readAhead = min(readAhead, self.__cacheSize // self.__pageSize)
+        if self.__totalPages is not None:
+            readAhead = min(readAhead, self.__totalPages - pageNum + 1)
+        pages = self.__readPages(pageNum, max(readAhead, 1))
+        page = ESENT_PAGE(self.__DBHeader, pages[0])
+        for i in range(len(pages)-1, 0, -1):
+            if (pageNum + i) not in cache:
+                self.__cacheStats['ReadAheadPages'] += 1
+                self.__cachePage(pageNum + i, pages[i])
+        if self.__cacheSize >= self.__pageSize:
+            self.__cachePage(pageNum, page)
+        return page
+
+    def getCacheStats(self):
+        # Returns the page cache counters, plus the amount of pages and bytes cached
+        stats = self.__cacheStats.copy()
+        stats['CachedPages'] = len(self.__pageCache)
+        stats['CachedBytes'] = len(self.__pageCache)*self.__pageSize
+        return stats
 
     def close(self):
+        LOG.debug("Page cache stats: %s" % ', '.join('%s: %d' % item for item in self.getCacheStats().items()))
+        self.__pageCache.clear()
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
         self.__DB.close()
 
-    def openTable(self, tableName):
-        # Returns a cursos for later use
+    def __getTableCatalogEntry(self, tableName):
+        entry = self.__tables[tableName]['TableEntry']
+        dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(entry['EntryData'])
+        return ESENT_CATALOG_DATA_DEFINITION_ENTRY(entry['EntryData'][len(dataDefinitionHeader):])
+
+    def getLeafPages(self, tableName):
+        # Returns the numbers of the leaf pages holding the table records, in the same order
+        # getNextRow() walks them. The whole tree is read (and cached) the first time
+        if isinstance(tableName, bytes) is not True:
+            tableName = b(tableName)
+
+        if tableName not in self.__tables:
+            return None
+
+        if tableName in self.__tableIndex:
+            return list(self.__tableIndex[tableName]['LeafPages'])
+
+        leafPages = []
+        pending = [self.__getTableCatalogEntry(tableName)['FatherDataPageNumber']]
+        while len(pending) > 0:
+            pageNum = pending.pop()
+            page = self.getPage(pageNum)
+            if page.record['PageFlags'] & FLAGS_LEAF > 0:
+                leafPages.append(pageNum)
+                continue
+            children = []
+            for i in range(1, page.record['FirstAvailablePageTag']):
+                flags, data = page.getTag(i)
+                children.append(ESENT_BRANCH_ENTRY(flags, data)['ChildPageNumber'])
+            # Leftmost child goes last, so it's the next one popped
+            pending.extend(reversed(children))
+
+        self.__tableIndex[tableName] = {'LeafPages': leafPages}
+        self.__saveSidecar()
+        return list(leafPages)
+
+    def getRowCount(self, tableName):
+        # Returns the amount of records in the table. Every leaf page is read the first time,
+        # the counts are kept (and saved in the sidecar index) for later
+        if isinstance(tableName, bytes) is not True:
+            tableName = b(tableName)
+
+        if tableName not in self.__tables:
+            return None
+
+        leafPages = self.getLeafPages(tableName)
+        tableIndex = self.__tableIndex[tableName]
+        if 'RowCounts' not in tableIndex:
+            rowCounts = []
+            prevPageNum = 0
+            for pageNum in leafPages:
+                if pageNum == prevPageNum + 1:
+                    page = self.getPage(pageNum, readAhead = self.__readAhead)
+                else:
+                    page = self.getPage(pageNum)
+                rowCounts.append(max(page.record['FirstAvailablePageTag'] - 1, 0))
+                prevPageNum = pageNum
+            tableIndex['RowCounts'] = rowCounts
+            self.__saveSidecar()
+        return sum(tableIndex['RowCounts'])
+
+    def __getLayout(self, tableData, columns):
+        # Record layouts are computed once per table and set of columns (None meaning all of them)
+        if columns is not None:
+            columns = frozenset(columns)
+        layouts = tableData['Layouts']
+        if columns not in layouts:
+            layouts[columns] = ESENT_RECORD_LAYOUT(self.__DBHeader, tableData['Columns'], columns)
+        return layouts[columns]
+
+    def openTable(self, tableName, leafPages = None, columns = None):
+        # Returns a cursos for later use. If leafPages is specified, the cursor only walks
+        # those leaf pages (as returned by getLeafPages()), in order. If columns is specified,
+        # getNextRow() returns ESENT_RECORD objects with just those columns, decoded on access
 
         if isinstance(tableName, bytes) is not True:
             tableName = b(tableName)
 
         if tableName in self.__tables:
-            entry = self.__tables[tableName]['TableEntry']
-            dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(entry['EntryData'])
-            catalogEntry = ESENT_CATALOG_DATA_DEFINITION_ENTRY(entry['EntryData'][len(dataDefinitionHeader):])
-            
+            catalogEntry = self.__getTableCatalogEntry(tableName)
+
+            cursor = TABLE_CURSOR.copy()
+            cursor['TableData'] = self.__tables[tableName]
+            cursor['FatherDataPageNumber'] = catalogEntry['FatherDataPageNumber']
+            cursor['CurrentTag']  = 0
+            if columns is not None:
+                cursor['Layout'] = self.__getLayout(self.__tables[tableName], columns)
+
+            if leafPages is not None:
+                cursor['LeafPages'] = leafPages
+                cursor['LeafPageIndex'] = 0
+                if len(leafPages) > 0:
+                    cursor['CurrentPageData'] = self.getPage(leafPages[0], readAhead = self.__readAhead)
+                    cursor['CurrentPageNumber'] = leafPages[0]
+                else:
+                    cursor['CurrentPageData'] = None
+                return cursor
+
+            if tableName in self.__tableIndex and len(self.__tableIndex[tableName]['LeafPages']) > 0:
+                # We already know where the leaf level starts
+                pageNum = self.__tableIndex[tableName]['LeafPages'][0]
+                cursor['CurrentPageData'] = self.getPage(pageNum)
+                cursor['CurrentPageNumber'] = pageNum
+                return cursor
+
             # Let's position the cursor at the leaf levels for fast reading
             pageNum = catalogEntry['FatherDataPageNumber']
             done = False
@@ -741,15 +1208,155 @@ class ESENT_DB:
                         done = True
                         break
                 
-            cursor = TABLE_CURSOR
-            cursor['TableData'] = self.__tables[tableName]
-            cursor['FatherDataPageNumber'] = catalogEntry['FatherDataPageNumber']
             cursor['CurrentPageData'] = page
-            cursor['CurrentTag']  = 0
+            cursor['CurrentPageNumber'] = pageNum
             return cursor
         else:
             return None
 
+    def openIndex(self, tableName, indexName, columns = None):
+        # Returns a cursor over one of the table indexes. It must be positioned with seek() or
+        # seekRange() before calling getNextRow(), which returns the table records in index order.
+        # columns works as in openTable()
+
+        if isinstance(tableName, bytes) is not True:
+            tableName = b(tableName)
+        if isinstance(indexName, bytes) is not True:
+            indexName = b(indexName)
+
+        if tableName not in self.__tables or indexName not in self.__tables[tableName]['Indexes']:
+            return None
+
+        entry = self.__tables[tableName]['Indexes'][indexName]
+        dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(entry['EntryData'])
+        indexEntry = ESENT_CATALOG_DATA_DEFINITION_ENTRY(entry['EntryData'][len(dataDefinitionHeader):])
+
+        cursor = TABLE_CURSOR.copy()
+        cursor['TableData'] = self.__tables[tableName]
+        cursor['FatherDataPageNumber'] = self.__getTableCatalogEntry(tableName)['FatherDataPageNumber']
+        cursor['IndexFatherDataPageNumber'] = indexEntry['FatherDataPageNumber']
+        cursor['CurrentPageData'] = None
+        if columns is not None:
+            cursor['Layout'] = self.__getLayout(self.__tables[tableName], columns)
+        return cursor
+
+    def makeKey(self, tableName, columnName, value):
+        # Returns the index key for a column value. Keys for indexes over several columns are
+        # the concatenation of every column key. Text columns are not supported, since their keys
+        # are built from the Windows sort tables
+        if isinstance(tableName, bytes) is not True:
+            tableName = b(tableName)
+        if isinstance(columnName, bytes) is not True:
+            columnName = b(columnName)
+
+        columnType = self.__tables[tableName]['Columns'][columnName]['Record']['ColumnType']
+        if columnType in KeyNormalization:
+            fmt, signed = KeyNormalization[columnType]
+            key = bytearray(pack(fmt, value))
+            if signed is True:
+                key[0] ^= 0x80
+            return pack('B', KEY_PREFIX_DATA) + bytes(key)
+        elif columnType == JET_coltypBinary or columnType == JET_coltypLongBinary:
+            if len(value) == 0:
+                return pack('B', KEY_PREFIX_ZERO_LENGTH)
+            key = pack('B', KEY_PREFIX_DATA)
+            for i in range(0, len(value), KEY_BINARY_CHUNK):
+                chunk = value[i:i+KEY_BINARY_CHUNK]
+                if i + KEY_BINARY_CHUNK < len(value):
+                    key += chunk + pack('B', KEY_BINARY_CHUNK + 1)
+                else:
+                    key += chunk + b'\x00'*(KEY_BINARY_CHUNK-len(chunk)) + pack('B', len(chunk))
+            return key
+        else:
+            raise Exception('Keys for %s columns are not supported' % ColumnTypeToName[columnType])
+
+    def seek(self, cursor, key):
+        # Positions an index cursor on the records whose key starts with key
+        self.seekRange(cursor, key, key)
+
+    def seekRange(self, cursor, low, high):
+        # Positions an index cursor on the records with low <= key, and a key not greater than
+        # high when truncated to its length (so high also matches longer keys starting with it)
+        pageNum, page = self.__findLeafPage(cursor['IndexFatherDataPageNumber'], low)
+        cursor['CurrentPageData'] = page
+        cursor['CurrentPageNumber'] = pageNum
+        cursor['CurrentTag'] = 0
+        cursor['SeekLow'] = low
+        cursor['SeekHigh'] = high
+
+    def __getEntryKey(self, page, flags, entry):
+        # Rebuilds the full key of a leaf or branch entry. Compressed keys share a prefix with the
+        # page common key, kept on tag 0 of non root pages
+        if flags & TAG_COMMON > 0 and page.record['PageFlags'] & FLAGS_ROOT == 0:
+            pageFlags, commonKey = page.getTag(0)
+            return commonKey[:entry['CommonPageKeySize']] + entry['LocalPageKey']
+        return entry['LocalPageKey']
+
+    def __findLeafPage(self, pageNum, key):
+        # Descends the B-tree rooted at pageNum, down to the leaf page where key is or would be.
+        # Every branch entry key is greater or equal than the keys in its child
+        while True:
+            page = self.getPage(pageNum)
+            if page.record['PageFlags'] & FLAGS_LEAF > 0:
+                return pageNum, page
+            for i in range(1, page.record['FirstAvailablePageTag']):
+                flags, data = page.getTag(i)
+                branchEntry = ESENT_BRANCH_ENTRY(flags, data)
+                pageNum = branchEntry['ChildPageNumber']
+                if self.__getEntryKey(page, flags, branchEntry) >= key:
+                    break
+
+    def __getRecordData(self, pageNum, key):
+        # Returns the data of the leaf entry with the given key, in the B-tree rooted at pageNum
+        pageNum, page = self.__findLeafPage(pageNum, key)
+        while True:
+            for i in range(1, page.record['FirstAvailablePageTag']):
+                flags, data = page.getTag(i)
+                leafEntry = ESENT_LEAF_ENTRY(flags, data)
+                entryKey = self.__getEntryKey(page, flags, leafEntry)
+                if entryKey == key:
+                    return leafEntry['EntryData']
+                elif entryKey > key:
+                    return None
+            if page.record['NextPageNumber'] == 0:
+                return None
+            page = self.getPage(page.record['NextPageNumber'])
+
+    def __getNextIndexRow(self, cursor, filter_tables = None):
+        while True:
+            page = cursor['CurrentPageData']
+            cursor['CurrentTag'] += 1
+            if cursor['CurrentTag'] >= page.record['FirstAvailablePageTag']:
+                if page.record['NextPageNumber'] == 0:
+                    cursor['CurrentPageData'] = None
+                    return None
+                cursor['CurrentPageNumber'] = page.record['NextPageNumber']
+                cursor['CurrentPageData'] = self.getPage(cursor['CurrentPageNumber'])
+                cursor['CurrentTag'] = 0
+                continue
+
+            flags, data = page.getTag(cursor['CurrentTag'])
+            leafEntry = ESENT_LEAF_ENTRY(flags, data)
+            entryKey = self.__getEntryKey(page, flags, leafEntry)
+            if entryKey < cursor['SeekLow']:
+                continue
+            if entryKey[:len(cursor['SeekHigh'])] > cursor['SeekHigh']:
+                # Past the range, chau
+                cursor['CurrentPageData'] = None
+                return None
+
+            if cursor['IndexFatherDataPageNumber'] == cursor['FatherDataPageNumber']:
+                # Primary index, the entry is the record itself
+                record = leafEntry['EntryData']
+            else:
+                # Secondary index entries point to the record primary key
+                indexEntry = ESENT_INDEX_ENTRY(leafEntry['EntryData'])
+                record = self.__getRecordData(cursor['FatherDataPageNumber'], indexEntry['RecordPageKey'])
+                if record is None:
+                    LOG.debug('Record for index key %s not found' % hexlify(entryKey))
+                    continue
+            return self.__tagToRecord(cursor, record, filter_tables = filter_tables)
+
     def __getNextTag(self, cursor):
         page = cursor['CurrentPageData']
 
@@ -774,6 +1381,13 @@ class ESENT_DB:
         return None
 
     def getNextRow(self, cursor, filter_tables = None):
+        if cursor['CurrentPageData'] is None:
+            # Empty leaf pages list, or index cursor not positioned
+            return None
+
+        if cursor['SeekLow'] is not None:
+            return self.__getNextIndexRow(cursor, filter_tables = filter_tables)
+
         cursor['CurrentTag'] += 1
 
         tag = self.__getNextTag(cursor)
@@ -782,11 +1396,26 @@ class ESENT_DB:
         if tag is None:
             # No more tags in this page, search for the next one on the right
             page = cursor['CurrentPageData']
-            if page.record['NextPageNumber'] == 0:
+            if cursor['LeafPages'] is not None:
+                cursor['LeafPageIndex'] += 1
+                if cursor['LeafPageIndex'] >= len(cursor['LeafPages']):
+                    nextPageNumber = 0
+                else:
+                    nextPageNumber = cursor['LeafPages'][cursor['LeafPageIndex']]
+            else:
+                nextPageNumber = page.record['NextPageNumber']
+            if nextPageNumber == 0:
                 # No more pages, chau
                 return None
             else:
-                cursor['CurrentPageData'] = self.getPage(page.record['NextPageNumber'])
+                # Leaf pages are usually allocated in runs. If we're walking one, read the next pages along
+                pageNum = nextPageNumber
+                if pageNum == cursor['CurrentPageNumber'] + 1:
+                    readAhead = self.__readAhead
+                else:
+                    readAhead = 1
+                cursor['CurrentPageData'] = self.getPage(pageNum, readAhead = readAhead)
+                cursor['CurrentPageNumber'] = pageNum
                 cursor['CurrentTag'] = 0
                 return self.getNextRow(cursor, filter_tables = filter_tables)
         else:
@@ -812,145 +1441,13 @@ class ESENT_DB:
         # saving space. That's why I got over all the columns, and if I find data (of any type), i assign it. If 
         # not, the column's empty.
         #
-        # There are a lot of caveats in the code, so take your time to explore it. 
-        #
-        # ToDo: Better complete this description
+        # ESENT_RECORD does the actual parsing, through the column locations in ESENT_RECORD_LAYOUT.
         #
 
-        record = OrderedDict()
-        taggedItems = OrderedDict()
-        taggedItemsParsed = False
-
-        dataDefinitionHeader = ESENT_DATA_DEFINITION_HEADER(tag)
-        #dataDefinitionHeader.dump()
-        variableDataBytesProcessed = (dataDefinitionHeader['LastVariableDataType'] - 127) * 2
-        prevItemLen = 0
-        tagLen = len(tag)
-        fixedSizeOffset = len(dataDefinitionHeader)
-        variableSizeOffset = dataDefinitionHeader['VariableSizeOffset'] 
- 
-        columns = cursor['TableData']['Columns'] 
-        
-        for column in list(columns.keys()):
-            if filter_tables is not None:
-                if column not in filter_tables:
-                    continue
-            columnRecord = columns[column]['Record']
-            #columnRecord.dump()
-            if columnRecord['Identifier'] <= dataDefinitionHeader['LastFixedSize']:
-                # Fixed Size column data type, still available data
-                record[column] = tag[fixedSizeOffset:][:columnRecord['SpaceUsage']]
-                fixedSizeOffset += columnRecord['SpaceUsage']
-
-            elif 127 < columnRecord['Identifier'] <= dataDefinitionHeader['LastVariableDataType']:
-                # Variable data type
-                index = columnRecord['Identifier'] - 127 - 1
-                itemLen = unpack('<H',tag[variableSizeOffset+index*2:][:2])[0]
-
-                if itemLen & 0x8000:
-                    # Empty item
-                    itemLen = prevItemLen
-                    record[column] = None
-                else:
-                    itemValue = tag[variableSizeOffset+variableDataBytesProcessed:][:itemLen-prevItemLen]
-                    record[column] = itemValue
-
-                #if columnRecord['Identifier'] <= dataDefinitionHeader['LastVariableDataType']:
-                variableDataBytesProcessed +=itemLen-prevItemLen
-
-                prevItemLen = itemLen
-
-            elif columnRecord['Identifier'] > 255:
-                # Have we parsed the tagged items already?
-                if taggedItemsParsed is False and (variableDataBytesProcessed+variableSizeOffset) < tagLen:
-                    index = variableDataBytesProcessed+variableSizeOffset
-                    #hexdump(tag[index:])
-                    endOfVS = self.__pageSize
-                    firstOffsetTag = (unpack('<H', tag[index+2:][:2])[0] & 0x3fff) + variableDataBytesProcessed+variableSizeOffset
-                    while True:
-                        taggedIdentifier = unpack('<H', tag[index:][:2])[0]
-                        index += 2
-                        taggedOffset = (unpack('<H', tag[index:][:2])[0] & 0x3fff) 
-                        # As of Windows 7 and later ( version 0x620 revision 0x11) the 
-                        # tagged data type flags are always present
-                        if self.__DBHeader['Version'] == 0x620 and self.__DBHeader['FileFormatRevision'] >= 17 and self.__DBHeader['PageSize'] > 8192: 
-                            flagsPresent = 1
-                        else:
-                            flagsPresent = (unpack('<H', tag[index:][:2])[0] & 0x4000)
-                        index += 2
-                        if taggedOffset < endOfVS:
-                            endOfVS = taggedOffset
-                        taggedItems[taggedIdentifier] = (taggedOffset, tagLen, flagsPresent)
-                        #print "ID: %d, Offset:%d, firstOffset:%d, index:%d, flag: 0x%x" % (taggedIdentifier, taggedOffset,firstOffsetTag,index, flagsPresent)
-                        if index >= firstOffsetTag:
-                            # We reached the end of the variable size array
-                            break
-                
-                    # Calculate length of variable items
-                    # Ugly.. should be redone
-                    prevKey = list(taggedItems.keys())[0]
-                    for i in range(1,len(taggedItems)):
-                        offset0, length, flags = taggedItems[prevKey]
-                        offset, _, _ = list(taggedItems.items())[i][1]
-                        taggedItems[prevKey] = (offset0, offset-offset0, flags)
-                        #print "ID: %d, Offset: %d, Len: %d, flags: %d" % (prevKey, offset0, offset-offset0, flags)
-                        prevKey = list(taggedItems.keys())[i]
-                    taggedItemsParsed = True
- 
-                # Tagged data type
-                if columnRecord['Identifier'] in taggedItems:
-                    offsetItem = variableDataBytesProcessed + variableSizeOffset + taggedItems[columnRecord['Identifier']][0] 
-                    itemSize = taggedItems[columnRecord['Identifier']][1]
-                    # If item have flags, we should skip them
-                    if taggedItems[columnRecord['Identifier']][2] > 0:
-                        itemFlag = ord(tag[offsetItem:offsetItem+1])
-                        offsetItem += 1
-                        itemSize -= 1
-                    else:
-                        itemFlag = 0
-
-                    #print "ID: %d, itemFlag: 0x%x" %( columnRecord['Identifier'], itemFlag)
-                    if itemFlag & (TAGGED_DATA_TYPE_COMPRESSED ):
-                        LOG.error('Unsupported tag column: %s, flag:0x%x' % (column, itemFlag))
-                        record[column] = None
-                    elif itemFlag & TAGGED_DATA_TYPE_MULTI_VALUE:
-                        # ToDo: Parse multi-values properly
-                        LOG.debug('Multivalue detected in column %s, returning raw results' % (column))
-                        record[column] = (hexlify(tag[offsetItem:][:itemSize]),)
-                    else:
-                        record[column] = tag[offsetItem:][:itemSize]
-
-                else:
-                    record[column] = None
-            else:
-                record[column] = None
-
-            # If we understand the data type, we unpack it and cast it accordingly
-            # otherwise, we just encode it in hex
-            if type(record[column]) is tuple:
-                # A multi value data, we won't decode it, just leave it this way
-                record[column] = record[column][0]
-            elif columnRecord['ColumnType'] == JET_coltypText or columnRecord['ColumnType'] == JET_coltypLongText: 
-                # Let's handle strings
-                if record[column] is not None:
-                    if columnRecord['CodePage'] not in StringCodePages:
-                        raise Exception('Unknown codepage 0x%x'% columnRecord['CodePage'])
-                    stringDecoder = StringCodePages[columnRecord['CodePage']]
-
-                    try:
-                        record[column] = record[column].decode(stringDecoder)
-                    except Exception:
-                        LOG.debug("Exception:", exc_info=True)
-                        LOG.debug('Fixing Record[%r][%d]: %r' % (column, columnRecord['ColumnType'], record[column]))
-                        record[column] = record[column].decode(stringDecoder, "replace")
-                        pass
-            else:
-                unpackData = ColumnTypeSize[columnRecord['ColumnType']]
-                if record[column] is not None:
-                    if unpackData is None:
-                        record[column] = hexlify(record[column])
-                    else:
-                        unpackStr = unpackData[1]
-                        record[column] = unpack(unpackStr, record[column])[0]
+        if cursor['Layout'] is not None:
+            # Cursor opened with a list of columns, they're decoded when accessed
+            return ESENT_RECORD(cursor['Layout'], tag)
 
-        return record
+        # Otherwise every column (or the ones in filter_tables) is decoded right away
+        layout = self.__getLayout(cursor['TableData'], filter_tables)
+        return OrderedDict(ESENT_RECORD(layout, tag).items())
@@ -145,7 +145,8 @@ class DCSYNCRelayClient(ProtocolClient):
         self.endpoint_uuid = drsuapi.MSRPC_UUID_DRSUAPI
 
         LOG.debug("Connecting to ncacn_ip_tcp:%s[135] to determine %s stringbinding" % (target.netloc, self.endpoint))
-        self.stringbinding = epm.hept_map(target.netloc, self.endpoint_uuid, protocol='ncacn_ip_tcp')
+        self.stringbinding = epm.hept_map(target.netloc, self.endpoint_uuid, protocol='ncacn_ip_tcp',
+                                          cache=epm.EPM_CACHE)
 
         LOG.debug("%s stringbinding is %s" % (self.endpoint, self.stringbinding))
 
@@ -160,7 +161,12 @@ class DCSYNCRelayClient(ProtocolClient):
 
         self.session = MYDCERPC_v5(rpctransport)
         self.session.set_auth_level(rpcrt.RPC_C_AUTHN_LEVEL_PKT_PRIVACY)
-        self.session.connect()
+        try:
+            self.session.connect()
+        except:
+            # The target might have been restarted since the endpoint was resolved
+            epm.EPM_CACHE.invalidate(self.target.netloc, self.endpoint_uuid, 'ncacn_ip_tcp')
+            raise
 
         return True
 
@@ -330,10 +336,14 @@ class DCSYNCRelayClient(ProtocolClient):
             # We're in NTLMv1, not supported
             return STATUS_ACCESS_DENIED
 
-        binding = epm.hept_map(self.target.netloc, nrpc.MSRPC_UUID_NRPC, protocol='ncacn_ip_tcp')
+        binding = epm.hept_map(self.target.netloc, nrpc.MSRPC_UUID_NRPC, protocol='ncacn_ip_tcp', cache=epm.EPM_CACHE)
 
         dce = transport.DCERPCTransportFactory(binding).get_dce_rpc()
-        dce.connect()
+        try:
+            dce.connect()
+        except:
+            epm.EPM_CACHE.invalidate(self.target.netloc, nrpc.MSRPC_UUID_NRPC, 'ncacn_ip_tcp')
+            raise
         dce.bind(nrpc.MSRPC_UUID_NRPC)
         MAX_ATTEMPTS = 6000
         for attempt in range(0, MAX_ATTEMPTS):
@@ -142,7 +142,8 @@ class RPCRelayClient(ProtocolClient):
                 raise NotImplementedError("Not implemented!")
         else:
             LOG.debug("Connecting to ncacn_ip_tcp:%s[135] to determine %s stringbinding" % (target.netloc, self.endpoint))
-            self.stringbinding = epm.hept_map(target.netloc, self.endpoint_uuid, protocol='ncacn_ip_tcp')
+            self.stringbinding = epm.hept_map(target.netloc, self.endpoint_uuid, protocol='ncacn_ip_tcp',
+                                              cache=epm.EPM_CACHE)
 
         LOG.debug("%s stringbinding is %s" % (self.endpoint, self.stringbinding))
 
@@ -157,7 +158,13 @@ class RPCRelayClient(ProtocolClient):
 
         self.session = MYDCERPC_v5(rpctransport)
         self.session.set_auth_level(RPC_C_AUTHN_LEVEL_CONNECT)
-        self.session.connect()
+        try:
+            self.session.connect()
+        except:
+            if not self.serverConfig.rpc_use_smb:
+                # The target might have been restarted since the endpoint was resolved
+                epm.EPM_CACHE.invalidate(self.target.netloc, self.endpoint_uuid, 'ncacn_ip_tcp')
+            raise
 
         if self.serverConfig.rpc_use_smb:
             LOG.info("Authentication to smb://%s:%d succeeded" % (self.target.netloc, self.serverConfig.rpc_smb_port))
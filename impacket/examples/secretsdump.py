@@ -53,6 +53,7 @@ import codecs
 import json
 import hashlib
 import logging
+import multiprocessing
 import ntpath
 import os
 import re
@@ -113,6 +114,11 @@ except NotImplementedError:
     rand = random
     pass
 
+# RemoteFile reads aligned blocks of this size (or MaxReadSize if smaller), and keeps up to
+# REMOTE_FILE_CACHE_SIZE bytes of them
+REMOTE_FILE_BLOCK_SIZE = 64*1024
+REMOTE_FILE_CACHE_SIZE = 32*1024*1024
+
 # Structures
 # Taken from https://insecurety.net/?p=768
 class SAM_KEY_DATA(Structure):
@@ -317,12 +323,25 @@ def openFile(fileName, mode='w+', openFileFunc=None):
 
 # Classes
 class RemoteFile:
-    def __init__(self, smbConnection, fileName):
+    def __init__(self, smbConnection, fileName, blockSize = REMOTE_FILE_BLOCK_SIZE, cacheSize = REMOTE_FILE_CACHE_SIZE):
         self.__smbConnection = smbConnection
         self.__fileName = fileName
         self.__tid = self.__smbConnection.connectTree('ADMIN$')
         self.__fid = None
         self.__currentOffset = 0
+        self.__fileSize = None
+        # Reads are served from a LRU cache of aligned blocks. Missing blocks next to each other
+        # are fetched together, with a single (multi-credit) read of up to MaxReadSize bytes
+        self.__blockSize = blockSize
+        self.__cacheSize = cacheSize
+        self.__maxReadSize = None
+        self.__blocks = OrderedDict()
+        self.__cacheStats = {
+            'Reads'         : 0,
+            'RoundTrips'    : 0,
+            'BytesRequested': 0,
+            'BytesFetched'  : 0,
+        }
 
     def open(self):
         tries = 0
@@ -344,18 +363,83 @@ class RemoteFile:
                 break
 
     def seek(self, offset, whence):
-        # Implement whence, for now it's always from the beginning of the file
         if whence == 0:
             self.__currentOffset = offset
+        elif whence == 1:
+            self.__currentOffset += offset
+        elif whence == 2:
+            if self.__fileSize is None:
+                self.__fileSize = self.__smbConnection.queryInfo(self.__tid, self.__fid)['EndOfFile']
+            self.__currentOffset = self.__fileSize + offset
+
+    def __fetchBlocks(self, firstBlock, count):
+        # One round trip for count consecutive blocks. Blocks past the end of the file come back empty
+        data = self.__smbConnection.readFile(self.__tid, self.__fid, firstBlock*self.__blockSize,
+                                             count*self.__blockSize, singleCall=False)
+        self.__cacheStats['RoundTrips'] += 1
+        self.__cacheStats['BytesFetched'] += len(data)
+        for i in range(count):
+            self.__blocks[firstBlock+i] = data[i*self.__blockSize:(i+1)*self.__blockSize]
+            self.__blocks.move_to_end(firstBlock+i)
 
     def read(self, bytesToRead):
-        if bytesToRead > 0:
-            data =  self.__smbConnection.readFile(self.__tid, self.__fid, self.__currentOffset, bytesToRead)
-            self.__currentOffset += len(data)
-            return data
-        return b''
+        if bytesToRead <= 0:
+            return b''
+
+        self.__cacheStats['Reads'] += 1
+        self.__cacheStats['BytesRequested'] += bytesToRead
+        if self.__maxReadSize is None:
+            self.__maxReadSize = self.__smbConnection.getIOCapabilities()['MaxReadSize']
+            self.__blockSize = min(self.__blockSize, self.__maxReadSize)
+
+        blockSize = self.__blockSize
+        firstBlock = self.__currentOffset // blockSize
+        lastBlock = (self.__currentOffset + bytesToRead - 1) // blockSize
+
+        # Fetch the missing blocks, merging the adjacent ones up to MaxReadSize
+        maxBlocks = max(1, self.__maxReadSize // blockSize)
+        missing = None
+        for block in range(firstBlock, lastBlock + 2):
+            if block <= lastBlock and block not in self.__blocks:
+                if missing is None:
+                    missing = block
+                if block - missing + 1 < maxBlocks:
+                    continue
+                self.__fetchBlocks(missing, block - missing + 1)
+                missing = None
+            elif missing is not None:
+                self.__fetchBlocks(missing, block - missing)
+                missing = None
+
+        data = b''
+        for block in range(firstBlock, lastBlock + 1):
+            blockData = self.__blocks[block]
+            self.__blocks.move_to_end(block)
+            if block == firstBlock:
+                blockData = blockData[self.__currentOffset - block*blockSize:]
+            data += blockData
+            if len(self.__blocks[block]) < blockSize:
+                # End of the file
+                break
+        data = data[:bytesToRead]
+
+        while len(self.__blocks)*blockSize > self.__cacheSize and len(self.__blocks) > 1:
+            self.__blocks.popitem(last=False)
+
+        self.__currentOffset += len(data)
+        return data
+
+    def getCacheStats(self):
+        # Returns the block cache counters. Without the cache, every read() would have been a round trip
+        stats = self.__cacheStats.copy()
+        stats['RoundTripsSaved'] = stats['Reads'] - stats['RoundTrips']
+        stats['CachedBlocks'] = len(self.__blocks)
+        return stats
 
     def close(self):
+        if len(self.__blocks) > 0 or self.__cacheStats['Reads'] > 0:
+            LOG.debug("%s cache stats: %s" % (self, ', '.join('%s: %d' % item for item in self.getCacheStats().items())))
+            self.__blocks.clear()
         if self.__fid is not None:
             self.__smbConnection.closeFile(self.__tid, self.__fid)
             self.__smbConnection.deleteFile('ADMIN$', self.__fileName)
@@ -447,7 +531,7 @@ class RemoteOperations:
 
     def __connectDrds(self):
         stringBinding = epm.hept_map(self.__smbConnection.getRemoteHost(), drsuapi.MSRPC_UUID_DRSUAPI,
-                                     protocol='ncacn_ip_tcp')
+                                     protocol='ncacn_ip_tcp', cache=epm.EPM_CACHE)
         rpc = transport.DCERPCTransportFactory(stringBinding)
         rpc.setRemoteHost(self.__smbConnection.getRemoteHost())
         rpc.setRemoteName(self.__smbConnection.getRemoteName())
@@ -459,7 +543,12 @@ class RemoteOperations:
         self.__drsr.set_auth_level(RPC_C_AUTHN_LEVEL_PKT_PRIVACY)
         if self.__doKerberos:
             self.__drsr.set_auth_type(RPC_C_AUTHN_GSS_NEGOTIATE)
-        self.__drsr.connect()
+        try:
+            self.__drsr.connect()
+        except:
+            # The server might have been restarted since the endpoint was resolved
+            epm.EPM_CACHE.invalidate(self.__smbConnection.getRemoteHost(), drsuapi.MSRPC_UUID_DRSUAPI, 'ncacn_ip_tcp')
+            raise
         # Uncomment these lines if you want to play some tricks
         # This will make the dump way slower tho.
         #self.__drsr.bind(samr.MSRPC_UUID_SAMR)
@@ -1936,6 +2025,36 @@ class ResumeSessionMgrInFile(object):
             self.__resumeFile = None
 
 
+# Offline NTDS.DIT dumping with several processes. Every worker keeps its own NTDSHashes instance
+# (and database handle) around. What it would have printed, written or logged is recorded as
+# events, handed back to the parent and replayed there in the same order the serial dump would
+# have produced them
+_ntdsWorker = None
+
+class NTDSWorkerOutputFile:
+    def __init__(self, events, fileIndex):
+        self.__events = events
+        self.__fileIndex = fileIndex
+
+    def write(self, data):
+        self.__events.append(('write', self.__fileIndex, data))
+
+    def flush(self):
+        pass
+
+class NTDSWorkerLogHandler(logging.Handler):
+    def __init__(self, events):
+        logging.Handler.__init__(self)
+        self.__events = events
+        self.__formatter = logging.Formatter()
+
+    def emit(self, record):
+        message = record.getMessage()
+        if record.exc_info:
+            message += '\n' + self.__formatter.formatException(record.exc_info)
+        self.__events.append(('log', record.levelno, message))
+
+
 class NTDSHashes:
     class SECRET_TYPE:
         NTDS = 0
@@ -2059,18 +2178,18 @@ class NTDSHashes:
                  useVSSMethod=False, justNTLM=False, pwdLastSet=False, resumeSession=None, outputFileName=None,
                  justUser=None, skipUser=None,ldapFilter=None, printUserStatus=False,
                  perSecretCallback = lambda secretType, secret : _print_helper(secret),
-                 resumeSessionMgr=ResumeSessionMgrInFile):
+                 resumeSessionMgr=ResumeSessionMgrInFile, workers=1, indexFile=None):
         self.__bootKey = bootKey
         self.__NTDS = ntdsFile
+        self.__isRemote = isRemote
+        self.__workers = workers
+        self.__indexFile = indexFile
         self.__history = history
         self.__noLMHash = noLMHash
         self.__useVSSMethod = useVSSMethod
         self.__remoteOps = remoteOps
         self.__pwdLastSet = pwdLastSet
         self.__printUserStatus = printUserStatus
-        if self.__NTDS is not None:
-            self.__ESEDB = ESENT_DB(ntdsFile, isRemote = isRemote)
-            self.__cursor = self.__ESEDB.openTable('datatable')
         self.__tmpUsers = list()
         self.__PEK = list()
         self.__cryptoCommon = CryptoCommon()
@@ -2103,6 +2222,12 @@ class NTDSHashes:
 
         }
 
+        if self.__NTDS is not None:
+            # Only the columns above get decoded. If indexFile is specified, the catalog and the
+            # datatable leaf pages are kept there for the next runs
+            self.__ESEDB = ESENT_DB(ntdsFile, isRemote = isRemote, sidecarFile = indexFile)
+            self.__cursor = self.__ESEDB.openTable('datatable', columns=self.__filter_tables_usersecret)
+
     def getResumeSessionFile(self):
         return self.__resumeSession.getFileName()
 
@@ -2619,50 +2744,27 @@ class NTDSHashes:
                 self.__getPek()
                 if self.__PEK is not None:
                     LOG.info('Reading and decrypting hashes from %s ' % self.__NTDS)
-                    # First of all, if we have users already cached, let's decrypt their hashes
-                    for record in self.__tmpUsers:
-                        try:
-                            self.__decryptHash(record, outputFile=hashesOutputFile)
-                            if self.__justNTLM is False:
-                                self.__decryptSupplementalInfo(record, None, keysOutputFile, clearTextOutputFile)
-                        except Exception as e:
-                            LOG.debug('Exception', exc_info=True)
+                    if self.__justUser is not None:
+                        self.__dumpUser(hashesOutputFile, keysOutputFile, clearTextOutputFile)
+                    elif self.__workers > 1 and self.__isRemote is False:
+                        self.__dumpParallel(hashesOutputFile, keysOutputFile, clearTextOutputFile)
+                    else:
+                        # First of all, if we have users already cached, let's decrypt their hashes
+                        for record in self.__tmpUsers:
+                            self.__decryptRecord(record, hashesOutputFile, keysOutputFile, clearTextOutputFile)
+
+                        # Now let's keep moving through the NTDS file and decrypting what we find
+                        while True:
                             try:
-                                LOG.error(
-                                    "Error while processing row for user %s" % record[self.NAME_TO_INTERNAL['name']])
-                                LOG.error(str(e))
-                                pass
+                                record = self.__ESEDB.getNextRow(self.__cursor, filter_tables=self.__filter_tables_usersecret)
                             except:
-                                LOG.error("Error while processing row!")
-                                LOG.error(str(e))
-                                pass
-
-                    # Now let's keep moving through the NTDS file and decrypting what we find
-                    while True:
-                        try:
-                            record = self.__ESEDB.getNextRow(self.__cursor, filter_tables=self.__filter_tables_usersecret)
-                        except:
-                            LOG.error('Error while calling getNextRow(), trying the next one')
-                            continue
+                                LOG.error('Error while calling getNextRow(), trying the next one')
+                                continue
 
-                        if record is None:
-                            break
-                        try:
+                            if record is None:
+                                break
                             if record[self.NAME_TO_INTERNAL['sAMAccountType']] in self.ACCOUNT_TYPES:
-                                self.__decryptHash(record, outputFile=hashesOutputFile)
-                                if self.__justNTLM is False:
-                                    self.__decryptSupplementalInfo(record, None, keysOutputFile, clearTextOutputFile)
-                        except Exception as e:
-                            LOG.debug('Exception', exc_info=True)
-                            try:
-                                LOG.error(
-                                    "Error while processing row for user %s" % record[self.NAME_TO_INTERNAL['name']])
-                                LOG.error(str(e))
-                                pass
-                            except:
-                                LOG.error("Error while processing row!")
-                                LOG.error(str(e))
-                                pass
+                                self.__decryptRecord(record, hashesOutputFile, keysOutputFile, clearTextOutputFile)
             else:
                 LOG.info('Using the DRSUAPI method to get NTDS.DIT secrets')
                 status = STATUS_MORE_ENTRIES
@@ -2874,6 +2976,170 @@ class NTDSHashes:
 
             self.__resumeSession.endTransaction()
 
+    def __decryptRecord(self, record, hashesOutputFile, keysOutputFile, clearTextOutputFile):
+        try:
+            self.__decryptHash(record, outputFile=hashesOutputFile)
+            if self.__justNTLM is False:
+                self.__decryptSupplementalInfo(record, None, keysOutputFile, clearTextOutputFile)
+        except Exception as e:
+            LOG.debug('Exception', exc_info=True)
+            try:
+                LOG.error(
+                    "Error while processing row for user %s" % record[self.NAME_TO_INTERNAL['name']])
+                LOG.error(str(e))
+                pass
+            except:
+                LOG.error("Error while processing row!")
+                LOG.error(str(e))
+                pass
+
+    def __seekUserSid(self, userSid):
+        # Looks the SID up in the objectSid index. NTDS.DIT stores the sub authorities big endian
+        indexName = 'INDEX_%08X' % int(self.NAME_TO_INTERNAL['objectSid'][4:])
+        cursor = self.__ESEDB.openIndex('datatable', indexName, columns=self.__filter_tables_usersecret)
+        if cursor is None:
+            LOG.debug('%s index not found' % indexName)
+            return []
+
+        fields = userSid.upper().split('-')
+        subAuthorities = [int(subAuthority) for subAuthority in fields[3:]]
+        sid = pack('>BB', int(fields[1]), len(subAuthorities)) + pack('>Q', int(fields[2]))[2:]
+        sid += pack('>%dL' % len(subAuthorities), *subAuthorities)
+        self.__ESEDB.seek(cursor, self.__ESEDB.makeKey('datatable', self.NAME_TO_INTERNAL['objectSid'], sid))
+
+        records = []
+        while True:
+            record = self.__ESEDB.getNextRow(cursor, filter_tables=self.__filter_tables_usersecret)
+            if record is None:
+                break
+            records.append(record)
+        return records
+
+    def __isJustUser(self, record):
+        if record[self.NAME_TO_INTERNAL['sAMAccountType']] not in self.ACCOUNT_TYPES:
+            return False
+        if self.__justUser.upper().startswith('S-1-'):
+            if record[self.NAME_TO_INTERNAL['objectSid']] is None:
+                return False
+            sid = SAMR_RPC_SID(unhexlify(record[self.NAME_TO_INTERNAL['objectSid']]))
+            return sid.formatCanonical() == self.__justUser.upper()
+        userName = self.__justUser.replace('/', '\\').split('\\')[-1]
+        return record[self.NAME_TO_INTERNAL['sAMAccountName']] is not None and \
+               record[self.NAME_TO_INTERNAL['sAMAccountName']].lower() == userName.lower()
+
+    def __dumpUser(self, hashesOutputFile, keysOutputFile, clearTextOutputFile):
+        # A SID can be looked up through the objectSid index. Names can't, since text index keys are
+        # built with the Windows sort tables, so they (and SIDs not found in the index) need a scan
+        records = []
+        if self.__justUser.upper().startswith('S-1-'):
+            try:
+                records = [record for record in self.__seekUserSid(self.__justUser) if self.__isJustUser(record)]
+            except Exception as e:
+                LOG.debug('Exception', exc_info=True)
+                LOG.debug('objectSid index lookup failed: %s' % str(e))
+
+        if len(records) == 0:
+            LOG.info('Searching for %s, be patient' % self.__justUser)
+            records = [record for record in self.__tmpUsers if self.__isJustUser(record)]
+            while True:
+                try:
+                    record = self.__ESEDB.getNextRow(self.__cursor, filter_tables=self.__filter_tables_usersecret)
+                except:
+                    LOG.error('Error while calling getNextRow(), trying the next one')
+                    continue
+
+                if record is None:
+                    break
+                if self.__isJustUser(record):
+                    records.append(record)
+
+        if len(records) == 0:
+            LOG.error('%s not found in %s' % (self.__justUser, self.__NTDS))
+
+        for record in records:
+            self.__decryptRecord(record, hashesOutputFile, keysOutputFile, clearTextOutputFile)
+
+    def __dumpParallel(self, hashesOutputFile, keysOutputFile, clearTextOutputFile):
+        # The datatable leaf pages are split in contiguous chunks, decrypted by the workers and
+        # replayed here in order. The users found while searching for the pekList are on those
+        # pages as well, so they don't need to be processed here
+        self.__tmpUsers = list()
+        leafPages = self.__ESEDB.getLeafPages('datatable')
+        # A few chunks per worker to balance the load, not too big so results don't pile up in memory
+        chunkSize = max(1, min(256, len(leafPages) // (self.__workers * 4)))
+        chunks = [leafPages[i:i+chunkSize] for i in range(0, len(leafPages), chunkSize)]
+        LOG.debug('Decrypting %d leaf pages in %d chunks with %d workers' % (len(leafPages), len(chunks),
+                                                                               self.__workers))
+
+        options = {
+            'history'         : self.__history,
+            'noLMHash'        : self.__noLMHash,
+            'justNTLM'        : self.__justNTLM,
+            'pwdLastSet'      : self.__pwdLastSet,
+            'printUserStatus' : self.__printUserStatus,
+            'indexFile'       : self.__indexFile,
+        }
+        outputFiles = (hashesOutputFile, keysOutputFile, clearTextOutputFile)
+        with multiprocessing.Pool(self.__workers, NTDSHashes._workerInit,
+                                  (self.__NTDS, self.__bootKey, self.__PEK, options, LOG.getEffectiveLevel())) as pool:
+            for events in pool.imap(NTDSHashes._workerDecrypt, chunks):
+                for event in events:
+                    if event[0] == 'secret':
+                        self.__perSecretCallback(event[1], event[2])
+                    elif event[0] == 'write':
+                        if outputFiles[event[1]] is not None:
+                            self.__writeOutput(outputFiles[event[1]], event[2])
+                    elif event[0] == 'kerberos':
+                        self.__kerberosKeys[event[1]] = None
+                    elif event[0] == 'cleartext':
+                        self.__clearTextPwds[event[1]] = None
+                    else:
+                        LOG.log(event[1], event[2])
+                for outputFile in outputFiles:
+                    if outputFile is not None:
+                        outputFile.flush()
+
+    @staticmethod
+    def _workerInit(ntdsFile, bootKey, pek, options, logLevel):
+        # Runs once in every worker process
+        global _ntdsWorker
+        events = list()
+        LOG.handlers = [NTDSWorkerLogHandler(events)]
+        LOG.propagate = False
+        LOG.setLevel(logLevel)
+        worker = NTDSHashes(ntdsFile, bootKey, useVSSMethod=True,
+                            perSecretCallback=lambda secretType, secret: events.append(('secret', secretType, secret)),
+                            **options)
+        worker.__PEK = pek
+        del events[:]
+        _ntdsWorker = (worker, events)
+
+    @staticmethod
+    def _workerDecrypt(leafPages):
+        worker, events = _ntdsWorker
+        del events[:]
+        hashesOutputFile, keysOutputFile, clearTextOutputFile = [NTDSWorkerOutputFile(events, i) for i in range(3)]
+        cursor = worker.__ESEDB.openTable('datatable', leafPages=leafPages, columns=worker.__filter_tables_usersecret)
+        while True:
+            try:
+                record = worker.__ESEDB.getNextRow(cursor, filter_tables=worker.__filter_tables_usersecret)
+            except:
+                LOG.error('Error while calling getNextRow(), trying the next one')
+                continue
+
+            if record is None:
+                break
+            if record[NTDSHashes.NAME_TO_INTERNAL['sAMAccountType']] in NTDSHashes.ACCOUNT_TYPES:
+                worker.__decryptRecord(record, hashesOutputFile, keysOutputFile, clearTextOutputFile)
+                # The parent collects the Kerberos keys and cleartext passwords, keeping the order
+                for answer in worker.__kerberosKeys:
+                    events.append(('kerberos', answer))
+                for answer in worker.__clearTextPwds:
+                    events.append(('cleartext', answer))
+                worker.__kerberosKeys.clear()
+                worker.__clearTextPwds.clear()
+        return list(events)
+
     @classmethod
     def __writeOutput(cls, fd, data):
         try:
@@ -890,8 +890,10 @@ class NetBIOSTCPSession(NetBIOSSession):
         self.__select_poll = select_poll
         if self.__select_poll:
             self.read_function = self.polling_read
+            self.read_into_function = self.polling_read_into
         else:
             self.read_function = self.non_polling_read
+            self.read_into_function = self.non_polling_read_into
         NetBIOSSession.__init__(self, myname, remote_name, remote_host, remote_type=remote_type, sess_port=sess_port,
                                 timeout=timeout, local_type=local_type, sock=sock)
 
@@ -914,12 +916,11 @@ class NetBIOSTCPSession(NetBIOSSession):
         self._sock.sendall(p.rawData())
 
     def recv_packet(self, timeout = None):
-        data = self.__read(timeout)
-        NBSPacket = NetBIOSSessionPacket(data)
-        if NBSPacket.get_type() == NETBIOS_SESSION_KEEP_ALIVE:
-            # Discard packet
-            return self.recv_packet(timeout)
-        return NetBIOSSessionPacket(data)
+        while True:
+            data = self.__read(timeout)
+            # Discard keep alive packets
+            if indexbytes(data, 0) != NETBIOS_SESSION_KEEP_ALIVE:
+                return NetBIOSSessionPacket(data)
 
     def _request_session(self, remote_type, local_type, timeout = None):
         p = NetBIOSSessionPacket()
@@ -940,74 +941,79 @@ class NetBIOSTCPSession(NetBIOSSession):
                 pass
 
     def polling_read(self, read_length, timeout):
-        data = b''
+        data = bytearray(read_length)
+        self.polling_read_into(memoryview(data), timeout)
+        return bytes(data)
+
+    def polling_read_into(self, buffer, timeout):
+        # Fills buffer (a writable memoryview), select() tells when there's something to read
         if timeout is None:
             timeout = 3600
 
-        time_left = timeout
-        CHUNK_TIME = 0.025
-        bytes_left = read_length
+        deadline = time.time() + timeout
+        received = 0
 
-        while bytes_left > 0:
+        while received < len(buffer):
             try:
-                ready, _, _ = select.select([self._sock.fileno()], [], [], 0)
-
+                ready, _, _ = select.select([self._sock.fileno()], [], [], max(deadline - time.time(), 0))
                 if not ready:
-                    if time_left <= 0:
-                        raise NetBIOSTimeout
-                    else:
-                        time.sleep(CHUNK_TIME)
-                        time_left -= CHUNK_TIME
-                        continue
+                    raise NetBIOSTimeout
 
-                received = self._sock.recv(bytes_left)
-                if len(received) == 0:
-                    raise NetBIOSError('Error while reading from remote', ERRCLASS_OS, None)
-
-                data = data + received
-                bytes_left = read_length - len(data)
+                count = self._sock.recv_into(buffer[received:])
             except select.error as ex:
                 if ex.errno != errno.EINTR and ex.errno != errno.EAGAIN:
                     raise NetBIOSError('Error occurs while reading from remote', ERRCLASS_OS, ex.errno)
+                continue
 
-        return bytes(data)
+            if count == 0:
+                raise NetBIOSError('Error while reading from remote', ERRCLASS_OS, None)
+
+            received += count
 
     def non_polling_read(self, read_length, timeout):
-        data = b''
+        data = bytearray(read_length)
+        self.non_polling_read_into(memoryview(data), timeout)
+        return bytes(data)
+
+    def non_polling_read_into(self, buffer, timeout):
+        # Fills buffer (a writable memoryview), blocking on the socket with whatever time is left
         if timeout is None:
             timeout = 3600
 
-        start_time = time.time()
-        bytes_left = read_length
+        deadline = time.time() + timeout
+        received = 0
+
+        while received < len(buffer):
+            timeLeft = deadline - time.time()
+            if timeLeft <= 0:
+                raise NetBIOSTimeout
 
-        while bytes_left > 0:
-            self._sock.settimeout(timeout)
+            self._sock.settimeout(timeLeft)
             try:
-                received = self._sock.recv(bytes_left)
+                count = self._sock.recv_into(buffer[received:])
             except socket.timeout:
                 raise NetBIOSTimeout
             except Exception as ex:
-                raise NetBIOSError('Error occurs while reading from remote', ERRCLASS_OS, ex.errno)
-
-            if (time.time() - start_time) > timeout:
-                raise NetBIOSTimeout
+                raise NetBIOSError('Error occurs while reading from remote', ERRCLASS_OS, getattr(ex, 'errno', None))
 
-            if len(received) == 0:
+            if count == 0:
                 raise NetBIOSError('Error while reading from remote', ERRCLASS_OS, None)
 
-            data = data + received
-            bytes_left = read_length - len(data)
-
-        return bytes(data)
+            received += count
 
     def __read(self, timeout = None):
-        data = self.read_function(4, timeout)
-        type, flags, length = unpack('>ccH', data)
-        if ord(type) == NETBIOS_SESSION_MESSAGE:
-            length |= ord(flags) << 16
+        # The NetBIOS header tells how long the frame is, so it's read straight into a buffer of the right size
+        header = bytearray(4)
+        self.read_into_function(memoryview(header), timeout)
+        type, flags, length = unpack('>BBH', header)
+        if type == NETBIOS_SESSION_MESSAGE:
+            length |= flags << 16
         else:
-            if ord(flags) & 0x01:
+            if flags & 0x01:
                 length |= 0x10000
-        data2 = self.read_function(length, timeout)
 
-        return data + data2
+        data = bytearray(4 + length)
+        data[:4] = header
+        self.read_into_function(memoryview(data)[4:], timeout)
+
+        return bytes(data)
@@ -33,21 +33,28 @@
 from __future__ import division
 from __future__ import print_function
 
+import os
+import re
 import socket
 import ntpath
 import random
 import string
 import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from six import indexbytes, b
 from binascii import a2b_hex
 from contextlib import contextmanager
 from pyasn1.type.univ import noValue
 from Cryptodome.Cipher import AES
 
-from impacket import nmb, ntlm, uuid, crypto
+from impacket import nmb, ntlm, uuid, crypto, xca
 from impacket.smb3structs import *
 from impacket.nt_errors import STATUS_SUCCESS, STATUS_MORE_PROCESSING_REQUIRED, STATUS_INVALID_PARAMETER, \
-    STATUS_NO_MORE_FILES, STATUS_PENDING, STATUS_NOT_IMPLEMENTED, ERROR_MESSAGES
+    STATUS_NO_MORE_FILES, STATUS_PENDING, STATUS_NOT_IMPLEMENTED, STATUS_END_OF_FILE, STATUS_NOT_SUPPORTED, \
+    STATUS_ACCESS_DENIED, STATUS_BAD_COMPRESSION_BUFFER, ERROR_MESSAGES
 from impacket.spnego import SPNEGO_NegTokenInit, TypesMech, SPNEGO_NegTokenResp, ASN1_OID, asn1encode, ASN1_AID
 from impacket.krb5.gssapi import KRB5_AP_REQ
 
@@ -73,6 +80,9 @@ TREE_CONNECT = {
     'IsCAShare'       : False,
     'EncryptData'     : False,
     'IsScaleoutShare' : False,
+    # If the client implements the SMB 3.1.1 dialect,
+    # the client MUST also implement the following
+    'CompressData'    : False,
     # Outside the protocol
     'NumberOfUses'    : 0,
 }
@@ -117,6 +127,45 @@ CHANNEL = {
     'Connection' : 0,
 }
 
+# Max amount of bytes retrieveFile(), storeFile() and writeFile() keep in flight. The amount
+# of requests is also bounded by the credits granted by the server
+TRANSFER_WINDOW_SIZE = 8*1024*1024
+
+# FileID used by related requests in a compound, it refers to the file opened by the CREATE request
+# that comes before them in the same compound
+RELATED_FILEID = b'\xff'*16
+
+# Bytes read along with the CREATE request by retrieveFile(). Files up to this size are
+# opened, read and closed in a single round trip
+COMPOUND_READ_SIZE = 65536
+
+# Ciphers and signing algorithms offered when negotiating SMB 3.1.1, in order of preference.
+# GCM and GMAC run way faster than CCM and CMAC on CPUs with AES and carry-less multiplication instructions.
+# As Windows does, 128 bit keys go first and, for every key size, GCM before CCM
+ENCRYPTION_ALGORITHMS = [SMB2_ENCRYPTION_AES128_GCM, SMB2_ENCRYPTION_AES128_CCM, SMB2_ENCRYPTION_AES256_GCM,
+                         SMB2_ENCRYPTION_AES256_CCM]
+SIGNING_ALGORITHMS = [SMB2_SIGNING_AES_GMAC, SMB2_SIGNING_AES_CMAC, SMB2_SIGNING_HMAC_SHA256]
+
+# Compression algorithms offered when negotiating SMB 3.1.1, in order of preference. Pattern_V1
+# is only used with chained compression, for runs of zeros
+COMPRESSION_ALGORITHMS = [COMPRESSION_ALGORITHM_LZ77_HUFFMAN, COMPRESSION_ALGORITHM_LZ77,
+                          COMPRESSION_ALGORITHM_PATTERN_V1]
+# Messages smaller than this aren't compressed, and READ requests for less than this don't ask
+# for a compressed response
+COMPRESSION_MIN_SIZE = 4096
+# Shortest run of zeros sent as a Pattern_V1 payload when there's no other algorithm to compress the
+# message with. Otherwise only runs of a page or more are, the compressor takes care of shorter ones
+# for less than a payload of their own
+COMPRESSION_PATTERN_MIN_SIZE = 64
+COMPRESSION_PATTERN_MIN_PAGE = 4096
+# Largest message accepted inside a compression transform header
+COMPRESSION_MAX_SIZE = 16*1024*1024
+
+COMPRESSORS = {
+    COMPRESSION_ALGORITHM_LZ77        : (xca.lz77_compress, xca.lz77_decompress),
+    COMPRESSION_ALGORITHM_LZ77_HUFFMAN: (xca.lz77huffman_compress, xca.lz77huffman_decompress),
+}
+
 # Source:
 # https://en.wikipedia.org/wiki/List_of_Microsoft_Windows_versions
 # https://www.gaijin.at/en/infos/windows-version-numbers
@@ -182,20 +231,406 @@ class SessionError(Exception):
         return 'SMB SessionError: %s(%s)' % (ERROR_MESSAGES[self.error])
 
 
+def _compressPayload(algorithm, data):
+    # Returns data compressed with algorithm, or None if it doesn't get smaller. zlib tells
+    # quickly whether it's worth the (pure Python) compressor: already compressed or encrypted
+    # files aren't
+    if len(zlib.compress(data, 1)) >= len(data) * 0.9:
+        return None
+    compressed = COMPRESSORS[algorithm][0](data)
+    if len(compressed) >= len(data):
+        return None
+    return compressed
+
+
+NON_ZERO = re.compile(b'[^\x00]')
+
+def _zeroRuns(data, minSize):
+    # Yields (start, end) for every run of at least minSize zeros
+    zeros = b'\x00' * minSize
+    start = data.find(zeros)
+    while start >= 0:
+        nonZero = NON_ZERO.search(data, start + minSize)
+        end = len(data) if nonZero is None else nonZero.start()
+        yield start, end
+        start = data.find(zeros, end)
+
+
+def compressSMB(data, compressionIds, chained = False):
+    # Returns the message data inside an SMB2_COMPRESSION_TRANSFORM_HEADER, or None if compressing
+    # doesn't make it smaller. compressionIds are the algorithms negotiated for the connection.
+    # With chained compression runs of zeros go as Pattern_V1 payloads, and the rest is compressed
+    # with the first algorithm negotiated
+    algorithm = None
+    for compressionId in compressionIds:
+        if compressionId in COMPRESSORS:
+            algorithm = compressionId
+            break
+
+    if chained is False:
+        if algorithm is None:
+            return None
+        compressed = _compressPayload(algorithm, data)
+        if compressed is None:
+            return None
+        transformHeader = SMB2_COMPRESSION_TRANSFORM_HEADER()
+        transformHeader['ProtocolID'] = 0x424d53fc
+        transformHeader['OriginalCompressedSegmentSize'] = len(data)
+        transformHeader['CompressionAlgorithm'] = algorithm
+        transformHeader['Flags'] = SMB2_COMPRESSION_FLAG_NONE
+        transformHeader['Offset_Length'] = 0
+        if len(transformHeader) + len(compressed) >= len(data):
+            return None
+        return transformHeader.getData() + compressed
+
+    def addPayload(segment):
+        payloadHeader = SMB2_COMPRESSION_PAYLOAD_HEADER()
+        payloadHeader['Flags'] = SMB2_COMPRESSION_FLAG_CHAINED
+        compressed = None
+        if algorithm is not None and len(segment) >= COMPRESSION_PATTERN_MIN_SIZE:
+            compressed = _compressPayload(algorithm, segment)
+        if compressed is None:
+            payloadHeader['AlgorithmId'] = COMPRESSION_ALGORITHM_NONE
+            payloadHeader['Length'] = len(segment)
+            payloads.append(payloadHeader.getData() + segment)
+        else:
+            # OriginalPayloadSize is part of the payload
+            payloadHeader['AlgorithmId'] = algorithm
+            payloadHeader['Length'] = 4 + len(compressed)
+            payloads.append(payloadHeader.getData() + struct.pack('<L', len(segment)) + compressed)
+
+    payloads = []
+    position = 0
+    if COMPRESSION_ALGORITHM_PATTERN_V1 in compressionIds:
+        if algorithm is None:
+            minSize = COMPRESSION_PATTERN_MIN_SIZE
+        else:
+            minSize = max(COMPRESSION_PATTERN_MIN_SIZE, COMPRESSION_PATTERN_MIN_PAGE)
+        for start, end in _zeroRuns(data, minSize):
+            if start > position:
+                addPayload(data[position:start])
+            pattern = SMB2_COMPRESSION_PATTERN_PAYLOAD_V1()
+            pattern['Pattern'] = 0
+            pattern['Repetitions'] = end - start
+            payloadHeader = SMB2_COMPRESSION_PAYLOAD_HEADER()
+            payloadHeader['AlgorithmId'] = COMPRESSION_ALGORITHM_PATTERN_V1
+            payloadHeader['Flags'] = SMB2_COMPRESSION_FLAG_CHAINED
+            payloadHeader['Length'] = len(pattern)
+            payloads.append(payloadHeader.getData() + pattern.getData())
+            position = end
+    if position < len(data):
+        addPayload(data[position:])
+
+    transformHeader = SMB2_COMPRESSION_TRANSFORM_HEADER_CHAINED()
+    transformHeader['ProtocolID'] = 0x424d53fc
+    transformHeader['OriginalCompressedSegmentSize'] = len(data)
+    compressedData = transformHeader.getData() + b''.join(payloads)
+    if len(compressedData) >= len(data):
+        return None
+    return compressedData
+
+
+def decompressSMB(data):
+    # Returns the message inside an SMB2_COMPRESSION_TRANSFORM_HEADER, chained or not
+    transformHeader = SMB2_COMPRESSION_TRANSFORM_HEADER(data)
+    originalSize = transformHeader['OriginalCompressedSegmentSize']
+    if originalSize > COMPRESSION_MAX_SIZE:
+        raise SessionError(STATUS_BAD_COMPRESSION_BUFFER)
+
+    try:
+        if transformHeader['Flags'] & SMB2_COMPRESSION_FLAG_CHAINED == 0:
+            if (transformHeader['CompressionAlgorithm'] in COMPRESSORS) is False:
+                raise SessionError(STATUS_BAD_COMPRESSION_BUFFER)
+            offset = len(transformHeader) + transformHeader['Offset_Length']
+            return data[len(transformHeader):offset] + \
+                COMPRESSORS[transformHeader['CompressionAlgorithm']][1](data[offset:], originalSize)
+
+        # In chained messages OriginalCompressedSegmentSize is the size of the whole message
+        segments = []
+        decompressedSize = 0
+        position = len(SMB2_COMPRESSION_TRANSFORM_HEADER_CHAINED())
+        while position < len(data):
+            payloadHeader = SMB2_COMPRESSION_PAYLOAD_HEADER(data[position:])
+            position += len(payloadHeader)
+            payload = data[position:position + payloadHeader['Length']]
+            position += payloadHeader['Length']
+            if len(payload) != payloadHeader['Length']:
+                raise SessionError(STATUS_BAD_COMPRESSION_BUFFER)
+
+            if payloadHeader['AlgorithmId'] == COMPRESSION_ALGORITHM_NONE:
+                segment = payload
+            elif payloadHeader['AlgorithmId'] == COMPRESSION_ALGORITHM_PATTERN_V1:
+                pattern = SMB2_COMPRESSION_PATTERN_PAYLOAD_V1(payload)
+                if decompressedSize + pattern['Repetitions'] > originalSize:
+                    raise SessionError(STATUS_BAD_COMPRESSION_BUFFER)
+                segment = struct.pack('B', pattern['Pattern']) * pattern['Repetitions']
+            elif payloadHeader['AlgorithmId'] in COMPRESSORS:
+                payloadSize = struct.unpack('<L', payload[:4])[0]
+                if decompressedSize + payloadSize > originalSize:
+                    raise SessionError(STATUS_BAD_COMPRESSION_BUFFER)
+                segment = COMPRESSORS[payloadHeader['AlgorithmId']][1](payload[4:], payloadSize)
+            else:
+                raise SessionError(STATUS_BAD_COMPRESSION_BUFFER)
+            segments.append(segment)
+            decompressedSize += len(segment)
+
+        if decompressedSize != originalSize:
+            raise SessionError(STATUS_BAD_COMPRESSION_BUFFER)
+        return b''.join(segments)
+    except (xca.XCAError, struct.error):
+        raise SessionError(STATUS_BAD_COMPRESSION_BUFFER)
+
+
+# I/O-free parts of the [MS-SMB2] client, shared by SMB3 and asyncsmb3.AsyncSMB3. connection and session
+# are their _Connection and _Session dicts
+
+def negotiateContextList(encryptionAlgorithms, signingAlgorithms, compressionAlgorithms):
+    # Returns the number of SMB 3.1.1 negotiate contexts offering the algorithms given, in the order of
+    # preference, and their NegotiateContextList
+    # Add an SMB2_NEGOTIATE_CONTEXT with ContextType as SMB2_PREAUTH_INTEGRITY_CAPABILITIES
+    # to the negotiate request as specified in section 2.2.3.1:
+    negotiateContext = SMB2NegotiateContext()
+    negotiateContext['ContextType'] = SMB2_PREAUTH_INTEGRITY_CAPABILITIES
+
+    preAuthIntegrityCapabilities = SMB2PreAuthIntegrityCapabilities()
+    preAuthIntegrityCapabilities['HashAlgorithmCount'] = 1
+    preAuthIntegrityCapabilities['SaltLength'] = 32
+    preAuthIntegrityCapabilities['HashAlgorithms'] = b'\x01\x00'
+    preAuthIntegrityCapabilities['Salt'] = ''.join([rand.choice(string.ascii_letters) for _ in
+                                                     range(preAuthIntegrityCapabilities['SaltLength'])])
+
+    negotiateContext['Data'] = preAuthIntegrityCapabilities.getData()
+    negotiateContext['DataLength'] = len(negotiateContext['Data'])
+
+    # Add an SMB2_NEGOTIATE_CONTEXT with ContextType as SMB2_ENCRYPTION_CAPABILITIES
+    # to the negotiate request as specified in section 2.2.3.1 and initialize
+    # the Ciphers field with the ciphers supported by the client in the order of preference.
+
+    negotiateContext2 = SMB2NegotiateContext()
+    negotiateContext2['ContextType'] = SMB2_ENCRYPTION_CAPABILITIES
+
+    encryptionCapabilities = SMB2EncryptionCapabilities()
+    encryptionCapabilities['CipherCount'] = len(encryptionAlgorithms)
+    encryptionCapabilities['Ciphers'] = b''.join([struct.pack('<H', cipherId) for cipherId in
+                                                 encryptionAlgorithms])
+
+    negotiateContext2['Data'] = encryptionCapabilities.getData()
+    negotiateContext2['DataLength'] = len(negotiateContext2['Data'])
+
+    # Add an SMB2_NEGOTIATE_CONTEXT with ContextType as SMB2_SIGNING_CAPABILITIES, with the
+    # signing algorithms supported by the client in the order of preference.
+
+    negotiateContext3 = SMB2NegotiateContext()
+    negotiateContext3['ContextType'] = SMB2_SIGNING_CAPABILITIES
+
+    signingCapabilities = SMB2SigningCapabilities()
+    signingCapabilities['SigningAlgorithmCount'] = len(signingAlgorithms)
+    signingCapabilities['SigningAlgorithms'] = b''.join([struct.pack('<H', algorithmId) for
+                                                         algorithmId in signingAlgorithms])
+
+    negotiateContext3['Data'] = signingCapabilities.getData()
+    negotiateContext3['DataLength'] = len(negotiateContext3['Data'])
+    contexts = [negotiateContext, negotiateContext2, negotiateContext3]
+
+    # Add an SMB2_NEGOTIATE_CONTEXT with ContextType as SMB2_COMPRESSION_CAPABILITIES, with the
+    # compression algorithms supported by the client in the order of preference.
+    if len(compressionAlgorithms) > 0:
+        negotiateContext4 = SMB2NegotiateContext()
+        negotiateContext4['ContextType'] = SMB2_COMPRESSION_CAPABILITIES
+
+        compressionCapabilities = SMB2CompressionCapabilities()
+        compressionCapabilities['CompressionAlgorithmCount'] = len(compressionAlgorithms)
+        compressionCapabilities['Flags'] = SMB2_COMPRESSION_CAPABILITIES_FLAG_CHAINED
+        compressionCapabilities['CompressionAlgorithms'] = b''.join([struct.pack('<H', algorithmId)
+                                                                     for algorithmId in
+                                                                     compressionAlgorithms])
+
+        negotiateContext4['Data'] = compressionCapabilities.getData()
+        negotiateContext4['DataLength'] = len(negotiateContext4['Data'])
+        contexts.append(negotiateContext4)
+
+    # Subsequent negotiate contexts MUST appear at the first 8-byte aligned offset following the
+    # previous negotiate context.
+    contextList = []
+    for context in contexts:
+        if len(contextList) > 0:
+            contextList.append(b'\xFF' * ((8 - (len(contextList[-1]) % 8)) % 8))
+        contextList.append(context.getData())
+    return len(contexts), b''.join(contextList)
+
+
+def processContextList(connection, contextCount, contextList, encryptionAlgorithms, signingAlgorithms,
+                       compressionAlgorithms):
+    # The negotiate contexts answered by the server, the algorithms are the ones offered
+    offset = 0
+    while contextCount > 0:
+        context = SMB2NegotiateContext(contextList[offset:])
+        if context['ContextType'] == SMB2_PREAUTH_INTEGRITY_CAPABILITIES:
+            contextPreAuth = SMB2PreAuthIntegrityCapabilities(context['Data'])
+            connection['PreauthIntegrityHashId'] = struct.unpack('<H', contextPreAuth['HashAlgorithms'])[0]
+        elif context['ContextType'] == SMB2_ENCRYPTION_CAPABILITIES:
+            contextEncryption = SMB2EncryptionCapabilities(context['Data'])
+            cipherId = struct.unpack('<H', contextEncryption['Ciphers'][:2])[0]
+            if cipherId != 0:
+                if (cipherId in encryptionAlgorithms) is False:
+                    # The server must pick one of the ciphers we offered
+                    raise SessionError(STATUS_INVALID_PARAMETER)
+                connection['CipherId'] = cipherId
+                connection['SupportsEncryption'] = True
+        elif context['ContextType'] == SMB2_SIGNING_CAPABILITIES:
+            contextSigning = SMB2SigningCapabilities(context['Data'])
+            signingAlgorithmId = struct.unpack('<H', contextSigning['SigningAlgorithms'][:2])[0]
+            if (signingAlgorithmId in signingAlgorithms) is False:
+                raise SessionError(STATUS_INVALID_PARAMETER)
+            connection['SigningAlgorithmId'] = signingAlgorithmId
+        elif context['ContextType'] == SMB2_COMPRESSION_CAPABILITIES:
+            contextCompression = SMB2CompressionCapabilities(context['Data'])
+            compressionIds = [struct.unpack('<H', contextCompression['CompressionAlgorithms'][i*2:i*2+2])[0]
+                              for i in range(contextCompression['CompressionAlgorithmCount'])]
+            if compressionIds != [COMPRESSION_ALGORITHM_NONE]:
+                for compressionId in compressionIds:
+                    if (compressionId in compressionAlgorithms) is False:
+                        # The server must pick among the algorithms we offered
+                        raise SessionError(STATUS_INVALID_PARAMETER)
+                connection['CompressionIds'] = compressionIds
+                connection['SupportsChainedCompression'] = \
+                    (contextCompression['Flags'] & SMB2_COMPRESSION_CAPABILITIES_FLAG_CHAINED) > 0
+        elif context['ContextType'] == SMB2_NETNAME_NEGOTIATE_CONTEXT_ID:
+            pass
+
+        padding = ((8 - (context['DataLength'] % 8)) % 8)
+        offset += 8 + context['DataLength'] + padding
+        contextCount -= 1
+
+
+def signSMB(connection, session, packet, padLength = 0):
+    # padLength bytes of padding follow the packet in a compounded request, they're signed too
+    packet['Signature'] = '\x00'*16
+    if connection['Dialect'] == SMB2_DIALECT_21 or connection['Dialect'] == SMB2_DIALECT_002:
+        if len(session['SessionKey']) > 0:
+            signature = hmac.new(session['SessionKey'], packet.getData() + b'\x00'*padLength, hashlib.sha256).digest()
+            packet['Signature'] = signature[:16]
+    else:
+        if len(session['SessionKey']) > 0:
+            p = packet.getData() + b'\x00'*padLength
+            if connection['SigningAlgorithmId'] == SMB2_SIGNING_AES_GMAC:
+                # The nonce is the MessageId followed by whether this is a response and a CANCEL request
+                nonceFlags = 0
+                if packet['Flags'] & SMB2_FLAGS_SERVER_TO_REDIR:
+                    nonceFlags |= 1
+                if packet['Command'] == SMB2_CANCEL:
+                    nonceFlags |= 2
+                nonce = struct.pack('<QL', packet['MessageID'], nonceFlags)
+                signature = crypto.AES_GMAC(session['SigningKey'], nonce, p)
+            elif connection['SigningAlgorithmId'] == SMB2_SIGNING_HMAC_SHA256:
+                signature = hmac.new(session['SigningKey'], p, hashlib.sha256).digest()[:16]
+            else:
+                signature = crypto.AES_CMAC(session['SigningKey'], p, len(p))
+            packet['Signature'] = signature
+
+
+def _getCipher(connection, key, nonce):
+    # SMB 3.0 and 3.0.2 only know about AES-128-CCM
+    if connection['CipherId'] in (SMB2_ENCRYPTION_AES128_GCM, SMB2_ENCRYPTION_AES256_GCM):
+        return AES.new(key, AES.MODE_GCM, nonce[:12])
+    return AES.new(key, AES.MODE_CCM, nonce[:11])
+
+
+def _cipherKeyLength(connection):
+    # In bits, AES-256 keys are only derived in SMB 3.1.1
+    if connection['CipherId'] in (SMB2_ENCRYPTION_AES256_CCM, SMB2_ENCRYPTION_AES256_GCM):
+        return 256
+    return 128
+
+
+def encryptSMB(connection, session, plainText):
+    transformHeader = SMB2_TRANSFORM_HEADER()
+    # 12 bytes of nonce for GCM, 11 for CCM, the rest is zeroed. Never reuse one for the same key
+    if connection['CipherId'] in (SMB2_ENCRYPTION_AES128_GCM, SMB2_ENCRYPTION_AES256_GCM):
+        transformHeader['Nonce'] = os.urandom(12) + b'\x00'*4
+    else:
+        transformHeader['Nonce'] = os.urandom(11) + b'\x00'*5
+    transformHeader['OriginalMessageSize'] = len(plainText)
+    # Flags in SMB 3.1.1, 0x0001 is Encrypted. SMB 3.0 calls it EncryptionAlgorithm, same value
+    transformHeader['EncryptionAlgorithm'] = SMB2_ENCRYPTION_AES128_CCM
+    transformHeader['SessionID'] = session['SessionID']
+    cipher = _getCipher(connection, session['EncryptionKey'], transformHeader['Nonce'])
+    cipher.update(transformHeader.getData()[20:])
+    cipherText = cipher.encrypt(plainText)
+    transformHeader['Signature'] = cipher.digest()
+    return transformHeader.getData() + cipherText
+
+
+def decryptSMB(connection, session, data):
+    transformHeader = SMB2_TRANSFORM_HEADER(data)
+    cipher = _getCipher(connection, session['DecryptionKey'], transformHeader['Nonce'])
+    cipher.update(transformHeader.getData()[20:])
+    try:
+        plainText = cipher.decrypt_and_verify(data[len(transformHeader):], transformHeader['Signature'])
+    except ValueError:
+        # Wrong signature, the message was tampered with
+        raise SessionError(STATUS_ACCESS_DENIED)
+    return plainText
+
+
+def deriveSigningKey(connection, session, sessionKey):
+    # If Connection.Dialect is "3.1.1", the case-sensitive ASCII string "SMBSigningKey" as the label;
+    # otherwise, the case - sensitive ASCII string "SMB2AESCMAC" as the label.
+    # If Connection.Dialect is "3.1.1", Session.PreauthIntegrityHashValue as the context; otherwise,
+    # the case-sensitive ASCII string "SmbSign" as context for the algorithm.
+    if connection['Dialect'] == SMB2_DIALECT_311:
+        return crypto.KDF_CounterMode(sessionKey, b"SMBSigningKey\x00", session['PreauthIntegrityHashValue'], 128)
+    return crypto.KDF_CounterMode(sessionKey, b"SMB2AESCMAC\x00", b"SmbSign\x00", 128)
+
+
+def deriveCipherKeys(connection, session, sessionKey):
+    # Returns the application, encryption and decryption keys
+    # Application Key
+    # If Connection.Dialect is "3.1.1",the case-sensitive ASCII string "SMBAppKey" as the label;
+    # otherwise, the case-sensitive ASCII string "SMB2APP" as the label. Session.PreauthIntegrityHashValue
+    # as the context; otherwise, the case-sensitive ASCII string "SmbRpc" as context for the algorithm.
+    # Encryption Key
+    # If Connection.Dialect is "3.1.1",the case-sensitive ASCII string "SMBC2SCipherKey" as # the label;
+    # otherwise, the case-sensitive ASCII string "SMB2AESCCM" as the label. Session.PreauthIntegrityHashValue
+    # as the context; otherwise, the case-sensitive ASCII string "ServerIn " as context for the algorithm
+    # (note the blank space at the end)
+    # Decryption Key
+    # If Connection.Dialect is "3.1.1", the case-sensitive ASCII string "SMBS2CCipherKey" as the label;
+    # otherwise, the case-sensitive ASCII string "SMB2AESCCM" as the label. Session.PreauthIntegrityHashValue
+    # as the context; otherwise, the case-sensitive ASCII string "ServerOut" as context for the algorithm.
+    if connection['Dialect'] == SMB2_DIALECT_311:
+        return (crypto.KDF_CounterMode(sessionKey, b"SMBAppKey\x00", session['PreauthIntegrityHashValue'], 128),
+                crypto.KDF_CounterMode(sessionKey, b"SMBC2SCipherKey\x00", session['PreauthIntegrityHashValue'],
+                                       _cipherKeyLength(connection)),
+                crypto.KDF_CounterMode(sessionKey, b"SMBS2CCipherKey\x00", session['PreauthIntegrityHashValue'],
+                                       _cipherKeyLength(connection)))
+    return (crypto.KDF_CounterMode(sessionKey, b"SMB2APP\x00", b"SmbRpc\x00", 128),
+            crypto.KDF_CounterMode(sessionKey, b"SMB2AESCCM\x00", b"ServerIn \x00", 128),
+            crypto.KDF_CounterMode(sessionKey, b"SMB2AESCCM\x00", b"ServerOut\x00", 128))
+
+
 class SMB3:
     class HostnameValidationException(Exception):
         pass
 
     def __init__(self, remote_name, remote_host, my_name=None, host_type=nmb.TYPE_SERVER, sess_port=445, timeout=60,
-                 UDP=0, preferredDialect=None, session=None, negSessionResponse=None):
+                 UDP=0, preferredDialect=None, session=None, negSessionResponse=None, clientGuid=None):
 
         # [MS-SMB2] Section 3
         self.RequireMessageSigning = False    #
         self.ConnectionTable = {}
         self.GlobalFileTable = {}
-        self.ClientGuid = ''.join([random.choice(string.ascii_letters) for i in range(16)])
-        # Only for SMB 3.0
-        self.EncryptionAlgorithmList = ['AES-CCM']
+        if clientGuid is None:
+            self.ClientGuid = ''.join([random.choice(string.ascii_letters) for i in range(16)])
+        else:
+            # Alternative channels of a session must come from the same client
+            self.ClientGuid = clientGuid
+        # Only for SMB 3.x
+        self.EncryptionAlgorithmList = list(ENCRYPTION_ALGORITHMS)
+        self.SigningAlgorithmList = list(SIGNING_ALGORITHMS)
+        self.CompressionAlgorithmList = list(COMPRESSION_ALGORITHMS)
+        # WRITE requests are compressed on shares asking for it, or always if this is set
+        self.CompressAllRequests = False
         self.MaxDialect = []
         self.RequireSecureNegotiate = False
 
@@ -238,7 +673,12 @@ class SMB3:
             # it MUST also implement the following
             'PreauthIntegrityHashId': 0,
             'PreauthIntegrityHashValue': a2b_hex(b'0'*128),
-            'CipherId' : 0
+            'CipherId' : 0,
+            'SigningAlgorithmId'       : SMB2_SIGNING_AES_CMAC,
+            'CompressionIds'           : [],
+            'SupportsChainedCompression': False,
+            # Outside the protocol
+            'Credits'                  : 1,     # Granted by the server and not spent yet
         }
 
         self._Session = {
@@ -274,10 +714,26 @@ class SMB3:
         self.SMB_PACKET = SMB2Packet
 
         self._timeout = timeout
+        self._sess_port = sess_port
+        self._transferWindow = TRANSFER_WINDOW_SIZE
         self._Connection['ServerIP'] = remote_host
         self._NetBIOSSession = None
         self._preferredDialect = preferredDialect
         self._doKerberos = False
+        # The SMB3 object of the session this connection is being bound to, if any
+        self._bindingSession = None
+
+        # Requests can be sent by several threads at once. Once enableConcurrentRequests() is called, a
+        # reader thread hands the answers to the Futures in OutstandingRequests, by MessageID
+        self.__sendLock = threading.RLock()
+        self.__stateLock = threading.Condition()
+        self.__treeLock = threading.RLock()
+        self.__reader = None
+        self.__readerError = None
+        self.__inFlight = 0
+        self.__lastRequest = threading.local()
+        # MessageIDs whose answers nobody will collect, see discardAnswer()
+        self.__discarded = set()
 
         # Strict host validation - off by default
         self._strict_hostname_validation = False
@@ -409,153 +865,357 @@ class SMB3:
         return self._Connection['Dialect']
 
     def processContextList(self, contextCount, contextList):
-        offset = 0
-        while contextCount > 0:
-            context = SMB2NegotiateContext(contextList[offset:])
-            if context['ContextType'] == SMB2_PREAUTH_INTEGRITY_CAPABILITIES:
-                contextPreAuth = SMB2PreAuthIntegrityCapabilities(context['Data'])
-                self._Connection['PreauthIntegrityHashId'] = struct.unpack('<H', contextPreAuth['HashAlgorithms'])[0]
-            elif context['ContextType'] == SMB2_ENCRYPTION_CAPABILITIES:
-                contextEncryption = SMB2EncryptionCapabilities(context['Data'])
-                cipherId = struct.unpack('<H', contextEncryption['Ciphers'])[0]
-                self._Connection['CipherId'] = cipherId
-                if cipherId != 0:
-                    self._Connection['SupportsEncryption'] = True
-            elif context['ContextType'] == SMB2_COMPRESSION_CAPABILITIES:
-                pass
-            elif context['ContextType'] == SMB2_NETNAME_NEGOTIATE_CONTEXT_ID:
-                pass
+        processContextList(self._Connection, contextCount, contextList, self.EncryptionAlgorithmList,
+                           self.SigningAlgorithmList, self.CompressionAlgorithmList)
 
-            padding = ((8 - (context['DataLength'] % 8)) % 8)
-            offset = 8 + context['DataLength'] + padding
-            contextCount -= 1
-
-    def signSMB(self, packet):
-        packet['Signature'] = '\x00'*16
-        if self._Connection['Dialect'] == SMB2_DIALECT_21 or self._Connection['Dialect'] == SMB2_DIALECT_002:
-            if len(self._Session['SessionKey']) > 0:
-                signature = hmac.new(self._Session['SessionKey'], packet.getData(), hashlib.sha256).digest()
-                packet['Signature'] = signature[:16]
-        else:
-            if len(self._Session['SessionKey']) > 0:
-                p = packet.getData()
-                signature = crypto.AES_CMAC(self._Session['SigningKey'], p, len(p))
-                packet['Signature'] = signature
+    def signSMB(self, packet, padLength = 0):
+        signSMB(self._Connection, self._Session, packet, padLength)
 
-    def sendSMB(self, packet):
-        # The idea here is to receive multiple/single commands and create a compound request, and send it
-        # Should return the MessageID for later retrieval. Implement compounded related requests.
+    def __prepareSMB(self, packet):
+        # Fills the MessageID, SessionID and credits of a request. Returns its MessageID
 
         # If Connection.Dialect is equal to "3.000" and if Connection.SupportsMultiChannel or
         # Connection.SupportsPersistentHandles is TRUE, the client MUST set ChannelSequence in the
         # SMB2 header to Session.ChannelSequence
 
-        # Check this is not a CANCEL request. If so, don't consume sequence numbers
-        if packet['Command'] is not SMB2_CANCEL:
-            packet['MessageID'] = self._Connection['SequenceWindow']
-            self._Connection['SequenceWindow'] += 1
-        packet['SessionID'] = self._Session['SessionID']
-
         # Default the credit charge to 1 unless set by the caller
         if ('CreditCharge' in packet.fields) is False:
             packet['CreditCharge'] = 1
 
+        # Check this is not a CANCEL request. If so, don't consume sequence numbers
+        if packet['Command'] is not SMB2_CANCEL:
+            # In all dialects but 2.0.2, a request consumes as many message IDs as credits it's charged.
+            # Do it right away, so other requests can be sent before this one is answered
+            if self._Connection['Dialect'] > SMB2_DIALECT_002:
+                creditCharge = max(packet['CreditCharge'], 1)
+            else:
+                creditCharge = 1
+            with self.__stateLock:
+                if self.__reader is not None:
+                    self.__waitForCredits(creditCharge)
+                packet['MessageID'] = self._Connection['SequenceWindow']
+                self._Connection['SequenceWindow'] += creditCharge
+                self._Connection['Credits'] -= creditCharge
+                if self.__reader is not None:
+                    self._Connection['OutstandingRequests'][packet['MessageID']] = Future()
+                    self.__inFlight += 1
+        packet['SessionID'] = self._Session['SessionID']
+        if self._Connection['Dialect'] >= SMB2_DIALECT_30 and (self._Connection['SupportsMultiChannel'] is True or
+                                                               self._Connection['SupportsPersistentHandles'] is True):
+            packet['ChannelSequence'] = self._Session['ChannelSequence']
+
         # Standard credit request after negotiating protocol
         if self._Connection['SequenceWindow'] > 3:
             packet['CreditRequestResponse'] = 127
 
-        messageId = packet['MessageID']
+        return packet['MessageID']
+
+    def __waitForCredits(self, creditCharge):
+        # Called with __stateLock held. While other requests are in flight, waits for the server to grant
+        # the credits this one needs. If it doesn't grant them in time, the request goes anyway
+        if self.__readerError is not None:
+            raise self.__readerError
+        while self._Connection['Credits'] < creditCharge and self.__inFlight > 0:
+            if self.__stateLock.wait(self._timeout) is False:
+                break
+            if self.__readerError is not None:
+                raise self.__readerError
 
+    def __isSigningRequired(self, packet):
+        # Requests binding a channel to a session are signed with the session's key
+        if self._bindingSession is not None and packet['Command'] == SMB2_SESSION_SETUP:
+            return True
         if self._Session['SigningActivated'] is True and self._Connection['SequenceWindow'] > 2:
             if packet['TreeID'] > 0 and (packet['TreeID'] in self._Session['TreeConnectTable']) is True:
                 if self._Session['TreeConnectTable'][packet['TreeID']]['EncryptData'] is False:
-                    packet['Flags'] = SMB2_FLAGS_SIGNED
-                    self.signSMB(packet)
+                    return True
             elif packet['TreeID'] == 0:
+                return True
+        return False
+
+    def __compressSMB(self, packet, data):
+        # Only WRITE requests carry enough data to be worth compressing. Returns data as is if
+        # it doesn't compress
+        if len(self._Connection['CompressionIds']) == 0 or packet['Command'] != SMB2_WRITE or \
+                len(data) < COMPRESSION_MIN_SIZE:
+            return data
+        if self.CompressAllRequests is False and self._Session['TreeConnectTable'][packet['TreeID']]['CompressData'] is False:
+            return data
+        compressedData = compressSMB(data, self._Connection['CompressionIds'],
+                                     self._Connection['SupportsChainedCompression'])
+        if compressedData is None:
+            return data
+        return compressedData
+
+    def __isEncryptionRequired(self, treeId):
+        return (self._Session['SessionFlags'] & SMB2_SESSION_FLAG_ENCRYPT_DATA) or ( treeId != 0 and self._Session['TreeConnectTable'][treeId]['EncryptData'] is True)
+
+    def __encryptSMB(self, plainText):
+        return encryptSMB(self._Connection, self._Session, plainText)
+
+    def __decryptSMB(self, data):
+        return decryptSMB(self._Connection, self._Session, data)
+
+    def sendSMB(self, packet):
+        # Sends a single request. Should return the MessageID for later retrieval.
+        # Use sendCompound() to send several requests in the same frame
+
+        # Message IDs must go out in the same order they're taken
+        with self.__sendLock:
+            messageId = self.__prepareSMB(packet)
+
+            if self.__isSigningRequired(packet) is True:
                 packet['Flags'] = SMB2_FLAGS_SIGNED
                 self.signSMB(packet)
 
-        if packet['Command'] is SMB2_NEGOTIATE:
-            data = packet.getData()
-            self.__UpdateConnectionPreAuthHash(data)
-            self._Session['CalculatePreAuthHash'] = False
+            if packet['Command'] is SMB2_NEGOTIATE:
+                data = packet.getData()
+                self.__UpdateConnectionPreAuthHash(data)
+                self._Session['CalculatePreAuthHash'] = False
 
-        if packet['Command'] is SMB2_SESSION_SETUP:
-            self._Session['CalculatePreAuthHash'] = True
-
-        if (self._Session['SessionFlags'] & SMB2_SESSION_FLAG_ENCRYPT_DATA) or ( packet['TreeID'] != 0 and self._Session['TreeConnectTable'][packet['TreeID']]['EncryptData'] is True):
-            plainText = packet.getData()
-            transformHeader = SMB2_TRANSFORM_HEADER()
-            transformHeader['Nonce'] = ''.join([rand.choice(string.ascii_letters) for _ in range(11)])
-            transformHeader['OriginalMessageSize'] = len(plainText)
-            transformHeader['EncryptionAlgorithm'] = SMB2_ENCRYPTION_AES128_CCM
-            transformHeader['SessionID'] = self._Session['SessionID']
-            cipher = AES.new(self._Session['EncryptionKey'], AES.MODE_CCM,  b(transformHeader['Nonce']))
-            cipher.update(transformHeader.getData()[20:])
-            cipherText = cipher.encrypt(plainText)
-            transformHeader['Signature'] = cipher.digest()
-            packet = transformHeader.getData() + cipherText
-
-            self._NetBIOSSession.send_packet(packet)
-        else:
-            data = packet.getData()
-            if self._Session['CalculatePreAuthHash'] is True:
-                self.__UpdatePreAuthHash(data)
+            if packet['Command'] is SMB2_SESSION_SETUP:
+                self._Session['CalculatePreAuthHash'] = True
 
-            self._NetBIOSSession.send_packet(data)
+            try:
+                if self.__isEncryptionRequired(packet['TreeID']):
+                    # Compression goes before encryption, it's useless afterwards
+                    self._NetBIOSSession.send_packet(self.__encryptSMB(self.__compressSMB(packet, packet.getData())))
+                else:
+                    data = packet.getData()
+                    if self._Session['CalculatePreAuthHash'] is True:
+                        self.__UpdatePreAuthHash(data)
+
+                    self._NetBIOSSession.send_packet(self.__compressSMB(packet, data))
+            except Exception:
+                self.__forgetRequests([messageId])
+                raise
+        # What recvSMB() waits for if no packetID is given
+        self.__lastRequest.messageId = messageId
 
         return messageId
 
-    def recvSMB(self, packetID = None):
-        # First, verify we don't have the packet already
-        if packetID in self._Connection['OutstandingResponses']:
-            return self._Connection['OutstandingResponses'].pop(packetID)
+    def sendCompound(self, packets, related = True):
+        # Sends several requests chained in a single frame, and returns their MessageIDs.
+        # If related is True, each request operates on the same file, session and tree than the
+        # previous one. Requests working on the file opened by a previous CREATE should use RELATED_FILEID.
+        # Answers can be collected with recvSMB() or recvCompound()
+        with self.__sendLock:
+            messageIds = []
+            frame = []
+            for i, packet in enumerate(packets):
+                messageIds.append(self.__prepareSMB(packet))
+                if ('Flags' in packet.fields) is False:
+                    packet['Flags'] = 0
+                if related is True and i > 0:
+                    packet['Flags'] |= SMB2_FLAGS_RELATED_OPERATIONS
+
+                # Every request but the last one is padded to 8 bytes, NextCommand points to the following one
+                padLength = 0
+                if i + 1 < len(packets):
+                    padLength = -len(packet.getData()) % 8
+                    packet['NextCommand'] = len(packet.getData()) + padLength
+
+                if self.__isSigningRequired(packet) is True:
+                    packet['Flags'] |= SMB2_FLAGS_SIGNED
+                    self.signSMB(packet, padLength)
+
+                frame.append(packet.getData() + b'\x00'*padLength)
+
+            # The whole compound goes encrypted in a single transform header
+            try:
+                if self.__isEncryptionRequired(packets[0]['TreeID']):
+                    self._NetBIOSSession.send_packet(self.__encryptSMB(b''.join(frame)))
+                else:
+                    self._NetBIOSSession.send_packet(b''.join(frame))
+            except Exception:
+                self.__forgetRequests(messageIds)
+                raise
+
+        return messageIds
+
+    def __forgetRequests(self, packetIDs):
+        # The requests couldn't be sent, no answer will come for them
+        with self.__stateLock:
+            for packetID in packetIDs:
+                future = self._Connection['OutstandingRequests'].pop(packetID, None)
+                if future is not None and future.done() is False:
+                    future.cancel()
+                    self.__inFlight -= 1
+            self.__stateLock.notify_all()
+
+    def discardAnswer(self, packetID):
+        # For requests sent whose answer the caller won't collect with recvSMB(), e.g. because it gave up
+        # on them after an error. Whatever is kept for packetID is dropped, and so is the answer if it
+        # comes later on
+        with self.__stateLock:
+            if self._Connection['OutstandingResponses'].pop(packetID, None) is not None:
+                return
+            future = self._Connection['OutstandingRequests'].pop(packetID, None)
+            if future is not None:
+                if future.done() is True:
+                    return
+                future.cancel()
+                self.__inFlight -= 1
+                self.__stateLock.notify_all()
+            self.__discarded.add(packetID)
+
+    def __keepAnswer(self, packet):
+        # Called with __stateLock held, or from the only thread reading. Keeps an answer no one is waiting
+        # for yet in OutstandingResponses, unless the request was discarded
+        if packet['MessageID'] in self.__discarded:
+            self.__discarded.remove(packet['MessageID'])
+        else:
+            self._Connection['OutstandingResponses'][packet['MessageID']] = packet
 
-        data = self._NetBIOSSession.recv_packet(self._timeout)
+    def recvCompound(self, packetIDs):
+        # Returns the answers for packetIDs, in the same order. Errors are not checked,
+        # it's up to the caller to check each answer with isValidAnswer()
+        return [self.recvSMB(packetID) for packetID in packetIDs]
+
+    def __recvFrame(self, timeout):
+        # Receives a frame and returns the answers in it, more than one if the server answered
+        # a compounded request
+        data = self._NetBIOSSession.recv_packet(timeout)
 
         if data.get_trailer().startswith(b'\xfdSMB'):
             # Packet is encrypted
-            transformHeader = SMB2_TRANSFORM_HEADER(data.get_trailer())
-            cipher = AES.new(self._Session['DecryptionKey'], AES.MODE_CCM,  transformHeader['Nonce'][:11])
-            cipher.update(transformHeader.getData()[20:])
-            plainText = cipher.decrypt(data.get_trailer()[len(SMB2_TRANSFORM_HEADER()):])
-            #cipher.verify(transformHeader['Signature'])
-            packet = SMB2Packet(plainText)
+            plainText = self.__decryptSMB(data.get_trailer())
         else:
             # In all SMB dialects for a response this field is interpreted as the Status field.
             # This field can be set to any value. For a list of valid status codes,
             # see [MS-ERREF] section 2.3.
-            packet = SMB2Packet(data.get_trailer())
+            plainText = data.get_trailer()
+
+        if plainText.startswith(b'\xfcSMB'):
+            # Packet is compressed, it comes inside the encrypted one if both are used
+            plainText = decompressSMB(plainText)
+
+        packets = []
+        while True:
+            packet = SMB2Packet(plainText)
+            with self.__stateLock:
+                self._Connection['Credits'] += packet['CreditRequestResponse']
+            if packet['NextCommand'] == 0:
+                packets.append(packet)
+                break
+            packets.append(SMB2Packet(plainText[:packet['NextCommand']]))
+            plainText = plainText[packet['NextCommand']:]
+        return packets
+
+    def __recvPacket(self):
+        # Receives a frame and returns the first answer in it. If the server answered a compounded
+        # request, the rest of the answers are kept in OutstandingResponses
+        packets = self.__recvFrame(self._timeout)
+
+        # Interim answers are not kept, the final one will come later on
+        for packet in packets[1:]:
+            if packet['Status'] != STATUS_PENDING:
+                self.__keepAnswer(packet)
+
+        return packets[0]
+
+    def recvSMB(self, packetID = None):
+        if self.__reader is not None:
+            return self.__waitAnswer(packetID)
+
+        # First, verify we don't have the packet already
+        if packetID in self._Connection['OutstandingResponses']:
+            return self._Connection['OutstandingResponses'].pop(packetID)
+
+        packet = self.__recvPacket()
 
         # Loop while we receive pending requests
-        if packet['Status'] == STATUS_PENDING:
-            status = STATUS_PENDING
-            while status == STATUS_PENDING:
-                data = self._NetBIOSSession.recv_packet(self._timeout)
-                if data.get_trailer().startswith(b'\xfeSMB'):
-                    packet = SMB2Packet(data.get_trailer())
-                else:
-                    # Packet is encrypted
-                    transformHeader = SMB2_TRANSFORM_HEADER(data.get_trailer())
-                    cipher = AES.new(self._Session['DecryptionKey'], AES.MODE_CCM,  transformHeader['Nonce'][:11])
-                    cipher.update(transformHeader.getData()[20:])
-                    plainText = cipher.decrypt(data.get_trailer()[len(SMB2_TRANSFORM_HEADER()):])
-                    #cipher.verify(transformHeader['Signature'])
-                    packet = SMB2Packet(plainText)
-                status = packet['Status']
+        while packet['Status'] == STATUS_PENDING:
+            packet = self.__recvPacket()
 
         if packet['MessageID'] == packetID or packetID is None:
-            # Let's update the sequenceWindow based on the CreditsCharged
-            # In the SMB 2.0.2 dialect, this field MUST NOT be used and MUST be reserved.
-            # The sender MUST set this to 0, and the receiver MUST ignore it.
-            # In all other dialects, this field indicates the number of credits that this request consumes.
-            if self._Connection['Dialect'] > SMB2_DIALECT_002:
-                self._Connection['SequenceWindow'] += (packet['CreditCharge'] - 1)
+            # The message IDs consumed by multi-credit requests were already accounted for in sendSMB()
             return packet
         else:
-            self._Connection['OutstandingResponses'][packet['MessageID']] = packet
+            self.__keepAnswer(packet)
             return self.recvSMB(packetID)
 
+    def enableConcurrentRequests(self):
+        # Starts a thread reading everything the server sends and handing each answer to the request
+        # waiting for it, by MessageID. From then on several threads can use this connection at once,
+        # and a request answered with STATUS_PENDING doesn't hold up the others. The session's
+        # alternative channels get a thread of their own
+        with self.__stateLock:
+            if self.__reader is None:
+                self.__reader = threading.Thread(target=self.__dispatchAnswers, name='SMB3 reader %s' %
+                                                 self._Connection['ServerIP'])
+                self.__reader.daemon = True
+                self.__reader.start()
+        for channel in self._Session['ChannelList']:
+            channel.enableConcurrentRequests()
+
+    def __dispatchAnswers(self):
+        # Body of the reader thread. Runs until the connection breaks or is closed
+        try:
+            while True:
+                try:
+                    packets = self.__recvFrame(None)
+                except nmb.NetBIOSTimeout:
+                    # Nothing came for a long while, keep waiting
+                    continue
+                with self.__stateLock:
+                    for packet in packets:
+                        # Interim answers only grant credits, the final one will come later on
+                        if packet['Status'] == STATUS_PENDING:
+                            continue
+                        future = self._Connection['OutstandingRequests'].get(packet['MessageID'])
+                        if future is not None and future.done() is False:
+                            future.set_result(packet)
+                            self.__inFlight -= 1
+                        else:
+                            # Discarded, or sent before the thread was started
+                            self.__keepAnswer(packet)
+                    self.__stateLock.notify_all()
+        except Exception as e:
+            with self.__stateLock:
+                self.__readerError = e
+                for future in self._Connection['OutstandingRequests'].values():
+                    if future.done() is False:
+                        future.set_exception(e)
+                # Threads already waiting get the error through their Future, the rest from __readerError
+                self._Connection['OutstandingRequests'].clear()
+                self.__discarded.clear()
+                self.__inFlight = 0
+                self.__stateLock.notify_all()
+
+    def __waitAnswer(self, packetID):
+        # recvSMB() once the reader thread is running. Without packetID, waits for the last request
+        # sent by the calling thread
+        if packetID is None:
+            packetID = getattr(self.__lastRequest, 'messageId', None)
+        with self.__stateLock:
+            if packetID in self._Connection['OutstandingResponses']:
+                return self._Connection['OutstandingResponses'].pop(packetID)
+            future = self._Connection['OutstandingRequests'].get(packetID)
+            if future is None:
+                if self.__readerError is not None:
+                    raise self.__readerError
+                raise SessionError(STATUS_INVALID_PARAMETER)
+        try:
+            packet = future.result(self._timeout)
+        except FutureTimeoutError:
+            # The answer can still be collected later on, or dropped with discardAnswer()
+            raise nmb.NetBIOSTimeout
+        with self.__stateLock:
+            self._Connection['OutstandingRequests'].pop(packetID, None)
+        return packet
+
+    def __stopReader(self):
+        # Shutting the socket down wakes the reader thread up, it finishes with an error
+        reader = self.__reader
+        if reader is None or reader is threading.current_thread():
+            return
+        try:
+            self._NetBIOSSession.get_socket().shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        reader.join(self._timeout)
+
     def negotiateSession(self, preferredDialect = None, negSessionResponse = None):
         # Let's store some data for later use
         self._Connection['ClientSecurityMode'] = SMB2_NEGOTIATE_SIGNING_ENABLED
@@ -586,44 +1246,11 @@ class SMB3:
                     # Build the Contexts
                     contextData = SMB311ContextData()
                     contextData['NegotiateContextOffset'] = 64+38+2
-                    contextData['NegotiateContextCount'] = 0
-                    # Add an SMB2_NEGOTIATE_CONTEXT with ContextType as SMB2_PREAUTH_INTEGRITY_CAPABILITIES
-                    # to the negotiate request as specified in section 2.2.3.1:
-                    negotiateContext = SMB2NegotiateContext()
-                    negotiateContext['ContextType'] = SMB2_PREAUTH_INTEGRITY_CAPABILITIES
-
-                    preAuthIntegrityCapabilities = SMB2PreAuthIntegrityCapabilities()
-                    preAuthIntegrityCapabilities['HashAlgorithmCount'] = 1
-                    preAuthIntegrityCapabilities['SaltLength'] = 32
-                    preAuthIntegrityCapabilities['HashAlgorithms'] = b'\x01\x00'
-                    preAuthIntegrityCapabilities['Salt'] = ''.join([rand.choice(string.ascii_letters) for _ in
-                                                                     range(preAuthIntegrityCapabilities['SaltLength'])])
-
-                    negotiateContext['Data'] = preAuthIntegrityCapabilities.getData()
-                    negotiateContext['DataLength'] = len(negotiateContext['Data'])
-                    contextData['NegotiateContextCount'] += 1
-                    pad = b'\xFF' * ((8 - (negotiateContext['DataLength'] % 8)) % 8)
-
-                    # Add an SMB2_NEGOTIATE_CONTEXT with ContextType as SMB2_ENCRYPTION_CAPABILITIES
-                    # to the negotiate request as specified in section 2.2.3.1 and initialize
-                    # the Ciphers field with the ciphers supported by the client in the order of preference.
-
-                    negotiateContext2 = SMB2NegotiateContext()
-                    negotiateContext2['ContextType'] = SMB2_ENCRYPTION_CAPABILITIES
-
-                    encryptionCapabilities = SMB2EncryptionCapabilities()
-                    encryptionCapabilities['CipherCount'] = 1
-                    encryptionCapabilities['Ciphers'] = b'\x01\x00'
-
-                    negotiateContext2['Data'] = encryptionCapabilities.getData()
-                    negotiateContext2['DataLength'] = len(negotiateContext2['Data'])
-                    contextData['NegotiateContextCount'] += 1
-
+                    contextData['NegotiateContextCount'], negSession['NegotiateContextList'] = \
+                        negotiateContextList(self.EncryptionAlgorithmList, self.SigningAlgorithmList,
+                                             self.CompressionAlgorithmList)
                     negSession['ClientStartTime'] = contextData.getData()
                     negSession['Padding'] = b'\xFF\xFF'
-                    # Subsequent negotiate contexts MUST appear at the first 8-byte aligned offset following the
-                    # previous negotiate context.
-                    negSession['NegotiateContextList'] = negotiateContext.getData() + pad + negotiateContext2.getData()
 
                     # Do you want to enforce encryption? Uncomment here:
                     #self._Connection['SupportsEncryption'] = True
@@ -722,6 +1349,8 @@ class SMB3:
            sessionSetup['SecurityMode'] = SMB2_NEGOTIATE_SIGNING_ENABLED
 
         sessionSetup['Flags'] = 0
+        if self._bindingSession is not None:
+            sessionSetup['Flags'] = SMB2_SESSION_FLAG_BINDING
         #sessionSetup['Capabilities'] = SMB2_GLOBAL_CAP_LARGE_MTU | SMB2_GLOBAL_CAP_LEASING | SMB2_GLOBAL_CAP_DFS
 
         # Importing down here so pyasn1 is not required if kerberos is not used.
@@ -876,17 +1505,8 @@ class SMB3:
             else:
                 self._Session['SessionKey']  = sessionKey.contents[:16]
 
-            if self._Session['SigningRequired'] is True and self._Connection['Dialect'] >= SMB2_DIALECT_30:
-                # If Connection.Dialect is "3.1.1", the case-sensitive ASCII string "SMBSigningKey" as the label;
-                # otherwise, the case - sensitive ASCII string "SMB2AESCMAC" as the label.
-                # If Connection.Dialect is "3.1.1", Session.PreauthIntegrityHashValue as the context; otherwise,
-                # the case-sensitive ASCII string "SmbSign" as context for the algorithm.
-                if self._Connection['Dialect'] == SMB2_DIALECT_311:
-                    self._Session['SigningKey'] = crypto.KDF_CounterMode (self._Session['SessionKey'], b"SMBSigningKey\x00",
-                                                                          self._Session['PreauthIntegrityHashValue'], 128)
-                else:
-                    self._Session['SigningKey'] = crypto.KDF_CounterMode (self._Session['SessionKey'], b"SMB2AESCMAC\x00",
-                                                                          b"SmbSign\x00", 128)
+            if self._Connection['Dialect'] >= SMB2_DIALECT_30:
+                self._Session['SigningKey'] = deriveSigningKey(self._Connection, self._Session, self._Session['SessionKey'])
 
             # Do not encrypt anonymous connections
             if user == '' or self.isGuestSession():
@@ -897,33 +1517,8 @@ class SMB3:
             if self._Connection['Dialect'] >= SMB2_DIALECT_30 and self._Connection['SupportsEncryption'] is True:
                 # Encryption available. Let's enforce it if we have AES CCM available
                 self._Session['SessionFlags'] |= SMB2_SESSION_FLAG_ENCRYPT_DATA
-                # Application Key
-                # If Connection.Dialect is "3.1.1",the case-sensitive ASCII string "SMBAppKey" as the label;
-                # otherwise, the case-sensitive ASCII string "SMB2APP" as the label. Session.PreauthIntegrityHashValue
-                # as the context; otherwise, the case-sensitive ASCII string "SmbRpc" as context for the algorithm.
-                # Encryption Key
-                # If Connection.Dialect is "3.1.1",the case-sensitive ASCII string "SMBC2SCipherKey" as # the label;
-                # otherwise, the case-sensitive ASCII string "SMB2AESCCM" as the label. Session.PreauthIntegrityHashValue
-                # as the context; otherwise, the case-sensitive ASCII string "ServerIn " as context for the algorithm
-                # (note the blank space at the end)
-                # Decryption Key
-                # If Connection.Dialect is "3.1.1", the case-sensitive ASCII string "SMBS2CCipherKey" as the label;
-                # otherwise, the case-sensitive ASCII string "SMB2AESCCM" as the label. Session.PreauthIntegrityHashValue
-                # as the context; otherwise, the case-sensitive ASCII string "ServerOut" as context for the algorithm.
-                if self._Connection['Dialect'] == SMB2_DIALECT_311:
-                    self._Session['ApplicationKey'] = crypto.KDF_CounterMode (self._Session['SessionKey'], b"SMBAppKey\x00",
-                                                                              self._Session['PreauthIntegrityHashValue'], 128)
-                    self._Session['EncryptionKey'] = crypto.KDF_CounterMode (self._Session['SessionKey'], b"SMBC2SCipherKey\x00",
-                                                                             self._Session['PreauthIntegrityHashValue'], 128)
-                    self._Session['DecryptionKey'] = crypto.KDF_CounterMode (self._Session['SessionKey'], b"SMBS2CCipherKey\x00",
-                                                                             self._Session['PreauthIntegrityHashValue'], 128)
-                else:
-                    self._Session['ApplicationKey'] = crypto.KDF_CounterMode (self._Session['SessionKey'], b"SMB2APP\x00",
-                                                                              b"SmbRpc\x00", 128)
-                    self._Session['EncryptionKey'] = crypto.KDF_CounterMode (self._Session['SessionKey'], b"SMB2AESCCM\x00",
-                                                                             b"ServerIn \x00", 128)
-                    self._Session['DecryptionKey'] = crypto.KDF_CounterMode (self._Session['SessionKey'], b"SMB2AESCCM\x00",
-                                                                             b"ServerOut\x00", 128)
+                self._Session['ApplicationKey'], self._Session['EncryptionKey'], self._Session['DecryptionKey'] = \
+                    deriveCipherKeys(self._Connection, self._Session, self._Session['SessionKey'])
 
             self._Session['CalculatePreAuthHash'] = False
             return True
@@ -937,6 +1532,7 @@ class SMB3:
             self._Session['SigningKey']        = ''
             self._Session['SessionKey']        = ''
             self._Session['SigningActivated']  = False
+            self._Session['SessionFlags']      = 0
             self._Session['CalculatePreAuthHash'] = False
             self._Session['PreauthIntegrityHashValue'] = a2b_hex(b'0'*128)
             raise Exception('Unsuccessful Login')
@@ -969,6 +1565,8 @@ class SMB3:
            sessionSetup['SecurityMode'] = SMB2_NEGOTIATE_SIGNING_ENABLED
 
         sessionSetup['Flags'] = 0
+        if self._bindingSession is not None:
+            sessionSetup['Flags'] = SMB2_SESSION_FLAG_BINDING
         #sessionSetup['Capabilities'] = SMB2_GLOBAL_CAP_LARGE_MTU | SMB2_GLOBAL_CAP_LEASING | SMB2_GLOBAL_CAP_DFS
 
         # Let's build a NegTokenInit with the NTLMSSP
@@ -984,11 +1582,10 @@ class SMB3:
         sessionSetup['SecurityBufferLength'] = len(blob)
         sessionSetup['Buffer']               = blob.getData()
 
-        # ToDo:
         # If this authentication is for establishing an alternative channel for an existing Session, as specified
         # in section 3.2.4.1.7, the client MUST also set the following values:
         # The SessionId field in the SMB2 header MUST be set to the Session.SessionId for the new
-        # channel being established.
+        # channel being established (bindChannel() takes care of that).
         # The SMB2_SESSION_FLAG_BINDING bit MUST be set in the Flags field.
         # The PreviousSessionId field MUST be set to zero.
 
@@ -1074,19 +1671,8 @@ class SMB3:
             # Let's calculate Key Materials before moving on
             if exportedSessionKey is not None:
                 self._Session['SessionKey']  = exportedSessionKey
-                if self._Session['SigningRequired'] is True and self._Connection['Dialect'] >= SMB2_DIALECT_30:
-                    # If Connection.Dialect is "3.1.1", the case-sensitive ASCII string "SMBSigningKey" as the label;
-                    # otherwise, the case - sensitive ASCII string "SMB2AESCMAC" as the label.
-                    # If Connection.Dialect is "3.1.1", Session.PreauthIntegrityHashValue as the context; otherwise,
-                    # the case-sensitive ASCII string "SmbSign" as context for the algorithm.
-                    if self._Connection['Dialect'] == SMB2_DIALECT_311:
-                        self._Session['SigningKey'] = crypto.KDF_CounterMode (exportedSessionKey,
-                                                                              b"SMBSigningKey\x00",
-                                                                              self._Session['PreauthIntegrityHashValue'],
-                                                                              128)
-                    else:
-                        self._Session['SigningKey'] = crypto.KDF_CounterMode (exportedSessionKey, b"SMB2AESCMAC\x00",
-                                                                              b"SmbSign\x00", 128)
+                if self._Connection['Dialect'] >= SMB2_DIALECT_30:
+                    self._Session['SigningKey'] = deriveSigningKey(self._Connection, self._Session, exportedSessionKey)
             try:
                 if packet.isValidAnswer(STATUS_SUCCESS):
                     sessionSetupResponse = SMB2SessionSetup_Response(packet['Data'])
@@ -1103,34 +1689,9 @@ class SMB3:
                     if self._Connection['Dialect'] >= SMB2_DIALECT_30 and self._Connection['SupportsEncryption'] is True:
                         # SMB 3.0. Encryption available. Let's enforce it if we have AES CCM available
                         self._Session['SessionFlags'] |= SMB2_SESSION_FLAG_ENCRYPT_DATA
-                        # Application Key
-                        # If Connection.Dialect is "3.1.1",the case-sensitive ASCII string "SMBAppKey" as the label;
-                        # otherwise, the case-sensitive ASCII string "SMB2APP" as the label. Session.PreauthIntegrityHashValue
-                        # as the context; otherwise, the case-sensitive ASCII string "SmbRpc" as context for the algorithm.
-                        # Encryption Key
-                        # If Connection.Dialect is "3.1.1",the case-sensitive ASCII string "SMBC2SCipherKey" as # the label;
-                        # otherwise, the case-sensitive ASCII string "SMB2AESCCM" as the label. Session.PreauthIntegrityHashValue
-                        # as the context; otherwise, the case-sensitive ASCII string "ServerIn " as context for the algorithm
-                        # (note the blank space at the end)
-                        # Decryption Key
-                        # If Connection.Dialect is "3.1.1", the case-sensitive ASCII string "SMBS2CCipherKey" as the label;
-                        # otherwise, the case-sensitive ASCII string "SMB2AESCCM" as the label. Session.PreauthIntegrityHashValue
-                        # as the context; otherwise, the case-sensitive ASCII string "ServerOut" as context for the algorithm.
-                        if self._Connection['Dialect'] == SMB2_DIALECT_311:
-                            self._Session['ApplicationKey']  = crypto.KDF_CounterMode(exportedSessionKey, b"SMBAppKey\x00",
-                                                                             self._Session['PreauthIntegrityHashValue'], 128)
-                            self._Session['EncryptionKey']   = crypto.KDF_CounterMode(exportedSessionKey, b"SMBC2SCipherKey\x00",
-                                                                             self._Session['PreauthIntegrityHashValue'], 128)
-                            self._Session['DecryptionKey'] = crypto.KDF_CounterMode (exportedSessionKey, b"SMBS2CCipherKey\x00",
-                                                                             self._Session['PreauthIntegrityHashValue'], 128)
-
-                        else:
-                            self._Session['ApplicationKey'] = crypto.KDF_CounterMode (exportedSessionKey, b"SMB2APP\x00",
-                                                                                      b"SmbRpc\x00", 128)
-                            self._Session['EncryptionKey'] = crypto.KDF_CounterMode (exportedSessionKey, b"SMB2AESCCM\x00",
-                                                                                     b"ServerIn \x00", 128)
-                            self._Session['DecryptionKey'] = crypto.KDF_CounterMode (exportedSessionKey, b"SMB2AESCCM\x00",
-                                                                                     b"ServerOut\x00", 128)
+                        self._Session['ApplicationKey'], self._Session['EncryptionKey'], \
+                            self._Session['DecryptionKey'] = deriveCipherKeys(self._Connection, self._Session,
+                                                                              exportedSessionKey)
                     self._Session['CalculatePreAuthHash'] = False
                     return True
             except:
@@ -1143,11 +1704,17 @@ class SMB3:
                 self._Session['SigningKey']        = ''
                 self._Session['SessionKey']        = ''
                 self._Session['SigningActivated']  = False
+                self._Session['SessionFlags']      = 0
                 self._Session['CalculatePreAuthHash'] = False
                 self._Session['PreauthIntegrityHashValue'] = a2b_hex(b'0'*128)
                 raise
 
     def connectTree(self, share):
+        # Threads sharing the connection may be connecting to the same share at once
+        with self.__treeLock:
+            return self.__connectTree(share)
+
+    def __connectTree(self, share):
 
         # Just in case this came with the full path (maybe an SMB1 client), let's just leave
         # the sharename, we'll take care of the rest
@@ -1199,6 +1766,9 @@ class SMB3:
                    # them in Session.EncryptionKey and Session.DecryptionKey:
                if (treeConnectResponse['Capabilities'] & SMB2_SHARE_CAP_SCALEOUT) == SMB2_SHARE_CAP_SCALEOUT:
                    treeEntry['IsScaleoutShare'] = True
+               if len(self._Connection['CompressionIds']) > 0 and \
+                       (treeConnectResponse['ShareFlags'] & SMB2_SHAREFLAG_COMPRESS_DATA) == SMB2_SHAREFLAG_COMPRESS_DATA:
+                   treeEntry['CompressData'] = True
 
            self._Session['TreeConnectTable'][packet['TreeID']] = treeEntry
            self._Session['TreeConnectTable'][share]            = treeEntry
@@ -1206,6 +1776,10 @@ class SMB3:
            return packet['TreeID']
 
     def disconnectTree(self, treeId):
+        with self.__treeLock:
+            return self.__disconnectTree(treeId)
+
+    def __disconnectTree(self, treeId):
         if (treeId in self._Session['TreeConnectTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
@@ -1226,7 +1800,8 @@ class SMB3:
         packet = self.recvSMB(packetID)
         if packet.isValidAnswer(STATUS_SUCCESS):
             shareName = self._Session['TreeConnectTable'][treeId]['ShareName']
-            del(self._Session['TreeConnectTable'][shareName])
+            if self._Session['TreeConnectTable'].get(shareName) is self._Session['TreeConnectTable'][treeId]:
+                del(self._Session['TreeConnectTable'][shareName])
             del(self._Session['TreeConnectTable'][treeId])
             filesIDToBeRemoved = []
             for fileID in list(self._Session['OpenTable'].keys()):
@@ -1246,10 +1821,7 @@ class SMB3:
             if fileName[0] == '\\':
                 fileName = fileName[1:]
 
-        if self._Session['TreeConnectTable'][treeId]['IsDfsShare'] is True:
-            pathName = fileName
-        else:
-            pathName = '\\\\' + self._Connection['ServerName'] + '\\' + fileName
+        pathName = self.__pathName(treeId, fileName)
 
         fileEntry = copy.deepcopy(FILE)
         fileEntry['LeaseKey']   = uuid.generate()
@@ -1268,6 +1840,47 @@ class SMB3:
                parentEntry['LeaseState'] = SMB2_LEASE_NONE
                self.GlobalFileTable[parentDir] = parentEntry
 
+        packet = self.__createPacket(treeId, fileName, desiredAccess, shareMode, creationOptions, creationDisposition,
+                                     fileAttributes, impersonationLevel, securityFlags, oplockLevel, createContexts)
+        packetID = self.sendSMB(packet)
+        ans = self.recvSMB(packetID)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            return self.__keepOpen(treeId, pathName, oplockLevel, SMB2Create_Response(ans['Data']))
+
+    def __pathName(self, treeId, fileName):
+        if self._Session['TreeConnectTable'][treeId]['IsDfsShare'] is True:
+            return fileName
+        return '\\\\' + self._Connection['ServerName'] + '\\' + fileName
+
+    def __keepOpen(self, treeId, pathName, oplockLevel, createResponse):
+        # Keeps track of the file opened by a CREATE, returns its handle
+        openFile = copy.deepcopy(OPEN)
+        openFile['FileID']      = createResponse['FileID']
+        openFile['TreeConnect'] = treeId
+        openFile['Oplocklevel'] = oplockLevel
+        openFile['Durable']     = False
+        openFile['ResilientHandle']    = False
+        openFile['LastDisconnectTime'] = 0
+        openFile['FileName'] = pathName
+
+        # ToDo: Complete the OperationBuckets
+        if self._Connection['Dialect'] >= SMB2_DIALECT_30:
+            openFile['DesiredAccess']     = oplockLevel
+            openFile['ShareMode']         = oplockLevel
+            openFile['CreateOptions']     = oplockLevel
+            openFile['FileAttributes']    = oplockLevel
+            openFile['CreateDisposition'] = oplockLevel
+
+        # ToDo: Process the contexts
+        self._Session['OpenTable'][createResponse['FileID'].getData()] = openFile
+
+        # The client MUST generate a handle for the Open, and it MUST
+        # return success and the generated handle to the calling application.
+        # In our case, str(FileID)
+        return createResponse['FileID'].getData()
+
+    def __createPacket(self, treeId, fileName, desiredAccess, shareMode, creationOptions, creationDisposition, fileAttributes, impersonationLevel = SMB2_IL_IMPERSONATION, securityFlags = 0, oplockLevel = SMB2_OPLOCK_LEVEL_NONE, createContexts = None):
+        # fileName must be already normalized
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_CREATE
         packet['TreeID']  = treeId
@@ -1306,36 +1919,7 @@ class SMB3:
             smb2Create['CreateContextsLength'] = 0
 
         packet['Data'] = smb2Create
-
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            createResponse = SMB2Create_Response(ans['Data'])
-
-            openFile = copy.deepcopy(OPEN)
-            openFile['FileID']      = createResponse['FileID']
-            openFile['TreeConnect'] = treeId
-            openFile['Oplocklevel'] = oplockLevel
-            openFile['Durable']     = False
-            openFile['ResilientHandle']    = False
-            openFile['LastDisconnectTime'] = 0
-            openFile['FileName'] = pathName
-
-            # ToDo: Complete the OperationBuckets
-            if self._Connection['Dialect'] >= SMB2_DIALECT_30:
-                openFile['DesiredAccess']     = oplockLevel
-                openFile['ShareMode']         = oplockLevel
-                openFile['CreateOptions']     = oplockLevel
-                openFile['FileAttributes']    = oplockLevel
-                openFile['CreateDisposition'] = oplockLevel
-
-            # ToDo: Process the contexts
-            self._Session['OpenTable'][createResponse['FileID'].getData()] = openFile
-
-            # The client MUST generate a handle for the Open, and it MUST
-            # return success and the generated handle to the calling application.
-            # In our case, str(FileID)
-            return createResponse['FileID'].getData()
+        return packet
 
     def close(self, treeId, fileId):
         if (treeId in self._Session['TreeConnectTable']) is False:
@@ -1343,6 +1927,18 @@ class SMB3:
         if (fileId in self._Session['OpenTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID = self.sendSMB(self.__closePacket(treeId, fileId))
+        ans = self.recvSMB(packetID)
+
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            # Another thread may have opened and closed the same file meanwhile
+            self.GlobalFileTable.pop(self._Session['OpenTable'][fileId]['FileName'], None)
+            del(self._Session['OpenTable'][fileId])
+
+            # ToDo Remove stuff from GlobalFileTable
+            return True
+
+    def __closePacket(self, treeId, fileId):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_CLOSE
         packet['TreeID']  = treeId
@@ -1352,28 +1948,18 @@ class SMB3:
         smbClose['FileID'] = fileId
 
         packet['Data'] = smbClose
+        return packet
 
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
-
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            del(self.GlobalFileTable[self._Session['OpenTable'][fileId]['FileName']])
-            del(self._Session['OpenTable'][fileId])
-
-            # ToDo Remove stuff from GlobalFileTable
-            return True
-
-    def read(self, treeId, fileId, offset = 0, bytesToRead = 0, waitAnswer = True):
-        # IMPORTANT NOTE: As you can see, this was coded as a recursive function
-        # Hence, you can exhaust the memory pretty easy ( large bytesToRead )
-        # This function should NOT be used for reading files directly, but another higher
-        # level function should be used that will break the read into smaller pieces
-
+    def __sendRead(self, treeId, fileId, offset, bytesToRead):
+        # Sends a READ request, returns its packetID
         if (treeId in self._Session['TreeConnectTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
         if (fileId in self._Session['OpenTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        return self.sendSMB(self.__readPacket(treeId, fileId, offset, bytesToRead))
+
+    def __readPacket(self, treeId, fileId, offset, bytesToRead):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_READ
         packet['TreeID']  = treeId
@@ -1393,9 +1979,23 @@ class SMB3:
         smbRead['FileID']   = fileId
         smbRead['Length']   = maxBytesToRead
         smbRead['Offset']   = offset
+        # Since SMB 3.0.2 Reserved holds the READ Flags
+        if self.__isCompressedReadWanted(maxBytesToRead):
+            smbRead['Reserved'] = SMB2_READFLAG_REQUEST_COMPRESSED
         packet['Data'] = smbRead
+        return packet
 
-        packetID = self.sendSMB(packet)
+    def __isCompressedReadWanted(self, bytesToRead):
+        # Small reads aren't worth the server compressing them, nor the transform header. Whether
+        # the data actually compresses is for the server to find out, it answers uncompressed otherwise
+        return len(self._Connection['CompressionIds']) > 0 and bytesToRead >= COMPRESSION_MIN_SIZE
+
+    def read(self, treeId, fileId, offset = 0, bytesToRead = 0, waitAnswer = True):
+        # IMPORTANT NOTE: As you can see, this was coded as a recursive function
+        # Hence, you can exhaust the memory pretty easy ( large bytesToRead )
+        # This function should NOT be used for reading files directly, but another higher
+        # level function should be used that will break the read into smaller pieces
+        packetID = self.__sendRead(treeId, fileId, offset, bytesToRead)
         ans = self.recvSMB(packetID)
 
         if ans.isValidAnswer(STATUS_SUCCESS):
@@ -1405,12 +2005,8 @@ class SMB3:
                 retData += self.read(treeId, fileId, offset+len(retData), readResponse['DataRemaining'], waitAnswer)
             return retData
 
-    def write(self, treeId, fileId, data, offset = 0, bytesToWrite = 0, waitAnswer = True):
-        # IMPORTANT NOTE: As you can see, this was coded as a recursive function
-        # Hence, you can exhaust the memory pretty easy ( large bytesToWrite )
-        # This function should NOT be used for writing directly to files, but another higher
-        # level function should be used that will break the writes into smaller pieces
-
+    def __sendWrite(self, treeId, fileId, data, offset, bytesToWrite):
+        # Sends a WRITE request, returns its packetID and the amount of bytes sent in it
         if (treeId in self._Session['TreeConnectTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
         if (fileId in self._Session['OpenTable']) is False:
@@ -1438,7 +2034,14 @@ class SMB3:
         smbWrite['Buffer'] = data[:maxBytesToWrite]
         packet['Data'] = smbWrite
 
-        packetID = self.sendSMB(packet)
+        return self.sendSMB(packet), maxBytesToWrite
+
+    def write(self, treeId, fileId, data, offset = 0, bytesToWrite = 0, waitAnswer = True):
+        # IMPORTANT NOTE: As you can see, this was coded as a recursive function
+        # Hence, you can exhaust the memory pretty easy ( large bytesToWrite )
+        # This function should NOT be used for writing directly to files, but another higher
+        # level function should be used that will break the writes into smaller pieces
+        packetID, maxBytesToWrite = self.__sendWrite(treeId, fileId, data, offset, bytesToWrite)
         if waitAnswer is True:
             ans = self.recvSMB(packetID)
         else:
@@ -1457,6 +2060,13 @@ class SMB3:
         if (fileId in self._Session['OpenTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID = self.sendSMB(self.__queryDirectoryPacket(treeId, fileId, searchString, resumeIndex, informationClass, maxBufferSize))
+        ans = self.recvSMB(packetID)
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            queryDirectoryResponse = SMB2QueryDirectory_Response(ans['Data'])
+            return queryDirectoryResponse['Buffer']
+
+    def __queryDirectoryPacket(self, treeId, fileId, searchString = '*', resumeIndex = 0, informationClass = FILENAMES_INFORMATION, maxBufferSize = None):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_QUERY_DIRECTORY
         packet['TreeID']  = treeId
@@ -1478,11 +2088,7 @@ class SMB3:
         if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
             packet['CreditCharge'] = ( 1 + (maxBufferSize - 1) // 65536)
 
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            queryDirectoryResponse = SMB2QueryDirectory_Response(ans['Data'])
-            return queryDirectoryResponse['Buffer']
+        return packet
 
     def echo(self):
         packet = self.SMB_PACKET()
@@ -1626,6 +2232,9 @@ class SMB3:
             self._Session['SigningKey']        = ''
             self._Session['SessionKey']        = ''
             self._Session['SigningActivated']  = False
+            self._Session['SessionFlags']      = 0
+            # The session is gone, so are its alternative channels
+            self.__closeChannels()
             return True
 
     def queryInfo(self, treeId, fileId, inputBlob = '', infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_STANDARD_INFO, additionalInformation = 0, flags = 0 ):
@@ -1634,6 +2243,14 @@ class SMB3:
         if (fileId in self._Session['OpenTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID = self.sendSMB(self.__queryInfoPacket(treeId, fileId, inputBlob, infoType, fileInfoClass, additionalInformation, flags))
+        ans = self.recvSMB(packetID)
+
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            queryResponse = SMB2QueryInfo_Response(ans['Data'])
+            return queryResponse['Buffer']
+
+    def __queryInfoPacket(self, treeId, fileId, inputBlob = '', infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_STANDARD_INFO, additionalInformation = 0, flags = 0 ):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_QUERY_INFO
         packet['TreeID']  = treeId
@@ -1653,12 +2270,7 @@ class SMB3:
         queryInfo['Flags']                 = flags
 
         packet['Data'] = queryInfo
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
-
-        if ans.isValidAnswer(STATUS_SUCCESS):
-            queryResponse = SMB2QueryInfo_Response(ans['Data'])
-            return queryResponse['Buffer']
+        return packet
 
     def setInfo(self, treeId, fileId, inputBlob = '', infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_STANDARD_INFO, additionalInformation = 0 ):
         if (treeId in self._Session['TreeConnectTable']) is False:
@@ -1666,6 +2278,13 @@ class SMB3:
         if (fileId in self._Session['OpenTable']) is False:
             raise SessionError(STATUS_INVALID_PARAMETER)
 
+        packetID = self.sendSMB(self.__setInfoPacket(treeId, fileId, inputBlob, infoType, fileInfoClass, additionalInformation))
+        ans = self.recvSMB(packetID)
+
+        if ans.isValidAnswer(STATUS_SUCCESS):
+            return True
+
+    def __setInfoPacket(self, treeId, fileId, inputBlob = '', infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_STANDARD_INFO, additionalInformation = 0 ):
         packet = self.SMB_PACKET()
         packet['Command'] = SMB2_SET_INFO
         packet['TreeID']  = treeId
@@ -1679,11 +2298,34 @@ class SMB3:
         setInfo['Buffer']                = inputBlob
 
         packet['Data'] = setInfo
-        packetID = self.sendSMB(packet)
-        ans = self.recvSMB(packetID)
+        return packet
+
+    def __compoundOnFile(self, treeId, createPacket, packets):
+        # Opens a file, sends packets working on it (FileID must be RELATED_FILEID) and closes it,
+        # all in a single round trip. Returns the answers to packets, they must be checked by the caller
+        answers = self.recvCompound(self.sendCompound([createPacket] + packets + [self.__closePacket(treeId, RELATED_FILEID)]))
+        # If the CREATE failed, the rest of the requests failed the same way
+        answers[0].isValidAnswer(STATUS_SUCCESS)
+        answers[-1].isValidAnswer(STATUS_SUCCESS)
+        return answers[1:-1]
+
+    def queryPathInfo(self, treeId, pathName, infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_STANDARD_INFO, additionalInformation = 0, flags = 0, desiredAccess = FILE_READ_ATTRIBUTES):
+        # Same as queryInfo() but for a path, the file is opened, queried and closed in a single round trip
+        if (treeId in self._Session['TreeConnectTable']) is False:
+            raise SessionError(STATUS_INVALID_PARAMETER)
 
+        pathName = pathName.replace('/', '\\')
+        if len(pathName) > 0:
+            pathName = ntpath.normpath(pathName)
+            if pathName[0] == '\\':
+                pathName = pathName[1:]
+
+        createPacket = self.__createPacket(treeId, pathName, desiredAccess, FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE, 0, FILE_OPEN, 0)
+        ans, = self.__compoundOnFile(treeId, createPacket, [self.__queryInfoPacket(treeId, RELATED_FILEID, infoType=infoType,
+                                     fileInfoClass=fileInfoClass, additionalInformation=additionalInformation, flags=flags)])
         if ans.isValidAnswer(STATUS_SUCCESS):
-            return True
+            queryResponse = SMB2QueryInfo_Response(ans['Data'])
+            return queryResponse['Buffer']
 
     def getSessionKey(self):
         if self.getDialect() >= SMB2_DIALECT_30:
@@ -1712,34 +2354,325 @@ class SMB3:
             newPath = newPath[1:]
 
         treeId = self.connectTree(shareName)
-        fileId = None
         try:
-            fileId = self.create(treeId, oldPath, MAXIMUM_ALLOWED ,FILE_SHARE_READ | FILE_SHARE_WRITE |FILE_SHARE_DELETE, 0x200020, FILE_OPEN, 0)
             renameReq = FILE_RENAME_INFORMATION_TYPE_2()
             renameReq['ReplaceIfExists'] = 1
             renameReq['RootDirectory']   = '\x00'*8
             renameReq['FileNameLength']  = len(newPath)*2
             renameReq['FileName']        = newPath.encode('utf-16le')
-            self.setInfo(treeId, fileId, renameReq, infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_RENAME_INFO)
+            createPacket = self.__createPacket(treeId, oldPath, MAXIMUM_ALLOWED ,FILE_SHARE_READ | FILE_SHARE_WRITE |FILE_SHARE_DELETE, 0x200020, FILE_OPEN, 0)
+            ans, = self.__compoundOnFile(treeId, createPacket, [self.__setInfoPacket(treeId, RELATED_FILEID, renameReq,
+                                         infoType = SMB2_0_INFO_FILE, fileInfoClass = SMB2_FILE_RENAME_INFO)])
+            ans.isValidAnswer(STATUS_SUCCESS)
         finally:
-            if fileId is not None:
-                self.close(treeId, fileId)
             self.disconnectTree(treeId)
 
         return True
 
-    def writeFile(self, treeId, fileId, data, offset = 0):
-        finished = False
-        writeOffset = offset
-        while not finished:
-            if len(data) == 0:
+    def setTransferWindow(self, windowSize):
+        # Max amount of bytes retrieveFile(), storeFile() and writeFile() keep in flight, per channel
+        self._transferWindow = windowSize
+        for channel in self._Session['ChannelList']:
+            channel._transferWindow = windowSize
+
+    def queryNetworkInterfaces(self):
+        # Returns the network interfaces the server can be reached through, as reported by
+        # FSCTL_QUERY_NETWORK_INTERFACE_INFO. A list of dicts with IfIndex, Capability, LinkSpeed and Address
+        treeId = self.connectTree('IPC$')
+        try:
+            data = self.ioctl(treeId, None, FSCTL_QUERY_NETWORK_INTERFACE_INFO, SMB2_0_IOCTL_IS_FSCTL,
+                              maxInputResponse=0, maxOutputResponse=65536)
+        finally:
+            self.disconnectTree(treeId)
+
+        interfaces = []
+        offset = 0
+        while len(data) - offset >= len(NETWORK_INTERFACE_INFO()):
+            interfaceInfo = NETWORK_INTERFACE_INFO(data[offset:])
+            sockAddr = interfaceInfo['SockAddr_Storage']
+            family = struct.unpack('<H', sockAddr[:2])[0]
+            if family == 0x2:
+                address = socket.inet_ntoa(sockAddr[4:8])
+            elif family == 0x17:
+                address = socket.inet_ntop(socket.AF_INET6, sockAddr[8:24])
+            else:
+                address = None
+            if address is not None:
+                interfaces.append({'IfIndex': interfaceInfo['IfIndex'], 'Capability': interfaceInfo['Capability'],
+                                   'LinkSpeed': interfaceInfo['LinkSpeed'], 'Address': address})
+            if interfaceInfo['Next'] == 0:
                 break
-            writeData = data[:self._Connection['MaxWriteSize']]
-            data = data[self._Connection['MaxWriteSize']:]
-            written = self.write(treeId, fileId, writeData, writeOffset, len(writeData))
-            writeOffset += written
+            offset += interfaceInfo['Next']
+        return interfaces
+
+    def bindChannel(self, remoteHost=None):
+        # Establishes another connection to the server (remoteHost, or the address we're connected to) and
+        # binds it to the current session as an alternative channel ([MS-SMB2] 3.2.4.1.7). READ and WRITE
+        # requests of file transfers are spread over all the session's channels. Returns the new channel
+        if self._Connection['Dialect'] < SMB2_DIALECT_30 or self._Connection['SupportsMultiChannel'] is False:
+            raise SessionError(STATUS_NOT_SUPPORTED)
+        if remoteHost is None:
+            remoteHost = self._Connection['ServerIP']
+
+        channel = SMB3(self._Connection['ServerName'], remoteHost, self._Connection['ClientName'] or None,
+                       sess_port=self._sess_port, timeout=self._timeout, preferredDialect=self._Connection['Dialect'],
+                       clientGuid=self.ClientGuid)
+        try:
+            if channel._Connection['Dialect'] != self._Connection['Dialect'] or \
+                    channel._Connection['SupportsMultiChannel'] is False:
+                raise SessionError(STATUS_NOT_SUPPORTED)
+
+            # Binding requests go with our SessionID, signed with the session's key
+            channel._bindingSession = self
+            channel._Session['SessionID'] = self._Session['SessionID']
+            channel._Session['SessionKey'] = self._Session['SessionKey']
+            channel._Session['SigningKey'] = self._Session['SigningKey']
+            user, password, domain, lmhash, nthash, aesKey, TGT, TGS = self.getCredentials()
+            if self._doKerberos is True:
+                channel.kerberosLogin(user, password, domain, lmhash, nthash, aesKey, self.__kdc, TGT, TGS)
+            else:
+                channel.login(user, password, domain, lmhash, nthash)
+        except:
+            channel.close_session()
+            raise
+        channel._bindingSession = None
+
+        # The channel keeps the signing key it just got, everything else belongs to the session
+        for key in ('SessionKey', 'SessionFlags', 'SigningRequired', 'SigningActivated', 'EncryptionKey',
+                    'DecryptionKey', 'ApplicationKey', 'ChannelSequence'):
+            channel._Session[key] = self._Session[key]
+        channel._Session['TreeConnectTable'] = self._Session['TreeConnectTable']
+        channel._Session['OpenTable'] = self._Session['OpenTable']
+        channel._Connection['SupportsEncryption'] = self._Connection['SupportsEncryption']
+        channel._transferWindow = self._transferWindow
+        if self.__reader is not None:
+            channel.enableConcurrentRequests()
+        self._Session['ChannelList'].append(channel)
+        return channel
+
+    def enableMultiChannel(self, channels=2):
+        # Binds alternative channels to the session, spread over the network interfaces the server
+        # reports, until it has the given number of channels. Returns how many channels the session has
+        if self._Connection['Dialect'] < SMB2_DIALECT_30 or self._Connection['SupportsMultiChannel'] is False:
+            return 1
+
+        try:
+            interfaces = sorted(self.queryNetworkInterfaces(), key=lambda interface: interface['LinkSpeed'],
+                                reverse=True)
+        except SessionError:
+            interfaces = []
+        addresses = [interface['Address'] for interface in interfaces] or [self._Connection['ServerIP']]
+
+        while len(self._Session['ChannelList']) + 1 < channels:
+            address = addresses[len(self._Session['ChannelList']) % len(addresses)]
+            try:
+                self.bindChannel(address)
+            except (nmb.NetBIOSError, nmb.NetBIOSTimeout, socket.error):
+                if address == self._Connection['ServerIP']:
+                    raise
+                # We can't reach the server through that one, let's stick to the address we know works
+                addresses = [self._Connection['ServerIP']]
+        return len(self._Session['ChannelList']) + 1
+
+    def __dropChannel(self, channel):
+        # An alternative channel broke. It's taken out of the session and, since requests it had in
+        # flight will be sent again through another channel, Session.ChannelSequence is incremented.
+        # Several threads could find out at the same time
+        if (channel in self._Session['ChannelList']) is False:
+            return
+        self._Session['ChannelList'].remove(channel)
+        self._Session['ChannelSequence'] = (self._Session['ChannelSequence'] + 1) & 0xffff
+        for otherChannel in self._Session['ChannelList']:
+            otherChannel._Session['ChannelSequence'] = self._Session['ChannelSequence']
+        channel.close_session()
+
+    def __closeChannels(self):
+        for channel in self._Session['ChannelList']:
+            channel.close_session()
+        self._Session['ChannelList'] = []
+
+    def __onChannel(self, channel, call):
+        # Returns call(channel). If channel is an alternative channel that broke (now or before), it's dropped
+        # and None is returned, so the caller can redo the work through this connection
+        if channel is self:
+            return call(self)
+        if (channel in self._Session['ChannelList']) is False:
+            return None
+        try:
+            return call(channel)
+        except (nmb.NetBIOSError, nmb.NetBIOSTimeout, socket.error):
+            self.__dropChannel(channel)
+            return None
+
+    def __nextChannel(self, pending, turn, chunkSize):
+        # Round robin over the session's channels, starting at the turn-th, for one that can take another
+        # chunk given the (channel, packetID, ...) requests pending. None if all of them are busy
+        channels = [self] + self._Session['ChannelList']
+        for i in range(len(channels)):
+            channel = channels[(turn + i) % len(channels)]
+            if channel.__canSendChunk(len([item for item in pending if item[0] is channel]), chunkSize):
+                return channel
+        return None
+
+    def __getChunkSize(self, maxSize):
+        # Biggest READ/WRITE we can send in a single request
+        if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
+            return maxSize
+        return min(65536, maxSize)
+
+    def __canSendChunk(self, inFlight, chunkSize):
+        # Another request can go if the server granted us the credits it needs and it fits in the window.
+        # If nothing is in flight we always send one, just like read() and write() do
+        if inFlight == 0:
+            return True
+        if self._Connection['Dialect'] != SMB2_DIALECT_002 and self._Connection['SupportsMultiCredit'] is True:
+            creditCharge = 1 + (chunkSize - 1) // 65536
+        else:
+            creditCharge = 1
+        return self._Connection['Credits'] >= creditCharge and (inFlight + 1) * chunkSize <= self._transferWindow
+
+    def __drainRequests(self, pending):
+        # Collects the answers for the (channel, packetID, ...) requests still in flight, so they don't
+        # stay in OutstandingResponses
+        for item in pending:
+            try:
+                self.__onChannel(item[0], lambda channel: channel.recvSMB(item[1]))
+            except SessionError:
+                pass
+
+    def __discardRequests(self, pending):
+        # The (channel, packetID, ...) requests still in flight won't be collected, their answers are dropped
+        for item in pending:
+            item[0].discardAnswer(item[1])
+
+    def __recvRead(self, treeId, fileId, packetID, offset):
+        # Returns the data answered for the READ request packetID, nothing if the end of file was reached
+        try:
+            ans = self.recvSMB(packetID)
+            ans.isValidAnswer(STATUS_SUCCESS)
+        except SessionError as e:
+            if e.get_error_code() != STATUS_END_OF_FILE:
+                raise
+            return b''
+        readResponse = SMB2Read_Response(ans['Data'])
+        data = readResponse['Buffer']
+        if readResponse['DataRemaining'] > 0:
+            data += self.read(treeId, fileId, offset+len(data), readResponse['DataRemaining'])
+        return data
+
+    def __pipelinedRead(self, treeId, fileId, offset, bytesToRead, callback):
+        # Reads bytesToRead bytes starting at offset keeping several READ requests in flight, spread over
+        # the session's channels. Answers are collected by MessageID and handed to callback in order.
+        # Returns the amount of bytes read
+        chunkSize = self.__getChunkSize(self._Connection['MaxReadSize'])
+        pending = deque()
+        readOffset = offset
+        endOffset = offset + bytesToRead
+        totalRead = 0
+        turn = 0
+        try:
+            while True:
+                while readOffset < endOffset:
+                    channel = self.__nextChannel(pending, turn, chunkSize)
+                    if channel is None:
+                        break
+                    turn += 1
+                    length = min(chunkSize, endOffset - readOffset)
+                    packetID = self.__onChannel(channel, lambda c: c.__sendRead(treeId, fileId, readOffset, length))
+                    if packetID is not None:
+                        pending.append((channel, packetID, readOffset, length))
+                        readOffset += length
+                if len(pending) == 0:
+                    break
+
+                channel, packetID, chunkOffset, length = pending.popleft()
+                data = self.__onChannel(channel, lambda c: c.__recvRead(treeId, fileId, packetID, chunkOffset))
+                if data is None:
+                    # Its channel broke, the chunk is read again through this connection
+                    data = self.__recvRead(treeId, fileId, self.__sendRead(treeId, fileId, chunkOffset, length),
+                                           chunkOffset)
+                # Short read, let's get the rest of the chunk before moving on
+                while 0 < len(data) < length:
+                    remaining = self.__recvRead(treeId, fileId, self.__sendRead(treeId, fileId, chunkOffset+len(data),
+                                                length-len(data)), chunkOffset+len(data))
+                    if len(remaining) == 0:
+                        break
+                    data += remaining
+
+                if len(data) > 0:
+                    totalRead += len(data)
+                    callback(data)
+                if len(data) < length:
+                    # End of file reached, nothing else to read
+                    self.__drainRequests(pending)
+                    pending.clear()
+                    break
+        except SessionError:
+            self.__drainRequests(pending)
+            raise
+        except Exception:
+            self.__discardRequests(pending)
+            raise
+        return totalRead
+
+    def __pipelinedWrite(self, treeId, fileId, offset, callback):
+        # Writes the data returned by callback(size) starting at offset, until it returns no data,
+        # keeping several WRITE requests in flight, spread over the session's channels. Returns the
+        # amount of bytes written
+        chunkSize = self.__getChunkSize(self._Connection['MaxWriteSize'])
+        pending = deque()
+        writeOffset = offset
+        finished = False
+        turn = 0
+        try:
+            while True:
+                while finished is False:
+                    channel = self.__nextChannel(pending, turn, chunkSize)
+                    if channel is None:
+                        break
+                    turn += 1
+                    data = callback(chunkSize)
+                    if len(data) == 0:
+                        finished = True
+                        break
+                    packetID = self.__onChannel(channel, lambda c: c.__sendWrite(treeId, fileId, data, writeOffset,
+                                                                                 len(data))[0])
+                    if packetID is None:
+                        # Its channel broke, this one will do
+                        channel = self
+                        packetID = self.__sendWrite(treeId, fileId, data, writeOffset, len(data))[0]
+                    pending.append((channel, packetID, writeOffset, data))
+                    writeOffset += len(data)
+                if len(pending) == 0:
+                    break
+
+                channel, packetID, chunkOffset, data = pending.popleft()
+                ans = self.__onChannel(channel, lambda c: c.recvSMB(packetID))
+                if ans is None:
+                    # Its channel broke, the chunk is written again through this connection
+                    bytesWritten = self.write(treeId, fileId, data, chunkOffset, len(data))
+                else:
+                    ans.isValidAnswer(STATUS_SUCCESS)
+                    bytesWritten = SMB2Write_Response(ans['Data'])['Count']
+                if bytesWritten < len(data):
+                    # Short write, let's write the rest of the chunk before moving on
+                    self.write(treeId, fileId, data[bytesWritten:], chunkOffset+bytesWritten, len(data)-bytesWritten)
+        except SessionError:
+            self.__drainRequests(pending)
+            raise
+        except Exception:
+            self.__discardRequests(pending)
+            raise
         return writeOffset - offset
 
+    def writeFile(self, treeId, fileId, data, offset = 0):
+        position = [0]
+        def getData(size):
+            chunk = data[position[0]:position[0]+size]
+            position[0] += len(chunk)
+            return chunk
+        return self.__pipelinedWrite(treeId, fileId, offset, getData)
+
     def isSnapshotRequest(self, path):
         #TODO: use a regex here?
         return '@GMT-' in path
@@ -1790,17 +2723,46 @@ class SMB3:
         fileId = None
         try:
             # ToDo, we're assuming it's a directory, we should check what the file type is
-            fileId = self.create(treeId, ntpath.dirname(path), FILE_READ_ATTRIBUTES | FILE_READ_DATA, FILE_SHARE_READ |
-                                 FILE_SHARE_WRITE | FILE_SHARE_DELETE,
-                                 FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_OPEN, 0,
-                                 createContexts=createContexts)
-            res = ''
+            def queryDirectoryPacket(fileId):
+                return self.__queryDirectoryPacket(treeId, fileId, ntpath.basename(path), maxBufferSize=65535,
+                                                   informationClass=FILE_FULL_DIRECTORY_INFORMATION)
+
+            # Most directories are opened, listed and closed in a single round trip. If the second
+            # QUERY_DIRECTORY still returns entries, there's more to list and we go the long way
+            createPacket = self.__createPacket(treeId, ntpath.dirname(path), FILE_READ_ATTRIBUTES | FILE_READ_DATA,
+                                               FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+                                               FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_OPEN, 0,
+                                               createContexts=createContexts)
+            answers = self.__compoundOnFile(treeId, createPacket, [queryDirectoryPacket(RELATED_FILEID),
+                                                                   queryDirectoryPacket(RELATED_FILEID)])
+            results = []
+            for ans in answers:
+                try:
+                    ans.isValidAnswer(STATUS_SUCCESS)
+                except SessionError as e:
+                    if (e.get_error_code()) != STATUS_NO_MORE_FILES:
+                        raise
+                    break
+                results.append(SMB2QueryDirectory_Response(ans['Data'])['Buffer'])
+            else:
+                results = []
+                fileId = self.create(treeId, ntpath.dirname(path), FILE_READ_ATTRIBUTES | FILE_READ_DATA, FILE_SHARE_READ |
+                                     FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+                                     FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_OPEN, 0,
+                                     createContexts=createContexts)
+                while True:
+                    try:
+                        results.append(self.queryDirectory(treeId, fileId, ntpath.basename(path), maxBufferSize=65535,
+                                                           informationClass=FILE_FULL_DIRECTORY_INFORMATION))
+                    except SessionError as e:
+                        if (e.get_error_code()) != STATUS_NO_MORE_FILES:
+                            raise
+                        break
+
             files = []
             from impacket import smb
-            while True:
+            for res in results:
                 try:
-                    res = self.queryDirectory(treeId, fileId, ntpath.basename(path), maxBufferSize=65535,
-                                              informationClass=FILE_FULL_DIRECTORY_INFORMATION)
                     nextOffset = 1
                     while nextOffset != 0:
                         fileInfo = smb.SMBFindFileFullDirectoryInfo(smb.SMB.FLAGS2_UNICODE)
@@ -1812,10 +2774,6 @@ class SMB3:
                                                     fileInfo['FileName'].decode('utf-16le')))
                         nextOffset = fileInfo['NextEntryOffset']
                         res = res[nextOffset:]
-                except SessionError as e:
-                    if (e.get_error_code()) != STATUS_NO_MORE_FILES:
-                        raise
-                    break
                 except Exception as e:
                     print(str(e))
                     raise
@@ -1835,13 +2793,11 @@ class SMB3:
 
         treeId = self.connectTree(shareName)
 
-        fileId = None
         try:
-            fileId = self.create(treeId, pathName, GENERIC_ALL, FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
-                                 FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_CREATE, 0)
+            createPacket = self.__createPacket(treeId, pathName, GENERIC_ALL, FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE,
+                                               FILE_DIRECTORY_FILE | FILE_SYNCHRONOUS_IO_NONALERT, FILE_CREATE, 0)
+            self.__compoundOnFile(treeId, createPacket, [])
         finally:
-            if fileId is not None:
-                self.close(treeId, fileId)
             self.disconnectTree(treeId)
 
         return True
@@ -1855,19 +2811,18 @@ class SMB3:
 
         treeId = self.connectTree(shareName)
 
-        fileId = None
         try:
-            fileId = self.create(treeId, pathName, desiredAccess=DELETE | FILE_READ_ATTRIBUTES | SYNCHRONIZE,
-                                 shareMode=FILE_SHARE_DELETE | FILE_SHARE_READ | FILE_SHARE_WRITE,
-                                 creationOptions=FILE_DIRECTORY_FILE | FILE_OPEN_REPARSE_POINT,
-                                 creationDisposition=FILE_OPEN, fileAttributes=0)
+            createPacket = self.__createPacket(treeId, pathName, desiredAccess=DELETE | FILE_READ_ATTRIBUTES | SYNCHRONIZE,
+                                               shareMode=FILE_SHARE_DELETE | FILE_SHARE_READ | FILE_SHARE_WRITE,
+                                               creationOptions=FILE_DIRECTORY_FILE | FILE_OPEN_REPARSE_POINT,
+                                               creationDisposition=FILE_OPEN, fileAttributes=0)
             from impacket import smb
             delete_req = smb.SMBSetFileDispositionInfo()
             delete_req['DeletePending'] = True
-            self.setInfo(treeId, fileId, inputBlob=delete_req, fileInfoClass=SMB2_FILE_DISPOSITION_INFO)
+            ans, = self.__compoundOnFile(treeId, createPacket, [self.__setInfoPacket(treeId, RELATED_FILEID, inputBlob=delete_req,
+                                                                                      fileInfoClass=SMB2_FILE_DISPOSITION_INFO)])
+            ans.isValidAnswer(STATUS_SUCCESS)
         finally:
-            if fileId is not None:
-                self.close(treeId, fileId)
             self.disconnectTree(treeId)
 
         return True
@@ -1881,12 +2836,10 @@ class SMB3:
 
         treeId = self.connectTree(shareName)
 
-        fileId = None
         try:
-            fileId = self.create(treeId, pathName,DELETE | FILE_READ_ATTRIBUTES, FILE_SHARE_DELETE, FILE_NON_DIRECTORY_FILE | FILE_DELETE_ON_CLOSE, FILE_OPEN, 0)
+            createPacket = self.__createPacket(treeId, pathName,DELETE | FILE_READ_ATTRIBUTES, FILE_SHARE_DELETE, FILE_NON_DIRECTORY_FILE | FILE_DELETE_ON_CLOSE, FILE_OPEN, 0)
+            self.__compoundOnFile(treeId, createPacket, [])
         finally:
-            if fileId is not None:
-                self.close(treeId, fileId)
             self.disconnectTree(treeId)
 
         return True
@@ -1907,29 +2860,48 @@ class SMB3:
 
         treeId = self.connectTree(shareName)
         fileId = None
+        closeId = None
         from impacket import smb
         try:
-            fileId = self.create(treeId, path, FILE_READ_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, mode, 0, createContexts=createContexts)
-            res = self.queryInfo(treeId, fileId)
-            fileInfo = smb.SMBQueryFileStandardInfo(res)
+            # The file is opened, queried and its first chunk read in a single round trip. The rest of it
+            # is read through the same handle
+            createPacket = self.__createPacket(treeId, path, FILE_READ_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, mode, 0, createContexts=createContexts)
+            createAns, queryAns, readAns = self.recvCompound(self.sendCompound([createPacket,
+                                                             self.__queryInfoPacket(treeId, RELATED_FILEID),
+                                                             self.__readPacket(treeId, RELATED_FILEID, offset, COMPOUND_READ_SIZE)]))
+            # If the CREATE failed, the rest of the requests failed the same way
+            createAns.isValidAnswer(STATUS_SUCCESS)
+            fileId = self.__keepOpen(treeId, self.__pathName(treeId, path), SMB2_OPLOCK_LEVEL_NONE,
+                                     SMB2Create_Response(createAns['Data']))
+            queryAns.isValidAnswer(STATUS_SUCCESS)
+            fileInfo = smb.SMBQueryFileStandardInfo(SMB2QueryInfo_Response(queryAns['Data'])['Buffer'])
             fileSize = fileInfo['EndOfFile']
-            if (fileSize-offset) < self._Connection['MaxReadSize']:
-                # Skip reading 0 bytes files.
-                if (fileSize-offset) > 0:
-                    data = self.read(treeId, fileId, offset, fileSize-offset)
-                    callback(data)
-            else:
-                written = 0
-                toBeRead = fileSize-offset
-                while written < toBeRead:
-                    data = self.read(treeId, fileId, offset, self._Connection['MaxReadSize'])
-                    written += len(data)
-                    offset  += len(data)
+            # Skip reading 0 bytes files.
+            if (fileSize-offset) > 0:
+                data = b''
+                try:
+                    readAns.isValidAnswer(STATUS_SUCCESS)
+                    data = SMB2Read_Response(readAns['Data'])['Buffer']
+                except SessionError as e:
+                    if e.get_error_code() != STATUS_END_OF_FILE:
+                        raise
+                if len(data) > 0:
                     callback(data)
+                offset += len(data)
+                if (fileSize-offset) > 0 and len(data) > 0:
+                    self.__pipelinedRead(treeId, fileId, offset, fileSize-offset, callback)
+            # Nothing left to read, the CLOSE goes along with the TREE_DISCONNECT so small files still take
+            # a single round trip besides the tree ones
+            closeId = self.sendSMB(self.__closePacket(treeId, fileId))
         finally:
-            if fileId is not None:
+            if closeId is None and fileId is not None:
                 self.close(treeId, fileId)
-            self.disconnectTree(treeId)
+            try:
+                self.disconnectTree(treeId)
+            finally:
+                if closeId is not None:
+                    self._Session['OpenTable'].pop(fileId, None)
+                    self.recvSMB(closeId).isValidAnswer(STATUS_SUCCESS)
 
     def storeFile(self, shareName, path, callback, mode = FILE_OVERWRITE_IF, offset = 0, password = None, shareAccessMode = FILE_SHARE_WRITE):
         # ToDo: Handle situations where share is password protected
@@ -1942,14 +2914,7 @@ class SMB3:
         fileId = None
         try:
             fileId = self.create(treeId, path, FILE_WRITE_DATA, shareAccessMode, FILE_NON_DIRECTORY_FILE, mode, 0)
-            finished = False
-            writeOffset = offset
-            while not finished:
-                data = callback(self._Connection['MaxWriteSize'])
-                if len(data) == 0:
-                    break
-                written = self.write(treeId, fileId, data, writeOffset, len(data))
-                writeOffset += written
+            self.__pipelinedWrite(treeId, fileId, offset, callback)
         finally:
             if fileId is not None:
                 self.close(treeId, fileId)
@@ -2005,7 +2970,9 @@ class SMB3:
     list_path                  = listPath
 
     def close_session(self):
+        self.__closeChannels()
         if self._NetBIOSSession:
+            self.__stopReader()
             self._NetBIOSSession.close()
             self._NetBIOSSession = None
 
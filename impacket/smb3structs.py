@@ -68,11 +68,17 @@ SMB2_PREAUTH_INTEGRITY_CAPABILITIES = 0x1
 SMB2_ENCRYPTION_CAPABILITIES        = 0x2
 SMB2_COMPRESSION_CAPABILITIES       = 0x3
 SMB2_NETNAME_NEGOTIATE_CONTEXT_ID   = 0x5
+SMB2_SIGNING_CAPABILITIES           = 0x8
 
 # SMB2_COMPRESSION_CAPABILITIES
 SMB2_COMPRESSION_CAPABILITIES_FLAG_NONE    = 0x0
 SMB2_COMPRESSION_CAPABILITIES_FLAG_CHAINED = 0x1
 
+# SMB2_SIGNING_CAPABILITIES
+SMB2_SIGNING_HMAC_SHA256 = 0x0
+SMB2_SIGNING_AES_CMAC    = 0x1
+SMB2_SIGNING_AES_GMAC    = 0x2
+
 # Compression Algorithms
 COMPRESSION_ALGORITHM_NONE         = 0x0
 COMPRESSION_ALGORITHM_LZNT1        = 0x1
@@ -80,6 +86,10 @@ COMPRESSION_ALGORITHM_LZ77         = 0x2
 COMPRESSION_ALGORITHM_LZ77_HUFFMAN = 0x3
 COMPRESSION_ALGORITHM_PATTERN_V1   = 0x4
 
+# SMB2_COMPRESSION_TRANSFORM_HEADER Flags
+SMB2_COMPRESSION_FLAG_NONE    = 0x0
+SMB2_COMPRESSION_FLAG_CHAINED = 0x1
+
 # Capabilities
 SMB2_GLOBAL_CAP_DFS                = 0x01
 SMB2_GLOBAL_CAP_LEASING            = 0x02
@@ -125,6 +135,7 @@ SMB2_SHAREFLAG_FORCE_LEVELII_OPLOCK        = 0x00001000
 SMB2_SHAREFLAG_ENABLE_HASH_V1              = 0x00002000
 SMB2_SHAREFLAG_ENABLE_HASH_V2              = 0x00004000
 SMB2_SHAREFLAG_ENCRYPT_DATA                = 0x00008000
+SMB2_SHAREFLAG_COMPRESS_DATA               = 0x00100000
 
 # Capabilities
 SMB2_SHARE_CAP_DFS                         = 0x00000008
@@ -266,6 +277,10 @@ SMB2_DHANDLE_FLAG_PERSISTENT = 0x02
 SMB2_CLOSE_FLAG_POSTQUERY_ATTRIB  = 0x0001
 
 # SMB2_READ
+# Flags
+SMB2_READFLAG_READ_UNBUFFERED    = 0x01
+SMB2_READFLAG_REQUEST_COMPRESSED = 0x02
+
 # Channel
 SMB2_CHANNEL_NONE     = 0x00
 SMB2_CHANNEL_RDMA_V1  = 0x01
@@ -445,6 +460,8 @@ SL_INDEX_SPECIFIED      = 0x00000004
 # TRANSFORM_HEADER
 SMB2_ENCRYPTION_AES128_CCM = 0x0001
 SMB2_ENCRYPTION_AES128_GCM = 0x0002
+SMB2_ENCRYPTION_AES256_CCM = 0x0003
+SMB2_ENCRYPTION_AES256_GCM = 0x0004
 
 
 # STRUCtures
@@ -641,6 +658,13 @@ class SMB2EncryptionCapabilities(Structure):
         ('Ciphers',':=""'),
     )
 
+# SMB2_SIGNING_CAPABILITIES
+class SMB2SigningCapabilities(Structure):
+    structure = (
+        ('SigningAlgorithmCount','<H=0'),
+        ('SigningAlgorithms',':=""'),
+    )
+
 # SMB2_COMPRESSION_CAPABILITIES
 class SMB2CompressionCapabilities(Structure):
     structure = (
@@ -1559,10 +1583,16 @@ class SMB2_COMPRESSION_TRANSFORM_HEADER(Structure):
         ('Offset_Length','<L=0'),
     )
 
+class SMB2_COMPRESSION_TRANSFORM_HEADER_CHAINED(Structure):
+    structure = (
+        ('ProtocolID','<L=0'),
+        ('OriginalCompressedSegmentSize','<L=0'),
+    )
+
 class SMB2_COMPRESSION_PAYLOAD_HEADER(Structure):
     structure = (
         ('AlgorithmId','<H=0'),
-        ('Reserved','<H=0'),
+        ('Flags','<H=0'),
         ('Length','<L=0'),
     )
 
@@ -1570,7 +1600,7 @@ class SMB2_COMPRESSION_PATTERN_PAYLOAD_V1(Structure):
     structure = (
         ('Pattern','B=0'),
         ('Reserved1','B=0'),
-        ('Reserved2','B=0'),
+        ('Reserved2','<H=0'),
         ('Repetitions','<L=0'),
     )
 
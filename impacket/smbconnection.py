@@ -640,6 +640,30 @@ class SMBConnection:
         except (smb.SessionError, smb3.SessionError) as e:
             raise SessionError(e.get_error_code(), e.get_error_packet())
 
+    def queryPathInfo(self, treeId, pathName):
+        """
+        queries basic information about a file/directory by its path. In SMB2/3 the file is opened, queried and
+        closed in a single round trip
+
+        :param HANDLE treeId: a valid handle for the share where the file is to be queried
+        :param string pathName: the path name of the file/directory to be queried
+
+        :return: a smb.SMBQueryFileStandardInfo structure.
+        :raise SessionError: if error
+        """
+        if self.getDialect() == smb.SMB_DIALECT:
+            fileId = self.openFile(treeId, pathName, desiredAccess=FILE_READ_ATTRIBUTES,
+                                   shareMode=FILE_SHARE_READ | FILE_SHARE_WRITE | FILE_SHARE_DELETE, creationOption=0)
+            try:
+                return self.queryInfo(treeId, fileId)
+            finally:
+                self.closeFile(treeId, fileId)
+        try:
+            res = self._SMBConnection.queryPathInfo(treeId, pathName)
+            return smb.SMBQueryFileStandardInfo(res)
+        except (smb.SessionError, smb3.SessionError) as e:
+            raise SessionError(e.get_error_code(), e.get_error_packet())
+
     def createDirectory(self, shareName, pathName ):
         """
         creates a directory
@@ -942,6 +966,43 @@ class SMBConnection:
         except (smb.SessionError, smb3.SessionError) as e:
             raise SessionError(e.get_error_code(), e.get_error_packet())
 
+    def setTransferWindow(self, windowSize):
+        # Max amount of bytes getFile(), putFile() and writeFile() keep in flight. SMB1 sends one request at a time
+        if self.getDialect() != smb.SMB_DIALECT:
+            self._SMBConnection.setTransferWindow(windowSize)
+
+    def enableMultiChannel(self, channels=2):
+        """
+        binds more connections (channels) to the current session, so file transfers are spread over them.
+        Needs SMB 3 and a server supporting multichannel, otherwise the session keeps its single channel
+
+        :param int channels: amount of channels the session should have
+
+        :return: the amount of channels the session has
+        :raise SessionError: if error
+        """
+        if self.getDialect() == smb.SMB_DIALECT:
+            return 1
+        try:
+            return self._SMBConnection.enableMultiChannel(channels)
+        except (smb.SessionError, smb3.SessionError) as e:
+            raise SessionError(e.get_error_code(), e.get_error_packet())
+
+    def enableConcurrentRequests(self):
+        """
+        starts a thread reading the server answers, so several threads can use this connection at the same
+        time (e.g. reading files while an RPC pipe is open). Call it once logged in. Needs SMB 2 or newer
+
+        :return: None
+        :raise SessionError: if error
+        """
+        if self.getDialect() == smb.SMB_DIALECT:
+            raise SessionError(error = nt_errors.STATUS_NOT_SUPPORTED)
+        try:
+            self._SMBConnection.enableConcurrentRequests()
+        except (smb.SessionError, smb3.SessionError) as e:
+            raise SessionError(e.get_error_code(), e.get_error_packet())
+
     def getSessionKey(self):
         if self.getDialect() == smb.SMB_DIALECT:
             return self._SMBConnection.get_session_key()
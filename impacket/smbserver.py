@@ -25,6 +25,9 @@
 # estamos en la B
 
 import calendar
+import collections
+import itertools
+import selectors
 import socket
 import time
 import datetime
@@ -46,10 +49,12 @@ import hmac
 from binascii import unhexlify, hexlify, a2b_hex
 from six import b, ensure_str
 from six.moves import configparser, socketserver
+from Cryptodome.Cipher import AES
 
 # For signing
-from impacket import smb, nmb, ntlm, uuid
+from impacket import smb, nmb, ntlm, uuid, crypto
 from impacket import smb3structs as smb2
+from impacket.smb3 import COMPRESSORS, COMPRESSION_MIN_SIZE, SessionError, compressSMB, decompressSMB
 from impacket.spnego import SPNEGO_NegTokenInit, TypesMech, MechTypes, SPNEGO_NegTokenResp, ASN1_AID, \
     ASN1_SUPPORTED_MECH
 from impacket.nt_errors import STATUS_NO_MORE_FILES, STATUS_NETWORK_NAME_DELETED, STATUS_INVALID_PARAMETER, \
@@ -57,7 +62,7 @@ from impacket.nt_errors import STATUS_NO_MORE_FILES, STATUS_NETWORK_NAME_DELETED
     STATUS_FILE_IS_A_DIRECTORY, STATUS_NOT_IMPLEMENTED, STATUS_INVALID_HANDLE, STATUS_OBJECT_NAME_COLLISION, \
     STATUS_NO_SUCH_FILE, STATUS_CANCELLED, STATUS_OBJECT_NAME_NOT_FOUND, STATUS_SUCCESS, STATUS_ACCESS_DENIED, \
     STATUS_NOT_SUPPORTED, STATUS_INVALID_DEVICE_REQUEST, STATUS_FS_DRIVER_REQUIRED, STATUS_INVALID_INFO_CLASS, \
-    STATUS_LOGON_FAILURE, STATUS_OBJECT_PATH_SYNTAX_BAD
+    STATUS_LOGON_FAILURE, STATUS_OBJECT_PATH_SYNTAX_BAD, STATUS_USER_SESSION_DELETED
 
 # Setting LOG to current's module name
 LOG = logging.getLogger(__name__)
@@ -2826,15 +2831,39 @@ class SMB2Commands:
             SMBCommand = smb.SMBCommand(recvPacket['Data'][0])
 
             dialects = SMBCommand['Data'].split(b'\x02')
-            if b'SMB 2.002\x00' in dialects or b'SMB 2.???\x00' in dialects:
+            if b'SMB 2.???\x00' in dialects and smbServer.getSMB3Support() is True:
+                # The client will send a SMB2 NEGOTIATE next, telling us whether it talks SMB 3
+                respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_WILDCARD
+            elif b'SMB 2.002\x00' in dialects or b'SMB 2.???\x00' in dialects:
                 respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_002
             else:
                 # Client does not support SMB2 fallbacking
                 raise Exception('SMB2 not supported, fallbacking')
         else:
-            respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_002
+            negotiateRequest = smb2.SMB2Negotiate(recvPacket['Data'])
+            dialects = negotiateRequest['Dialects'][:negotiateRequest['DialectCount']]
+            if smbServer.getSMB3Support() is True and smb2.SMB2_DIALECT_311 in dialects:
+                respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_311
+            elif smbServer.getSMB3Support() is True and smb2.SMB2_DIALECT_30 in dialects:
+                respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_30
+            else:
+                respSMBCommand['DialectRevision'] = smb2.SMB2_DIALECT_002
+        connData['Dialect'] = respSMBCommand['DialectRevision']
+        connData['CipherId'] = 0
+        connData['CompressionIds'] = []
+        connData['ServerCapabilities'] = 0
+        connData['SigningAlgorithm'] = smb2.SMB2_SIGNING_HMAC_SHA256
+        if connData['Dialect'] >= smb2.SMB2_DIALECT_30:
+            # Other connections can be bound to the sessions established here
+            connData['ServerCapabilities'] = smb2.SMB2_GLOBAL_CAP_MULTI_CHANNEL
+            connData['SigningAlgorithm'] = smb2.SMB2_SIGNING_AES_CMAC
+            if connData['Dialect'] == smb2.SMB2_DIALECT_30 and \
+                    negotiateRequest['Capabilities'] & smb2.SMB2_GLOBAL_CAP_ENCRYPTION:
+                # SMB 3.0 only knows about AES-128-CCM
+                connData['ServerCapabilities'] |= smb2.SMB2_GLOBAL_CAP_ENCRYPTION
+                connData['CipherId'] = smb2.SMB2_ENCRYPTION_AES128_CCM
         respSMBCommand['ServerGuid'] = b'A' * 16
-        respSMBCommand['Capabilities'] = 0
+        respSMBCommand['Capabilities'] = connData['ServerCapabilities']
         respSMBCommand['MaxTransactSize'] = 65536
         respSMBCommand['MaxReadSize'] = 65536
         respSMBCommand['MaxWriteSize'] = 65536
@@ -2848,12 +2877,122 @@ class SMB2Commands:
         respSMBCommand['Buffer'] = blob.getData()
         respSMBCommand['SecurityBufferLength'] = len(respSMBCommand['Buffer'])
 
+        if connData['Dialect'] == smb2.SMB2_DIALECT_311:
+            contextList = SMB2Commands.negotiateContexts(connData, negotiateRequest, recvPacket)
+            if contextList is None:
+                respPacket['Status'] = STATUS_INVALID_PARAMETER
+                respPacket['Data'] = smb2.SMB2Error()
+                smbServer.setConnectionData(connId, connData)
+                return None, [respPacket], STATUS_INVALID_PARAMETER
+            # Negotiate contexts start at the first 8-byte aligned offset after the security buffer
+            padLen = -(respSMBCommand['SecurityBufferOffset'] + respSMBCommand['SecurityBufferLength']) % 8
+            respSMBCommand['Padding'] = b'\x00' * padLen
+            respSMBCommand['NegotiateContextOffset'] = respSMBCommand['SecurityBufferOffset'] + \
+                                                       respSMBCommand['SecurityBufferLength'] + padLen
+            respSMBCommand['NegotiateContextCount'] = len(contextList)
+            for i in range(len(contextList) - 1):
+                contextList[i] += b'\x00' * (-len(contextList[i]) % 8)
+            respSMBCommand['NegotiateContextList'] = b''.join(contextList)
+
         respPacket['Data'] = respSMBCommand
 
         smbServer.setConnectionData(connId, connData)
 
         return None, [respPacket], STATUS_SUCCESS
 
+    @staticmethod
+    def negotiateContexts(connData, negotiateRequest, recvPacket):
+        # Processes the SMB 3.1.1 negotiate contexts sent by the client, picking the cipher, signing
+        # and compression algorithms for this connection. Returns the contexts to answer back, None if
+        # the client didn't offer SHA-512 for preauth integrity
+        contextData = smb2.SMB311ContextData(negotiateRequest['ClientStartTime'])
+        contextList = recvPacket['Data'][contextData['NegotiateContextOffset'] - 64:]
+        hashAlgorithms = ciphers = signingAlgorithms = compressionAlgorithms = ()
+        compressionFlags = smb2.SMB2_COMPRESSION_CAPABILITIES_FLAG_NONE
+        offset = 0
+        for i in range(contextData['NegotiateContextCount']):
+            context = smb2.SMB2NegotiateContext(contextList[offset:])
+            if context['ContextType'] == smb2.SMB2_PREAUTH_INTEGRITY_CAPABILITIES:
+                preAuthCapabilities = smb2.SMB2PreAuthIntegrityCapabilities(context['Data'])
+                hashAlgorithms = struct.unpack('<%dH' % preAuthCapabilities['HashAlgorithmCount'],
+                                               preAuthCapabilities['HashAlgorithms'])
+            elif context['ContextType'] == smb2.SMB2_ENCRYPTION_CAPABILITIES:
+                encryptionCapabilities = smb2.SMB2EncryptionCapabilities(context['Data'])
+                ciphers = struct.unpack('<%dH' % encryptionCapabilities['CipherCount'],
+                                        encryptionCapabilities['Ciphers'][:2 * encryptionCapabilities['CipherCount']])
+            elif context['ContextType'] == smb2.SMB2_SIGNING_CAPABILITIES:
+                signingCapabilities = smb2.SMB2SigningCapabilities(context['Data'])
+                signingAlgorithms = struct.unpack('<%dH' % signingCapabilities['SigningAlgorithmCount'],
+                                                  signingCapabilities['SigningAlgorithms'][
+                                                  :2 * signingCapabilities['SigningAlgorithmCount']])
+            elif context['ContextType'] == smb2.SMB2_COMPRESSION_CAPABILITIES:
+                compressionCapabilities = smb2.SMB2CompressionCapabilities(context['Data'])
+                compressionAlgorithms = struct.unpack('<%dH' % compressionCapabilities['CompressionAlgorithmCount'],
+                                                      compressionCapabilities['CompressionAlgorithms'][
+                                                      :2 * compressionCapabilities['CompressionAlgorithmCount']])
+                compressionFlags = compressionCapabilities['Flags']
+            offset += 8 + context['DataLength'] + (-context['DataLength'] % 8)
+
+        # SHA-512 is the only hash algorithm defined
+        if 1 not in hashAlgorithms:
+            return None
+
+        preAuthCapabilities = smb2.SMB2PreAuthIntegrityCapabilities()
+        preAuthCapabilities['HashAlgorithmCount'] = 1
+        preAuthCapabilities['SaltLength'] = 32
+        preAuthCapabilities['HashAlgorithms'] = struct.pack('<H', 1)
+        preAuthCapabilities['Salt'] = os.urandom(32)
+        answers = [(smb2.SMB2_PREAUTH_INTEGRITY_CAPABILITIES, preAuthCapabilities)]
+
+        # The client lists them in order of preference, and we support them all
+        supportedCiphers = (smb2.SMB2_ENCRYPTION_AES128_CCM, smb2.SMB2_ENCRYPTION_AES128_GCM,
+                            smb2.SMB2_ENCRYPTION_AES256_CCM, smb2.SMB2_ENCRYPTION_AES256_GCM)
+        if len(ciphers) > 0:
+            connData['CipherId'] = next((cipherId for cipherId in ciphers if cipherId in supportedCiphers), 0)
+            encryptionCapabilities = smb2.SMB2EncryptionCapabilities()
+            encryptionCapabilities['CipherCount'] = 1
+            encryptionCapabilities['Ciphers'] = struct.pack('<H', connData['CipherId'])
+            answers.append((smb2.SMB2_ENCRYPTION_CAPABILITIES, encryptionCapabilities))
+
+        supportedSigningAlgorithms = (smb2.SMB2_SIGNING_HMAC_SHA256, smb2.SMB2_SIGNING_AES_CMAC,
+                                      smb2.SMB2_SIGNING_AES_GMAC)
+        if len(signingAlgorithms) > 0:
+            connData['SigningAlgorithm'] = next((algorithmId for algorithmId in signingAlgorithms if
+                                                 algorithmId in supportedSigningAlgorithms), smb2.SMB2_SIGNING_AES_CMAC)
+            signingCapabilities = smb2.SMB2SigningCapabilities()
+            signingCapabilities['SigningAlgorithmCount'] = 1
+            signingCapabilities['SigningAlgorithms'] = struct.pack('<H', connData['SigningAlgorithm'])
+            answers.append((smb2.SMB2_SIGNING_CAPABILITIES, signingCapabilities))
+
+        # Pattern_V1 is only allowed with chained compression
+        if len(compressionAlgorithms) > 0:
+            supportedCompressionAlgorithms = list(COMPRESSORS)
+            connData['CompressionChained'] = \
+                (compressionFlags & smb2.SMB2_COMPRESSION_CAPABILITIES_FLAG_CHAINED) > 0
+            if connData['CompressionChained'] is True:
+                supportedCompressionAlgorithms.append(smb2.COMPRESSION_ALGORITHM_PATTERN_V1)
+            connData['CompressionIds'] = [algorithmId for algorithmId in compressionAlgorithms if
+                                          algorithmId in supportedCompressionAlgorithms]
+            compressionCapabilities = smb2.SMB2CompressionCapabilities()
+            if len(connData['CompressionIds']) > 0:
+                compressionCapabilities['CompressionAlgorithmCount'] = len(connData['CompressionIds'])
+                compressionCapabilities['Flags'] = compressionFlags & smb2.SMB2_COMPRESSION_CAPABILITIES_FLAG_CHAINED
+                compressionCapabilities['CompressionAlgorithms'] = b''.join(
+                    [struct.pack('<H', algorithmId) for algorithmId in connData['CompressionIds']])
+            else:
+                compressionCapabilities['CompressionAlgorithmCount'] = 1
+                compressionCapabilities['CompressionAlgorithms'] = struct.pack('<H', smb2.COMPRESSION_ALGORITHM_NONE)
+            answers.append((smb2.SMB2_COMPRESSION_CAPABILITIES, compressionCapabilities))
+
+        contextList = []
+        for contextType, capabilities in answers:
+            context = smb2.SMB2NegotiateContext()
+            context['ContextType'] = contextType
+            context['Data'] = capabilities.getData()
+            context['DataLength'] = len(context['Data'])
+            contextList.append(context.getData())
+        return contextList
+
     @staticmethod
     def smb2SessionSetup(connId, smbServer, recvPacket):
         connData = smbServer.getConnectionData(connId, checkStatus=False)
@@ -2971,7 +3110,11 @@ class SMB2Commands:
             # in the connection's data
             # Picking a fixed value
             # TODO: Manage more UIDs for the same session
-            connData['Uid'] = random.randint(1, 0xffffffff)
+            if sessionSetupData['Flags'] & smb2.SMB2_SESSION_FLAG_BINDING:
+                # This connection is becoming another channel of an existing session, same SessionID
+                connData['Uid'] = recvPacket['SessionID']
+            else:
+                connData['Uid'] = random.randint(1, 0xffffffff)
             # Let's store it in the connection data
             connData['CHALLENGE_MESSAGE'] = challengeMessage
 
@@ -3006,8 +3149,17 @@ class SMB2Commands:
 
                     if sessionKey is not None:
                         connData['SignatureEnabled'] = True
-                        connData['SigningSessionKey'] = sessionKey
+                        if connData['Dialect'] == smb2.SMB2_DIALECT_311:
+                            connData['SigningSessionKey'] = crypto.KDF_CounterMode(sessionKey, b"SMBSigningKey\x00",
+                                                                                   connData['SessionPreauthIntegrityHashValue'],
+                                                                                   128)
+                        elif connData['Dialect'] == smb2.SMB2_DIALECT_30:
+                            connData['SigningSessionKey'] = crypto.KDF_CounterMode(sessionKey, b"SMB2AESCMAC\x00",
+                                                                                   b"SmbSign\x00", 128)
+                        else:
+                            connData['SigningSessionKey'] = sessionKey
                         connData['SignSequenceNumber'] = 1
+                        SMB2Commands.deriveEncryptionKeys(connData, sessionKey)
                 else:
                     errorCode = STATUS_LOGON_FAILURE
             else:
@@ -3022,6 +3174,13 @@ class SMB2Commands:
                     isGuest = True
                     errorCode = STATUS_SUCCESS
 
+            if errorCode == STATUS_SUCCESS and sessionSetupData['Flags'] & smb2.SMB2_SESSION_FLAG_BINDING:
+                if isGuest or isAnonymus:
+                    errorCode = STATUS_NOT_SUPPORTED
+                else:
+                    errorCode = SMB2Commands.bindSession(connId, smbServer, connData, recvPacket,
+                                                         authenticateMessage)
+
             if errorCode == STATUS_SUCCESS:
                 connData['Authenticated'] = True
                 respToken = SPNEGO_NegTokenResp()
@@ -3083,6 +3242,58 @@ class SMB2Commands:
 
         return [respSMBCommand], None, errorCode
 
+    @staticmethod
+    def deriveEncryptionKeys(connData, sessionKey):
+        # The server decrypts with the client's encryption key and the other way around
+        if connData['CipherId'] == 0:
+            return
+        if connData['Dialect'] == smb2.SMB2_DIALECT_311:
+            keyLength = 128
+            if connData['CipherId'] in (smb2.SMB2_ENCRYPTION_AES256_CCM, smb2.SMB2_ENCRYPTION_AES256_GCM):
+                keyLength = 256
+            connData['DecryptionKey'] = crypto.KDF_CounterMode(sessionKey, b"SMBC2SCipherKey\x00",
+                                                               connData['SessionPreauthIntegrityHashValue'], keyLength)
+            connData['EncryptionKey'] = crypto.KDF_CounterMode(sessionKey, b"SMBS2CCipherKey\x00",
+                                                               connData['SessionPreauthIntegrityHashValue'], keyLength)
+        else:
+            connData['DecryptionKey'] = crypto.KDF_CounterMode(sessionKey, b"SMB2AESCCM\x00", b"ServerIn \x00", 128)
+            connData['EncryptionKey'] = crypto.KDF_CounterMode(sessionKey, b"SMB2AESCCM\x00", b"ServerOut\x00", 128)
+
+    @staticmethod
+    def bindSession(connId, smbServer, connData, recvPacket, authenticateMessage):
+        # Looks for the connection that established the session connData['Uid'] and, if the
+        # same user authenticated here and the request is signed with the session's key ([MS-SMB2]
+        # 3.3.5.5.2), shares its trees and files with this new channel
+        for otherConnId, otherConnData in smbServer.getActiveConnections().items():
+            if otherConnId == connId or otherConnData['Uid'] != connData['Uid'] or \
+                    ('AUTHENTICATE_MESSAGE' in otherConnData) is False:
+                continue
+            if connData['Dialect'] < smb2.SMB2_DIALECT_30 or otherConnData['Dialect'] != connData['Dialect']:
+                return STATUS_INVALID_PARAMETER
+            if recvPacket['Flags'] & smb2.SMB2_FLAGS_SIGNED == 0:
+                smbServer.log("Unsigned request binding session 0x%x" % connData['Uid'], logging.ERROR)
+                return STATUS_INVALID_PARAMETER
+            signedPacket = smb2.SMB2Packet(recvPacket.getData())
+            smbServer.signSMBv2(signedPacket, otherConnData['SigningSessionKey'],
+                                signingAlgorithm=connData['SigningAlgorithm'])
+            if signedPacket['Signature'] != recvPacket['Signature']:
+                smbServer.log("Wrong signature binding session 0x%x" % connData['Uid'], logging.ERROR)
+                return STATUS_ACCESS_DENIED
+            otherAuthenticateMessage = otherConnData['AUTHENTICATE_MESSAGE']
+            if otherAuthenticateMessage['user_name'].decode('utf-16le').lower() != \
+                    authenticateMessage['user_name'].decode('utf-16le').lower() or \
+                    otherAuthenticateMessage['domain_name'].decode('utf-16le').lower() != \
+                    authenticateMessage['domain_name'].decode('utf-16le').lower():
+                return STATUS_ACCESS_DENIED
+            connData['ConnectedShares'] = otherConnData['ConnectedShares']
+            connData['OpenedFiles'] = otherConnData['OpenedFiles']
+            # Encryption keys belong to the session, every channel signs with its own key though
+            connData['EncryptionKey'] = otherConnData['EncryptionKey']
+            connData['DecryptionKey'] = otherConnData['DecryptionKey']
+            smbServer.log("Channel bound to session 0x%x" % connData['Uid'])
+            return STATUS_SUCCESS
+        return STATUS_USER_SESSION_DELETED
+
     @staticmethod
     def smb2TreeConnect(connId, smbServer, recvPacket):
         connData = smbServer.getConnectionData(connId)
@@ -3114,7 +3325,14 @@ class SMB2Commands:
             path = ntpath.basename(UNCOrShare)
 
         share = searchShare(connId, path.upper(), smbServer)
-        if share is not None:
+        encryptData = share is not None and share.get('encrypt data', 'no').lower() in ('yes', 'true', '1')
+        if encryptData is True and len(connData['EncryptionKey']) == 0:
+            # The share only allows encrypted access, and this session can't do it
+            smbServer.log("SMB2_TREE_CONNECT %s requires encryption" % path, logging.ERROR)
+            share = None
+            errorCode = STATUS_ACCESS_DENIED
+            respPacket['Status'] = errorCode
+        elif share is not None:
             # Simple way to generate a Tid
             if len(connData['ConnectedShares']) == 0:
                 tid = 1
@@ -3136,6 +3354,11 @@ class SMB2Commands:
         else:
             respSMBCommand['ShareType'] = smb2.SMB2_SHARE_TYPE_DISK
             respSMBCommand['ShareFlags'] = 0x0
+        if encryptData is True:
+            respSMBCommand['ShareFlags'] |= smb2.SMB2_SHAREFLAG_ENCRYPT_DATA
+        if share is not None and share.get('compress data', 'no').lower() in ('yes', 'true', '1') and \
+                len(connData['CompressionIds']) > 0:
+            respSMBCommand['ShareFlags'] |= smb2.SMB2_SHAREFLAG_COMPRESS_DATA
 
         respSMBCommand['Capabilities'] = 0
         respSMBCommand['MaximalAccess'] = 0x000f01ff
@@ -3144,7 +3367,8 @@ class SMB2Commands:
 
         # Sign the packet if needed
         if connData['SignatureEnabled']:
-            smbServer.signSMBv2(respPacket, connData['SigningSessionKey'])
+            smbServer.signSMBv2(respPacket, connData['SigningSessionKey'],
+                                signingAlgorithm=connData['SigningAlgorithm'])
         smbServer.setConnectionData(connId, connData)
 
         return None, [respPacket], errorCode
@@ -3561,10 +3785,15 @@ class SMB2Commands:
                 try:
                     if fileHandle != PIPE_FILE_DESCRIPTOR:
                         offset = writeRequest['Offset']
-                        # If we're trying to write past the file end we just skip the write call (Vista does this)
-                        if os.lseek(fileHandle, 0, 2) >= offset:
-                            os.lseek(fileHandle, offset, 0)
-                            os.write(fileHandle, writeRequest['Buffer'])
+                        # If we're trying to write past the file end we just skip the write call (Vista does this).
+                        # Not for SMB 3 though, writes spread over several channels can arrive out of order
+                        if connData['Dialect'] >= smb2.SMB2_DIALECT_30 or os.fstat(fileHandle).st_size >= offset:
+                            # pwrite() doesn't move the file offset other channels may be using
+                            if hasattr(os, 'pwrite'):
+                                os.pwrite(fileHandle, writeRequest['Buffer'], offset)
+                            else:
+                                os.lseek(fileHandle, offset, 0)
+                                os.write(fileHandle, writeRequest['Buffer'])
                     else:
                         sock = connData['OpenedFiles'][fileID]['Socket']
                         sock.send(writeRequest['Buffer'])
@@ -3608,8 +3837,12 @@ class SMB2Commands:
                 try:
                     if fileHandle != PIPE_FILE_DESCRIPTOR:
                         offset = readRequest['Offset']
-                        os.lseek(fileHandle, offset, 0)
-                        content = os.read(fileHandle, readRequest['Length'])
+                        # pread() doesn't move the file offset other channels may be using
+                        if hasattr(os, 'pread'):
+                            content = os.pread(fileHandle, readRequest['Length'], offset)
+                        else:
+                            os.lseek(fileHandle, offset, 0)
+                            content = os.read(fileHandle, readRequest['Length'])
                     else:
                         sock = connData['OpenedFiles'][fileID]['Socket']
                         content = sock.recv(readRequest['Length'])
@@ -3618,6 +3851,14 @@ class SMB2Commands:
                     respSMBCommand['DataLength'] = len(content)
                     respSMBCommand['DataRemaining'] = 0
                     respSMBCommand['Buffer'] = content
+
+                    # The client asks for it in every READ, or the share wants everything compressed.
+                    # Since SMB 3.0.2 Reserved holds the READ Flags
+                    if len(connData['CompressionIds']) > 0 and len(content) >= COMPRESSION_MIN_SIZE:
+                        if readRequest['Reserved'] & smb2.SMB2_READFLAG_REQUEST_COMPRESSED or \
+                                connData['ConnectedShares'][recvPacket['TreeID']].get('compress data', 'no').lower() in \
+                                ('yes', 'true', '1'):
+                            connData['CompressResponse'] = True
                 except Exception as e:
                     smbServer.log('SMB2_READ: %s ' % e, logging.ERROR)
                     errorCode = STATUS_ACCESS_DENIED
@@ -3932,14 +4173,38 @@ class Ioctls:
 
         validateNegotiateInfo = smb2.VALIDATE_NEGOTIATE_INFO(ioctlRequest['Buffer'])
         validateNegotiateInfoResponse = smb2.VALIDATE_NEGOTIATE_INFO_RESPONSE()
-        validateNegotiateInfoResponse['Capabilities'] = 0
+        validateNegotiateInfoResponse['Capabilities'] = connData['ServerCapabilities']
         validateNegotiateInfoResponse['Guid'] = b'A' * 16
         validateNegotiateInfoResponse['SecurityMode'] = 1
-        validateNegotiateInfoResponse['Dialect'] = smb2.SMB2_DIALECT_002
+        validateNegotiateInfoResponse['Dialect'] = connData['Dialect']
 
         smbServer.setConnectionData(connId, connData)
         return validateNegotiateInfoResponse.getData(), errorCode
 
+    @staticmethod
+    def fsctlQueryNetworkInterfaceInfo(connId, smbServer, ioctlRequest):
+        connData = smbServer.getConnectionData(connId)
+
+        if connData['ServerIP'] is None:
+            return smb2.SMB2Error(), STATUS_NOT_SUPPORTED
+
+        errorCode = STATUS_SUCCESS
+
+        # We just know about the address this connection came in through, that's the one reported
+        networkInterfaceInfo = smb2.NETWORK_INTERFACE_INFO()
+        networkInterfaceInfo['IfIndex'] = 1
+        networkInterfaceInfo['Capability'] = 0
+        networkInterfaceInfo['LinkSpeed'] = 1000000000
+        if ':' in connData['ServerIP']:
+            networkInterfaceInfo['SockAddr_Storage'] = struct.pack('<HHL', 0x17, 0, 0) + \
+                                                       socket.inet_pton(socket.AF_INET6, connData['ServerIP'])
+        else:
+            networkInterfaceInfo['SockAddr_Storage'] = struct.pack('<HH', 0x2, 0) + \
+                                                       socket.inet_aton(connData['ServerIP'])
+
+        smbServer.setConnectionData(connId, connData)
+        return networkInterfaceInfo.getData(), errorCode
+
 
 class SMBSERVERHandler(socketserver.BaseRequestHandler):
     def __init__(self, request, client_address, server, select_poll=False):
@@ -3955,12 +4220,12 @@ class SMBSERVERHandler(socketserver.BaseRequestHandler):
 
     def handle(self):
         self.__SMB.log("Incoming connection (%s,%d)" % (self.__ip, self.__port))
-        self.__SMB.addConnection(self.__connId, self.__ip, self.__port)
+        self.__SMB.addConnection(self.__connId, self.__ip, self.__port, self.__request.getsockname()[0])
+        session = nmb.NetBIOSTCPSession(self.__SMB.getServerName(), 'HOST', self.__ip, sess_port=self.__port,
+                                        sock=self.__request, select_poll=self.__select_poll)
         while True:
             try:
                 # First of all let's get the NETBIOS packet
-                session = nmb.NetBIOSTCPSession(self.__SMB.getServerName(), 'HOST', self.__ip, sess_port=self.__port,
-                                                sock=self.__request, select_poll=self.__select_poll)
                 try:
                     p = session.recv_packet(self.__timeOut)
                 except nmb.NetBIOSTimeout:
@@ -3968,26 +4233,8 @@ class SMBSERVERHandler(socketserver.BaseRequestHandler):
                 except nmb.NetBIOSError:
                     break
 
-                if p.get_type() == nmb.NETBIOS_SESSION_REQUEST:
-                    # Someone is requesting a session, we're gonna accept them all :)
-                    _, rn, my = p.get_trailer().split(b' ')
-                    remote_name = nmb.decode_name(b'\x20' + rn)
-                    myname = nmb.decode_name(b'\x20' + my)
-                    self.__SMB.log(
-                        "NetBIOS Session request (%s,%s,%s)" % (self.__ip, remote_name[1].strip(), myname[1]))
-                    r = nmb.NetBIOSSessionPacket()
-                    r.set_type(nmb.NETBIOS_SESSION_POSITIVE_RESPONSE)
-                    r.set_trailer(p.get_trailer())
-                    self.__request.send(r.rawData())
-                else:
-                    resp = self.__SMB.processRequest(self.__connId, p.get_trailer())
-                    # Send all the packets received. Except for big transactions this should be
-                    # a single packet
-                    for i in resp:
-                        if hasattr(i, 'getData'):
-                            session.send_packet(i.getData())
-                        else:
-                            session.send_packet(i)
+                for data in self.__SMB.processSessionPacket(self.__connId, p):
+                    self.__request.sendall(data)
             except Exception as e:
                 self.__SMB.log("Handle: %s" % e)
                 # import traceback
@@ -4001,8 +4248,187 @@ class SMBSERVERHandler(socketserver.BaseRequestHandler):
         return socketserver.BaseRequestHandler.finish(self)
 
 
+class SMBSERVERConnection:
+    """
+    State of a connection served by an SMBSERVERLoop: the socket, the bytes received that don't make a
+    full NetBIOS packet yet and the answers the socket didn't take yet. Only the loop owning the connection
+    touches it
+    """
+    def __init__(self, connId, sock, client_address):
+        self.connId = connId
+        self.sock = sock
+        # In case of AF_INET6 the client_address contains 4 items, ignore the last 2
+        self.ip, self.port = client_address[:2]
+        self.inBuffer = bytearray()
+        self.outBuffer = collections.deque()
+        self.lastActivity = time.time()
+        self.closed = False
+
+
+class SMBSERVERLoop(threading.Thread):
+    """
+    Serves many connections from a single thread, with non blocking sockets and a selector. SMBSERVER
+    hands the accepted connections to its loops. Requests are processed one at a time, so a request
+    blocking (e.g. on a named pipe) holds up the rest of the connections of its loop
+    """
+    RECV_SIZE = 256 * 1024
+
+    def __init__(self, server, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.__SMB = server
+        self.__timeOut = 60 * 5
+        self.__selector = selectors.DefaultSelector()
+        self.__connections = {}
+        # Accepted connections waiting to be registered, appended from the server's thread
+        self.__newConnections = collections.deque()
+        self.__running = True
+        # Writing here wakes the loop up
+        self.__wakeupRecv, self.__wakeupSend = socket.socketpair()
+        self.__wakeupRecv.setblocking(False)
+        self.__wakeupSend.setblocking(False)
+        self.__selector.register(self.__wakeupRecv, selectors.EVENT_READ, None)
+
+    def addConnection(self, connId, sock, client_address):
+        self.__newConnections.append(SMBSERVERConnection(connId, sock, client_address))
+        self.__wakeup()
+
+    def getConnectionCount(self):
+        return len(self.__connections)
+
+    def stop(self):
+        self.__running = False
+        self.__wakeup()
+
+    def __wakeup(self):
+        try:
+            self.__wakeupSend.send(b'\x00')
+        except socket.error:
+            # Full, the loop has been woken up already
+            pass
+
+    def run(self):
+        lastCheck = time.time()
+        while self.__running:
+            for key, events in self.__selector.select(1):
+                if key.data is None:
+                    self.__registerNewConnections()
+                    continue
+                conn = key.data
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        self.__flush(conn)
+                    if events & selectors.EVENT_READ and conn.closed is False:
+                        self.__read(conn)
+                except Exception as e:
+                    self.__SMB.log("Handle: %s" % e)
+                    self.__close(conn)
+
+            # Same as the timeout waiting for a packet when there's a thread per connection
+            now = time.time()
+            if now - lastCheck > 1:
+                lastCheck = now
+                for conn in list(self.__connections.values()):
+                    if now - conn.lastActivity > self.__timeOut:
+                        self.__SMB.log("Handle: Connection timed out")
+                        self.__close(conn)
+
+        for conn in list(self.__connections.values()):
+            self.__close(conn)
+        self.__selector.close()
+        self.__wakeupRecv.close()
+        self.__wakeupSend.close()
+
+    def __registerNewConnections(self):
+        try:
+            while self.__wakeupRecv.recv(4096):
+                pass
+        except socket.error:
+            pass
+        while len(self.__newConnections) > 0:
+            conn = self.__newConnections.popleft()
+            self.__SMB.log("Incoming connection (%s,%d)" % (conn.ip, conn.port))
+            self.__SMB.addConnection(conn.connId, conn.ip, conn.port, conn.sock.getsockname()[0])
+            conn.sock.setblocking(False)
+            self.__connections[conn.connId] = conn
+            self.__selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def __read(self, conn):
+        try:
+            data = conn.sock.recv(self.RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(data) == 0:
+            self.__close(conn)
+            return
+        conn.lastActivity = time.time()
+        conn.inBuffer += data
+
+        # Every full NetBIOS packet received is processed, the rest waits for more data
+        buffer = conn.inBuffer
+        offset = 0
+        while len(buffer) - offset >= 4:
+            type, flags, length = struct.unpack('>BBH', buffer[offset:offset + 4])
+            if type == nmb.NETBIOS_SESSION_MESSAGE:
+                length |= flags << 16
+            elif flags & 0x01:
+                length |= 0x10000
+            if len(buffer) - offset - 4 < length:
+                break
+            packet = nmb.NetBIOSSessionPacket(bytes(buffer[offset:offset + 4 + length]))
+            offset += 4 + length
+            for answer in self.__SMB.processSessionPacket(conn.connId, packet):
+                self.__send(conn, answer)
+            if conn.closed is True:
+                return
+        del buffer[:offset]
+
+    def __send(self, conn, data):
+        if len(conn.outBuffer) == 0:
+            try:
+                sent = conn.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            if sent == len(data):
+                return
+            # Nothing else is read from this client until it takes its answers
+            self.__selector.modify(conn.sock, selectors.EVENT_WRITE, conn)
+            data = memoryview(data)[sent:]
+        conn.outBuffer.append(data)
+
+    def __flush(self, conn):
+        while len(conn.outBuffer) > 0:
+            data = conn.outBuffer[0]
+            try:
+                sent = conn.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                return
+            if sent < len(data):
+                conn.outBuffer[0] = memoryview(data)[sent:]
+                return
+            conn.outBuffer.popleft()
+        conn.lastActivity = time.time()
+        self.__selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def __close(self, conn):
+        if conn.closed is True:
+            return
+        conn.closed = True
+        self.__SMB.log("Closing down connection (%s,%d)" % (conn.ip, conn.port))
+        try:
+            self.__selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+        del self.__connections[conn.connId]
+        self.__SMB.removeConnection(conn.connId)
+
+
 class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
     # class SMBSERVER(socketserver.ForkingMixIn, socketserver.TCPServer):
+    # Clients connecting at once wait in the listen backlog, the default 5 makes them retry the SYN
+    request_queue_size = socket.SOMAXCONN
+
     def __init__(self, server_address, handler_class=SMBSERVERHandler, config_parser=None):
         socketserver.TCPServer.allow_reuse_address = True
         socketserver.TCPServer.__init__(self, server_address, handler_class)
@@ -4032,6 +4458,9 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         # SMB2 Support flag = default not active
         self.__SMB2Support = False
 
+        # SMB 3.0 (multichannel) Support flag = default not active
+        self.__SMB3Support = False
+
         # Allow anonymous logon
         self.__anonymousLogon = True
 
@@ -4105,7 +4534,7 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
             # smb2.FSCTL_SRV_READ_HASH:                self.__IoctlHandler.fsctlSrvReadHash,
             # smb2.FSCTL_SRV_COPYCHUNK_WRITE:          self.__IoctlHandler.fsctlSrvCopyChunkWrite,
             # smb2.FSCTL_LMR_REQUEST_RESILIENCY:       self.__IoctlHandler.fsctlLmrRequestResiliency,
-            # smb2.FSCTL_QUERY_NETWORK_INTERFACE_INFO: self.__IoctlHandler.fsctlQueryNetworkInterfaceInfo,
+            smb2.FSCTL_QUERY_NETWORK_INTERFACE_INFO: self.__IoctlHandler.fsctlQueryNetworkInterfaceInfo,
             # smb2.FSCTL_SET_REPARSE_POINT:            self.__IoctlHandler.fsctlSetReparsePoint,
             # smb2.FSCTL_DFS_GET_REFERRALS_EX:         self.__IoctlHandler.fsctlDfsGetReferralsEx,
             # smb2.FSCTL_FILE_LEVEL_TRIM:              self.__IoctlHandler.fsctlFileLevelTrim,
@@ -4135,8 +4564,24 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
             0xFF: self.__smb2CommandsHandler.default
         }
 
-        # List of active connections
+        # List of active connections, connId -> connData. The lock guards the table itself: adding, removing
+        # and looking up connections, from whatever thread or loop serves them. See addConnection() for what
+        # each connData holds
         self.__activeConnections = {}
+        self.__connectionsLock = threading.Lock()
+
+        # Connections accepted and requests processed so far, along with the request rate
+        self.__statsLock = threading.Lock()
+        self.__stats = {'Connections': 0, 'Requests': 0}
+        self.__requestRate = 0.0
+        self.__rateSample = (time.time(), 0)
+        self.__statsInterval = 0
+        self.__lastStatsLog = time.time()
+
+        # Event loops serving the connections. If none, each connection gets its own thread
+        self.__eventLoopCount = 0
+        self.__eventLoops = []
+        self.__connIds = itertools.count(1)
 
     def getIoctls(self):
         return self.__smb2Ioctls
@@ -4145,41 +4590,65 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         return self.__credentials
 
     def removeConnection(self, name):
-        try:
-            del (self.__activeConnections[name])
-        except:
-            pass
-        self.log("Remaining connections %s" % list(self.__activeConnections.keys()))
-
-    def addConnection(self, name, ip, port):
-        self.__activeConnections[name] = {}
+        with self.__connectionsLock:
+            self.__activeConnections.pop(name, None)
+            remaining = list(self.__activeConnections.keys())
+        self.log("Remaining connections %s" % remaining)
+
+    def addConnection(self, name, ip, port, serverIp=None):
+        # connData is the protocol state of a connection: dialect and negotiated algorithms, keys, the
+        # authenticated user (Uid) and the trees and files opened. Its socket and buffers are kept apart,
+        # by the handler thread or the SMBSERVERConnection of its loop. Only the thread or loop serving
+        # the connection changes it, other connections just read it (e.g. bindSession() looking for the
+        # session being bound), so it takes no lock of its own
+        connData = {}
         # Let's init with some know stuff we will need to have
-        # TODO: Document what's in there
-        # print "Current Connections", self.__activeConnections.keys()
-        self.__activeConnections[name]['PacketNum'] = 0
-        self.__activeConnections[name]['ClientIP'] = ip
-        self.__activeConnections[name]['ClientPort'] = port
-        self.__activeConnections[name]['Uid'] = 0
-        self.__activeConnections[name]['ConnectedShares'] = {}
-        self.__activeConnections[name]['OpenedFiles'] = {}
+        connData['PacketNum'] = 0
+        connData['ClientIP'] = ip
+        connData['ClientPort'] = port
+        connData['ServerIP'] = serverIp
+        connData['Dialect'] = smb2.SMB2_DIALECT_002
+        connData['ServerCapabilities'] = 0
+        connData['SigningAlgorithm'] = smb2.SMB2_SIGNING_HMAC_SHA256
+        connData['CipherId'] = 0
+        connData['CompressionIds'] = []
+        connData['CompressionChained'] = False
+        # Set by the commands whose answer should go compressed
+        connData['CompressResponse'] = False
+        connData['EncryptionKey'] = b''
+        connData['DecryptionKey'] = b''
+        # SMB 3.1.1 preauth integrity hashes, for the connection and the session being set up
+        connData['PreauthIntegrityHashValue'] = b'\x00' * 64
+        connData['SessionPreauthIntegrityHashValue'] = b'\x00' * 64
+        connData['Uid'] = 0
+        connData['ConnectedShares'] = {}
+        connData['OpenedFiles'] = {}
         # SID results for findfirst2
-        self.__activeConnections[name]['SIDs'] = {}
-        self.__activeConnections[name]['LastRequest'] = {}
-        self.__activeConnections[name]['SignatureEnabled'] = False
-        self.__activeConnections[name]['SigningChallengeResponse'] = ''
-        self.__activeConnections[name]['SigningSessionKey'] = b''
-        self.__activeConnections[name]['Authenticated'] = False
+        connData['SIDs'] = {}
+        connData['LastRequest'] = {}
+        connData['SignatureEnabled'] = False
+        connData['SigningChallengeResponse'] = ''
+        connData['SigningSessionKey'] = b''
+        connData['Authenticated'] = False
+        with self.__connectionsLock:
+            self.__activeConnections[name] = connData
+        with self.__statsLock:
+            self.__stats['Connections'] += 1
 
     def getActiveConnections(self):
-        return self.__activeConnections
+        # A snapshot of the table, connections can come and go while the caller goes through it
+        with self.__connectionsLock:
+            return dict(self.__activeConnections)
 
     def setConnectionData(self, connId, data):
-        self.__activeConnections[connId] = data
+        with self.__connectionsLock:
+            self.__activeConnections[connId] = data
         # print "setConnectionData"
         # print self.__activeConnections
 
     def getConnectionData(self, connId, checkStatus=True):
-        conn = self.__activeConnections[connId]
+        with self.__connectionsLock:
+            conn = self.__activeConnections[connId]
         if checkStatus is True:
             if ('Authenticated' in conn) is not True:
                 # Can't keep going further
@@ -4358,12 +4827,90 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
     def getJTRdumpPath(self):
         return self.__jtr_dump_path
 
+    def getSMB3Support(self):
+        return self.__SMB3Support
+
     def getAuthCallback(self):
         return self.auth_callback
 
     def setAuthCallback(self, callback):
         self.auth_callback = callback
 
+    def getStats(self):
+        # Connection count and request rate, the rate is updated every second while serving
+        with self.__statsLock:
+            stats = dict(self.__stats)
+        with self.__connectionsLock:
+            stats['ActiveConnections'] = len(self.__activeConnections)
+        stats['RequestRate'] = self.__requestRate
+        return stats
+
+    def service_actions(self):
+        # Called by serve_forever() every time it wakes up
+        now = time.time()
+        sampleTime, sampleRequests = self.__rateSample
+        if now - sampleTime >= 1:
+            requests = self.__stats['Requests']
+            self.__requestRate = (requests - sampleRequests) / (now - sampleTime)
+            self.__rateSample = (now, requests)
+        if self.__statsInterval > 0 and now - self.__lastStatsLog >= self.__statsInterval:
+            self.__lastStatsLog = now
+            stats = self.getStats()
+            self.log("Stats: %d active connections (%d total), %d requests, %.1f requests/s" % (
+                stats['ActiveConnections'], stats['Connections'], stats['Requests'], stats['RequestRate']))
+
+    def serve_forever(self, poll_interval=0.5):
+        # The event loops, if any, serve the connections. This thread keeps accepting them
+        for i in range(self.__eventLoopCount - len(self.__eventLoops)):
+            loop = SMBSERVERLoop(self, 'SMBSERVERLoop-%d' % len(self.__eventLoops))
+            loop.start()
+            self.__eventLoops.append(loop)
+        socketserver.TCPServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        if len(self.__eventLoops) == 0:
+            return socketserver.ThreadingMixIn.process_request(self, request, client_address)
+        # The connection goes to the loop serving the least connections
+        loop = min(self.__eventLoops, key=lambda l: l.getConnectionCount())
+        loop.addConnection('SMBConn-%d' % next(self.__connIds), request, client_address)
+
+    def server_close(self):
+        for loop in self.__eventLoops:
+            loop.stop()
+        for loop in self.__eventLoops:
+            loop.join(5)
+        self.__eventLoops = []
+        socketserver.ThreadingMixIn.server_close(self)
+
+    def processSessionPacket(self, connId, packet):
+        # Processes a NetBIOS session packet, returns the NetBIOS packets to send back
+        if packet.get_type() == nmb.NETBIOS_SESSION_REQUEST:
+            # Someone is requesting a session, we're gonna accept them all :)
+            connData = self.getConnectionData(connId, False)
+            _, rn, my = packet.get_trailer().split(b' ')
+            remote_name = nmb.decode_name(b'\x20' + rn)
+            myname = nmb.decode_name(b'\x20' + my)
+            self.log("NetBIOS Session request (%s,%s,%s)" % (connData['ClientIP'], remote_name[1].strip(), myname[1]))
+            r = nmb.NetBIOSSessionPacket()
+            r.set_type(nmb.NETBIOS_SESSION_POSITIVE_RESPONSE)
+            r.set_trailer(packet.get_trailer())
+            return [r.rawData()]
+        elif packet.get_type() == nmb.NETBIOS_SESSION_KEEP_ALIVE:
+            return []
+
+        answers = []
+        # Send all the packets received. Except for big transactions this should be
+        # a single packet
+        for i in self.processRequest(connId, packet.get_trailer()):
+            r = nmb.NetBIOSSessionPacket()
+            r.set_type(nmb.NETBIOS_SESSION_MESSAGE)
+            if hasattr(i, 'getData'):
+                r.set_trailer(i.getData())
+            else:
+                r.set_trailer(i)
+            answers.append(r.rawData())
+        return answers
+
     def verify_request(self, request, client_address):
         # TODO: Control here the max amount of processes we want to launch
         # returning False, closes the connection
@@ -4403,27 +4950,89 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         packet['SecurityFeatures'] = m.digest()[:8]
         connData['SignSequenceNumber'] += 2
 
-    def signSMBv2(self, packet, signingSessionKey, padLength=0):
+    def signSMBv2(self, packet, signingSessionKey, padLength=0, signingAlgorithm=smb2.SMB2_SIGNING_HMAC_SHA256):
         packet['Signature'] = b'\x00' * 16
         packet['Flags'] |= smb2.SMB2_FLAGS_SIGNED
         packetData = packet.getData() + b'\x00' * padLength
-        signature = hmac.new(signingSessionKey, packetData, hashlib.sha256).digest()
-        packet['Signature'] = signature[:16]
+        if signingAlgorithm == smb2.SMB2_SIGNING_AES_GMAC:
+            # The nonce is the MessageId followed by whether this is a response and a CANCEL request
+            nonceFlags = 0
+            if packet['Flags'] & smb2.SMB2_FLAGS_SERVER_TO_REDIR:
+                nonceFlags |= 1
+            if packet['Command'] == smb2.SMB2_CANCEL:
+                nonceFlags |= 2
+            nonce = struct.pack('<QL', packet['MessageID'], nonceFlags)
+            packet['Signature'] = crypto.AES_GMAC(signingSessionKey, nonce, packetData)
+        elif signingAlgorithm == smb2.SMB2_SIGNING_AES_CMAC:
+            packet['Signature'] = crypto.AES_CMAC(signingSessionKey, packetData, len(packetData))
+        else:
+            signature = hmac.new(signingSessionKey, packetData, hashlib.sha256).digest()
+            packet['Signature'] = signature[:16]
         # print "%s" % packet['Signature'].encode('hex')
 
+    @staticmethod
+    def __getCipher(connData, key, nonce):
+        if connData['CipherId'] in (smb2.SMB2_ENCRYPTION_AES128_GCM, smb2.SMB2_ENCRYPTION_AES256_GCM):
+            return AES.new(key, AES.MODE_GCM, nonce[:12])
+        return AES.new(key, AES.MODE_CCM, nonce[:11])
+
+    def encryptSMBv3(self, connData, plainText):
+        transformHeader = smb2.SMB2_TRANSFORM_HEADER()
+        # 12 bytes of nonce for GCM, 11 for CCM, the rest is zeroed
+        if connData['CipherId'] in (smb2.SMB2_ENCRYPTION_AES128_GCM, smb2.SMB2_ENCRYPTION_AES256_GCM):
+            transformHeader['Nonce'] = os.urandom(12) + b'\x00' * 4
+        else:
+            transformHeader['Nonce'] = os.urandom(11) + b'\x00' * 5
+        transformHeader['OriginalMessageSize'] = len(plainText)
+        # Flags in SMB 3.1.1, 0x0001 is Encrypted. SMB 3.0 calls it EncryptionAlgorithm, same value
+        transformHeader['EncryptionAlgorithm'] = smb2.SMB2_ENCRYPTION_AES128_CCM
+        transformHeader['SessionID'] = connData['Uid']
+        cipher = self.__getCipher(connData, connData['EncryptionKey'], transformHeader['Nonce'])
+        cipher.update(transformHeader.getData()[20:])
+        cipherText = cipher.encrypt(plainText)
+        transformHeader['Signature'] = cipher.digest()
+        return transformHeader.getData() + cipherText
+
+    def decryptSMBv3(self, connData, data):
+        transformHeader = smb2.SMB2_TRANSFORM_HEADER(data)
+        if len(connData['DecryptionKey']) == 0:
+            # Encrypted message received, but no encryption keys for this session
+            raise SessionError(STATUS_ACCESS_DENIED)
+        cipher = self.__getCipher(connData, connData['DecryptionKey'], transformHeader['Nonce'])
+        cipher.update(transformHeader.getData()[20:])
+        try:
+            return cipher.decrypt_and_verify(data[len(transformHeader):], transformHeader['Signature'])
+        except ValueError:
+            # Wrong signature in encrypted message
+            raise SessionError(STATUS_ACCESS_DENIED)
+
+    def __updatePreauthIntegrityHash(self, connData, hashName, data):
+        # [MS-SMB2] 3.3.5.4 and 3.3.5.5. SMB 3.1.1 keys are derived from a SHA-512 chain over the
+        # NEGOTIATE and SESSION_SETUP messages exchanged
+        connData[hashName] = hashlib.sha512(connData[hashName] + data).digest()
+
     def processRequest(self, connId, data):
+        with self.__statsLock:
+            self.__stats['Requests'] += 1
 
         # TODO: Process batched commands.
         isSMB2 = False
         SMBCommand = None
+        isEncrypted = False
+        if data[:4] == b'\xfdSMB':
+            # SMB 3 encrypted message. Answers go encrypted as well
+            data = self.decryptSMBv3(self.getConnectionData(connId, False), data)
+            isEncrypted = True
+        if data[:4] == b'\xfcSMB':
+            # SMB 3.1.1 compressed message, inside the encrypted one if both are used
+            data = decompressSMB(data)
         try:
             packet = smb.NewSMBPacket(data=data)
             SMBCommand = smb.SMBCommand(packet['Data'][0])
         except:
             # Maybe a SMB2 packet?
+            # Signature and flags are left as received, session binding checks them
             packet = smb2.SMB2Packet(data=data)
-            connData = self.getConnectionData(connId, False)
-            self.signSMBv2(packet, connData['SigningSessionKey'])
             isSMB2 = True
 
         connData = self.getConnectionData(connId, False)
@@ -4527,6 +5136,16 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
                 else:
                     done = False
                     while not done:
+                        if packet['Command'] == smb2.SMB2_NEGOTIATE:
+                            connData['PreauthIntegrityHashValue'] = b'\x00' * 64
+                            self.__updatePreauthIntegrityHash(connData, 'PreauthIntegrityHashValue', data)
+                        elif packet['Command'] == smb2.SMB2_SESSION_SETUP and \
+                                connData['Dialect'] == smb2.SMB2_DIALECT_311:
+                            if connData['Uid'] == 0 or packet['SessionID'] != connData['Uid']:
+                                # A new session (or channel) starts from the connection's hash
+                                connData['SessionPreauthIntegrityHashValue'] = connData['PreauthIntegrityHashValue']
+                            self.__updatePreauthIntegrityHash(connData, 'SessionPreauthIntegrityHashValue',
+                                                              data[:packet['NextCommand'] or len(data)])
                         if packet['Command'] in self.__smb2Commands:
                             if self.__SMB2Support is True:
                                 respCommands, respPackets, errorCode = self.__smb2Commands[packet['Command']](
@@ -4639,15 +5258,33 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
                 if idx + 1 < totalPackets:
                     packet['NextCommand'] = len(packet) + padLen
 
-                if connData['SignatureEnabled']:
-                    self.signSMBv2(packet, connData['SigningSessionKey'], padLength=padLen)
+                # Encrypted messages are not signed
+                if connData['SignatureEnabled'] and isEncrypted is False:
+                    self.signSMBv2(packet, connData['SigningSessionKey'], padLength=padLen,
+                                   signingAlgorithm=connData['SigningAlgorithm'])
 
                 if hasattr(packet, 'getData'):
                     finalData.append(packet.getData() + padLen * b'\x00')
+                    if connData['Dialect'] == smb2.SMB2_DIALECT_311:
+                        if packet['Command'] == smb2.SMB2_NEGOTIATE:
+                            self.__updatePreauthIntegrityHash(connData, 'PreauthIntegrityHashValue', finalData[-1])
+                        elif packet['Command'] == smb2.SMB2_SESSION_SETUP and \
+                                packet['Status'] == STATUS_MORE_PROCESSING_REQUIRED:
+                            self.__updatePreauthIntegrityHash(connData, 'SessionPreauthIntegrityHashValue',
+                                                              finalData[-1])
                 else:
                     finalData.append(packet + padLen * b'\x00')
 
             packetsToSend = [b"".join(finalData)]
+            # Compression goes after signing and before encryption
+            if connData['CompressResponse'] is True:
+                connData['CompressResponse'] = False
+                compressedData = compressSMB(packetsToSend[0], connData['CompressionIds'],
+                                             connData['CompressionChained'])
+                if compressedData is not None:
+                    packetsToSend = [compressedData]
+            if isEncrypted is True:
+                packetsToSend = [self.encryptSMBv3(connData, packetsToSend[0])]
 
         # We clear the compound requests
         connData['LastRequest'] = {}
@@ -4679,12 +5316,29 @@ class SMBSERVER(socketserver.ThreadingMixIn, socketserver.TCPServer):
         else:
             self.__SMB2Support = False
 
+        if self.__serverConfig.has_option("global", "SMB3Support"):
+            self.__SMB3Support = self.__serverConfig.getboolean("global", "SMB3Support")
+        else:
+            self.__SMB3Support = False
+
 
         if self.__serverConfig.has_option("global", "anonymous_logon"):
             self.__anonymousLogon = self.__serverConfig.getboolean("global", "anonymous_logon")
         else:
             self.__anonymousLogon = True
 
+        # Amount of threads running an event loop each. 0 means a thread per connection
+        if self.__serverConfig.has_option("global", "event_loops"):
+            self.__eventLoopCount = self.__serverConfig.getint("global", "event_loops")
+        else:
+            self.__eventLoopCount = 0
+
+        # Seconds between stats log lines. 0 means no stats are logged
+        if self.__serverConfig.has_option("global", "stats_interval"):
+            self.__statsInterval = self.__serverConfig.getint("global", "stats_interval")
+        else:
+            self.__statsInterval = 0
+
         if self.__logFile != 'None':
             logging.basicConfig(filename=self.__logFile,
                                 level=logging.DEBUG,
@@ -4938,11 +5592,17 @@ class SimpleSMBServer:
     def getRegisteredNamedPipes(self):
         return self.__server.getRegisteredNamedPipes()
 
-    def addShare(self, shareName, sharePath, shareComment='', shareType='0', readOnly='no'):
+    def addShare(self, shareName, sharePath, shareComment='', shareType='0', readOnly='no', encryptData='no',
+                 compressData='no'):
         share = shareName.upper()
         self.__smbConfig.add_section(share)
         self.__smbConfig.set(share, 'comment', shareComment)
         self.__smbConfig.set(share, 'read only', readOnly)
+        # Only SMB 3 clients able to encrypt can connect to the share if set
+        self.__smbConfig.set(share, 'encrypt data', encryptData)
+        # SMB 3.1.1 clients negotiating compression get READ answers compressed, and are asked to
+        # compress their WRITE requests
+        self.__smbConfig.set(share, 'compress data', compressData)
         self.__smbConfig.set(share, 'share type', shareType)
         self.__smbConfig.set(share, 'path', sharePath)
         self.__server.setServerConfig(self.__smbConfig)
@@ -4984,6 +5644,31 @@ class SimpleSMBServer:
         self.__server.setServerConfig(self.__smbConfig)
         self.__server.processConfigFile()
 
+    def setSMB3Support(self, value):
+        # SMB 3.0 and 3.1.1 dialects, along with multichannel and encryption. Needs SMB2 support enabled as well
+        if value is True:
+            self.__smbConfig.set("global", "SMB3Support", "True")
+        else:
+            self.__smbConfig.set("global", "SMB3Support", "False")
+        self.__server.setServerConfig(self.__smbConfig)
+        self.__server.processConfigFile()
+
+    def setEventLoops(self, count):
+        # Serves the connections from count threads running an event loop each, instead of a thread per
+        # connection. Meant for many clients connecting at once
+        self.__smbConfig.set("global", "event_loops", str(count))
+        self.__server.setServerConfig(self.__smbConfig)
+        self.__server.processConfigFile()
+
+    def setStatsInterval(self, seconds):
+        # Logs the connection count and the request rate every so many seconds
+        self.__smbConfig.set("global", "stats_interval", str(seconds))
+        self.__server.setServerConfig(self.__smbConfig)
+        self.__server.processConfigFile()
+
+    def getStats(self):
+        return self.__server.getStats()
+
     def getAuthCallback(self):
         return self.__server.getAuthCallback()
 
@@ -11,7 +11,7 @@
 
 from __future__ import division
 from __future__ import print_function
-from struct import pack, unpack, calcsize
+from struct import pack, unpack, calcsize, Struct
 from six import b, PY3
 from binascii import hexlify
 
@@ -75,11 +75,24 @@ class Structure:
             ?&fieldname "Address of field fieldname".
                         For packing it will simply pack the id() of fieldname. Or use 0 if fieldname doesn't exists.
                         For unpacking, it's used to know weather fieldname has to be unpacked or not, i.e. by adding a & field you turn another field (fieldname) in an optional field.
+
+        compiled plans:
+          the first time a class is packed or unpacked, its commonHdr+structure is compiled into a plan (precompiled
+          struct.Struct objects, resolved length/address field links and compiled code specifiers) that is cached
+          on the class and reused by fromString() and getData(). Classes overriding any of the per-field hooks
+          (pack, unpack, calcPackSize, calcUnpackSize, ...) or with debug enabled keep using the interpreted path.
+          Set compiledPlan = False on a class (or instance) to force the interpreted path.
+
+        zero-copy parsing:
+          fromString() also accepts a memoryview (e.g. memoryview(buffer)[offset:]). In that case ':' fields
+          without a data class are kept as memoryviews into the original buffer (use bytes() or .tobytes() to
+          materialize them), and nested structures are handed views as well. Everything else is unpacked as usual.
             
     """
     commonHdr = ()
     structure = ()
     debug = 0
+    compiledPlan = True
 
     def __init__(self, data = None, alignment = 0):
         if not hasattr(self, 'alignment'):
@@ -124,6 +137,9 @@ class Structure:
     def getData(self):
         if self.data is not None:
             return self.data
+        plan = self.__getPlan()
+        if plan is not None:
+            return self.__getDataCompiled(plan)
         data = bytes()
         for field in self.commonHdr+self.structure:
             try:
@@ -142,6 +158,9 @@ class Structure:
         return data
 
     def fromString(self, data):
+        plan = self.__getPlan()
+        if plan is not None:
+            return self.__fromStringCompiled(plan, data)
         self.rawData = data
         for field in self.commonHdr+self.structure:
             if self.debug:
@@ -165,6 +184,106 @@ class Structure:
 
         return self
 
+    def __getPlan(self):
+        # Returns the compiled plan for this instance's commonHdr+structure, or None if the interpreted
+        # path has to be used
+        if self.debug or not self.compiledPlan:
+            return None
+        cls = self.__class__
+        plans = cls.__dict__.get('_structurePlans')
+        if plans is None:
+            if _overridesHooks(cls):
+                plans = False
+            else:
+                plans = {}
+            setattr(cls, '_structurePlans', plans)
+        if plans is False:
+            return None
+        # Keyed by contents, classes building their structure per instance (self.structure = self.common +
+        # self.structure) get a new tuple every time but share the plan
+        key = (self.commonHdr, self.structure)
+        try:
+            plan = plans.get(key)
+        except TypeError:
+            # Unhashable field definitions, interpreted
+            return None
+        if plan is None:
+            if len(plans) >= _MAX_PLANS_PER_CLASS:
+                return None
+            plan = _StructurePlan(self.commonHdr, self.structure)
+            plans[key] = plan
+        if plan.fields is None:
+            return None
+        return plan
+
+    def __getDataCompiled(self, plan):
+        fields = self.fields
+        alignment = self.alignment
+        data = []
+        size = 0
+        for fieldName, format, dataClassOrCode, packer, unpacker, addressField, lengthField, code in plan.fields:
+            value = fields.get(fieldName)
+            try:
+                if addressField is not None and value is None:
+                    answer = b''
+                else:
+                    answer = packer(self, value)
+            except Exception as e:
+                if fieldName in fields:
+                    e.args += ("When packing field '%s | %s | %r' in %s" % (fieldName, format, value, self.__class__),)
+                else:
+                    e.args += ("When packing field '%s | %s' in %s" % (fieldName, format, self.__class__),)
+                raise
+            data.append(answer)
+            size += len(answer)
+            if alignment and size % alignment:
+                data.append(b'\x00'*(alignment - size % alignment))
+                size += alignment - size % alignment
+
+        return b''.join(data)
+
+    def __fromStringCompiled(self, plan, data):
+        self.rawData = data
+        fields = self.fields
+        alignment = self.alignment
+        for fieldName, format, dataClassOrCode, packer, unpacker, addressField, lengthField, code in plan.fields:
+            if addressField is not None and not fields[addressField]:
+                self[fieldName] = None
+                continue
+            if code is not None:
+                # void specifier with an unpack code
+                evalFields = {'self':self, 'inputDataLeft':data[:0]}
+                evalFields.update(fields)
+                try:
+                    self[fieldName] = eval(code, {}, evalFields)
+                except Exception as e:
+                    e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, format, data, 0),)
+                    raise
+                continue
+
+            size = None
+            if lengthField is not None:
+                try:
+                    size = int(fields[lengthField])
+                except Exception:
+                    pass
+            if size is None:
+                size = unpacker.unpackSize(self, data)
+
+            try:
+                value = unpacker.unpack(self, data[:size], dataClassOrCode, fieldName)
+            except Exception as e:
+                e.args += ("When unpacking field '%s | %s | %r[:%d]'" % (fieldName, format, data, size),)
+                raise
+            self[fieldName] = value
+
+            size = unpacker.packSize(self, value)
+            if alignment and size % alignment:
+                size += alignment - (size % alignment)
+            data = data[size:]
+
+        return self
+
     def __setitem__(self, key, value):
         self.fields[key] = value
         self.data = None        # force recompute
@@ -278,6 +397,8 @@ class Structure:
                 return data.getData()
             elif isinstance(data, int):
                 return bytes(data)
+            elif isinstance(data, memoryview):
+                return data.tobytes()
             elif isinstance(data, bytes) is not True:
                 return bytes(b(data))
             else:
@@ -285,7 +406,7 @@ class Structure:
 
         if format[-1:] == 's':
             # Let's be sure we send the right type
-            if isinstance(data, bytes) or isinstance(data, bytearray):
+            if isinstance(data, (bytes, bytearray, memoryview)):
                 return pack(format, data)
             else:
                 return pack(format, b(data))
@@ -364,7 +485,7 @@ class Structure:
             if data[-1:] != b('\x00'):
                 raise Exception("%s 'z' field is not NUL terminated: %r" % (field, data))
             if PY3:
-                return data[:-1].decode('latin-1')
+                return bytes(data[:-1]).decode('latin-1')
             else:
                 return data[:-1]
 
@@ -372,16 +493,16 @@ class Structure:
         if format == 'u':
             if data[-2:] != b('\x00\x00'):
                 raise Exception("%s 'u' field is not NUL-NUL terminated: %r" % (field, data))
-            return data[:-2] # remove trailing NUL
+            return bytes(data[:-2]) # remove trailing NUL
 
         # DCE-RPC/NDR string specifier
         if format == 'w':
             l = unpack('<L', data[:4])[0]
-            return data[12:12+l*2]
+            return bytes(data[12:12+l*2])
 
         # literal specifier
         if format == ':':
-            if isinstance(data, bytes) and dataClassOrCode is b:
+            if isinstance(data, (bytes, memoryview)) and dataClassOrCode is b:
                 return data
             return dataClassOrCode(data)
 
@@ -524,11 +645,11 @@ class Structure:
 
         # asciiz specifier
         if format[:1] == 'z':
-            return data.index(b('\x00'))+1
+            return _index(data, b('\x00'))+1
 
         # asciiz specifier
         if format[:1] == 'u':
-            l = data.index(b('\x00\x00'))
+            l = _index(data, b('\x00\x00'))
             return l + (l & 1 and 3 or 2)
 
         # DCE-RPC/NDR string specifier
@@ -545,6 +666,9 @@ class Structure:
 
     def calcPackFieldSize(self, fieldName, format = None):
         if format is None:
+            plan = self.__getPlan()
+            if plan is not None and fieldName in plan.formats:
+                return plan.formats[fieldName].packSize(self, self[fieldName])
             format = self.formatForField(fieldName)
 
         return self.calcPackSize(format, self[fieldName])
@@ -617,6 +741,440 @@ class Structure:
             else:
                 print("%s%s: {%r}" % (ind,i,self[i]))
 
+def _index(data, sub):
+    # bytes.index() that doesn't copy the whole remaining buffer when data is a memoryview
+    if not isinstance(data, memoryview):
+        return data.index(sub)
+    window = 256
+    while True:
+        pos = bytes(data[:window]).find(sub)
+        if pos >= 0:
+            return pos
+        if window >= len(data):
+            raise ValueError('subsection not found')
+        window *= 4
+
+# Compiled plans. Each format specifier is compiled once (and shared by every class using it) into closures
+# that mirror, step by step, what Structure.pack(), unpack(), calcPackSize() and calcUnpackSize() do when
+# interpreting the very same format string.
+
+_MAX_PLANS_PER_CLASS = 64
+
+_PLAN_HOOKS = ('packField', 'pack', 'unpack', 'calcPackSize', 'calcUnpackSize', 'calcPackFieldSize',
+               'formatForField', 'findAddressFieldFor', 'findLengthFieldFor', '__setitem__', '__getitem__')
+
+class _Unsupported(Exception):
+    pass
+
+def _overridesHooks(cls):
+    for hook in _PLAN_HOOKS:
+        method = getattr(cls, hook)
+        if getattr(method, '__func__', method) is not getattr(Structure.__dict__[hook], '__func__', Structure.__dict__[hook]):
+            return True
+    return False
+
+def _compileCode(code):
+    try:
+        return compile(code, '<structure>', 'eval')
+    except SyntaxError:
+        # Leave it to eval() so the error shows up when (and if) the code is actually evaluated
+        return code
+
+def _evalCode(s, code):
+    fields = {'self':s}
+    fields.update(s.fields)
+    return eval(code, {}, fields)
+
+_packers = {}
+
+def _compilePacker(format):
+    packer = _packers.get(format)
+    if packer is None:
+        packer = _packers[format] = _buildPacker(format)
+    return packer
+
+def _buildPacker(format):
+    # void specifier
+    if format[:1] == '_':
+        return lambda s, data: b''
+
+    # quote specifier
+    if format[:1] == "'" or format[:1] == '"':
+        literal = b(format[1:])
+        return lambda s, data: literal
+
+    # code specifier
+    two = format.split('=')
+    if len(two) >= 2:
+        inner = _compilePacker(two[0])
+        code = _compileCode(two[1])
+        def packCode(s, data):
+            try:
+                return inner(s, data)
+            except:
+                return inner(s, _evalCode(s, code))
+        return packCode
+
+    # address specifier
+    two = format.split('&')
+    if len(two) == 2:
+        inner = _compilePacker(two[0])
+        addressFormat, fieldName = two
+        def packAddress(s, data):
+            try:
+                return inner(s, data)
+            except:
+                if (fieldName in s.fields) and (s[fieldName] is not None):
+                    return inner(s, id(s[fieldName]) & ((1<<(calcsize(addressFormat)*8))-1))
+                else:
+                    return inner(s, 0)
+        return packAddress
+
+    # length specifier
+    two = format.split('-')
+    if len(two) == 2:
+        inner = _compilePacker(two[0])
+        fieldName = two[1]
+        def packLength(s, data):
+            try:
+                return inner(s, data)
+            except:
+                return inner(s, s.calcPackFieldSize(fieldName))
+        return packLength
+
+    # array specifier
+    two = format.split('*')
+    if len(two) == 2:
+        element = _compilePacker(two[1])
+        if two[0].isdigit():
+            number = int(two[0])
+            def packFixedArray(s, data):
+                answer = b''.join([element(s, each) for each in data])
+                if number != len(data):
+                    raise Exception("Array field has a constant size, and it doesn't match the actual value")
+                return answer
+            return packFixedArray
+        elif two[0]:
+            count = _compilePacker(two[0])
+            def packCountedArray(s, data):
+                answer = b''.join([element(s, each) for each in data])
+                return count(s, len(data)) + answer
+            return packCountedArray
+        else:
+            return lambda s, data: b''.join([element(s, each) for each in data])
+
+    # "printf" string specifier
+    if format[:1] == '%':
+        return lambda s, data: b(format % data)
+
+    # asciiz specifier
+    if format[:1] == 'z':
+        def packAsciiz(s, data):
+            if isinstance(data, bytes):
+                return data + b('\0')
+            return bytes(b(data)+b('\0'))
+        return packAsciiz
+
+    # unicode specifier
+    if format[:1] == 'u':
+        return lambda s, data: bytes(data+b('\0\0') + (len(data) & 1 and b('\0') or b''))
+
+    # DCE-RPC/NDR string specifier
+    if format[:1] == 'w':
+        def packNDRString(s, data):
+            if len(data) == 0:
+                data = b('\0\0')
+            elif len(data) % 2:
+                data = b(data) + b('\0')
+            l = pack('<L', len(data)//2)
+            return b''.join([l, l, b('\0\0\0\0'), data])
+        return packNDRString
+
+    # literal specifier
+    if format[:1] == ':':
+        def packLiteral(s, data):
+            if data is None:
+                raise Exception("Trying to pack None")
+            if isinstance(data, Structure):
+                return data.getData()
+            elif hasattr(data, "getData"):
+                return data.getData()
+            elif isinstance(data, int):
+                return bytes(data)
+            elif isinstance(data, memoryview):
+                return data.tobytes()
+            elif isinstance(data, bytes) is not True:
+                return bytes(b(data))
+            else:
+                return data
+        return packLiteral
+
+    try:
+        packer = Struct(format).pack
+    except Exception:
+        packer = lambda data: pack(format, data)
+
+    if format[-1:] == 's':
+        def packString(s, data):
+            if data is None:
+                raise Exception("Trying to pack None")
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                return packer(data)
+            else:
+                return packer(b(data))
+        return packString
+
+    # struct like specifier
+    def packStruct(s, data):
+        if data is None:
+            raise Exception("Trying to pack None")
+        return packer(data)
+    return packStruct
+
+class _Unpacker(object):
+    __slots__ = ('unpackSize', 'unpack', 'packSize')
+
+    def __init__(self, unpackSize, unpack, packSize):
+        self.unpackSize = unpackSize
+        self.unpack = unpack
+        self.packSize = packSize
+
+_unpackers = {}
+
+def _compileUnpacker(format):
+    unpacker = _unpackers.get(format)
+    if unpacker is None:
+        try:
+            unpacker = _buildUnpacker(format)
+        except _Unsupported:
+            unpacker = False
+        _unpackers[format] = unpacker
+    if unpacker is False:
+        raise _Unsupported(format)
+    return unpacker
+
+def _buildUnpacker(format):
+    # void specifier
+    if format[:1] == '_':
+        def unpackVoid(s, data, dataClassOrCode = b, field = None):
+            if dataClassOrCode != b:
+                fields = {'self':s, 'inputDataLeft':data}
+                fields.update(s.fields)
+                return eval(dataClassOrCode, {}, fields)
+            return None
+        return _Unpacker(lambda s, data: 0, unpackVoid, lambda s, data: 0)
+
+    # quote specifier
+    if format[:1] == "'" or format[:1] == '"':
+        answer = format[1:]
+        literal = b(answer)
+        def unpackQuote(s, data, dataClassOrCode = b, field = None):
+            if literal != data:
+                raise Exception("Unpacked data doesn't match constant value '%r' should be '%r'" % (data, answer))
+            return answer
+        size = len(format)-1
+        return _Unpacker(lambda s, data: size, unpackQuote, lambda s, data: size)
+
+    # address specifier
+    two = format.split('&')
+    if len(two) == 2:
+        return _buildPlainUnpacker(two[0])
+
+    # code specifier
+    two = format.split('=')
+    if len(two) >= 2:
+        return _buildPlainUnpacker(two[0])
+
+    # length specifier
+    two = format.split('-')
+    if len(two) == 2:
+        return _buildPlainUnpacker(two[0])
+
+    # array specifier
+    two = format.split('*')
+    if len(two) == 2:
+        return _buildArrayUnpacker(two[0], _compileUnpacker(two[1]))
+
+    # "printf" string specifier
+    if format[:1] == '%':
+        raise _Unsupported(format)
+
+    # asciiz specifier
+    if format == 'z':
+        def unpackSizeAsciiz(s, data):
+            return _index(data, b('\x00'))+1
+        def unpackAsciiz(s, data, dataClassOrCode = b, field = None):
+            if data[-1:] != b('\x00'):
+                raise Exception("%s 'z' field is not NUL terminated: %r" % (field, data))
+            if PY3:
+                return bytes(data[:-1]).decode('latin-1')
+            else:
+                return data[:-1]
+        return _Unpacker(unpackSizeAsciiz, unpackAsciiz, lambda s, data: len(data)+1)
+
+    # unicode specifier
+    if format == 'u':
+        def unpackSizeUnicode(s, data):
+            l = _index(data, b('\x00\x00'))
+            return l + (l & 1 and 3 or 2)
+        def unpackUnicode(s, data, dataClassOrCode = b, field = None):
+            if data[-2:] != b('\x00\x00'):
+                raise Exception("%s 'u' field is not NUL-NUL terminated: %r" % (field, data))
+            return bytes(data[:-2]) # remove trailing NUL
+        def packSizeUnicode(s, data):
+            l = len(data)
+            return l + (l & 1 and 3 or 2)
+        return _Unpacker(unpackSizeUnicode, unpackUnicode, packSizeUnicode)
+
+    # DCE-RPC/NDR string specifier
+    if format == 'w':
+        def unpackSizeNDRString(s, data):
+            return 12+unpack('<L', data[:4])[0]*2
+        def unpackNDRString(s, data, dataClassOrCode = b, field = None):
+            l = unpack('<L', data[:4])[0]
+            return bytes(data[12:12+l*2])
+        def packSizeNDRString(s, data):
+            l = len(data)
+            return 12+l+l % 2
+        return _Unpacker(unpackSizeNDRString, unpackNDRString, packSizeNDRString)
+
+    # literal specifier
+    if format == ':':
+        def unpackLiteral(s, data, dataClassOrCode = b, field = None):
+            if isinstance(data, (bytes, memoryview)) and dataClassOrCode is b:
+                return data
+            return dataClassOrCode(data)
+        return _Unpacker(lambda s, data: len(data), unpackLiteral, lambda s, data: len(data))
+
+    # these are only understood by the interpreted path when they match exactly
+    if format[:1] in ('z', 'u', 'w', ':'):
+        raise _Unsupported(format)
+
+    # struct like specifier
+    try:
+        compiled = Struct(format)
+    except Exception:
+        raise _Unsupported(format)
+    size = compiled.size
+    structUnpack = compiled.unpack
+    def unpackStruct(s, data, dataClassOrCode = b, field = None):
+        return structUnpack(data)[0]
+    return _Unpacker(lambda s, data: size, unpackStruct, lambda s, data: size)
+
+def _buildPlainUnpacker(format):
+    # address, code and length specifiers are unpacked as the bare format, dropping the data class
+    inner = _compileUnpacker(format)
+    def unpackPlain(s, data, dataClassOrCode = b, field = None):
+        return inner.unpack(s, data)
+    return _Unpacker(inner.unpackSize, unpackPlain, inner.packSize)
+
+def _buildArrayUnpacker(countFormat, element):
+    if countFormat.isdigit():
+        fixedNumber = int(countFormat)
+        count = None
+    elif countFormat:
+        fixedNumber = None
+        count = _compileUnpacker(countFormat)
+    else:
+        fixedNumber = None
+        count = None
+
+    def unpackSizeArray(s, data):
+        answer = 0
+        if countFormat:
+            if count is None:
+                number = fixedNumber
+            else:
+                answer += count.unpackSize(s, data)
+                number = count.unpack(s, data[:answer])
+
+            while number:
+                number -= 1
+                answer += element.unpackSize(s, data[answer:])
+        else:
+            while answer < len(data):
+                answer += element.unpackSize(s, data[answer:])
+        return answer
+
+    def unpackArray(s, data, dataClassOrCode = b, field = None):
+        answer = []
+        sofar = 0
+        if count is None:
+            number = fixedNumber if countFormat else -1
+        else:
+            sofar += count.unpackSize(s, data)
+            number = count.unpack(s, data[:sofar])
+
+        while number and sofar < len(data):
+            nsofar = sofar + element.unpackSize(s, data[sofar:])
+            answer.append(element.unpack(s, data[sofar:nsofar], dataClassOrCode))
+            number -= 1
+            sofar = nsofar
+        return answer
+
+    def packSizeArray(s, data):
+        answer = 0
+        if count is None:
+            if countFormat and fixedNumber != len(data):
+                raise Exception("Array field has a constant size, and it doesn't match the actual value")
+        else:
+            answer += count.packSize(s, len(data))
+
+        for each in data:
+            answer += element.packSize(s, each)
+        return answer
+
+    return _Unpacker(unpackSizeArray, unpackArray, packSizeArray)
+
+class _StructurePlan(object):
+    """ compiled form of a commonHdr+structure pair, see Structure.__getPlan().
+        fields is None when the structure uses constructs only the interpreted path knows about.
+    """
+    def __init__(self, commonHdr, structure):
+        self.formats = {}
+        allFields = commonHdr + structure
+        try:
+            self.fields = [self.__compileField(field, allFields) for field in allFields]
+            for field in allFields:
+                if field[0] not in self.formats:
+                    self.formats[field[0]] = _compileUnpacker(field[1])
+        except _Unsupported:
+            self.fields = None
+            return
+        # Nested specifiers are resolved without a field name, the interpreted path then looks up
+        # '&None' and '-None', just give up on such structures
+        for field in allFields:
+            if field[1][-5:] in ('&None', '-None'):
+                self.fields = None
+
+    @staticmethod
+    def __compileField(field, allFields):
+        fieldName, format = field[0], field[1]
+        dataClassOrCode = b
+        if len(field) > 2:
+            dataClassOrCode = field[2]
+
+        addressField = None
+        descriptor = '&%s' % fieldName
+        for other in allFields:
+            if other[1][-len(descriptor):] == descriptor:
+                addressField = other[0]
+                break
+
+        lengthField = None
+        descriptor = '-%s' % fieldName
+        for other in allFields:
+            if other[1][-len(descriptor):] == descriptor:
+                lengthField = other[0]
+                break
+
+        code = None
+        if format[:1] == '_' and dataClassOrCode != b:
+            code = _compileCode(dataClassOrCode)
+
+        return (fieldName, format, dataClassOrCode, _compilePacker(format), _compileUnpacker(format),
+                addressField, lengthField, code)
+
 def pretty_print(x):
     if chr(x) in '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~ ':
        return chr(x)
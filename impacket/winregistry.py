@@ -25,6 +25,8 @@
 from __future__ import division
 from __future__ import print_function
 import sys
+import mmap
+from collections import OrderedDict
 from struct import unpack
 import ntpath
 from six import b
@@ -44,6 +46,9 @@ REG_DWORD       = 0x04
 REG_MULTISZ     = 0x07
 REG_QWORD       = 0x0b
 
+# Max amount of key paths and subkey lists Registry remembers
+KEY_CACHE_SIZE  = 4096
+
 # Structs
 class REG_REGF(Structure):
     structure = (
@@ -161,14 +166,28 @@ StructMappings = {b'nk': REG_NK,
                  }
 
 class Registry:
-    def __init__(self, hive, isRemote = False):
+    def __init__(self, hive, isRemote = False, useMmap = True, cacheSize = KEY_CACHE_SIZE):
         self.__hive = hive
+        self.__mmap = None
+        # Least recently used key paths (to their NK offset) and subkey lists (by their offset) are
+        # dropped once there are more than cacheSize of each. buildIndex() fills __keyIndex with
+        # every key in the hive
+        self.__cacheSize = cacheSize
+        self.__keyCache = OrderedDict()
+        self.__subKeyCache = OrderedDict()
+        self.__keyIndex = None
         if isRemote is True:
             self.fd = self.__hive
             self.__hive.open()
         else:
             self.fd = open(hive,'rb')
-        data = self.fd.read(4096)
+            if useMmap is True:
+                # Local hives are mapped, cells are then sliced out of it without any seek()/read()
+                try:
+                    self.__mmap = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError) as e:
+                    LOG.debug('Cannot map %s (%s), falling back to file reads' % (hive, str(e)))
+        data = self.__read(0, 4096)
         self.__regf = REG_REGF(data)
         self.indent = ''
         self.rootKey = self.__findRootKey()
@@ -178,20 +197,43 @@ class Registry:
             LOG.warning("Unsupported version (%d.%d) - things might not work!" % (self.__regf['MajorVersion'], self.__regf['MinorVersion']))
 
     def close(self):
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
         if hasattr(self, 'fd'):
             self.fd.close()
 
     def __del__(self):
         self.close()
 
+    def __read(self, offset, size):
+        # Returns size bytes at offset (up to the end of the file if size is negative, like read() does)
+        if self.__mmap is not None:
+            if size < 0:
+                return self.__mmap[offset:]
+            return self.__mmap[offset:offset+size]
+        self.fd.seek(offset, 0)
+        return self.fd.read(size)
+
     def __findRootKey(self):
-        self.fd.seek(0,0)
-        data = self.fd.read(4096)
+        # The header points to the root key, only scan the hbins if that doesn't look right
+        try:
+            rootKey = self.__getBlock(self.__regf['OffsetFirstRecord'])
+            if isinstance(rootKey, REG_NK) and rootKey['Type'] == ROOT_KEY:
+                return rootKey
+        except Exception as e:
+            pass
+
+        offset = 0
+        data = self.__read(offset, 4096)
+        offset += len(data)
         while len(data) > 0:
             try:
                 hbin = REG_HBIN(data[:0x20])
                 # Read the remaining bytes for this hbin
-                data += self.fd.read(hbin['OffsetNextHBin']-4096)
+                remaining = self.__read(offset, hbin['OffsetNextHBin']-4096)
+                offset += len(remaining)
+                data += remaining
                 data = data[0x20:]
                 blocks = self.__processDataBlocks(data)
                 for block in blocks:
@@ -200,15 +242,15 @@ class Registry:
                             return block
             except Exception as e:
                 pass
-            data = self.fd.read(4096)
+            data = self.__read(offset, 4096)
+            offset += len(data)
 
         return None
 
 
     def __getBlock(self, offset):
-        self.fd.seek(4096+offset,0)
-        sizeBytes = self.fd.read(4)
-        data = sizeBytes + self.fd.read(unpack('<l',sizeBytes)[0]*-1-4)
+        sizeBytes = self.__read(4096+offset, 4)
+        data = sizeBytes + self.__read(4096+offset+4, unpack('<l',sizeBytes)[0]*-1-4)
         if len(data) == 0:
             return None
         else:
@@ -221,11 +263,8 @@ class Registry:
             return None
 
     def __getValueBlocks(self, offset, count):
-        valueList = []
         res = []
-        self.fd.seek(4096+offset,0)
-        for i in range(count):
-            valueList.append(unpack('<l',self.fd.read(4))[0])
+        valueList = unpack('<%dl' % count, self.__read(4096+offset, 4*count))
 
         for valueOffset in valueList:
             if valueOffset > 0:
@@ -234,8 +273,7 @@ class Registry:
         return res
 
     def __getData(self, offset, count):
-        self.fd.seek(4096+offset, 0)
-        return self.fd.read(count)[4:]
+        return self.__read(4096+offset, count)[4:]
 
     def __processDataBlocks(self,data):
         res = []
@@ -288,7 +326,7 @@ class Registry:
             # Special case here, don't know exactly why, an ri pointing to a NK :-o
             offset = unpack('<L', hashData[:4])[0]
             nk = self.__getBlock(offset)
-            if nk['KeyName'] == key:
+            if nk['KeyName'].decode('utf-8') == key:
                 return offset
         else:
             LOG.critical("UNKNOWN Magic %s" % magic)
@@ -296,33 +334,57 @@ class Registry:
 
         return None
 
+    def __cacheItem(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.__cacheSize:
+            cache.popitem(last=False)
+
+    def __getSubKeyList(self, offset):
+        # Returns the magic of the subkey list at offset and its hash records. ri lists point to
+        # lf/lh lists, their records are returned all together
+        subKeyList = self.__subKeyCache.get(offset)
+        if subKeyList is not None:
+            self.__subKeyCache.move_to_end(offset)
+            return subKeyList
+
+        lf = self.__getBlock(offset)
+        if lf is None:
+            return None
+        data = lf['HashRecords']
+        if lf['Magic'] == 'ri':
+            # ri points to lf/lh records, so we must parse them before
+            records = b''
+            for i in range(lf['NumKeys']):
+                l = self.__getBlock(unpack('<L', data[:4])[0])
+                records = records + l['HashRecords'][:l['NumKeys']*8]
+                data = data[4:]
+            data = records
+
+        subKeyList = (lf['Magic'], data)
+        self.__cacheItem(self.__subKeyCache, offset, subKeyList)
+        return subKeyList
+
     def __findSubKey(self, parentKey, subKey):
-        lf = self.__getBlock(parentKey['OffsetSubKeyLf'])
-        if lf is not None:
-            data = lf['HashRecords']
+        # Returns the offset and NK record of subKey under parentKey
+        if parentKey['NumSubKeys'] == 0:
+            return None, None
+        subKeyList = self.__getSubKeyList(parentKey['OffsetSubKeyLf'])
+        if subKeyList is not None:
+            magic, data = subKeyList
             # Let's search the hash records for the name
-            if lf['Magic'] == 'ri':
-                # ri points to lf/lh records, so we must parse them before
-                records = b''
-                for i in range(lf['NumKeys']):
-                    offset = unpack('<L', data[:4])[0]
-                    l = self.__getBlock(offset)
-                    records = records + l['HashRecords'][:l['NumKeys']*8]
-                    data = data[4:]
-                data = records
-
             #for record in range(lf['NumKeys']):
             for record in range(parentKey['NumSubKeys']):
                 hashRec = data[:8]
-                res = self.__compareHash(lf['Magic'], hashRec, subKey)
+                res = self.__compareHash(magic, hashRec, subKey)
                 if res is not None:
                     # We have a match, now let's check the whole record
                     nk = self.__getBlock(res)
                     if nk['KeyName'].decode('utf-8') == subKey:
-                        return nk
+                        return res, nk
                 data = data[8:]
 
-        return None
+        return None, None
 
     def __walkSubNodes(self, rec):
         nk = self.__getBlock(rec['OffsetNk'])
@@ -369,6 +431,50 @@ class Registry:
             self.__walkSubNodes(hashRec)
             data = data[8:]
 
+    def __getKnownKey(self, path):
+        # Returns the NK offset for path if it's indexed or cached, None otherwise
+        if self.__keyIndex is not None and path in self.__keyIndex:
+            return self.__keyIndex[path]
+        offset = self.__keyCache.get(path)
+        if offset is not None:
+            self.__keyCache.move_to_end(path)
+        return offset
+
+    def buildIndex(self):
+        # Walks the whole hive once, indexing every key path to its NK offset. findKey() won't
+        # go through the subkey lists anymore for any of them. Returns the amount of keys indexed
+        keyIndex = {}
+        pending = [('', self.rootKey)]
+        while len(pending) > 0:
+            path, nk = pending.pop()
+            if nk['NumSubKeys'] == 0 or nk['OffsetSubKeyLf'] < 0:
+                continue
+            subKeyList = self.__getSubKeyList(nk['OffsetSubKeyLf'])
+            if subKeyList is None:
+                continue
+            data = subKeyList[1]
+            for i in range(nk['NumSubKeys']):
+                if len(data) < 8:
+                    break
+                offset = unpack('<L', data[:4])[0]
+                data = data[8:]
+                subKey = self.__getBlock(offset)
+                if isinstance(subKey, REG_NK) is False:
+                    continue
+                try:
+                    name = subKey['KeyName'].decode('utf-8')
+                except UnicodeDecodeError:
+                    # findKey() will walk the subkey lists for this one
+                    continue
+                if path != '':
+                    name = path + '\\' + name
+                keyIndex[name] = offset
+                pending.append((name, subKey))
+
+        self.__keyIndex = keyIndex
+        LOG.debug('%d keys indexed' % len(keyIndex))
+        return len(keyIndex)
+
     def findKey(self, key):
         # Let's strip '\' from the beginning, except for the case of
         # only asking for the root node
@@ -377,10 +483,21 @@ class Registry:
 
         parentKey = self.rootKey
         if len(key) > 0 and key[0]!='\\':
-            for subKey in key.split('\\'):
-                res = self.__findSubKey(parentKey, subKey)
+            subKeys = key.split('\\')
+            # Start from the longest parent path we already know
+            known = len(subKeys)
+            while known > 0:
+                offset = self.__getKnownKey('\\'.join(subKeys[:known]))
+                if offset is not None:
+                    parentKey = self.__getBlock(offset)
+                    break
+                known -= 1
+
+            for i in range(known, len(subKeys)):
+                offset, res = self.__findSubKey(parentKey, subKeys[i])
                 if res is not None:
                     parentKey = res
+                    self.__cacheItem(self.__keyCache, '\\'.join(subKeys[:i+1]), offset)
                 else:
                     #LOG.error("Key %s not found!" % key)
                     return None
@@ -418,18 +535,7 @@ class Registry:
         # If we're here.. we have a valid NK record for the key
         # Now let's searcht the subkeys
         if parentKey['NumSubKeys'] > 0:
-            lf = self.__getBlock(parentKey['OffsetSubKeyLf'])
-            data = lf['HashRecords']
-
-            if lf['Magic'] == 'ri':
-                # ri points to lf/lh records, so we must parse them before
-                records = ''
-                for i in range(lf['NumKeys']):
-                    offset = unpack('<L', data[:4])[0]
-                    l = self.__getBlock(offset)
-                    records = records + l['HashRecords'][:l['NumKeys']*8]
-                    data = data[4:]
-                data = records
+            data = self.__getSubKeyList(parentKey['OffsetSubKeyLf'])[1]
 
             for i in range(parentKey['NumSubKeys']):
                 hashRec = REG_HASH(data[:8])
@@ -0,0 +1,464 @@
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   [MS-XCA] Xpress Compression Algorithm
+#   Plain LZ77 (section 2.3 and 2.4) and LZ77+Huffman (section 2.1 and 2.2)
+#   compression and decompression, as used by SMB 3.1.1 compression.
+#
+#   Everything is pure Python, the compressor is a greedy single probe hash
+#   matcher: it trades ratio for speed, which is what matters when compressing
+#   SMB traffic on the fly.
+#
+from __future__ import division
+
+import heapq
+from struct import pack, unpack_from
+
+# Common to both algorithms
+MIN_MATCH = 3
+MAX_MATCH = 0xffff + MIN_MATCH
+
+# Plain LZ77
+LZ77_WINDOW = 8192
+
+# LZ77+Huffman
+HUFFMAN_WINDOW = 65535
+HUFFMAN_BLOCK_SIZE = 65536
+HUFFMAN_SYMBOLS = 512
+HUFFMAN_TABLE_SIZE = HUFFMAN_SYMBOLS // 2
+HUFFMAN_MAX_CODE_LENGTH = 15
+HUFFMAN_EOF = 256
+
+
+class XCAError(Exception):
+    pass
+
+
+def _matchLength(data, candidate, position, limit):
+    # Length of the match between candidate and position, up to limit bytes. Overlapping matches are
+    # fine, the decompressor copies byte by byte so the source is what we already have in data.
+    # The first differing byte is found by XORing the chunks as integers
+    length = MIN_MATCH
+    step = 32
+    while length < limit:
+        step = min(step, limit - length)
+        source = data[candidate + length:candidate + length + step]
+        target = data[position + length:position + length + step]
+        if source != target:
+            difference = int.from_bytes(source, 'little') ^ int.from_bytes(target, 'little')
+            return length + ((difference & -difference).bit_length() - 1) // 8
+        length += step
+        step = min(step * 2, 4096)
+    return length
+
+
+def _matches(data, window, blockSize=None):
+    # Greedy matcher, yields (position, offset, length) for every match found, literals are what is
+    # in between. If blockSize is specified, matches don't cross its boundaries. The longer it goes
+    # without finding a match the more positions it skips, incompressible data goes through quickly
+    table = {}
+    position = 0
+    misses = 0
+    end = len(data) - MIN_MATCH
+    while position <= end:
+        key = data[position:position + MIN_MATCH]
+        candidate = table.get(key)
+        table[key] = position
+        if candidate is None or position - candidate > window:
+            misses += 1
+            position += 1 + (misses >> 5)
+            continue
+        limit = min(len(data) - position, MAX_MATCH)
+        if blockSize is not None:
+            limit = min(limit, blockSize - position % blockSize)
+        if limit < MIN_MATCH:
+            position += 1
+            continue
+        length = _matchLength(data, candidate, position, limit)
+        misses = 0
+        yield position, position - candidate, length
+        position += length
+        # Keep the table useful after long matches
+        if position - 1 <= end:
+            table[data[position - 1:position - 1 + MIN_MATCH]] = position - 1
+
+
+#################################################################################
+# Plain LZ77
+#################################################################################
+
+def lz77_compress(data):
+    data = bytes(data)
+    output = bytearray(4)
+    flags = 0
+    flagCount = 0
+    flagPosition = 0
+    nibblePosition = None
+
+    def addFlags(bit, count):
+        nonlocal flags, flagCount, flagPosition
+        flags = (flags << count) | bit
+        flagCount += count
+        if flagCount == 32:
+            output[flagPosition:flagPosition + 4] = pack('<L', flags)
+            flags = 0
+            flagCount = 0
+            flagPosition = len(output)
+            output.extend(b'\x00\x00\x00\x00')
+
+    def addLiterals(start, end):
+        # Literals are flagged with 0s, as many at once as fit in the current flags
+        while start < end:
+            count = min(end - start, 32 - flagCount)
+            output.extend(data[start:start + count])
+            addFlags(0, count)
+            start += count
+
+    position = 0
+    for matchPosition, offset, length in _matches(data, LZ77_WINDOW):
+        addLiterals(position, matchPosition)
+        position = matchPosition + length
+
+        length -= MIN_MATCH
+        if length < 7:
+            output.extend(pack('<H', ((offset - 1) << 3) | length))
+        else:
+            output.extend(pack('<H', ((offset - 1) << 3) | 7))
+            length -= 7
+            # Length nibbles are shared by two matches
+            if nibblePosition is None:
+                nibblePosition = len(output)
+                output.append(min(length, 15))
+            else:
+                output[nibblePosition] |= min(length, 15) << 4
+                nibblePosition = None
+            if length >= 15:
+                length -= 15
+                if length < 255:
+                    output.append(length)
+                else:
+                    output.append(255)
+                    output.extend(pack('<H', length + 15 + 7))
+        addFlags(1, 1)
+
+    addLiterals(position, len(data))
+
+    # Unused flags are set, so the decompressor stops at the end of the input
+    flags = (flags << (32 - flagCount)) | ((1 << (32 - flagCount)) - 1)
+    output[flagPosition:flagPosition + 4] = pack('<L', flags)
+    return bytes(output)
+
+
+def lz77_decompress(data, size):
+    output = bytearray()
+    position = 0
+    flags = 0
+    flagCount = 0
+    nibblePosition = None
+    try:
+        while len(output) < size:
+            if flagCount == 0:
+                flags, = unpack_from('<L', data, position)
+                position += 4
+                flagCount = 32
+            # Literals up to the next match flag are copied at once
+            literals = min(flagCount - (flags & ((1 << flagCount) - 1)).bit_length(), size - len(output))
+            if literals > 0:
+                if position + literals > len(data):
+                    raise XCAError('Truncated LZ77 stream')
+                output += data[position:position + literals]
+                position += literals
+                flagCount -= literals
+                continue
+
+            flagCount -= 1
+            if position == len(data):
+                break
+            matchBytes, = unpack_from('<H', data, position)
+            position += 2
+            length = matchBytes & 7
+            offset = (matchBytes >> 3) + 1
+            if length == 7:
+                if nibblePosition is None:
+                    length = data[position] & 0xf
+                    nibblePosition = position
+                    position += 1
+                else:
+                    length = data[nibblePosition] >> 4
+                    nibblePosition = None
+                if length == 15:
+                    length = data[position]
+                    position += 1
+                    if length == 255:
+                        length, = unpack_from('<H', data, position)
+                        position += 2
+                        if length == 0:
+                            length, = unpack_from('<L', data, position)
+                            position += 4
+                        if length < 15 + 7:
+                            raise XCAError('Invalid match length')
+                        length -= 15 + 7
+                    length += 15
+                length += 7
+            length += MIN_MATCH
+            output += _copyMatch(output, offset, length)
+    except XCAError:
+        raise
+    except Exception as e:
+        raise XCAError('Invalid LZ77 stream: %s' % e)
+
+    if len(output) != size:
+        raise XCAError('LZ77 stream decompressed to %d bytes, expected %d' % (len(output), size))
+    return bytes(output)
+
+
+def _copyMatch(output, offset, length):
+    start = len(output) - offset
+    if start < 0:
+        raise XCAError('Match offset out of bounds')
+    if offset >= length:
+        return output[start:start + length]
+    # Overlapping match, the pattern repeats
+    pattern = bytes(output[start:])
+    return (pattern * (length // offset + 1))[:length]
+
+
+#################################################################################
+# LZ77+Huffman
+#################################################################################
+
+def _codeLengths(frequencies):
+    # Huffman code lengths for the 512 symbols, limited to 15 bits by flattening
+    # the frequencies until the tree is shallow enough
+    used = [symbol for symbol in range(HUFFMAN_SYMBOLS) if frequencies[symbol] > 0]
+    lengths = [0] * HUFFMAN_SYMBOLS
+    if len(used) == 1:
+        # A code needs two symbols at least
+        used.append(0 if used[0] != 0 else 1)
+    while True:
+        heap = [(frequencies[symbol] or 1, symbol, None) for symbol in used]
+        heapq.heapify(heap)
+        nodes = len(heap)
+        while len(heap) > 1:
+            a = heapq.heappop(heap)
+            b = heapq.heappop(heap)
+            heapq.heappush(heap, (a[0] + b[0], HUFFMAN_SYMBOLS + nodes, (a, b)))
+            nodes += 1
+        maxLength = 0
+        stack = [(heap[0], 0)]
+        while stack:
+            node, depth = stack.pop()
+            if node[2] is None:
+                lengths[node[1]] = depth
+                maxLength = max(maxLength, depth)
+            else:
+                stack.append((node[2][0], depth + 1))
+                stack.append((node[2][1], depth + 1))
+        if maxLength <= HUFFMAN_MAX_CODE_LENGTH:
+            return lengths
+        frequencies = [(f + 1) // 2 if f > 0 else 0 for f in frequencies]
+
+
+def _canonicalCodes(lengths):
+    # Codes are assigned in (length, symbol) order, the same way the decoding table is filled
+    codes = [0] * HUFFMAN_SYMBOLS
+    entry = 0
+    for length, symbol in sorted((length, symbol) for symbol, length in enumerate(lengths) if length > 0):
+        codes[symbol] = entry >> (HUFFMAN_MAX_CODE_LENGTH - length)
+        entry += 1 << (HUFFMAN_MAX_CODE_LENGTH - length)
+    if entry > 1 << HUFFMAN_MAX_CODE_LENGTH:
+        raise XCAError('Invalid Huffman code lengths')
+    return codes
+
+
+def _decodingTable(table):
+    lengths = []
+    for byte in bytearray(table):
+        lengths.append(byte & 0xf)
+        lengths.append(byte >> 4)
+    decoding = []
+    for length, symbol in sorted((length, symbol) for symbol, length in enumerate(lengths) if length > 0):
+        decoding.extend([(symbol, length)] * (1 << (HUFFMAN_MAX_CODE_LENGTH - length)))
+    if len(decoding) > 1 << HUFFMAN_MAX_CODE_LENGTH:
+        raise XCAError('Invalid Huffman table')
+    # Incomplete codes are legal, the remaining entries can't show up in a valid stream
+    decoding.extend([(None, 0)] * ((1 << HUFFMAN_MAX_CODE_LENGTH) - len(decoding)))
+    return decoding
+
+
+class _HuffmanBlockWriter:
+    # Lays out the bit stream exactly as the decompressor reads it: 16 bits words are fetched
+    # as bits get consumed, and extra length bytes are read from wherever the input is at
+    def __init__(self):
+        self.parts = []
+        self.words = []
+        self.bits = 0
+        self.bitCount = 0
+        self.consumed = 0
+        # The decompressor starts by fetching two words
+        self.parts.append(0)
+        self.parts.append(1)
+        self.fetched = 2
+
+    def writeBits(self, value, count):
+        self.bits = (self.bits << count) | value
+        self.bitCount += count
+        while self.bitCount >= 16:
+            self.bitCount -= 16
+            self.words.append((self.bits >> self.bitCount) & 0xffff)
+        self.bits &= (1 << self.bitCount) - 1
+        self.consumed += count
+        if self.consumed > 16 * (self.fetched - 1):
+            self.parts.append(self.fetched)
+            self.fetched += 1
+
+    def writeBytes(self, data):
+        self.parts.append(data)
+
+    def getData(self):
+        words = self.words
+        if self.bitCount > 0:
+            words = words + [(self.bits << (16 - self.bitCount)) & 0xffff]
+        output = []
+        for part in self.parts:
+            if isinstance(part, int):
+                output.append(pack('<H', words[part]) if part < len(words) else b'\x00\x00')
+            else:
+                output.append(part)
+        return b''.join(output)
+
+
+def _huffmanSymbols(data):
+    # Tokens for the whole input: (symbol, extra length bytes, offset bits count, offset bits, bytes output)
+    position = 0
+    for matchPosition, offset, length in _matches(data, HUFFMAN_WINDOW, HUFFMAN_BLOCK_SIZE):
+        for i in range(position, matchPosition):
+            yield data[i], None, 0, 0, 1
+        position = matchPosition + length
+
+        matchLength = length - MIN_MATCH
+        offsetBits = offset.bit_length() - 1
+        extra = None
+        if matchLength >= 15:
+            if matchLength - 15 < 255:
+                extra = pack('B', matchLength - 15)
+            else:
+                extra = pack('<BH', 255, matchLength)
+        yield 256 + (offsetBits << 4) + min(matchLength, 15), extra, offsetBits, offset - (1 << offsetBits), length
+    for i in range(position, len(data)):
+        yield data[i], None, 0, 0, 1
+
+
+def _huffmanBlock(tokens, eof):
+    frequencies = [0] * HUFFMAN_SYMBOLS
+    for token in tokens:
+        frequencies[token[0]] += 1
+    if eof:
+        frequencies[HUFFMAN_EOF] += 1
+    lengths = _codeLengths(frequencies)
+    codes = _canonicalCodes(lengths)
+
+    table = bytearray(HUFFMAN_TABLE_SIZE)
+    for i in range(HUFFMAN_TABLE_SIZE):
+        table[i] = lengths[2 * i] | (lengths[2 * i + 1] << 4)
+
+    writer = _HuffmanBlockWriter()
+    for symbol, extra, offsetBits, offset, _ in tokens:
+        writer.writeBits(codes[symbol], lengths[symbol])
+        if extra is not None:
+            writer.writeBytes(extra)
+        if offsetBits > 0:
+            writer.writeBits(offset, offsetBits)
+    if eof:
+        writer.writeBits(codes[HUFFMAN_EOF], lengths[HUFFMAN_EOF])
+    return bytes(table) + writer.getData()
+
+
+def lz77huffman_compress(data):
+    data = bytes(data)
+    blocks = []
+    tokens = []
+    blockOutput = 0
+    for token in _huffmanSymbols(data):
+        tokens.append(token)
+        blockOutput += token[4]
+        if blockOutput == HUFFMAN_BLOCK_SIZE:
+            blocks.append(_huffmanBlock(tokens, False))
+            tokens = []
+            blockOutput = 0
+    # EOF goes in the last block, which is a new one if the input ended on a block boundary
+    blocks.append(_huffmanBlock(tokens, True))
+    return b''.join(blocks)
+
+
+def lz77huffman_decompress(data, size):
+    data = bytes(data) + b'\x00' * 8
+    output = bytearray()
+    position = 0
+    try:
+        while len(output) < size:
+            decoding = _decodingTable(data[position:position + HUFFMAN_TABLE_SIZE])
+            position += HUFFMAN_TABLE_SIZE
+            nextBits = (unpack_from('<H', data, position)[0] << 16) | unpack_from('<H', data, position + 2)[0]
+            position += 4
+            extraBitCount = 16
+            blockEnd = min(len(output) + HUFFMAN_BLOCK_SIZE, size)
+
+            while len(output) < blockEnd:
+                symbol, length = decoding[nextBits >> (32 - HUFFMAN_MAX_CODE_LENGTH)]
+                if symbol is None:
+                    raise XCAError('Invalid Huffman code')
+                nextBits = (nextBits << length) & 0xffffffff
+                extraBitCount -= length
+                if extraBitCount < 0:
+                    nextBits |= unpack_from('<H', data, position)[0] << -extraBitCount
+                    extraBitCount += 16
+                    position += 2
+
+                if symbol < 256:
+                    output.append(symbol)
+                    continue
+
+                symbol -= 256
+                length = symbol & 0xf
+                offsetBits = symbol >> 4
+                if length == 15:
+                    length = data[position]
+                    position += 1
+                    if length == 255:
+                        length, = unpack_from('<H', data, position)
+                        position += 2
+                        if length == 0:
+                            length, = unpack_from('<L', data, position)
+                            position += 4
+                        if length < 15:
+                            raise XCAError('Invalid match length')
+                        length -= 15
+                    length += 15
+                length += MIN_MATCH
+
+                offset = (nextBits >> (32 - offsetBits)) if offsetBits > 0 else 0
+                offset += 1 << offsetBits
+                nextBits = (nextBits << offsetBits) & 0xffffffff
+                extraBitCount -= offsetBits
+                if extraBitCount < 0:
+                    nextBits |= unpack_from('<H', data, position)[0] << -extraBitCount
+                    extraBitCount += 16
+                    position += 2
+                output += _copyMatch(output, offset, length)
+    except XCAError:
+        raise
+    except Exception as e:
+        raise XCAError('Invalid LZ77+Huffman stream: %s' % e)
+
+    if len(output) != size:
+        raise XCAError('LZ77+Huffman stream decompressed to %d bytes, expected %d' % (len(output), size))
+    return bytes(output)
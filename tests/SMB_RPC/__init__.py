@@ -9,3 +9,18 @@
 # of the Apache Software License. See the accompanying LICENSE file
 # for more information.
 #
+#
+# Description:
+#   Helpers shared by the SMB and DCE/RPC tests.
+#
+from impacket.smbserver import SRVSServer, WKSTServer
+
+
+class SRVSWKSTServer(SRVSServer):
+    # Serves both interfaces on the same endpoint, like the ones in a Windows process do
+    NetrWkstaGetInfo = WKSTServer.NetrWkstaGetInfo
+
+    def __init__(self):
+        SRVSServer.__init__(self)
+        self.addCallbacks(("6BFFD098-A112-3610-9833-46C3F87E345A", "1.0"), "\\PIPE\\wkssvc",
+                          {0: self.NetrWkstaGetInfo})
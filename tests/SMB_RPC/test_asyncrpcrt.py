@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Loopback tests for the asyncio DCE/RPC client, against the SRVS server
+#   over ncacn_ip_tcp and through the SimpleSMBServer over ncacn_np.
+#
+import asyncio
+import socket
+import unittest
+from configparser import ConfigParser
+from multiprocessing import Process
+from os import mkdir, rmdir
+from os.path import exists
+from time import sleep
+
+from impacket.dcerpc.v5 import srvs, wkst
+from impacket.dcerpc.v5.asynctransport import AsyncDCERPCTransportFactory
+from impacket.dcerpc.v5.rpcrt import DCERPCException
+from impacket.smbserver import SimpleSMBServer
+from impacket.ntlm import compute_lmhash, compute_nthash
+from tests.SMB_RPC import SRVSWKSTServer
+
+
+def share_info(share):
+    request = srvs.NetrShareGetInfo()
+    request["ServerName"] = "\x00"
+    request["NetName"] = share + "\x00"
+    request["Level"] = 1
+    return request
+
+
+def requests(count):
+    # Every third share doesn't exist, its call fails
+    for i in range(count):
+        yield share_info("SHARE" if i % 3 else "MISSING%d" % i)
+
+
+class AsyncRPCRTTCPTests(unittest.TestCase):
+
+    def setUp(self):
+        config = ConfigParser()
+        config.add_section("global")
+        config.set("global", "log_file", "None")
+        config.add_section("SHARE")
+        config.set("SHARE", "comment", "A share")
+        config.set("SHARE", "share type", "0")
+        config.set("SHARE", "path", ".")
+        self.server = SRVSWKSTServer()
+        self.server.daemon = True
+        self.server.setServerConfig(config)
+        self.server.processConfigFile()
+        self.server.start()
+
+    async def connect(self):
+        dce = AsyncDCERPCTransportFactory("ncacn_ip_tcp:127.0.0.1[%d]" % self.server.getListenPort()).get_dce_rpc()
+        # The server starts listening in its thread
+        for _ in range(50):
+            try:
+                await dce.connect()
+                break
+            except DCERPCException:
+                await asyncio.sleep(0.1)
+        await dce.bind(srvs.MSRPC_UUID_SRVS)
+        return dce
+
+    def test_request(self):
+        async def run():
+            dce = await self.connect()
+            try:
+                resp = await srvs.hNetrShareGetInfo(dce, "SHARE\x00", 1)
+                self.assertEqual(resp["InfoStruct"]["ShareInfo1"]["shi1_remark"], "A share\x00")
+                with self.assertRaises(srvs.DCERPCSessionError):
+                    await srvs.hNetrShareGetInfo(dce, "MISSING\x00", 1)
+                # An opnum the server doesn't support is answered with a fault
+                with self.assertRaisesRegex(DCERPCException, "rpc_s_cannot_support"):
+                    await dce.request(srvs.NetrShareSetInfo())
+                return (await dce.request(srvs.NetrServerGetInfo()))["ErrorCode"]
+            finally:
+                await dce.disconnect()
+
+        self.assertEqual(asyncio.run(run()), 0)
+
+    def test_concurrent_requests(self):
+        """Many tasks making calls on the same association, more than the pipeline window.
+        """
+        async def run():
+            dce = await self.connect()
+            dce.set_pipeline_window(4)
+            try:
+                return await asyncio.gather(*[dce.request(request) for request in requests(60)],
+                                            return_exceptions=True)
+            finally:
+                await dce.disconnect()
+
+        for i, response in enumerate(asyncio.run(run())):
+            if i % 3:
+                self.assertEqual(response["InfoStruct"]["ShareInfo1"]["shi1_netname"], "SHARE\x00")
+            else:
+                self.assertIsInstance(response, srvs.DCERPCSessionError)
+
+    def test_alter_ctx(self):
+        """Tasks making calls on two presentation contexts of the same association at once.
+        """
+        async def run():
+            dce = await self.connect()
+            try:
+                wkstDce = await dce.alter_ctx(wkst.MSRPC_UUID_WKST)
+                calls = []
+                for i in range(10):
+                    calls.append(dce.request(share_info("SHARE")))
+                    calls.append(wkst.hNetrWkstaGetInfo(wkstDce, 100))
+                responses = await asyncio.gather(*calls)
+                # Another context while calls are in flight
+                task = dce.submit(share_info("SHARE"))
+                await asyncio.sleep(0)
+                srvsDce = await wkstDce.alter_ctx(srvs.MSRPC_UUID_SRVS)
+                responses += await asyncio.gather(task, srvsDce.request(share_info("SHARE")),
+                                                  wkst.hNetrWkstaGetInfo(wkstDce, 100))
+                return responses
+            finally:
+                await dce.disconnect()
+
+        responses = asyncio.run(run())
+        self.assertEqual(len(responses), 23)
+        for response in responses:
+            if isinstance(response, wkst.NetrWkstaGetInfoResponse):
+                self.assertEqual(response["WkstaInfo"]["WkstaInfo100"]["wki100_platform_id"], 500)
+            else:
+                self.assertEqual(response["InfoStruct"]["ShareInfo1"]["shi1_netname"], "SHARE\x00")
+
+    def test_request_many(self):
+        async def run():
+            dce = await self.connect()
+            try:
+                responses = [r async for r in dce.request_many(requests(50), returnExceptions=True)]
+                with self.assertRaises(srvs.DCERPCSessionError):
+                    async for _ in dce.request_many(requests(50)):
+                        pass
+                # A call cancelled while in flight doesn't get in the way of the next ones
+                task = dce.submit(share_info("SHARE"))
+                await asyncio.sleep(0)
+                task.cancel()
+                resp = await dce.request(share_info("SHARE"))
+                self.assertEqual(resp["ErrorCode"], 0)
+                return responses
+            finally:
+                await dce.disconnect()
+
+        responses = asyncio.run(run())
+        self.assertEqual(len(responses), 50)
+        for i, response in enumerate(responses):
+            if i % 3:
+                self.assertEqual(response["ErrorCode"], 0)
+            else:
+                self.assertEqual(response.get_error_code(), 0x906)
+
+    def test_connection_closed(self):
+        # A server going away without answering
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+
+        async def run():
+            dce = AsyncDCERPCTransportFactory("ncacn_ip_tcp:127.0.0.1[%d]" % listener.getsockname()[1]).get_dce_rpc()
+            await dce.connect()
+            sock, _ = listener.accept()
+            tasks = [dce.submit(share_info("SHARE")) for _ in range(3)]
+            await asyncio.sleep(0.1)
+            sock.close()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            with self.assertRaises(Exception):
+                await dce.request(share_info("SHARE"))
+            await dce.disconnect()
+            return results
+
+        results = asyncio.run(run())
+        for result in results:
+            self.assertIsInstance(result, (DCERPCException, ConnectionError))
+
+
+class AsyncRPCRTSMBTests(unittest.TestCase):
+    address = "127.0.0.1"
+    port = 1448
+    username = "UserName"
+    password = "Password"
+
+    share_name = "SHARE"
+    share_path = "async_rpc_jail_dir"
+
+    def setUp(self):
+        if not exists(self.share_path):
+            mkdir(self.share_path)
+        self.server = SimpleSMBServer(listenAddress=self.address, listenPort=self.port)
+        self.server.addCredential(self.username, 0, compute_lmhash(self.password), compute_nthash(self.password))
+        self.server.addShare(self.share_name, self.share_path, "A share")
+        self.server.setSMB2Support(True)
+        self.server_process = Process(target=self.server.start)
+        self.server_process.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_process.terminate()
+        sleep(0.1)
+        rmdir(self.share_path)
+
+    def test_named_pipe(self):
+        async def run():
+            rpctransport = AsyncDCERPCTransportFactory(r"ncacn_np:%s[\pipe\srvsvc]" % self.address)
+            rpctransport.set_dport(self.port)
+            rpctransport.set_credentials(self.username, self.password)
+            async with rpctransport.get_dce_rpc() as dce:
+                await dce.bind(srvs.MSRPC_UUID_SRVS)
+                resp = await srvs.hNetrShareEnum(dce, 1)
+                shares = [share["shi1_netname"][:-1] for share in resp["InfoStruct"]["ShareInfo"]["Level1"]["Buffer"]]
+                responses = await asyncio.gather(*[dce.request(request) for request in requests(20)],
+                                                 return_exceptions=True)
+            return shares, responses
+
+        # The server takes a while to start
+        for _ in range(50):
+            try:
+                shares, responses = asyncio.run(run())
+                break
+            except DCERPCException as e:
+                if "Could not connect" not in str(e):
+                    raise
+                sleep(0.1)
+        self.assertIn(self.share_name, shares)
+        for i, response in enumerate(responses):
+            if i % 3:
+                self.assertEqual(response["InfoStruct"]["ShareInfo1"]["shi1_remark"], "A share\x00")
+            else:
+                self.assertIsInstance(response, srvs.DCERPCSessionError)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Loopback tests for the asyncio SMB client against the SimpleSMBServer.
+#
+import asyncio
+import unittest
+from io import BytesIO
+from time import sleep
+from os import mkdir, remove, rmdir, listdir, urandom
+from os.path import exists, join
+from multiprocessing import Process
+
+from impacket.asyncsmb3 import AsyncSMB3
+from impacket.smb3 import SessionError, SIGNING_ALGORITHMS
+from impacket.smb3structs import SMB2_DIALECT_002, SMB2_DIALECT_30, SMB2_DIALECT_311, SMB2_SIGNING_AES_GMAC, \
+    SMB2_FLAGS_SERVER_TO_REDIR, SMB2_FLAGS_SIGNED, SMB2_CANCEL, SMB2_READ, SMB3Packet
+from impacket.smbserver import SimpleSMBServer, SMBSERVER
+from impacket.ntlm import compute_lmhash, compute_nthash
+
+
+class AsyncSMB3Tests(unittest.TestCase):
+    address = "127.0.0.1"
+    port = 1447
+    username = "UserName"
+    password = "Password"
+    domain = "DOMAIN"
+
+    share_name = "share"
+    share_path = "async_jail_dir"
+
+    def setUp(self):
+        if not exists(self.share_path):
+            mkdir(self.share_path)
+        self.server = SimpleSMBServer(listenAddress=self.address, listenPort=self.port)
+        self.server.addCredential(self.username, 0, compute_lmhash(self.password), compute_nthash(self.password))
+        self.server.addShare(self.share_name, self.share_path)
+        self.server.setSMB2Support(True)
+        self.server.setSMB3Support(True)
+        self.server_process = Process(target=self.server.start)
+        self.server_process.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_process.terminate()
+        sleep(0.1)
+        for f in listdir(self.share_path):
+            remove(join(self.share_path, f))
+        rmdir(self.share_path)
+
+    def get_client(self, dialect=None):
+        return AsyncSMB3(self.address, self.address, sess_port=self.port, preferredDialect=dialect)
+
+    async def transfer(self, dialect, name, content):
+        async with self.get_client(dialect) as client:
+            await client.login(self.username, self.password, self.domain)
+            await client.storeFile(self.share_name, name, BytesIO(content).read)
+            files = [f.get_longname() for f in await client.listPath(self.share_name, "*")]
+            data = []
+            await client.retrieveFile(self.share_name, name, data.append)
+            return client.getDialect(), files, b"".join(data)
+
+    def test_login(self):
+        async def login(password):
+            async with self.get_client() as client:
+                return await client.login(self.username, password, self.domain)
+
+        self.assertTrue(asyncio.run(login(self.password)))
+        with self.assertRaisesRegex(SessionError, "STATUS_LOGON_FAILURE"):
+            asyncio.run(login("wrong"))
+
+    def test_concurrent_sessions(self):
+        """Many sessions, with each of the dialects, writing, listing and reading back files at the same time.
+        """
+        async def run():
+            tasks = []
+            for i in range(40):
+                dialect = (None, SMB2_DIALECT_002, SMB2_DIALECT_30, SMB2_DIALECT_311)[i % 4]
+                tasks.append(self.transfer(dialect, "file%d" % i, urandom(1000 + i * 5000)))
+            return await asyncio.gather(*tasks)
+
+        results = asyncio.run(run())
+        for i, (dialect, files, data) in enumerate(results):
+            self.assertEqual(dialect, (SMB2_DIALECT_30, SMB2_DIALECT_002, SMB2_DIALECT_30, SMB2_DIALECT_311)[i % 4])
+            self.assertIn("file%d" % i, files)
+            with open(join(self.share_path, "file%d" % i), "rb") as fd:
+                self.assertEqual(fd.read(), data)
+
+    def test_concurrent_requests(self):
+        """Several tasks sharing a session, with many READ and WRITE requests in flight.
+        """
+        contents = [urandom(300000 + i) for i in range(4)]
+
+        async def run():
+            async with self.get_client(SMB2_DIALECT_311) as client:
+                await client.login(self.username, self.password, self.domain)
+                client.setTransferWindow(65536 * 4)
+                treeId = await client.connectTree(self.share_name)
+                fileIds = []
+                for i in range(len(contents)):
+                    fileIds.append(await client.create(treeId, "file%d" % i, 0x12019f, 0, 0x40, 5, 0x80))
+                await asyncio.gather(*[client.write(treeId, fileId, content) for fileId, content in
+                                       zip(fileIds, contents)])
+                data = await asyncio.gather(*[client.read(treeId, fileId, 0, len(content) + 100) for fileId, content
+                                              in zip(fileIds, contents)])
+                for fileId in fileIds:
+                    await client.close(treeId, fileId)
+                await client.disconnectTree(treeId)
+                return data
+
+        self.assertEqual(asyncio.run(run()), contents)
+
+    def test_signing(self):
+        """Signed SMB 3.1.1 sessions, with each of the signing algorithms.
+        """
+        async def run(signingAlgorithm):
+            client = self.get_client(SMB2_DIALECT_311)
+            # No ciphers, so requests are signed instead of encrypted
+            client.EncryptionAlgorithmList = []
+            client.SigningAlgorithmList = [signingAlgorithm]
+            async with client:
+                await client.login(self.username, self.password, self.domain)
+                await client.storeFile(self.share_name, "file", BytesIO(b"signed").read)
+                data = []
+                await client.retrieveFile(self.share_name, "file", data.append)
+                return client._Connection["SigningAlgorithmId"], client._Session["SigningActivated"], b"".join(data)
+
+        for signingAlgorithm in SIGNING_ALGORITHMS:
+            self.assertEqual(asyncio.run(run(signingAlgorithm)), (signingAlgorithm, True, b"signed"))
+
+        # AES-GMAC nonces tell responses and CANCEL requests apart, signatures must match the server's
+        client = self.get_client()
+        client._Connection["Dialect"] = SMB2_DIALECT_311
+        client._Connection["SigningAlgorithmId"] = SMB2_SIGNING_AES_GMAC
+        client._Session["SessionKey"] = client._Session["SigningKey"] = urandom(16)
+        server = SMBSERVER((self.address, 0))
+        self.addCleanup(server.server_close)
+        for command, flags in ((SMB2_READ, 0), (SMB2_READ, SMB2_FLAGS_SERVER_TO_REDIR), (SMB2_CANCEL, 0)):
+            packet = SMB3Packet()
+            packet["Command"] = command
+            packet["Flags"] = flags | SMB2_FLAGS_SIGNED
+            packet["MessageID"] = 10
+            client.signSMB(packet)
+            signature = packet["Signature"]
+            server.signSMBv2(packet, client._Session["SigningKey"], signingAlgorithm=SMB2_SIGNING_AES_GMAC)
+            self.assertEqual(packet["Signature"], signature)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Tests for the endpoint mapper resolution cache, hept_map() and
+#   hept_map_many() against a local endpoint mapper stand-in, and the
+#   DCE/RPC pool resolving endpoints through the cache.
+#
+import socket
+import unittest
+from configparser import ConfigParser
+from struct import pack
+from time import sleep
+
+from impacket.dcerpc.v5 import epm, srvs, wkst, transport
+from impacket.dcerpc.v5.pool import DCERPCPool
+from impacket.dcerpc.v5.rpcrt import DCERPCServer, DCERPCException
+from impacket.smbserver import SRVSServer
+from impacket.uuid import uuidtup_to_bin
+
+MSRPC_UUID_UNKNOWN = uuidtup_to_bin(("12345778-1234-ABCD-EF00-0123456789AB", "0.0"))
+
+
+class EPMServer(DCERPCServer):
+    # Answers ept_map with the TCP port of the interfaces in endpoints
+    def __init__(self, endpoints):
+        DCERPCServer.__init__(self)
+        self.endpoints = endpoints
+        self.binds = 0
+        self.calls = 0
+        self.addCallbacks(("E1AF8308-5D1F-11C9-91A4-08002B14A0FA", "3.0"), "\\PIPE\\epmapper", {3: self.ept_map})
+
+    def bind(self, packet, bind):
+        self.binds += 1
+        return DCERPCServer.bind(self, packet, bind)
+
+    def ept_map(self, data):
+        self.calls += 1
+        request = epm.ept_map(data)
+        tower = epm.EPMTower(b"".join(request["map_tower"]["tower_octet_string"]))
+        interface = tower["Floors"][0]
+        remoteIf = interface["InterfaceUUID"] + pack("<HH", interface["MajorVersion"], interface["MinorVersion"])
+
+        answer = epm.ept_mapResponse()
+        if remoteIf not in self.endpoints:
+            answer["status"] = 0x16c9a0d6
+            return answer
+
+        portAddr = epm.EPMPortAddr()
+        portAddr["IpPort"] = self.endpoints[remoteIf]
+        hostAddr = epm.EPMHostAddr()
+        hostAddr["Ip4addr"] = socket.inet_aton("127.0.0.1")
+        result = epm.EPMTower()
+        result["NumberOfFloors"] = 5
+        result["Floors"] = b"".join(floor.getData() for floor in tower["Floors"][:3]) + portAddr.getData() + \
+            hostAddr.getData()
+        towerPointer = epm.twr_p_t()
+        towerPointer["tower_length"] = len(result)
+        towerPointer["tower_octet_string"] = result.getData()
+        answer["num_towers"] = 1
+        answer["ITowers"].append(towerPointer)
+        return answer
+
+
+class EPMCacheTests(unittest.TestCase):
+
+    def test_cache(self):
+        cache = epm.EPMCache(maxEntries=2)
+        self.assertIsNone(cache.get("HOST", srvs.MSRPC_UUID_SRVS, "ncacn_ip_tcp"))
+        cache.set("HOST", srvs.MSRPC_UUID_SRVS, "ncacn_ip_tcp", "ncacn_ip_tcp:HOST[49664]")
+        self.assertEqual(cache.get("host", srvs.MSRPC_UUID_SRVS, "ncacn_ip_tcp"), "ncacn_ip_tcp:HOST[49664]")
+        self.assertIsNone(cache.get("host", srvs.MSRPC_UUID_SRVS, "ncacn_np"))
+        self.assertIsNone(cache.get("host", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp"))
+
+        # Full, the oldest one goes
+        cache.set("HOST", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp", "ncacn_ip_tcp:HOST[49665]")
+        cache.set("OTHER", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp", "ncacn_ip_tcp:OTHER[49665]")
+        self.assertIsNone(cache.get("HOST", srvs.MSRPC_UUID_SRVS, "ncacn_ip_tcp"))
+        self.assertEqual(cache.get("HOST", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp"), "ncacn_ip_tcp:HOST[49665]")
+
+        cache.invalidate("host")
+        self.assertIsNone(cache.get("HOST", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp"))
+        self.assertEqual(cache.get("OTHER", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp"), "ncacn_ip_tcp:OTHER[49665]")
+        self.assertEqual(cache.getStats(), {"hits": 3, "misses": 5, "expirations": 0, "entries": 1})
+        cache.clear()
+        self.assertEqual(cache.getStats()["entries"], 0)
+
+    def test_expiration(self):
+        cache = epm.EPMCache(ttl=0)
+        cache.set("HOST", srvs.MSRPC_UUID_SRVS, "ncacn_ip_tcp", "ncacn_ip_tcp:HOST[49664]")
+        self.assertIsNone(cache.get("HOST", srvs.MSRPC_UUID_SRVS, "ncacn_ip_tcp"))
+        self.assertEqual(cache.getStats(), {"hits": 0, "misses": 1, "expirations": 1, "entries": 0})
+
+
+class EPMMapTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EPMServer({srvs.MSRPC_UUID_SRVS: 49664, wkst.MSRPC_UUID_WKST: 49665})
+        self.server.daemon = True
+        self.server.start()
+        rpctransport = transport.DCERPCTransportFactory("ncacn_ip_tcp:127.0.0.1[%d]" %
+                                                        self.server.getListenPort())
+        self.dce = rpctransport.get_dce_rpc()
+        # The server starts listening in its thread
+        for _ in range(50):
+            try:
+                self.dce.connect()
+                break
+            except DCERPCException:
+                sleep(0.1)
+        self.addCleanup(self.dce.disconnect)
+
+    def test_hept_map(self):
+        cache = epm.EPMCache()
+        for _ in range(3):
+            stringBinding = epm.hept_map("127.0.0.1", srvs.MSRPC_UUID_SRVS, protocol="ncacn_ip_tcp", dce=self.dce,
+                                         cache=cache)
+            self.assertEqual(stringBinding, "ncacn_ip_tcp:127.0.0.1[49664]")
+        self.assertEqual(self.server.calls, 1)
+        self.assertEqual(cache.getStats(), {"hits": 2, "misses": 1, "expirations": 0, "entries": 1})
+
+        with self.assertRaisesRegex(DCERPCException, "ept_s_not_registered"):
+            epm.hept_map("127.0.0.1", MSRPC_UUID_UNKNOWN, protocol="ncacn_ip_tcp", dce=self.dce, cache=cache)
+
+    def test_hept_map_many(self):
+        cache = epm.EPMCache()
+        cache.set("127.0.0.1", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp", "ncacn_ip_tcp:127.0.0.1[49665]")
+        results = epm.hept_map_many("127.0.0.1", [srvs.MSRPC_UUID_SRVS, wkst.MSRPC_UUID_WKST, MSRPC_UUID_UNKNOWN],
+                                    protocol="ncacn_ip_tcp", dce=self.dce, cache=cache)
+        self.assertEqual(results, {srvs.MSRPC_UUID_SRVS: "ncacn_ip_tcp:127.0.0.1[49664]",
+                                   wkst.MSRPC_UUID_WKST: "ncacn_ip_tcp:127.0.0.1[49665]",
+                                   MSRPC_UUID_UNKNOWN: None})
+        # One bind, the cached interface isn't asked for
+        self.assertEqual(self.server.binds, 1)
+        self.assertEqual(self.server.calls, 2)
+        self.assertEqual(cache.get("127.0.0.1", srvs.MSRPC_UUID_SRVS, "ncacn_ip_tcp"),
+                         "ncacn_ip_tcp:127.0.0.1[49664]")
+
+        # Everything cached, no bind
+        results = epm.hept_map_many("127.0.0.1", [srvs.MSRPC_UUID_SRVS, wkst.MSRPC_UUID_WKST],
+                                    protocol="ncacn_ip_tcp", dce=self.dce, cache=cache)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(self.server.binds, 1)
+
+
+class EPMCachePoolTests(unittest.TestCase):
+
+    def setUp(self):
+        config = ConfigParser()
+        config.add_section("global")
+        config.set("global", "log_file", "None")
+        self.server = SRVSServer()
+        self.server.daemon = True
+        self.server.setServerConfig(config)
+        self.server.processConfigFile()
+        self.server.start()
+        self.addCleanup(epm.EPM_CACHE.clear)
+        # The server starts listening in its thread
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", self.server.getListenPort())).close()
+                break
+            except OSError:
+                sleep(0.1)
+
+    def test_pool(self):
+        # The endpoint is in the cache, the endpoint mapper isn't asked
+        epm.EPM_CACHE.set("127.0.0.1", srvs.MSRPC_UUID_SRVS, "ncacn_ip_tcp",
+                          "ncacn_ip_tcp:127.0.0.1[%d]" % self.server.getListenPort())
+        with DCERPCPool() as pool:
+            dce = pool.get("ncacn_ip_tcp:127.0.0.1", srvs.MSRPC_UUID_SRVS)
+            self.assertEqual(dce.get_rpc_transport().get_dport(), self.server.getListenPort())
+            pool.release(dce)
+
+            # Nothing listening there anymore, the endpoint is forgotten
+            listener = socket.socket()
+            listener.bind(("127.0.0.1", 0))
+            port = listener.getsockname()[1]
+            listener.close()
+            epm.EPM_CACHE.set("127.0.0.1", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp", "ncacn_ip_tcp:127.0.0.1[%d]" % port)
+            with self.assertRaises(DCERPCException):
+                pool.get("ncacn_ip_tcp:127.0.0.1", wkst.MSRPC_UUID_WKST)
+            self.assertIsNone(epm.EPM_CACHE.get("127.0.0.1", wkst.MSRPC_UUID_WKST, "ncacn_ip_tcp"))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -9,7 +9,11 @@
 # for more information.
 #
 import pytest
+import socket
 import unittest
+from os import urandom
+from struct import pack
+from threading import Thread
 from tests import RemoteTestCase
 
 from impacket import nmb
@@ -85,5 +89,52 @@ class NMBTests(RemoteTestCase, unittest.TestCase):
         print(resp.entries)
 
 
+class NetBIOSTCPSessionTests(unittest.TestCase):
+    select_poll = False
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+        self.session = nmb.NetBIOSTCPSession("CLIENT", "SERVER", "127.0.0.1", sess_port=nmb.SMB_SESSION_PORT,
+                                             sock=self.client, select_poll=self.select_poll)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def send_frames(self, *frames):
+        # Written from another thread, frames bigger than the socket buffers would block otherwise
+        def send():
+            for frame in frames:
+                self.server.sendall(frame)
+        thread = Thread(target=send)
+        thread.start()
+        return thread
+
+    def test_recv_packet(self):
+        large = urandom(8 * 1024 * 1024 + 3)
+        keep_alive = pack("!BBH", nmb.NETBIOS_SESSION_KEEP_ALIVE, 0, 0)
+        thread = self.send_frames(pack("!BBH", 0, 0, 5) + b"small",
+                                  keep_alive,
+                                  pack("!BBH", 0, len(large) >> 16, len(large) & 0xffff) + large)
+        self.assertEqual(self.session.recv_packet(5).get_trailer(), b"small")
+        packet = self.session.recv_packet(5)
+        thread.join()
+        self.assertEqual(packet.get_length(), len(large))
+        self.assertEqual(packet.get_trailer(), large)
+
+    def test_recv_packet_errors(self):
+        with self.assertRaises(nmb.NetBIOSTimeout):
+            self.session.recv_packet(0.1)
+        # Connection closed in the middle of a frame
+        self.server.sendall(pack("!BBH", 0, 0, 100) + b"truncated")
+        self.server.close()
+        with self.assertRaises(nmb.NetBIOSError):
+            self.session.recv_packet(5)
+
+
+class NetBIOSTCPSessionPollingTests(NetBIOSTCPSessionTests):
+    select_poll = True
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=1)
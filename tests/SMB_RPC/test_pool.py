@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Loopback tests for the DCE/RPC association pool, against the SRVS server
+#   over ncacn_ip_tcp and through the SimpleSMBServer over ncacn_np.
+#
+import socket
+import unittest
+from configparser import ConfigParser
+from multiprocessing import Process
+from os import mkdir, rmdir
+from os.path import exists
+from time import sleep
+
+from impacket.dcerpc.v5 import srvs, wkst
+from impacket.dcerpc.v5.pool import DCERPCPool
+from impacket.dcerpc.v5.rpcrt import DCERPCException
+from impacket.smbserver import SimpleSMBServer
+from impacket.ntlm import compute_lmhash, compute_nthash
+from impacket.uuid import uuidtup_to_bin
+from tests.SMB_RPC import SRVSWKSTServer
+
+
+class DCERPCPoolTCPTests(unittest.TestCase):
+
+    def setUp(self):
+        config = ConfigParser()
+        config.add_section("global")
+        config.set("global", "log_file", "None")
+        config.add_section("SHARE")
+        config.set("SHARE", "comment", "A share")
+        config.set("SHARE", "share type", "0")
+        config.set("SHARE", "path", ".")
+        self.server = SRVSWKSTServer()
+        self.server.daemon = True
+        self.server.setServerConfig(config)
+        self.server.processConfigFile()
+        self.server.start()
+        self.stringBinding = "ncacn_ip_tcp:127.0.0.1[%d]" % self.server.getListenPort()
+
+    def get(self, pool, iface_uuid=srvs.MSRPC_UUID_SRVS):
+        # The server starts listening in its thread
+        for _ in range(50):
+            try:
+                return pool.get(self.stringBinding, iface_uuid)
+            except DCERPCException as e:
+                if "Could not connect" not in str(e):
+                    raise
+                sleep(0.1)
+
+    def test_reuse(self):
+        with DCERPCPool() as pool:
+            dce = self.get(pool)
+            self.assertEqual(srvs.hNetrShareGetInfo(dce, "SHARE\x00", 1)["ErrorCode"], 0)
+            pool.release(dce)
+            self.assertIs(self.get(pool), dce)
+            self.assertEqual(srvs.hNetrShareGetInfo(dce, "SHARE\x00", 1)["ErrorCode"], 0)
+            pool.release(dce)
+
+    def test_alter_ctx(self):
+        with DCERPCPool() as pool:
+            srvsDce = self.get(pool)
+            pool.release(srvsDce)
+            wkstDce = self.get(pool, wkst.MSRPC_UUID_WKST)
+            # A second presentation context of the same association
+            self.assertIsNot(wkstDce, srvsDce)
+            self.assertIs(wkstDce.get_rpc_transport(), srvsDce.get_rpc_transport())
+            resp = wkst.hNetrWkstaGetInfo(wkstDce, 100)
+            self.assertEqual(resp["WkstaInfo"]["WkstaInfo100"]["wki100_platform_id"], 500)
+            pool.release(wkstDce)
+            self.assertIs(self.get(pool), srvsDce)
+            self.assertEqual(srvs.hNetrShareGetInfo(srvsDce, "SHARE\x00", 1)["ErrorCode"], 0)
+            pool.release(srvsDce)
+            self.assertIs(self.get(pool, wkst.MSRPC_UUID_WKST), wkstDce)
+            pool.release(wkstDce)
+
+    def test_unsupported_interface(self):
+        with DCERPCPool() as pool:
+            dce = self.get(pool)
+            pool.release(dce)
+            with self.assertRaises(DCERPCException):
+                self.get(pool, uuidtup_to_bin(("12345778-1234-ABCD-EF00-0123456789AB", "0.0")))
+            # The association is still there
+            self.assertIs(self.get(pool), dce)
+            pool.release(dce)
+
+    def test_idle_timeout(self):
+        with DCERPCPool(idleTimeout=0) as pool:
+            dce = self.get(pool)
+            pool.release(dce)
+            other = self.get(pool)
+            self.assertIsNot(other, dce)
+            self.assertEqual(srvs.hNetrShareGetInfo(other, "SHARE\x00", 1)["ErrorCode"], 0)
+            pool.release(other)
+
+    def test_health_check(self):
+        with DCERPCPool() as pool:
+            dce = self.get(pool)
+            pool.release(dce)
+            # The connection goes away while idle
+            dce.get_rpc_transport().get_socket().shutdown(socket.SHUT_RDWR)
+            other = self.get(pool)
+            self.assertIsNot(other, dce)
+            self.assertEqual(srvs.hNetrShareGetInfo(other, "SHARE\x00", 1)["ErrorCode"], 0)
+            pool.release(other)
+
+    def test_release(self):
+        pool = DCERPCPool()
+        # Calls still in flight, or an error: the association isn't kept
+        dce = self.get(pool)
+        request = srvs.NetrShareGetInfo()
+        request["ServerName"] = "\x00"
+        request["NetName"] = "SHARE\x00"
+        request["Level"] = 1
+        dce.submit(request)
+        pool.release(dce)
+        with pool.association(self.stringBinding, srvs.MSRPC_UUID_SRVS) as other:
+            self.assertIsNot(other, dce)
+        with self.assertRaises(ValueError):
+            with pool.association(self.stringBinding, srvs.MSRPC_UUID_SRVS) as dce:
+                self.assertIs(dce, other)
+                raise ValueError
+        with pool.association(self.stringBinding, srvs.MSRPC_UUID_SRVS) as dce:
+            self.assertIsNot(dce, other)
+        pool.close()
+        with self.assertRaises(DCERPCException):
+            pool.get(self.stringBinding, srvs.MSRPC_UUID_SRVS)
+
+
+class DCERPCPoolSMBTests(unittest.TestCase):
+    address = "127.0.0.1"
+    port = 1449
+    username = "UserName"
+    password = "Password"
+
+    share_name = "SHARE"
+    share_path = "pool_jail_dir"
+
+    def setUp(self):
+        if not exists(self.share_path):
+            mkdir(self.share_path)
+        self.server = SimpleSMBServer(listenAddress=self.address, listenPort=self.port)
+        self.server.addCredential(self.username, 0, compute_lmhash(self.password), compute_nthash(self.password))
+        self.server.addShare(self.share_name, self.share_path, "A share")
+        self.server.setSMB2Support(True)
+        self.server_process = Process(target=self.server.start)
+        self.server_process.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_process.terminate()
+        sleep(0.1)
+        rmdir(self.share_path)
+
+    def get(self, pool, pipe, iface_uuid):
+        # The server takes a while to start
+        for _ in range(50):
+            try:
+                return pool.get(r"ncacn_np:%s[\pipe\%s]" % (self.address, pipe), iface_uuid, self.username,
+                                self.password, dport=self.port)
+            except Exception as e:
+                if "Connection refused" not in str(e):
+                    raise
+                sleep(0.1)
+
+    def test_named_pipes(self):
+        with DCERPCPool(checkInterval=0) as pool:
+            srvsDce = self.get(pool, "srvsvc", srvs.MSRPC_UUID_SRVS)
+            wkstDce = self.get(pool, "wkssvc", wkst.MSRPC_UUID_WKST)
+            # Both pipes are open on the same SMB session
+            smbConnection = srvsDce.get_rpc_transport().get_smb_connection()
+            self.assertIs(wkstDce.get_rpc_transport().get_smb_connection(), smbConnection)
+            resp = srvs.hNetrShareEnum(srvsDce, 1)
+            shares = [share["shi1_netname"][:-1] for share in resp["InfoStruct"]["ShareInfo"]["Level1"]["Buffer"]]
+            self.assertIn(self.share_name, shares)
+            self.assertEqual(wkst.hNetrWkstaGetInfo(wkstDce, 100)["ErrorCode"], 0)
+            pool.release(wkstDce)
+            pool.release(srvsDce)
+
+            # Checked with an echo, and handed out again
+            self.assertIs(self.get(pool, "srvsvc", srvs.MSRPC_UUID_SRVS), srvsDce)
+            pool.release(srvsDce)
+
+            # Other credentials, another SMB session
+            with self.assertRaises(Exception):
+                pool.get(r"ncacn_np:%s[\pipe\srvsvc]" % self.address, srvs.MSRPC_UUID_SRVS, self.username,
+                         "Wrong", dport=self.port)
+
+    def test_broken_smb_session(self):
+        with DCERPCPool() as pool:
+            srvsDce = self.get(pool, "srvsvc", srvs.MSRPC_UUID_SRVS)
+            wkstDce = self.get(pool, "wkssvc", wkst.MSRPC_UUID_WKST)
+            pool.release(wkstDce)
+            smbConnection = srvsDce.get_rpc_transport().get_smb_connection()
+            smbConnection.getSMBServer()._NetBIOSSession.get_socket().shutdown(socket.SHUT_RDWR)
+            # A call fails on the broken connection, its SMB session is not used anymore
+            pool.release(srvsDce)
+            with self.assertRaises(Exception):
+                with pool.association(r"ncacn_np:%s[\pipe\srvsvc]" % self.address, srvs.MSRPC_UUID_SRVS,
+                                      self.username, self.password, dport=self.port) as dce:
+                    self.assertIs(dce, srvsDce)
+                    srvs.hNetrShareEnum(dce, 1)
+            # Not even by the idle associations it had, they're closed
+            otherWkstDce = self.get(pool, "wkssvc", wkst.MSRPC_UUID_WKST)
+            self.assertIsNot(otherWkstDce, wkstDce)
+            otherConnection = otherWkstDce.get_rpc_transport().get_smb_connection()
+            self.assertIsNot(otherConnection, smbConnection)
+            self.assertEqual(wkst.hNetrWkstaGetInfo(otherWkstDce, 100)["ErrorCode"], 0)
+            otherSrvsDce = self.get(pool, "srvsvc", srvs.MSRPC_UUID_SRVS)
+            self.assertIs(otherSrvsDce.get_rpc_transport().get_smb_connection(), otherConnection)
+            self.assertEqual(srvs.hNetrShareGetInfo(otherSrvsDce, "SHARE\x00", 1)["ErrorCode"], 0)
+            pool.release(otherSrvsDce)
+
+            # Found broken by the echo when handed out again
+            pool.release(otherWkstDce)
+            otherConnection.getSMBServer()._NetBIOSSession.get_socket().shutdown(socket.SHUT_RDWR)
+        with DCERPCPool(checkInterval=0) as pool:
+            srvsDce = self.get(pool, "srvsvc", srvs.MSRPC_UUID_SRVS)
+            wkstDce = self.get(pool, "wkssvc", wkst.MSRPC_UUID_WKST)
+            pool.release(wkstDce)
+            pool.release(srvsDce)
+            smbConnection = srvsDce.get_rpc_transport().get_smb_connection()
+            smbConnection.getSMBServer()._NetBIOSSession.get_socket().shutdown(socket.SHUT_RDWR)
+            dce = self.get(pool, "srvsvc", srvs.MSRPC_UUID_SRVS)
+            self.assertIsNot(dce.get_rpc_transport().get_smb_connection(), smbConnection)
+            self.assertEqual(srvs.hNetrShareGetInfo(dce, "SHARE\x00", 1)["ErrorCode"], 0)
+            pool.release(dce)
+            dce = self.get(pool, "wkssvc", wkst.MSRPC_UUID_WKST)
+            self.assertIsNot(dce, wkstDce)
+            self.assertEqual(wkst.hNetrWkstaGetInfo(dce, 100)["ErrorCode"], 0)
+            pool.release(dce)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
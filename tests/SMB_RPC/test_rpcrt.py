@@ -12,15 +12,22 @@ from __future__ import division
 from __future__ import print_function
 
 import pytest
+import socket
 import unittest
+from configparser import ConfigParser
+from os import urandom
+from threading import Thread
+from time import sleep
 from tests import RemoteTestCase
 
 from impacket.dcerpc.v5.ndr import NDRCALL
-from impacket.dcerpc.v5 import transport, epm, samr
+from impacket.dcerpc.v5 import transport, epm, samr, srvs, wkst
 from impacket.dcerpc.v5.dtypes import NULL
 from impacket.dcerpc.v5.rpcrt import RPC_C_AUTHN_LEVEL_PKT_INTEGRITY, RPC_C_AUTHN_LEVEL_PKT_PRIVACY, \
-    RPC_C_AUTHN_LEVEL_NONE, RPC_C_AUTHN_GSS_NEGOTIATE, RPC_C_AUTHN_WINNT
+    RPC_C_AUTHN_LEVEL_NONE, RPC_C_AUTHN_GSS_NEGOTIATE, RPC_C_AUTHN_WINNT, MSRPCRespHeader, DCERPCException, \
+    PFC_FIRST_FRAG, PFC_LAST_FRAG
 from impacket.dcerpc.v5.dtypes import RPC_UNICODE_STRING
+from tests.SMB_RPC import SRVSWKSTServer
 
 
 # aimed at testing just the DCERPC engine, not the particular
@@ -413,5 +420,208 @@ class RPCRTTestsSMBTransport(RPCRTTests, unittest.TestCase):
         self.stringBinding = r'ncacn_np:%s[\pipe\epmapper]' % self.machine
 
 
+class RPCRTRecvTests(unittest.TestCase):
+    """Reassembly of fragmented responses over ncacn_ip_tcp, from a socket replaying them.
+    """
+
+    @staticmethod
+    def fragments(stub, size):
+        data = []
+        for offset in range(0, len(stub), size):
+            fragment = MSRPCRespHeader()
+            fragment['flags'] = (PFC_FIRST_FRAG if offset == 0 else 0) | \
+                                (PFC_LAST_FRAG if offset + size >= len(stub) else 0)
+            fragment['alloc_hint'] = len(stub) - offset
+            fragment['pduData'] = stub[offset:offset + size]
+            data.append(fragment.getData())
+        return b"".join(data)
+
+    def replay(self, data, chunk):
+        # The data is sent in chunks of the given size, so fragments arrive split everywhere
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+
+        def serve():
+            sock, _ = listener.accept()
+            for offset in range(0, len(data), chunk):
+                sock.sendall(data[offset:offset + chunk])
+            sock.close()
+            listener.close()
+
+        Thread(target=serve).start()
+        rpctransport = transport.DCERPCTransportFactory("ncacn_ip_tcp:127.0.0.1[%d]" % listener.getsockname()[1])
+        rpctransport.connect()
+        self.addCleanup(rpctransport.disconnect)
+        return rpctransport.get_dce_rpc()
+
+    def test_recv_fragments(self):
+        stub = urandom(4256 * 250 + 100)
+        self.assertEqual(self.replay(self.fragments(stub, 4256), 1000).recv(), stub)
+        self.assertEqual(self.replay(self.fragments(stub, 4256), 100000).recv(), stub)
+
+    def test_recv_single_fragment(self):
+        stub = urandom(400)
+        self.assertEqual(self.replay(self.fragments(stub, 4256), 7).recv(), stub)
+
+    def test_recv_connection_closed(self):
+        data = self.fragments(urandom(40000), 4256)
+        with self.assertRaises(DCERPCException):
+            self.replay(data[:-10], 1000).recv()
+
+
+class RPCRTPipelineTests(unittest.TestCase):
+    """Many calls in flight on an association, against the SRVS server over ncacn_ip_tcp.
+    """
+
+    def setUp(self):
+        config = ConfigParser()
+        config.add_section("global")
+        config.set("global", "log_file", "None")
+        config.add_section("SHARE")
+        config.set("SHARE", "comment", "A share")
+        config.set("SHARE", "share type", "0")
+        config.set("SHARE", "path", ".")
+        server = SRVSWKSTServer()
+        server.daemon = True
+        server.setServerConfig(config)
+        server.processConfigFile()
+        server.start()
+
+        rpctransport = transport.DCERPCTransportFactory("ncacn_ip_tcp:127.0.0.1[%d]" % server.getListenPort())
+        self.dce = rpctransport.get_dce_rpc()
+        # The server starts listening in its thread
+        for _ in range(50):
+            try:
+                self.dce.connect()
+                break
+            except DCERPCException:
+                sleep(0.1)
+        self.addCleanup(self.dce.disconnect)
+        self.dce.bind(srvs.MSRPC_UUID_SRVS)
+
+    @staticmethod
+    def share_info(share):
+        request = srvs.NetrShareGetInfo()
+        request["ServerName"] = "\x00"
+        request["NetName"] = share + "\x00"
+        request["Level"] = 1
+        return request
+
+    def requests(self, count):
+        # Every third share doesn't exist, its call fails
+        for i in range(count):
+            yield self.share_info("SHARE" if i % 3 else "MISSING%d" % i)
+
+    def test_request_many(self):
+        expected = [self.dce.request(request, checkError=False) for request in self.requests(50)]
+        responses = list(self.dce.request_many(self.requests(50), checkError=False))
+        def fields(response):
+            if response["ErrorCode"] != 0:
+                return response["ErrorCode"]
+            return response["InfoStruct"]["ShareInfo1"]["shi1_netname"], response["InfoStruct"]["ShareInfo1"]["shi1_remark"]
+
+        self.assertEqual([fields(r) for r in responses], [fields(r) for r in expected])
+
+        self.dce.set_pipeline_window(3)
+        responses = list(self.dce.request_many(self.requests(50), returnExceptions=True))
+        for i, response in enumerate(responses):
+            if i % 3:
+                self.assertEqual(response["InfoStruct"]["ShareInfo1"]["shi1_netname"], "SHARE\x00")
+            else:
+                self.assertIsInstance(response, srvs.DCERPCSessionError)
+                self.assertEqual(response.get_error_code(), 0x906)
+
+        with self.assertRaises(srvs.DCERPCSessionError):
+            list(self.dce.request_many(self.requests(50)))
+        # The calls left in flight were drained
+        self.assertEqual(self.dce.request(self.share_info("SHARE"))["ErrorCode"], 0)
+
+    def test_submit(self):
+        self.assertEqual(self.dce.get_pipeline_window(), 16)
+        futures = [self.dce.submit(request) for request in self.requests(30)]
+        self.assertEqual(len(set(future.call_id for future in futures)), 30)
+        # The calls in flight are answered first
+        self.assertEqual(self.dce.request(srvs.NetrServerGetInfo())["ErrorCode"], 0)
+        for i, future in enumerate(futures):
+            self.assertTrue(future.done())
+            if i % 3:
+                self.assertEqual(future.result()["ErrorCode"], 0)
+            else:
+                self.assertIsInstance(future.exception(), srvs.DCERPCSessionError)
+
+        # An opnum the server doesn't support is answered with a fault
+        futures = [self.dce.submit(self.share_info("SHARE")), self.dce.submit(srvs.NetrShareSetInfo()),
+                   self.dce.submit(self.share_info("SHARE"))]
+        self.assertEqual(futures[2].result()["ErrorCode"], 0)
+        with self.assertRaisesRegex(DCERPCException, "rpc_s_cannot_support"):
+            futures[1].result()
+        self.assertEqual(futures[0].result()["ErrorCode"], 0)
+
+    @staticmethod
+    def wksta_info():
+        request = wkst.NetrWkstaGetInfo()
+        request["ServerName"] = "\x00"
+        request["Level"] = 100
+        return request
+
+    def test_alter_ctx(self):
+        # Calls in flight on two presentation contexts of the same association
+        wkstDce = self.dce.alter_ctx(wkst.MSRPC_UUID_WKST)
+        futures = []
+        for i, request in enumerate(self.requests(30)):
+            futures.append(self.dce.submit(request))
+            if i % 2:
+                futures.append(wkstDce.submit(self.wksta_info()))
+        self.assertEqual(len(set(future.call_id for future in futures)), len(futures))
+        # Each one gets its own response
+        self.assertEqual(wkstDce.request(self.wksta_info())["WkstaInfo"]["WkstaInfo100"]["wki100_platform_id"], 500)
+        futures.append(self.dce.submit(self.share_info("SHARE")))
+        self.assertEqual(wkstDce.request(self.wksta_info())["WkstaInfo"]["WkstaInfo100"]["wki100_platform_id"], 500)
+        for future in futures:
+            if isinstance(future.exception(), srvs.DCERPCSessionError):
+                continue
+            response = future.result()
+            if isinstance(response, wkst.NetrWkstaGetInfoResponse):
+                self.assertEqual(response["WkstaInfo"]["WkstaInfo100"]["wki100_platform_id"], 500)
+            else:
+                self.assertEqual(response["InfoStruct"]["ShareInfo1"]["shi1_netname"], "SHARE\x00")
+        self.assertEqual(len([future for future in futures if future.exception() is not None]), 10)
+
+        # Another context while calls are in flight
+        future = self.dce.submit(self.share_info("SHARE"))
+        otherDce = wkstDce.alter_ctx(srvs.MSRPC_UUID_SRVS)
+        self.assertEqual(future.result()["ErrorCode"], 0)
+        self.assertEqual(otherDce.request(self.share_info("SHARE"))["ErrorCode"], 0)
+
+    def test_fragmented_requests(self):
+        # The server puts the fragments of a request back together
+        self.dce.set_max_fragment_size(16)
+        self.assertEqual(self.dce.request(self.share_info("SHARE"))["InfoStruct"]["ShareInfo1"]["shi1_netname"],
+                         "SHARE\x00")
+        with self.assertRaises(srvs.DCERPCSessionError):
+            self.dce.request(self.share_info("MISSING" * 1000))
+        self.assertEqual(self.dce.request(srvs.NetrServerGetInfo())["ErrorCode"], 0)
+
+    def test_connection_closed(self):
+        # A server going away without answering
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        rpctransport = transport.DCERPCTransportFactory("ncacn_ip_tcp:127.0.0.1[%d]" % listener.getsockname()[1])
+        rpctransport.connect()
+        self.addCleanup(rpctransport.disconnect)
+        sock, _ = listener.accept()
+        listener.close()
+
+        dce = rpctransport.get_dce_rpc()
+        futures = [dce.submit(self.share_info("SHARE")) for _ in range(3)]
+        sock.close()
+        with self.assertRaises((DCERPCException, socket.error)):
+            futures[1].result()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertIs(futures[0].exception(), futures[2].exception())
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=1)
@@ -74,16 +74,23 @@
 #         [ ] smb2Lock
 #         [ ] smb2Cancel
 #
+import socket
 import unittest
 from time import sleep
+from threading import Thread
 from os.path import exists, join
-from os import mkdir, rmdir, remove
+from os import mkdir, rmdir, remove, urandom
 from multiprocessing import Process
 
 from six import PY2, StringIO, BytesIO, b, assertRaisesRegex, assertCountEqual
 
 from impacket.smb import SMB_DIALECT
-from impacket.smbserver import normalize_path, isInFileJail, SimpleSMBServer
+from impacket import smb3
+from impacket.smb3structs import SMB2_DIALECT_002, SMB2_DIALECT_30, SMB2_DIALECT_311, SMB2_ENCRYPTION_AES128_CCM, \
+    SMB2_ENCRYPTION_AES128_GCM, SMB2_ENCRYPTION_AES256_CCM, SMB2_ENCRYPTION_AES256_GCM, SMB2_SIGNING_AES_GMAC, \
+    COMPRESSION_ALGORITHM_LZ77, COMPRESSION_ALGORITHM_LZ77_HUFFMAN, COMPRESSION_ALGORITHM_PATTERN_V1, SMB2_ECHO, \
+    SMB2Echo
+from impacket.smbserver import normalize_path, isInFileJail, SimpleSMBServer, SMBSERVER
 from impacket.smbconnection import SMBConnection, SessionError, compute_lmhash, compute_nthash
 
 
@@ -141,6 +148,51 @@ class SMBServerUnitTests(unittest.TestCase):
         self.assertFalse(isInFileJail(jail_path, "../../filename"))
 
 
+    def test_decryptSMBv3(self):
+        """Test tampered encrypted messages, or ones for sessions without keys, are refused.
+        """
+        server = SMBSERVER(("127.0.0.1", 0))
+        self.addCleanup(server.server_close)
+        for cipher_id in (SMB2_ENCRYPTION_AES128_CCM, SMB2_ENCRYPTION_AES128_GCM):
+            conn_data = {"CipherId": cipher_id, "EncryptionKey": b"k" * 16, "DecryptionKey": b"k" * 16, "Uid": 1}
+            data = server.encryptSMBv3(conn_data, b"plain text")
+            self.assertEqual(server.decryptSMBv3(conn_data, data), b"plain text")
+            with assertRaisesRegex(self, smb3.SessionError, "STATUS_ACCESS_DENIED"):
+                server.decryptSMBv3(conn_data, data[:-1] + bytes([data[-1] ^ 1]))
+            conn_data["DecryptionKey"] = b""
+            with assertRaisesRegex(self, smb3.SessionError, "STATUS_ACCESS_DENIED"):
+                server.decryptSMBv3(conn_data, data)
+
+    def test_active_connections(self):
+        """Test the active connections are handed out as a snapshot, while other threads add and remove them.
+        """
+        server = SimpleSMBServer("127.0.0.1", 0)._SimpleSMBServer__server
+        self.addCleanup(server.server_close)
+        server.addConnection(1, "127.0.0.1", 1000)
+        connections = server.getActiveConnections()
+        server.removeConnection(1)
+        self.assertEqual(list(connections), [1])
+        self.assertEqual(server.getActiveConnections(), {})
+
+        def churn(first):
+            for connId in range(first, first + 500):
+                server.addConnection(connId, "127.0.0.1", connId)
+                server.getConnectionData(connId, checkStatus=False)
+                server.removeConnection(connId)
+
+        threads = [Thread(target=churn, args=(first,)) for first in (10000, 20000)]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for connId, connData in server.getActiveConnections().items():
+                    self.assertEqual(connData["ClientPort"], connId)
+        finally:
+            for thread in threads:
+                thread.join()
+        self.assertEqual(server.getStats()["ActiveConnections"], 0)
+
+
 class SimpleSMBServerFuncTests(unittest.TestCase):
     """Pseudo functional tests for the SimpleSMBServer.
 
@@ -149,6 +201,8 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
     """
     server = None
     server_smb2_support = False
+    server_smb3_support = False
+    server_event_loops = 0
     client_preferred_dialect = None
 
     address = "127.0.0.1"
@@ -166,6 +220,7 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
     share_path = "jail_dir"
     share_file = "jail_file"
     share_new_file = "jail_new_file"
+    share_large_file = "jail_large_file"
     share_unjailed_file = "unjailed_file"
     share_unjailed_new_file = "unjailed_new_file"
     share_new_content = "some content"
@@ -201,7 +256,8 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
                   self.share_unjailed_new_file,
                   join(self.share_path, self.share_file),
                   join(self.share_path, self.unicode_share_file),
-                  join(self.share_path, self.share_new_file)]:
+                  join(self.share_path, self.share_new_file),
+                  join(self.share_path, self.share_large_file)]:
             if exists(f):
                 remove(f)
         for d in [self.share_unjailed_directory,
@@ -221,6 +277,10 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
             smbserver.addShare(self.share_name, self.share_path)
         if self.server_smb2_support is not None:
             smbserver.setSMB2Support(self.server_smb2_support)
+        if self.server_smb3_support:
+            smbserver.setSMB3Support(self.server_smb3_support)
+        if self.server_event_loops:
+            smbserver.setEventLoops(self.server_event_loops)
         return smbserver
 
     def get_smbclient(self):
@@ -446,6 +506,32 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
 
         client.close()
 
+    def test_smbserver_put_get_large_file(self):
+        """Test writing and reading back files spanning several READ/WRITE requests.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+
+        content = b"".join(b(str(i)) for i in range(200000))
+        client.putFile(self.share_name, self.share_large_file, BytesIO(content).read)
+        with open(join(self.share_path, self.share_large_file), "rb") as fd:
+            self.assertEqual(fd.read(), content)
+
+        local_file = BytesIO()
+        client.getFile(self.share_name, self.share_large_file, local_file.write)
+        self.assertEqual(local_file.getvalue(), content)
+
+        # Same thing with a single request in flight
+        client.setTransferWindow(1)
+        local_file = BytesIO()
+        client.getFile(self.share_name, self.share_large_file, local_file.write)
+        self.assertEqual(local_file.getvalue(), content)
+
+        client.close()
+
     @unittest.skipIf(PY2, "Unicode filename expected failing in Python 2.x")
     def test_smbserver_get_unicode_file(self):
         """Test reading unicode files from a shared folder.
@@ -462,6 +548,29 @@ class SimpleSMBServerFuncTests(unittest.TestCase):
 
         client.close()
 
+    def test_smbserver_query_path_info(self):
+        """Test querying files and directories by their path.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        tid = client.connectTree(self.share_name)
+
+        info = client.queryPathInfo(tid, self.share_file)
+        self.assertEqual(info["EndOfFile"], len(self.share_new_content))
+        self.assertEqual(info["Directory"], 0)
+
+        info = client.queryPathInfo(tid, self.share_directory)
+        self.assertEqual(info["Directory"], 1)
+
+        with assertRaisesRegex(self, SessionError, "STATUS_NO_SUCH_FILE"):
+            client.queryPathInfo(tid, self.share_new_file)
+
+        client.disconnectTree(tid)
+        client.close()
+
     def test_smbserver_delete_file(self):
         """Test deleting files from a shared folder.
         """
@@ -689,5 +798,245 @@ class SimpleSMBServer2FuncTests(SimpleSMBServerFuncTests):
         client.close()
 
 
+class SimpleSMBServer3FuncTests(SimpleSMBServer2FuncTests):
+
+    server_smb3_support = True
+
+    def test_smbserver_multichannel(self):
+        """Test transferring files over several channels bound to the same session.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        self.assertEqual(client.getDialect(), self.client_preferred_dialect or SMB2_DIALECT_30)
+        self.assertEqual(client.enableMultiChannel(3), 3)
+
+        content = b"".join(b(str(i)) for i in range(200000))
+        client.putFile(self.share_name, self.share_large_file, BytesIO(content).read)
+        with open(join(self.share_path, self.share_large_file), "rb") as fd:
+            self.assertEqual(fd.read(), content)
+
+        local_file = BytesIO()
+        client.getFile(self.share_name, self.share_large_file, local_file.write)
+        self.assertEqual(local_file.getvalue(), content)
+
+        client.close()
+
+    def bind_channel(self, client, domain="", signing_key=None, channel_class=smb3.SMB3):
+        """Binds another connection to the client's session, the way SMB3.bindChannel() does.
+        """
+        session = client.getSMBServer()
+        channel = channel_class(session._Connection["ServerName"], self.address, sess_port=int(self.port),
+                                preferredDialect=session._Connection["Dialect"], clientGuid=session.ClientGuid)
+        try:
+            channel._bindingSession = session
+            channel._Session["SessionID"] = session._Session["SessionID"]
+            channel._Session["SessionKey"] = session._Session["SessionKey"]
+            channel._Session["SigningKey"] = signing_key or session._Session["SigningKey"]
+            channel.login(self.username, self.password, domain)
+        finally:
+            channel.close_session()
+
+    def test_smbserver_multichannel_binding(self):
+        """Test the server only binds channels signed with the session's key, for the same user.
+        """
+        class UnsignedSMB3(smb3.SMB3):
+            def _SMB3__isSigningRequired(self, packet):
+                return False
+
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        self.bind_channel(client)
+        with assertRaisesRegex(self, smb3.SessionError, "STATUS_ACCESS_DENIED"):
+            self.bind_channel(client, domain="OTHER")
+        with assertRaisesRegex(self, smb3.SessionError, "STATUS_ACCESS_DENIED"):
+            self.bind_channel(client, signing_key=b"\x00" * 16)
+        with assertRaisesRegex(self, smb3.SessionError, "STATUS_INVALID_PARAMETER"):
+            self.bind_channel(client, channel_class=UnsignedSMB3)
+        # The session still works
+        self.assertIn(self.share_file, [f.get_longname() for f in client.listPath(self.share_name, "*")])
+        client.close()
+
+    def test_smbserver_concurrent_requests(self):
+        """Test several threads transferring files and listing the share over the same session.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        client.enableConcurrentRequests()
+
+        contents = [urandom(200000 + i * 1000) for i in range(4)]
+        names = ["%s%d" % (self.share_large_file, i) for i in range(len(contents))]
+        results = {}
+
+        def transfer(name, content):
+            client.putFile(self.share_name, name, BytesIO(content).read)
+            local_file = BytesIO()
+            client.getFile(self.share_name, name, local_file.write)
+            results[name] = local_file.getvalue()
+
+        def list_path():
+            for _ in range(10):
+                files = [f.get_longname() for f in client.listPath(self.share_name, "*")]
+                self.assertIn(self.share_file, files)
+            results["list"] = True
+
+        threads = [Thread(target=transfer, args=args) for args in zip(names, contents)]
+        threads.append(Thread(target=list_path))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.close()
+
+        try:
+            self.assertIn("list", results)
+            for name, content in zip(names, contents):
+                self.assertEqual(results.get(name), content)
+                with open(join(self.share_path, name), "rb") as fd:
+                    self.assertEqual(fd.read(), content)
+        finally:
+            for name in names:
+                if exists(join(self.share_path, name)):
+                    remove(join(self.share_path, name))
+
+    def test_smbserver_abandoned_requests(self):
+        """Test nothing is left behind for requests that fail to be sent or whose answers are discarded.
+        """
+        server = self.get_smbserver()
+        self.start_smbserver(server)
+
+        client = self.get_smbclient()
+        client.login(self.username, self.password)
+        session = client.getSMBServer()
+
+        def send_echo():
+            packet = session.SMB_PACKET()
+            packet["Command"] = SMB2_ECHO
+            packet["Data"] = SMB2Echo()
+            return session.sendSMB(packet)
+
+        def failing_send(data):
+            raise socket.error("send failed")
+
+        for concurrent in (False, True):
+            if concurrent:
+                client.enableConcurrentRequests()
+            # Answers discarded after and before they come
+            discardedID = send_echo()
+            session.recvSMB(send_echo())
+            session.discardAnswer(discardedID)
+            session.discardAnswer(send_echo())
+            session.recvSMB(send_echo())
+            self.assertEqual(session._Connection["OutstandingRequests"], {})
+            self.assertEqual(session._Connection["OutstandingResponses"], {})
+            self.assertEqual(session._SMB3__discarded, set())
+
+            # Requests not sent
+            session._NetBIOSSession.send_packet = failing_send
+            try:
+                with self.assertRaises(socket.error):
+                    session.echo()
+            finally:
+                del session._NetBIOSSession.send_packet
+            self.assertEqual(session._Connection["OutstandingRequests"], {})
+            self.assertEqual(session._SMB3__inFlight, 0)
+            self.assertTrue(session.echo())
+
+        client.close()
+
+
+class SimpleSMBServer311FuncTests(SimpleSMBServer3FuncTests):
+
+    client_preferred_dialect = SMB2_DIALECT_311
+
+    def test_smbserver_encryption(self):
+        """Test transferring files from a share requiring encryption, with each of the ciphers.
+        """
+        server = self.get_smbserver(add_share=False)
+        server.addShare(self.share_name, self.share_path, encryptData="yes")
+        self.start_smbserver(server)
+
+        # The first cipher offered by the client is chosen
+        ciphers = smb3.ENCRYPTION_ALGORITHMS
+        content = b"".join(b(str(i)) for i in range(50000))
+        try:
+            for cipher in (SMB2_ENCRYPTION_AES128_GCM, SMB2_ENCRYPTION_AES128_CCM, SMB2_ENCRYPTION_AES256_GCM,
+                           SMB2_ENCRYPTION_AES256_CCM):
+                smb3.ENCRYPTION_ALGORITHMS = [cipher]
+                client = self.get_smbclient()
+                client.login(self.username, self.password)
+                connection = client.getSMBServer()._Connection
+                self.assertEqual(connection["CipherId"], cipher)
+                self.assertEqual(connection["SigningAlgorithmId"], SMB2_SIGNING_AES_GMAC)
+
+                client.putFile(self.share_name, self.share_large_file, BytesIO(content).read)
+                with open(join(self.share_path, self.share_large_file), "rb") as fd:
+                    self.assertEqual(fd.read(), content)
+                local_file = BytesIO()
+                client.getFile(self.share_name, self.share_large_file, local_file.write)
+                self.assertEqual(local_file.getvalue(), content)
+                client.close()
+        finally:
+            smb3.ENCRYPTION_ALGORITHMS = ciphers
+
+        # Sessions that can't encrypt are not let in
+        client = SMBConnection(self.address, self.address, sess_port=int(self.port),
+                               preferredDialect=SMB2_DIALECT_002)
+        client.login(self.username, self.password)
+        with assertRaisesRegex(self, SessionError, "STATUS_ACCESS_DENIED"):
+            client.connectTree(self.share_name)
+        client.close()
+
+    def test_smbserver_compression(self):
+        """Test transferring mostly zero filled files from a share asking for compression, with each of the
+        compression algorithms.
+        """
+        server = self.get_smbserver(add_share=False)
+        server.addShare(self.share_name, self.share_path, compressData="yes")
+        self.start_smbserver(server)
+
+        algorithms = smb3.COMPRESSION_ALGORITHMS
+        content = bytearray(300000)
+        content[1000:1000 + 30000] = b"".join(b(str(i)) for i in range(8000))[:30000]
+        content[200000:200000 + 4096] = urandom(4096)
+        content = bytes(content)
+        try:
+            for compressionIds in ([COMPRESSION_ALGORITHM_LZ77_HUFFMAN, COMPRESSION_ALGORITHM_PATTERN_V1],
+                                   [COMPRESSION_ALGORITHM_LZ77, COMPRESSION_ALGORITHM_PATTERN_V1],
+                                   [COMPRESSION_ALGORITHM_LZ77_HUFFMAN], [COMPRESSION_ALGORITHM_LZ77]):
+                smb3.COMPRESSION_ALGORITHMS = compressionIds
+                client = self.get_smbclient()
+                client.login(self.username, self.password)
+                self.assertEqual(client.getSMBServer()._Connection["CompressionIds"], compressionIds)
+
+                client.putFile(self.share_name, self.share_large_file, BytesIO(content).read)
+                with open(join(self.share_path, self.share_large_file), "rb") as fd:
+                    self.assertEqual(fd.read(), content)
+                local_file = BytesIO()
+                client.getFile(self.share_name, self.share_large_file, local_file.write)
+                self.assertEqual(local_file.getvalue(), content)
+                client.close()
+        finally:
+            smb3.COMPRESSION_ALGORITHMS = algorithms
+
+
+class SimpleSMBServerEventLoopFuncTests(SimpleSMBServerFuncTests):
+
+    server_event_loops = 2
+
+
+class SimpleSMBServer311EventLoopFuncTests(SimpleSMBServer311FuncTests):
+
+    server_event_loops = 2
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=1)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Many small calls on one DCE/RPC association (like querying thousands of
+#   users through SAMR), one at a time with request() and pipelined with
+#   request_many() for several windows. The SRVS server of the SMB server
+#   answers NetrShareGetInfo calls over ncacn_ip_tcp, through a relay adding
+#   the given round trip time, as a remote server would have.
+#
+#   python tests/benchmarks/bench_dcerpc_pipeline.py [-calls N] [-rtt MS]
+#
+import argparse
+import socket
+import time
+from configparser import ConfigParser
+from queue import Queue
+from threading import Thread
+
+from impacket.dcerpc.v5 import transport, srvs
+from impacket.smbserver import SRVSServer
+
+
+def start_server():
+    config = ConfigParser()
+    config.add_section('global')
+    config.set('global', 'log_file', 'None')
+    config.add_section('SHARE')
+    config.set('SHARE', 'comment', 'A share')
+    config.set('SHARE', 'share type', '0')
+    config.set('SHARE', 'path', '.')
+    server = SRVSServer()
+    server.daemon = True
+    server.setServerConfig(config)
+    server.processConfigFile()
+    server.start()
+    return server.getListenPort()
+
+
+def start_relay(port, rtt):
+    # Every byte reaches the other end half the round trip time after it was sent
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    def forward(source, destination):
+        queue = Queue()
+
+        def read():
+            while True:
+                data = source.recv(65536)
+                queue.put((time.time() + rtt / 2, data))
+                if not data:
+                    break
+
+        Thread(target=read, daemon=True).start()
+        while True:
+            due, data = queue.get()
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if not data:
+                destination.shutdown(socket.SHUT_WR)
+                break
+            destination.sendall(data)
+
+    def serve():
+        while True:
+            client, _ = listener.accept()
+            server = socket.create_connection(('127.0.0.1', port))
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Thread(target=forward, args=(client, server), daemon=True).start()
+            Thread(target=forward, args=(server, client), daemon=True).start()
+
+    Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def requests(count):
+    for i in range(count):
+        request = srvs.NetrShareGetInfo()
+        request['ServerName'] = '\x00'
+        request['NetName'] = 'SHARE\x00'
+        request['Level'] = 1
+        yield request
+
+
+def connect(port):
+    rpctransport = transport.DCERPCTransportFactory('ncacn_ip_tcp:127.0.0.1[%d]' % port)
+    dce = rpctransport.get_dce_rpc()
+    dce.connect()
+    dce.get_rpc_transport().get_socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    dce.bind(srvs.MSRPC_UUID_SRVS)
+    return dce
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DCE/RPC pipelined calls benchmark')
+    parser.add_argument('-calls', type=int, default=500, help='calls made in every run (default 500)')
+    parser.add_argument('-rtt', type=float, default=10, help='round trip time added, in ms (default 10)')
+    options = parser.parse_args()
+
+    port = start_relay(start_server(), options.rtt / 1000)
+    time.sleep(0.5)
+
+    print('%-16s %10s %10s' % ('calls', 'time (s)', 'calls/s'))
+    dce = connect(port)
+    start = time.time()
+    for request in requests(options.calls):
+        dce.request(request)
+    elapsed = time.time() - start
+    dce.disconnect()
+    print('%-16s %10.2f %10.0f' % ('request()', elapsed, options.calls / elapsed))
+
+    for window in (1, 4, 16, 64):
+        dce = connect(port)
+        dce.set_pipeline_window(window)
+        start = time.time()
+        count = len(list(dce.request_many(requests(options.calls))))
+        elapsed = time.time() - start
+        dce.disconnect()
+        if count != options.calls:
+            raise Exception('Responses missing')
+        print('%-16s %10.2f %10.0f' % ('window %d' % window, elapsed, options.calls / elapsed))
+
+
+if __name__ == '__main__':
+    main()
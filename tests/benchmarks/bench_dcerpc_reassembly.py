@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Reassembly of big fragmented DCE/RPC responses (like the ones answering
+#   DRSGetNCChanges or SamrQueryDisplayInformation) by DCERPC_v5.recv(). The
+#   fragments are replayed from memory, to measure the reassembly alone, and
+#   from a loopback socket through TCPTransport. The receive path impacket
+#   used to have (concatenating every chunk and every stub) runs too, for
+#   comparison.
+#
+#   By default the response is made up. -capture takes a recorded one instead:
+#   the bytes the server sent over ncacn_ip_tcp for a single call (e.g. a TCP
+#   stream exported from Wireshark, starting at the first response fragment).
+#
+#   python tests/benchmarks/bench_dcerpc_reassembly.py [-size MB] [-frag BYTES] [-capture FILE]
+#
+import argparse
+import os
+import socket
+import time
+from threading import Thread
+
+from impacket.dcerpc.v5 import transport
+from impacket.dcerpc.v5.rpcrt import DCERPC_v5, MSRPCRespHeader, PFC_FIRST_FRAG, PFC_LAST_FRAG
+
+
+class ReplayTransport(transport.DCERPCTransport):
+    # Hands out the recorded bytes as a socket would, at most 64 KB at a time
+    def __init__(self, data):
+        transport.DCERPCTransport.__init__(self, '', 0)
+        self.data = data
+        self.offset = 0
+
+    def recv(self, forceRecv=0, count=0):
+        size = min(count or 65536, 65536)
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+class LegacyTCPTransport(transport.TCPTransport):
+    # TCPTransport.recv() as it was before recv_into() was used
+    def recv(self, forceRecv=0, count=0):
+        if count:
+            buffer = b''
+            while len(buffer) < count:
+                buffer += self.get_socket().recv(count - len(buffer))
+        else:
+            buffer = self.get_socket().recv(8192)
+        return buffer
+
+
+class LegacyDCERPC_v5(DCERPC_v5):
+    # DCERPC_v5.recv() as it was before the stubs were joined once, unauthenticated responses only
+    def recv(self):
+        finished = False
+        retAnswer = b''
+        while not finished:
+            response_data = self._transport.recv(1, count=MSRPCRespHeader._SIZE)
+            response_header = MSRPCRespHeader(response_data)
+            while len(response_data) < response_header['frag_len']:
+                response_data += self._transport.recv(1, count=(response_header['frag_len'] - len(response_data)))
+            finished = response_header['flags'] & PFC_LAST_FRAG
+            retAnswer += response_data[response_header.get_header_size():]
+        return retAnswer
+
+
+def fragments(stub, size):
+    data = []
+    for offset in range(0, len(stub), size):
+        fragment = MSRPCRespHeader()
+        fragment['flags'] = (PFC_FIRST_FRAG if offset == 0 else 0) | (PFC_LAST_FRAG if offset + size >= len(stub) else 0)
+        fragment['alloc_hint'] = len(stub) - offset
+        fragment['pduData'] = stub[offset:offset + size]
+        data.append(fragment.getData())
+    return b''.join(data)
+
+
+def replay(dceClass, data):
+    dce = dceClass(ReplayTransport(data))
+    start = time.time()
+    stub = dce.recv()
+    return time.time() - start, stub
+
+
+def loopback(transportClass, dceClass, data):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    def serve():
+        sock, _ = listener.accept()
+        sock.sendall(data)
+        sock.close()
+
+    server = Thread(target=serve)
+    server.start()
+    rpctransport = transportClass('127.0.0.1', listener.getsockname()[1])
+    rpctransport.connect()
+    dce = dceClass(rpctransport)
+    start = time.time()
+    stub = dce.recv()
+    elapsed = time.time() - start
+    server.join()
+    rpctransport.disconnect()
+    listener.close()
+    return elapsed, stub
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DCE/RPC response reassembly benchmark')
+    parser.add_argument('-size', type=int, default=20, help='made up response stub size in MB (default 20)')
+    parser.add_argument('-frag', type=int, default=4256, help='stub bytes per fragment (default 4256, what fits '
+                                                               'in the usual 4280 bytes fragments)')
+    parser.add_argument('-capture', action='store', help='file with a recorded response to replay instead')
+    options = parser.parse_args()
+
+    if options.capture is not None:
+        with open(options.capture, 'rb') as fd:
+            data = fd.read()
+    else:
+        data = fragments(os.urandom(options.size * 1024 * 1024), options.frag)
+
+    print('%-10s %-10s %10s %10s' % ('source', 'recv', 'time (s)', 'MB/s'))
+    results = []
+    for source, run in (('memory', lambda dceClass, transportClass: replay(dceClass, data)),
+                        ('loopback', lambda dceClass, transportClass: loopback(transportClass, dceClass, data))):
+        for name, dceClass, transportClass in (('legacy', LegacyDCERPC_v5, LegacyTCPTransport),
+                                               ('current', DCERPC_v5, transport.TCPTransport)):
+            elapsed, stub = run(dceClass, transportClass)
+            results.append(stub)
+            print('%-10s %-10s %10.2f %10.1f' % (source, name, elapsed, len(data) / elapsed / 1024 / 1024))
+    if any(stub != results[0] for stub in results):
+        raise Exception('Different stubs reassembled')
+
+
+if __name__ == '__main__':
+    main()
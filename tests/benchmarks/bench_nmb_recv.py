@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   NetBIOSTCPSession.recv_packet() over a loopback TCP connection, in both
+#   polling modes. Large frames (like the ones answering multi-credit READs)
+#   measure throughput, a ping-pong of small frames measures latency. The
+#   receive path impacket used to have (sleep based polling and bytes
+#   concatenation) runs too, for comparison.
+#
+#   python tests/benchmarks/bench_nmb_recv.py [-size MB] [-frames N] [-pings N]
+#
+import argparse
+import errno
+import select
+import socket
+import time
+from struct import pack
+from threading import Thread
+
+from impacket import nmb
+
+
+class LegacyTCPSession(nmb.NetBIOSTCPSession):
+    # The reads as they were before recv_into() was used
+
+    def polling_read_into(self, buffer, timeout):
+        data = b''
+        if timeout is None:
+            timeout = 3600
+        time_left = timeout
+        while len(data) < len(buffer):
+            ready, _, _ = select.select([self._sock.fileno()], [], [], 0)
+            if not ready:
+                if time_left <= 0:
+                    raise nmb.NetBIOSTimeout
+                time.sleep(0.025)
+                time_left -= 0.025
+                continue
+            try:
+                received = self._sock.recv(len(buffer) - len(data))
+            except socket.error as ex:
+                if ex.errno not in (errno.EINTR, errno.EAGAIN):
+                    raise
+                continue
+            if len(received) == 0:
+                raise nmb.NetBIOSError('Error while reading from remote')
+            data = data + received
+        buffer[:] = data
+
+    def non_polling_read_into(self, buffer, timeout):
+        data = b''
+        self._sock.settimeout(timeout)
+        while len(data) < len(buffer):
+            received = self._sock.recv(len(buffer) - len(data))
+            if len(received) == 0:
+                raise nmb.NetBIOSError('Error while reading from remote')
+            data = data + received
+        buffer[:] = data
+
+
+def connect():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+
+def frame(data):
+    return pack('!BBH', 0, len(data) >> 16, len(data) & 0xffff) + data
+
+
+def throughput(sessionClass, selectPoll, size, frames):
+    client, server = connect()
+    session = sessionClass('CLIENT', 'SERVER', '127.0.0.1', sess_port=nmb.SMB_SESSION_PORT, sock=client,
+                           select_poll=selectPoll)
+    data = frame(b'A' * size)
+
+    def send():
+        for i in range(frames):
+            server.sendall(data)
+
+    sender = Thread(target=send)
+    start = time.time()
+    sender.start()
+    for i in range(frames):
+        if len(session.recv_packet(60).get_trailer()) != size:
+            raise Exception('Wrong frame received')
+    elapsed = time.time() - start
+    sender.join()
+    client.close()
+    server.close()
+    return size * frames / elapsed / 1024 / 1024
+
+
+def latency(sessionClass, selectPoll, pings):
+    client, server = connect()
+    for sock in (client, server):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    session = sessionClass('CLIENT', 'SERVER', '127.0.0.1', sess_port=nmb.SMB_SESSION_PORT, sock=client,
+                           select_poll=selectPoll)
+    request = frame(b'R' * 64)
+
+    def echo():
+        # Answers every request after a short while, so the client has to wait for it
+        for i in range(pings):
+            server.recv(len(request), socket.MSG_WAITALL)
+            time.sleep(0.001)
+            server.sendall(request)
+
+    responder = Thread(target=echo)
+    responder.start()
+    start = time.time()
+    for i in range(pings):
+        session.send_packet(b'R' * 64)
+        session.recv_packet(60)
+    elapsed = time.time() - start
+    responder.join()
+    client.close()
+    server.close()
+    return elapsed / pings * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NetBIOS session receive benchmark')
+    parser.add_argument('-size', type=int, default=8, help='large frame size in MB (default 8)')
+    parser.add_argument('-frames', type=int, default=16, help='large frames received (default 16)')
+    parser.add_argument('-pings', type=int, default=200, help='small frame round trips (default 200)')
+    options = parser.parse_args()
+
+    print('%-10s %-12s %18s %22s' % ('reads', 'mode', 'large frames MB/s', 'small frame RTT (ms)'))
+    for name, sessionClass in (('legacy', LegacyTCPSession), ('recv_into', nmb.NetBIOSTCPSession)):
+        for mode, selectPoll in (('blocking', False), ('select_poll', True)):
+            mbs = throughput(sessionClass, selectPoll, options.size * 1024 * 1024, options.frames)
+            rtt = latency(sessionClass, selectPoll, options.pings)
+            print('%-10s %-12s %18.1f %22.2f' % (name, mode, mbs, rtt))
+
+
+if __name__ == '__main__':
+    main()
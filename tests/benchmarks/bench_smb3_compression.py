@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Downloading a mostly zero filled registry hive over SMB 3.1.1, without
+#   compression and with each of the compression algorithms. Both ends run
+#   impacket, a SimpleSMBServer is started in another process. Besides the
+#   throughput over loopback, the bytes received are counted and the time the
+#   same download would take over a slow link is estimated from them.
+#
+#   python tests/benchmarks/bench_smb3_compression.py [-size MB] [-rounds N] [-link Mbit/s] [-port PORT]
+#
+import argparse
+import os
+import random
+import shutil
+import struct
+import tempfile
+import time
+from io import BytesIO
+from multiprocessing import get_context
+
+from impacket import smb3
+from impacket.smb3structs import SMB2_DIALECT_311, COMPRESSION_ALGORITHM_LZ77, COMPRESSION_ALGORITHM_LZ77_HUFFMAN, \
+    COMPRESSION_ALGORITHM_PATTERN_V1
+from impacket.smbconnection import SMBConnection
+from impacket.smbserver import SimpleSMBServer
+from impacket.ntlm import compute_lmhash, compute_nthash
+
+USERNAME = 'user'
+PASSWORD = 'Password'
+SHARE = 'BENCH'
+
+ALGORITHMS = (
+    ('none', []),
+    ('Pattern_V1', [COMPRESSION_ALGORITHM_PATTERN_V1]),
+    ('LZ77', [COMPRESSION_ALGORITHM_LZ77]),
+    ('LZ77+Pattern_V1', [COMPRESSION_ALGORITHM_LZ77, COMPRESSION_ALGORITHM_PATTERN_V1]),
+    ('LZ77+Huffman', [COMPRESSION_ALGORITHM_LZ77_HUFFMAN]),
+    ('LZ77+Huffman+Pattern_V1', [COMPRESSION_ALGORITHM_LZ77_HUFFMAN, COMPRESSION_ALGORITHM_PATTERN_V1]),
+)
+
+
+def hive(size):
+    # A regf base block followed by 4096 bytes hbins, each one with a few key and value
+    # cells at the beginning and zeros (free space) for the rest, like most hives out there
+    rnd = random.Random(0)
+    data = bytearray(size)
+    data[:4] = b'regf'
+    for offset in range(4096, size, 4096):
+        cells = b''
+        for i in range(rnd.randint(2, 12)):
+            name = ('Key%d' % rnd.randint(0, 100000)).encode('ascii')
+            cells += struct.pack('<l2sHQLL', -(80 + len(name)), b'nk', 0x20, 0x1d9c4e1a0000000 + rnd.getrandbits(32),
+                                 0, rnd.randint(0, size)) + b'\x00' * 8 + struct.pack('<L', rnd.randint(0, 20)) + \
+                     b'\xff' * 8 + b'\x00' * 36 + struct.pack('<H', len(name)) + name
+            cells += struct.pack('<l2sHLL', -24, b'vk', 4, 4 | 0x80000000, rnd.getrandbits(32)) + \
+                     struct.pack('<LH', 4, 1) + b'\x00' * 6
+        data[offset:offset + 32] = b'hbin' + struct.pack('<LL', offset - 4096, 4096) + b'\x00' * 20
+        data[offset + 32:offset + 32 + len(cells)] = cells[:4096 - 32]
+    return bytes(data)
+
+
+def serve(port, path):
+    server = SimpleSMBServer(listenAddress='127.0.0.1', listenPort=port)
+    server.addCredential(USERNAME, 0, compute_lmhash(PASSWORD), compute_nthash(PASSWORD))
+    server.addShare(SHARE, path)
+    server.setSMB2Support(True)
+    server.setSMB3Support(True)
+    server.start()
+
+
+def transfer(port, compressionIds, data, rounds):
+    smb3.COMPRESSION_ALGORITHMS = compressionIds
+    client = SMBConnection('127.0.0.1', '127.0.0.1', sess_port=port, preferredDialect=SMB2_DIALECT_311)
+    client.login(USERNAME, PASSWORD)
+
+    # Count what comes from the server
+    session = client.getSMBServer()._NetBIOSSession
+    received = [0]
+    recv_packet = session.recv_packet
+    def counted_recv_packet(timeout = None):
+        packet = recv_packet(timeout)
+        received[0] += 4 + len(packet.get_trailer())
+        return packet
+    session.recv_packet = counted_recv_packet
+
+    getTime = 0
+    for i in range(rounds):
+        output = BytesIO()
+        start = time.time()
+        client.getFile(SHARE, 'hive.dat', output.write)
+        getTime += time.time() - start
+        if output.getvalue() != data:
+            raise Exception('Wrong data read back')
+    client.close()
+    return getTime, received[0] // rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMB 3.1.1 compression benchmark')
+    parser.add_argument('-size', type=int, default=16, help='hive size in MB (default 16)')
+    parser.add_argument('-rounds', type=int, default=3, help='downloads per algorithm (default 3)')
+    parser.add_argument('-link', type=float, default=10, help='link speed used for the estimation, in Mbit/s '
+                                                                '(default 10)')
+    parser.add_argument('-port', type=int, default=14451, help='port for the local server (default 14451)')
+    options = parser.parse_args()
+
+    data = hive(options.size * 1024 * 1024)
+    path = tempfile.mkdtemp()
+    with open(os.path.join(path, 'hive.dat'), 'wb') as fd:
+        fd.write(data)
+    server = get_context('spawn').Process(target=serve, args=(options.port, path))
+    server.start()
+    try:
+        time.sleep(2)
+        print('%-24s %12s %14s %8s %22s' % ('algorithm', 'get (MB/s)', 'received (KB)', 'ratio',
+                                            'est. %g Mbit/s (s)' % options.link))
+        for name, compressionIds in ALGORITHMS:
+            getTime, received = transfer(options.port, compressionIds, data, options.rounds)
+            # CPU time on both ends plus the time the received bytes take on the link
+            estimation = getTime / options.rounds + received * 8 / (options.link * 1000000)
+            print('%-24s %12.1f %14d %8.2f %22.1f' % (name, options.size * options.rounds / getTime, received // 1024,
+                                                     len(data) / float(received), estimation))
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Throughput of SMB 3 encrypted file transfers over loopback for each cipher:
+#   AES-128-CCM on SMB 3.0 and AES-128/256-CCM/GCM on SMB 3.1.1. Both ends run
+#   impacket, a SimpleSMBServer with a share requiring encryption is started in
+#   another process, so figures include the cost of encrypting and decrypting
+#   every message on both sides.
+#
+#   python tests/benchmarks/bench_smb3_encryption.py [-size MB] [-rounds N] [-port PORT]
+#
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from io import BytesIO
+from multiprocessing import get_context
+
+from impacket import smb3
+from impacket.smb3structs import SMB2_DIALECT_30, SMB2_DIALECT_311, SMB2_ENCRYPTION_AES128_CCM, \
+    SMB2_ENCRYPTION_AES128_GCM, SMB2_ENCRYPTION_AES256_CCM, SMB2_ENCRYPTION_AES256_GCM
+from impacket.smbconnection import SMBConnection
+from impacket.smbserver import SimpleSMBServer
+from impacket.ntlm import compute_lmhash, compute_nthash
+
+USERNAME = 'user'
+PASSWORD = 'Password'
+SHARE = 'BENCH'
+
+CIPHERS = (
+    ('3.0', SMB2_DIALECT_30, SMB2_ENCRYPTION_AES128_CCM, 'AES-128-CCM'),
+    ('3.1.1', SMB2_DIALECT_311, SMB2_ENCRYPTION_AES128_CCM, 'AES-128-CCM'),
+    ('3.1.1', SMB2_DIALECT_311, SMB2_ENCRYPTION_AES128_GCM, 'AES-128-GCM'),
+    ('3.1.1', SMB2_DIALECT_311, SMB2_ENCRYPTION_AES256_CCM, 'AES-256-CCM'),
+    ('3.1.1', SMB2_DIALECT_311, SMB2_ENCRYPTION_AES256_GCM, 'AES-256-GCM'),
+)
+
+
+def serve(port, path):
+    server = SimpleSMBServer(listenAddress='127.0.0.1', listenPort=port)
+    server.addCredential(USERNAME, 0, compute_lmhash(PASSWORD), compute_nthash(PASSWORD))
+    server.addShare(SHARE, path, encryptData='yes')
+    server.setSMB2Support(True)
+    server.setSMB3Support(True)
+    server.start()
+
+
+def transfer(port, dialect, cipher, data, rounds):
+    # Only the cipher being measured is offered, the server picks it
+    smb3.ENCRYPTION_ALGORITHMS = [cipher]
+    client = SMBConnection('127.0.0.1', '127.0.0.1', sess_port=port, preferredDialect=dialect)
+    client.login(USERNAME, PASSWORD)
+    putTime = getTime = 0
+    for i in range(rounds):
+        start = time.time()
+        client.putFile(SHARE, 'bench.bin', BytesIO(data).read)
+        putTime += time.time() - start
+        output = BytesIO()
+        start = time.time()
+        client.getFile(SHARE, 'bench.bin', output.write)
+        getTime += time.time() - start
+        if output.getvalue() != data:
+            raise Exception('Wrong data read back')
+    client.deleteFile(SHARE, 'bench.bin')
+    client.close()
+    return putTime, getTime
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMB 3 encryption throughput benchmark')
+    parser.add_argument('-size', type=int, default=16, help='file size in MB (default 16)')
+    parser.add_argument('-rounds', type=int, default=3, help='transfers per cipher (default 3)')
+    parser.add_argument('-port', type=int, default=14450, help='port for the local server (default 14450)')
+    options = parser.parse_args()
+
+    data = os.urandom(options.size * 1024 * 1024)
+    total = options.size * options.rounds
+    path = tempfile.mkdtemp()
+    server = get_context('spawn').Process(target=serve, args=(options.port, path))
+    server.start()
+    try:
+        time.sleep(2)
+        print('%-8s %-12s %12s %12s' % ('dialect', 'cipher', 'put (MB/s)', 'get (MB/s)'))
+        for name, dialect, cipher, cipherName in CIPHERS:
+            putTime, getTime = transfer(options.port, dialect, cipher, data, options.rounds)
+            print('%-8s %-12s %12.1f %12.1f' % (name, cipherName, total / putTime, total / getTime))
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
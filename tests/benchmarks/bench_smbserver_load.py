@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Load test for the SMB server: many clients connecting at the same time,
+#   each one logging in (or failing to, like when capturing NTLM hashes) and
+#   listing a share. The server runs in another process, with a thread per
+#   connection or with event loops, and logs its connection count and request
+#   rate every second. The clients are asyncio ones, from a single process.
+#
+#   python tests/benchmarks/bench_smbserver_load.py [-clients N] [-rounds N] [-event-loops N] [-fail] [-port PORT]
+#
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+
+from impacket.asyncsmb3 import AsyncSMB3
+from impacket.smb3 import SessionError
+from impacket.smbserver import SimpleSMBServer, LOG
+from impacket.ntlm import compute_lmhash, compute_nthash
+
+USERNAME = 'user'
+PASSWORD = 'Password'
+SHARE = 'LOAD'
+
+
+def raise_fd_limit():
+    # Every client takes a socket on each end
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class StatsFilter(logging.Filter):
+    def filter(self, record):
+        return record.getMessage().startswith('Stats:')
+
+
+def serve(port, path, eventLoops):
+    raise_fd_limit()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(StatsFilter())
+    handler.setFormatter(logging.Formatter('  server %(message)s'))
+    LOG.addHandler(handler)
+    LOG.setLevel(logging.INFO)
+    LOG.propagate = False
+
+    server = SimpleSMBServer(listenAddress='127.0.0.1', listenPort=port)
+    server.addCredential(USERNAME, 0, compute_lmhash(PASSWORD), compute_nthash(PASSWORD))
+    server.addShare(SHARE, path)
+    server.setSMB2Support(True)
+    server.setStatsInterval(1)
+    if eventLoops > 0:
+        server.setEventLoops(eventLoops)
+    server.start()
+
+
+async def client(port, password, latencies):
+    start = time.time()
+    async with AsyncSMB3('127.0.0.1', '127.0.0.1', sess_port=port, timeout=120) as connection:
+        try:
+            await connection.login(USERNAME, password)
+        except SessionError:
+            latencies.append(time.time() - start)
+            return False
+        await connection.listPath(SHARE, '*')
+    latencies.append(time.time() - start)
+    return True
+
+
+async def run(port, clients, password):
+    latencies = []
+    results = await asyncio.gather(*[client(port, password, latencies) for _ in range(clients)],
+                                   return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMB server load test')
+    parser.add_argument('-clients', type=int, default=1000, help='clients connecting at once (default 1000)')
+    parser.add_argument('-rounds', type=int, default=3, help='times the clients connect (default 3)')
+    parser.add_argument('-event-loops', type=int, default=0, metavar='N',
+                        help='event loops serving the connections, 0 for a thread per connection (default 0)')
+    parser.add_argument('-fail', action='store_true', help='log in with a wrong password, like an NTLM capture')
+    parser.add_argument('-port', type=int, default=14452, help='port for the local server (default 14452)')
+    options = parser.parse_args()
+
+    limit = raise_fd_limit()
+    if options.clients * 2 + 100 > limit:
+        print('Warning: %d clients need more file descriptors than the %d allowed' % (options.clients, limit))
+
+    path = tempfile.mkdtemp()
+    for i in range(20):
+        with open(os.path.join(path, 'file%d' % i), 'wb') as fd:
+            fd.write(b'A' * 1024)
+    server = get_context('spawn').Process(target=serve, args=(options.port, path, options.event_loops))
+    server.start()
+    password = 'wrong' if options.fail else PASSWORD
+    try:
+        time.sleep(2)
+        print('%s, %d clients at once' % ('%d event loops' % options.event_loops if options.event_loops > 0 else
+                                          'thread per connection', options.clients))
+        for i in range(options.rounds):
+            start = time.time()
+            latencies, errors = asyncio.run(run(options.port, options.clients, password))
+            elapsed = time.time() - start
+            latencies.sort()
+            print('round %d: %.2f s, %.0f clients/s, median %.0f ms, p99 %.0f ms, %d errors' % (
+                i + 1, elapsed, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000 if latencies else 0,
+                latencies[len(latencies) * 99 // 100] * 1000 if latencies else 0, len(errors)))
+            if len(errors) > 0:
+                print('  first error: %r' % errors[0])
+        time.sleep(1.5)
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies 
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Peak memory of unmarshalling large responses from bytes vs. from a memoryview
+#   (zero-copy mode) for Structure (SMB2 READ response) and NDR (BaseRegQueryValue
+#   response with a big PBYTE_ARRAY). Every run happens in a fresh process so peak
+#   RSS figures don't leak between modes. ru_maxrss is reported in KB on Linux.
+#
+#   python tests/benchmarks/bench_zero_copy.py [-size MB]
+#
+import argparse
+import resource
+import tempfile
+import time
+from multiprocessing import get_context
+
+from impacket import smb3structs
+from impacket.dcerpc.v5 import rrp
+from impacket.dcerpc.v5.ndr import ByteArrayView
+
+
+def build_smb2_read(size):
+    packet = smb3structs.SMB2Packet()
+    packet['Command'] = smb3structs.SMB2_READ
+    response = smb3structs.SMB2Read_Response()
+    response['DataOffset'] = 0x50
+    response['DataLength'] = size
+    response['Buffer'] = b'A' * size
+    packet['Data'] = response
+    return packet.getData()
+
+
+def build_reg_value(size):
+    response = rrp.BaseRegQueryValueResponse()
+    response['lpType'] = rrp.REG_BINARY
+    # A view packs in one go, a list of one-byte strings would take ages to build
+    response['lpData'] = ByteArrayView(memoryview(b'B' * size))
+    response['lpcbData'] = size
+    response['lpcbLen'] = size
+    response['ErrorCode'] = 0
+    return response.getData()
+
+
+def parse_smb2_read(data):
+    packet = smb3structs.SMB2Packet(data)
+    return smb3structs.SMB2Read_Response(packet['Data'])
+
+
+def parse_reg_value(data):
+    return rrp.BaseRegQueryValueResponse(data)
+
+
+def run(parse, fileName, zero_copy, queue):
+    # Read the payload from disk so that the baseline isn't inflated by unpickling it
+    with open(fileName, 'rb') as f:
+        data = f.read()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    response = parse(memoryview(data) if zero_copy else data)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del response
+    queue.put((elapsed, baseline, peak))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zero-copy unmarshalling memory benchmark')
+    parser.add_argument('-size', type=int, default=8, help='payload size in MB (default 8)')
+    options = parser.parse_args()
+
+    size = options.size * 1024 * 1024
+    context = get_context('spawn')
+    print('%-6s %-10s %10s %14s %14s' % ('type', 'mode', 'time (s)', 'base RSS (KB)', 'peak RSS (KB)'))
+    for name, parse, build in (('smb2', parse_smb2_read, build_smb2_read),
+                               ('ndr', parse_reg_value, build_reg_value)):
+        with tempfile.NamedTemporaryFile() as payload:
+            payload.write(build(size))
+            payload.flush()
+            for zero_copy in (False, True):
+                queue = context.Queue()
+                process = context.Process(target=run, args=(parse, payload.name, zero_copy, queue))
+                process.start()
+                elapsed, baseline, peak = queue.get()
+                process.join()
+                print('%-6s %-10s %10.3f %14d %14d' % (name, 'memoryview' if zero_copy else 'bytes', elapsed,
+                                                       baseline, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -98,6 +98,17 @@ class EPMTests(DCERPCTests):
         MSRPC_UUID_SCMR = uuidtup_to_bin(('367ABB81-9844-35F1-AD32-98F038001003', '2.0'))
         epm.hept_map(self.machine, MSRPC_UUID_SCMR, protocol='ncacn_ip_tcp')
 
+    def test_hept_map_many(self):
+        MSRPC_UUID_SAMR = uuidtup_to_bin(('12345778-1234-ABCD-EF00-0123456789AC', '1.0'))
+        MSRPC_UUID_SCMR = uuidtup_to_bin(('367ABB81-9844-35F1-AD32-98F038001003', '2.0'))
+        cache = epm.EPMCache()
+        resp = epm.hept_map_many(self.machine, [MSRPC_UUID_SAMR, MSRPC_UUID_SCMR], protocol='ncacn_ip_tcp',
+                                 cache=cache)
+        self.assertEqual(resp[MSRPC_UUID_SAMR], epm.hept_map(self.machine, MSRPC_UUID_SAMR, protocol='ncacn_ip_tcp'))
+        self.assertEqual(epm.hept_map(self.machine, MSRPC_UUID_SCMR, protocol='ncacn_ip_tcp', cache=cache),
+                         resp[MSRPC_UUID_SCMR])
+        self.assertEqual(cache.getStats()['hits'], 1)
+
 
 @pytest.mark.remote
 class EPMTestsSMBTransport(EPMTests, unittest.TestCase):
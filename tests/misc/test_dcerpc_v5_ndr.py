@@ -10,16 +10,22 @@
 # for more information.
 #
 from __future__ import print_function
+import importlib
+import inspect
+import logging
+import random
 import unittest
 from binascii import hexlify
 
-from impacket.dcerpc.v5.ndr import (NDRSTRUCT, NDRLONG, NDRSHORT,
+from impacket.dcerpc.v5 import ndrcodegen, drsuapi, lsat, samr, srvs
+from impacket.dcerpc.v5.dtypes import LPWSTR, NULL
+from impacket.dcerpc.v5.ndr import (NDR, NDRSTRUCT, NDRCALL, NDRLONG, NDRSHORT,
                                     NDRUniFixedArray,
                                     NDRUniVaryingArray,
                                     NDRUniConformantVaryingArray,
                                     NDRVaryingString,
                                     NDRConformantVaryingString,
-                                    NDRPOINTERNULL)
+                                    NDRPOINTERNULL, ByteArrayView)
 
 
 def hexl(b):
@@ -28,12 +34,17 @@ def hexl(b):
 
 
 class NDRTest(object):
+    # generatedCodec = False runs the reflective getData/fromString path
+    generatedCodec = True
 
     def create(self, data=None, isNDR64=False):
+        theClass = self.theClass
+        if not self.generatedCodec:
+            theClass = type(theClass.__name__, (theClass,), {'generatedCodec': False})
         if data is not None:
-            return self.theClass(data, isNDR64=isNDR64)
+            return theClass(data, isNDR64=isNDR64)
         else:
-            return self.theClass(isNDR64=isNDR64)
+            return theClass(isNDR64=isNDR64)
 
     def do_test(self, isNDR64=False):
         a = self.create(isNDR64=isNDR64)
@@ -46,6 +57,14 @@ class NDRTest(object):
         b_str = b.getData()
         self.assertEqual(b_str, a_str)
 
+    def do_test_zero_copy(self, isNDR64=False):
+        a = self.create(isNDR64=isNDR64)
+        self.populate(a)
+        a_str = a.getData()
+        # unpacking from a memoryview must give back the same octet stream
+        b = self.create(memoryview(a_str), isNDR64=isNDR64)
+        self.assertEqual(b.getData(), a_str)
+
     def test_false(self):
         self.do_test(False)
 
@@ -53,6 +72,10 @@ class NDRTest(object):
         # Now the same tests but with NDR64
         self.do_test(True)
 
+    def test_zero_copy(self):
+        self.do_test_zero_copy(False)
+        self.do_test_zero_copy(True)
+
     def check_data(self, a_str, isNDR64):
         try:
             hexData = getattr(self, 'hexData64' if isNDR64 else 'hexData')
@@ -167,6 +190,29 @@ class TestConformantVaryingString(NDRTest, unittest.TestCase):
     hexData64 = '08000000 00000000 00000000 00000000 08000000 00000000 31323334 35363738'
 
 
+class TestByteArrayView(unittest.TestCase):
+    class theClass(NDRSTRUCT):
+        structure = (
+            ('Array', NDRUniConformantVaryingArray),
+        )
+
+    def test_byte_array_view(self):
+        a = self.theClass()
+        a['Array'] = b'12345678'
+        a_str = a.getData()
+        buffer = memoryview(a_str)
+        b = self.theClass(buffer)
+        data = b['Array']
+        self.assertIsInstance(data, ByteArrayView)
+        self.assertEqual(len(data), 8)
+        self.assertEqual(data[0], b'1')
+        self.assertEqual(data[-1], b'8')
+        self.assertEqual(b''.join(data), b'12345678')
+        self.assertEqual(data.tobytes(), b'12345678')
+        self.assertEqual(data, [b'1', b'2', b'3', b'4', b'5', b'6', b'7', b'8'])
+        self.assertEqual(self.theClass(a_str)['Array'], data)
+
+
 class TestPointerNULL(NDRTest, unittest.TestCase):
     class theClass(NDRSTRUCT):
         structure = (
@@ -180,5 +226,184 @@ class TestPointerNULL(NDRTest, unittest.TestCase):
     hexData64 = '00000000 00000000'
 
 
+class TestGeneratedCodec(unittest.TestCase):
+    # Interfaces covered by tests/dcerpc, their structures and calls are marshalled both ways and compared
+    modules = ('bkrp', 'dcomrt', 'dhcpm', 'drsuapi', 'epm', 'even', 'even6', 'lsad', 'lsat', 'mgmt', 'mimilib',
+               'nrpc', 'par', 'rprn', 'rrp', 'samr', 'scmr', 'srvs', 'tsch', 'wkst')
+
+    def classes(self):
+        for moduleName in self.modules:
+            module = importlib.import_module('impacket.dcerpc.v5.%s' % moduleName)
+            for name, value in sorted(vars(module).items()):
+                if inspect.isclass(value) and issubclass(value, (NDRSTRUCT, NDRCALL)) and \
+                        value.__module__ == module.__name__:
+                    yield value
+
+    def marshal(self, generatedCodec, function):
+        NDR.generatedCodec = generatedCodec
+        try:
+            return True, function()
+        except Exception as e:
+            return False, e.__class__
+        finally:
+            NDR.generatedCodec = True
+
+    def test_codec_is_cached(self):
+        class theClass(NDRSTRUCT):
+            structure = (
+                ('Long', NDRLONG),
+                ('Short', '<H=0'),
+            )
+        a = theClass()
+        a['Long'] = 1
+        self.assertEqual(a.getData(), b'\x01\x00\x00\x00\x00\x00')
+        codecs = theClass.__dict__['_ndrCodecs']
+        self.assertEqual(len(codecs), 1)
+        self.assertIsNotNone(list(codecs.values())[0])
+        self.assertIn('def encode', ndrcodegen.generateSource(theClass))
+
+    def test_codec_per_instance_layout(self):
+        class theClass(NDRSTRUCT):
+            def __init__(self, data=None, isNDR64=False):
+                # A new layout tuple per instance, like oaut.ARRAYDESC
+                self.structure = (
+                    ('Long', NDRLONG),
+                    ('Short', '<H=0'),
+                )
+                NDRSTRUCT.__init__(self, data, isNDR64)
+        for i in range(200):
+            a = theClass()
+            a['Long'] = i
+            self.assertEqual(theClass(a.getData())['Long'], i)
+        codecs = theClass.__dict__['_ndrCodecs']
+        self.assertEqual(len(codecs), 1)
+        self.assertIsNotNone(list(codecs.values())[0])
+
+    def test_unsupported_is_reflective(self):
+        class theClass(NDRSTRUCT):
+            structure = (
+                ('Array', NDRUniConformantVaryingArray),
+            )
+        self.assertRaises(ndrcodegen.Unsupported, ndrcodegen.generateSource, theClass)
+        a = theClass()
+        a['Array'] = b'12'
+        self.assertEqual(theClass(a.getData())['Array'], [b'1', b'2'])
+
+    def test_same_octet_stream(self):
+        logging.disable(logging.CRITICAL)
+        try:
+            for theClass in self.classes():
+                for isNDR64 in (False, True):
+                    def pack():
+                        random.seed(theClass.__name__)
+                        return theClass(isNDR64=isNDR64).getData()
+                    reflective = self.marshal(False, pack)
+                    self.assertEqual(self.marshal(True, pack), reflective, theClass)
+                    if reflective[0] is False:
+                        continue
+
+                    def unpack():
+                        a = theClass(isNDR64=isNDR64)
+                        size = a.fromString(reflective[1])
+                        NDR.generatedCodec = False
+                        return size, a.getData()
+                    self.assertEqual(self.marshal(True, unpack), self.marshal(False, unpack), theClass)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    # Populated instances, with pointers, unions, conformant arrays and strings
+    def shareEnumResponse(self, isNDR64):
+        resp = srvs.NetrShareEnumResponse(isNDR64=isNDR64)
+        resp['InfoStruct']['Level'] = 1
+        resp['InfoStruct']['ShareInfo']['tag'] = 1
+        resp['InfoStruct']['ShareInfo']['Level1']['EntriesRead'] = 3
+        for i in range(3):
+            shareInfo = srvs.SHARE_INFO_1(isNDR64=isNDR64)
+            shareInfo['shi1_netname'] = 'SHARE%d\x00' % i
+            shareInfo['shi1_type'] = i
+            shareInfo['shi1_remark'] = 'A share' * i + '\x00'
+            resp['InfoStruct']['ShareInfo']['Level1']['Buffer'].append(shareInfo)
+        resp['TotalEntries'] = 3
+        resp['ResumeHandle'] = 7
+        resp['ErrorCode'] = 0
+        return resp
+
+    def lookupSids(self, isNDR64):
+        request = lsat.LsarLookupSids(isNDR64=isNDR64)
+        request['PolicyHandle'] = b'\x01' * 20
+        sids = ('S-1-5-32-544', 'S-1-5-21-1-2-3-500', 'S-1-1-0')
+        request['SidEnumBuffer']['Entries'] = len(sids)
+        for sid in sids:
+            item = lsat.LSAPR_SID_INFORMATION(isNDR64=isNDR64)
+            item['Sid'].fromCanonical(sid)
+            request['SidEnumBuffer']['SidInfo'].append(item)
+        request['TranslatedNames']['Names'] = NULL
+        request['LookupLevel'] = lsat.LSAP_LOOKUP_LEVEL.LsapLookupWksta
+        return request
+
+    def setInformationUser(self, isNDR64):
+        request = samr.SamrSetInformationUser2(isNDR64=isNDR64)
+        request['UserHandle'] = b'\x02' * 20
+        request['UserInformationClass'] = samr.USER_INFORMATION_CLASS.UserGeneralInformation
+        request['Buffer']['tag'] = samr.USER_INFORMATION_CLASS.UserGeneralInformation
+        request['Buffer']['General']['UserName'] = 'user'
+        request['Buffer']['General']['FullName'] = 'A User'
+        request['Buffer']['General']['PrimaryGroupId'] = 513
+        request['Buffer']['General']['AdminComment'] = ''
+        request['Buffer']['General']['UserComment'] = 'comment'
+        return request
+
+    def crackNames(self, isNDR64):
+        request = drsuapi.DRSCrackNames(isNDR64=isNDR64)
+        request['hDrs'] = b'\x03' * 20
+        request['dwInVersion'] = 1
+        request['pmsgIn']['tag'] = 1
+        request['pmsgIn']['V1']['formatOffered'] = drsuapi.DS_NAME_FORMAT.DS_NT4_ACCOUNT_NAME
+        request['pmsgIn']['V1']['formatDesired'] = drsuapi.DS_NAME_FORMAT.DS_FQDN_1779_NAME
+        names = ('DOMAIN\\user', 'DOMAIN\\other')
+        request['pmsgIn']['V1']['cNames'] = len(names)
+        for name in names:
+            record = LPWSTR(isNDR64=isNDR64)
+            record['Data'] = name + '\x00'
+            request['pmsgIn']['V1']['rpNames'].append(record)
+        return request
+
+    def test_same_octet_stream_populated(self):
+        for build in (self.shareEnumResponse, self.lookupSids, self.setInformationUser, self.crackNames):
+            for isNDR64 in (False, True):
+                packed = []
+                for generatedCodec in (False, True):
+                    NDR.generatedCodec = generatedCodec
+                    try:
+                        # Same referent ids
+                        random.seed(build.__name__)
+                        packed.append(build(isNDR64).getData())
+                    finally:
+                        NDR.generatedCodec = True
+                self.assertEqual(packed[1], packed[0], (build.__name__, isNDR64))
+
+                theClass = build(isNDR64).__class__
+                self.assertIn('_ndrCodecs', theClass.__dict__)
+                unpacked = []
+                for generatedCodec in (False, True):
+                    NDR.generatedCodec = generatedCodec
+                    try:
+                        a = theClass(isNDR64=isNDR64)
+                        size = a.fromString(packed[0])
+                        # Both parsed instances packed again the same way
+                        NDR.generatedCodec = False
+                        unpacked.append((size, a.getData()))
+                    finally:
+                        NDR.generatedCodec = True
+                self.assertEqual(unpacked[1], unpacked[0], (build.__name__, isNDR64))
+                self.assertEqual(unpacked[0][0], len(packed[0]))
+
+
+for _name, _test in list(globals().items()):
+    if isinstance(_test, type) and issubclass(_test, NDRTest) and issubclass(_test, unittest.TestCase):
+        globals()[_name + '_reflective'] = type(_name + '_reflective', (_test,), {'generatedCodec': False})
+del _name, _test
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=1)
@@ -0,0 +1,704 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   ESENT_DB tests against small databases written by ESEDatabase, which lays
+#   out the catalog, table and index B-trees and records the way ese.py reads them.
+#
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from binascii import hexlify
+from collections import OrderedDict
+from struct import pack, unpack
+
+from Cryptodome.Cipher import ARC4, DES
+
+from impacket import LOG, ese, ntlm
+from impacket.dcerpc.v5 import samr
+from impacket.examples.secretsdump import NTDSHashes, CryptoCommon
+from impacket.ese import ESENT_DB, ESENT_DB_HEADER, ESENT_JET_SIGNATURE, ESENT_PAGE_HEADER, ESENT_ROOT_HEADER
+
+VERSION = 0x620
+REVISION = 0x11
+PAGE_SIZE = 8192
+FIXED_CATALOG_PAGES = 4
+
+
+class ESEDatabase(object):
+    """ Writes an ESE database. Tables are given as a list of columns (name, identifier, type,
+        SpaceUsage, CodePage) and records, dictionaries of column name to the value bytes. A value
+        can also be a (flags, bytes) tuple for tagged columns, flags being the tagged data type flags.
+    """
+    def __init__(self, pageSize=PAGE_SIZE):
+        self.pageSize = pageSize
+        self.pages = {}
+        self.catalog = []
+        self.nextPage = FIXED_CATALOG_PAGES + 1
+        self.objectId = 1
+
+    def allocate(self):
+        pageNum = self.nextPage
+        self.nextPage += 1
+        return pageNum
+
+    def page(self, pageNum, flags, tags, fatherDataPage, previous=0, next=0):
+        # tags are (tag flags, data), tag 0 first. The tags array grows backwards from the end of the page
+        header = ESENT_PAGE_HEADER(VERSION, REVISION, self.pageSize)
+        header['FatherDataPage'] = fatherDataPage
+        header['PreviousPageNumber'] = previous
+        header['NextPageNumber'] = next
+        header['FirstAvailablePageTag'] = len(tags)
+        header['PageFlags'] = flags
+        body = b''
+        tagsArray = b''
+        for tagFlags, data in tags:
+            tagsArray = pack('<HH', len(data), len(body) | (tagFlags << 13)) + tagsArray
+            body += data
+        header['FirstAvailableDataOffset'] = len(body)
+        header['AvailableDataSize'] = self.pageSize - len(header) - len(body) - len(tagsArray)
+        if header['AvailableDataSize'] < 0:
+            raise Exception('Page %d overflow' % pageNum)
+        self.pages[pageNum] = header.getData() + body + b'\x00' * header['AvailableDataSize'] + tagsArray
+
+    @staticmethod
+    def entry(key, data, commonKey=b''):
+        # Leaf entries share the page common key prefix, when there's one
+        common = 0
+        while common < min(len(key), len(commonKey)) and key[common] == commonKey[common]:
+            common += 1
+        if common > 0:
+            return ese.TAG_COMMON, pack('<HH', common, len(key) - common) + key[common:] + data
+        return 0, pack('<H', len(key)) + key + data
+
+    @staticmethod
+    def commonPrefix(keys):
+        prefix = os.path.commonprefix(keys)
+        return prefix if len(keys) > 1 else b''
+
+    def tree(self, entries, flags=0, perLeaf=None):
+        """ Writes a B-tree with the (key, data) entries, sorted by key. Returns its root page.
+            Entries are split in leaf pages of perLeaf entries (or as many as they fit).
+        """
+        root = self.allocate()
+        rootHeader = ESENT_ROOT_HEADER()
+        leaves = []
+        current = []
+        size = 0
+        for key, data in entries:
+            entrySize = len(key) + len(data) + 16
+            if current and ((perLeaf is not None and len(current) >= perLeaf) or
+                            size + entrySize > self.pageSize * 3 // 4):
+                leaves.append(current)
+                current = []
+                size = 0
+            current.append((key, data))
+            size += entrySize
+        leaves.append(current)
+
+        if len(leaves) == 1:
+            tags = [(0, rootHeader.getData())] + [self.entry(key, data) for key, data in leaves[0]]
+            self.page(root, ese.FLAGS_ROOT | ese.FLAGS_LEAF | flags, tags, root)
+            return root
+
+        leafPages = [self.allocate() for _ in leaves]
+        branches = [(0, rootHeader.getData())]
+        for i, leaf in enumerate(leaves):
+            commonKey = self.commonPrefix([key for key, data in leaf])
+            tags = [(0, commonKey)] + [self.entry(key, data, commonKey) for key, data in leaf]
+            self.page(leafPages[i], ese.FLAGS_LEAF | flags, tags, root, leafPages[i - 1] if i > 0 else 0,
+                      leafPages[i + 1] if i + 1 < len(leafPages) else 0)
+            # Branch keys are the greatest key in the child
+            branches.append(self.entry(leaf[-1][0], pack('<L', leafPages[i])))
+        self.page(root, ese.FLAGS_ROOT | ese.FLAGS_PARENT | flags, branches, root)
+        return root
+
+    def catalogEntry(self, entryType, identifier, fields, name):
+        # Catalog records: data definition header, the fixed fields and the name as the only variable column
+        fixed = pack('<LHL', 0, entryType, identifier) + fields
+        data = pack('<BBH', 0, 128, 4 + len(fixed)) + fixed + pack('<H', len(name)) + name
+        self.catalog.append(data)
+
+    @staticmethod
+    def record(columns, values):
+        fixed = b''
+        lastFixed = 0
+        variable = []
+        lastVariable = 127
+        tagged = []
+        for name, identifier, columnType, spaceUsage, codePage in columns:
+            value = values.get(name)
+            if identifier <= 127:
+                if value is not None:
+                    lastFixed = identifier
+                fixed += (value or b'').ljust(spaceUsage, b'\x00')[:spaceUsage]
+            elif identifier <= 255:
+                variable.append((identifier, value))
+                if value is not None:
+                    lastVariable = identifier
+            elif value is not None:
+                tagged.append((identifier, value))
+
+        # Fixed values of the columns after lastFixed aren't there
+        fixedSize = sum(spaceUsage for name, identifier, columnType, spaceUsage, codePage in columns
+                        if identifier <= lastFixed)
+        data = fixed[:fixedSize]
+
+        offsets = b''
+        variableData = b''
+        for identifier, value in variable:
+            if identifier > lastVariable:
+                break
+            if value is None:
+                offsets += pack('<H', 0x8000 | len(variableData))
+            else:
+                variableData += value
+                offsets += pack('<H', len(variableData))
+
+        taggedArray = b''
+        taggedData = b''
+        for identifier, value in tagged:
+            if isinstance(value, tuple):
+                flags, value = value
+                taggedArray += pack('<HH', identifier, (len(tagged) * 4 + len(taggedData)) | 0x4000)
+                taggedData += pack('B', flags) + value
+            else:
+                taggedArray += pack('<HH', identifier, len(tagged) * 4 + len(taggedData))
+                taggedData += value
+        return pack('<BBH', lastFixed, lastVariable, 4 + len(data)) + data + offsets + variableData + \
+            taggedArray + taggedData
+
+    def addTable(self, tableName, columns, records, primaryKey, indexes=None, perLeaf=None, primaryIndex=None):
+        """ records go in primary key order, primaryKey(record) returns it. indexes maps an index
+            name to a function returning the index key of a record (or None). The primary index,
+            if named, is the table tree itself.
+        """
+        entries = sorted((primaryKey(values), self.record(columns, values)) for values in records)
+        tableRoot = self.tree(entries, perLeaf=perLeaf)
+        self.catalogEntry(ese.CATALOG_TYPE_TABLE, self.objectId, pack('<LL', tableRoot, 0), tableName)
+        self.objectId += 1
+        for name, identifier, columnType, spaceUsage, codePage in columns:
+            self.catalogEntry(ese.CATALOG_TYPE_COLUMN, identifier, pack('<LLLL', columnType, spaceUsage, 0, codePage),
+                              name)
+        if primaryIndex is not None:
+            self.catalogEntry(ese.CATALOG_TYPE_INDEX, self.objectId, pack('<LLLL', tableRoot, 0, 0, 0), primaryIndex)
+            self.objectId += 1
+        for indexName, indexKey in (indexes or {}).items():
+            indexEntries = []
+            for values in records:
+                key = indexKey(values)
+                if key is not None:
+                    # Keys of non unique indexes end with the primary key
+                    indexEntries.append((key + primaryKey(values), primaryKey(values)))
+            indexRoot = self.tree(sorted(indexEntries), ese.FLAGS_INDEX, perLeaf=perLeaf)
+            self.catalogEntry(ese.CATALOG_TYPE_INDEX, self.objectId, pack('<LLLL', indexRoot, 0, 0, 0), indexName)
+            self.objectId += 1
+
+    def write(self, fileName):
+        self.page(ese.CATALOG_PAGE_NUMBER, ese.FLAGS_ROOT | ese.FLAGS_LEAF,
+                  [(0, ESENT_ROOT_HEADER().getData())] +
+                  [self.entry(pack('>H', i), data) for i, data in enumerate(self.catalog)], ese.CATALOG_FDP)
+
+        header = ESENT_DB_HEADER()
+        header['Version'] = VERSION
+        header['FileFormatRevision'] = REVISION
+        header['PageSize'] = self.pageSize
+        header['DBState'] = ese.JET_dbstateCleanShutdown
+        signature = ESENT_JET_SIGNATURE()
+        signature['Random'] = 0x12345678
+        header['DBSignature'] = signature.getData()
+        header['LogSignature'] = ESENT_JET_SIGNATURE().getData()
+        header = header.getData().ljust(self.pageSize, b'\x00')
+        with open(fileName, 'wb') as f:
+            # Header and its shadow copy, then the pages
+            f.write(header + header)
+            for pageNum in range(1, self.nextPage):
+                if pageNum in self.pages:
+                    f.write(self.pages[pageNum])
+                else:
+                    f.write(b'\x00' * self.pageSize)
+
+
+def primaryKey(values):
+    return pack('>BL', ese.KEY_PREFIX_DATA, 0x80000000 ^ unpack('<l', values[b'Id'])[0])
+
+
+def binaryKey(value):
+    # Normalized key of a binary column value, in chunks of eight bytes
+    if len(value) == 0:
+        return pack('B', ese.KEY_PREFIX_ZERO_LENGTH)
+    key = pack('B', ese.KEY_PREFIX_DATA)
+    for i in range(0, len(value), 8):
+        chunk = value[i:i + 8]
+        key += chunk.ljust(8, b'\x00') + pack('B', 9 if i + 8 < len(value) else len(chunk))
+    return key
+
+
+# Fixed, variable and tagged columns, ordered by identifier as the catalog has them
+COLUMNS = [
+    (b'Id', 1, ese.JET_coltypLong, 4, 0),
+    (b'Flags', 2, ese.JET_coltypUnsignedShort, 2, 0),
+    (b'Time', 3, ese.JET_coltypLongLong, 8, 0),
+    (b'Name', 128, ese.JET_coltypText, 0, ese.CODEPAGE_ASCII),
+    (b'Blob', 129, ese.JET_coltypBinary, 0, 0),
+    (b'Title', 130, ese.JET_coltypText, 0, ese.CODEPAGE_UNICODE),
+    (b'Description', 256, ese.JET_coltypLongText, 0, ese.CODEPAGE_UNICODE),
+    (b'Data', 257, ese.JET_coltypLongBinary, 0, 0),
+    (b'Values', 258, ese.JET_coltypBinary, 0, 0),
+    (b'Separated', 259, ese.JET_coltypLongBinary, 0, 0),
+]
+
+
+def makeRecord(i):
+    values = {
+        b'Id': pack('<l', i),
+        b'Flags': pack('<H', i & 0xffff),
+        b'Time': pack('<Q', 132000000000000000 + i),
+        b'Name': b'name%d' % i,
+        b'Blob': None if i % 5 == 0 else pack('>L', i) * (i % 4),
+        b'Title': ('Title %d' % i).encode('utf-16le'),
+    }
+    if i % 2:
+        values[b'Description'] = ('Description of %d ' % i * 20).encode('utf-16le')
+    if i % 3 == 0:
+        # Long value kept in the record
+        values[b'Data'] = (1, bytes(range(256)) * (2 + i % 3))
+    if i % 4 == 0:
+        values[b'Values'] = (ese.TAGGED_DATA_TYPE_MULTI_VALUE, pack('<HH', 4, 8) + pack('>L', i) * 2)
+    if i % 7 == 0:
+        # Stored in the long value tree, the record just has its id
+        values[b'Separated'] = (ese.TAGGED_DATA_TYPE_STORED, pack('<L', i))
+    return values
+
+
+class ESETestCase(unittest.TestCase):
+    rows = 400
+    perLeaf = 23
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.fileName = os.path.join(self.directory, 'test.edb')
+        self.writeDatabase(self.rows)
+
+    def writeDatabase(self, rows):
+        db = ESEDatabase()
+        db.addTable(b'TestTable', COLUMNS, [makeRecord(i) for i in range(rows)], primaryKey,
+                    {b'IdxBlob': lambda values: None if values[b'Blob'] is None else binaryKey(values[b'Blob'])},
+                    perLeaf=self.perLeaf, primaryIndex=b'IdxId')
+        db.write(self.fileName)
+
+    def open(self, **kwargs):
+        db = ESENT_DB(self.fileName, **kwargs)
+        self.addCleanup(db.close)
+        return db
+
+    @staticmethod
+    def readTable(db, tableName=b'TestTable', **kwargs):
+        cursor = db.openTable(tableName, **kwargs)
+        records = []
+        while True:
+            record = db.getNextRow(cursor)
+            if record is None:
+                return records
+            records.append(dict(record.items()))
+
+
+class PageCacheTests(ESETestCase):
+
+    def test_records(self):
+        records = self.readTable(self.open())
+        self.assertEqual(len(records), self.rows)
+        self.assertEqual([record[b'Id'] for record in records], list(range(self.rows)))
+        self.assertEqual(records[5][b'Name'], 'name5')
+        self.assertEqual(records[5][b'Title'], 'Title 5')
+
+    def test_cache_hits(self):
+        db = self.open(useMmap=False)
+        first = self.readTable(db)
+        stats = db.getCacheStats()
+        self.assertGreater(stats['Misses'], 0)
+        # Everything's cached, walking the table again doesn't read a thing
+        self.assertEqual(self.readTable(db), first)
+        again = db.getCacheStats()
+        self.assertEqual(again['Misses'], stats['Misses'])
+        self.assertEqual(again['Reads'], stats['Reads'])
+        self.assertGreater(again['Hits'], stats['Hits'])
+        self.assertEqual(again['Evictions'], 0)
+
+    def test_read_ahead(self):
+        db = self.open(useMmap=False)
+        self.readTable(db)
+        stats = db.getCacheStats()
+        leafPages = db.getLeafPages(b'TestTable')
+        self.assertGreater(len(leafPages), 10)
+        # Leaf pages are consecutive, they come in a few reads
+        self.assertGreater(stats['ReadAheadPages'], 0)
+        self.assertLess(stats['Reads'], len(leafPages))
+
+        db = self.open(useMmap=False, readAhead=1)
+        self.readTable(db)
+        self.assertEqual(db.getCacheStats()['ReadAheadPages'], 0)
+        self.assertGreaterEqual(db.getCacheStats()['Reads'], len(leafPages))
+
+    def test_mmap(self):
+        mapped = self.open()
+        self.assertIsNotNone(mapped._ESENT_DB__mmap)
+        read = self.open(useMmap=False)
+        self.assertIsNone(read._ESENT_DB__mmap)
+        self.assertEqual(mapped.getPage(-1), read.getPage(-1))
+        for pageNum in range(1, os.path.getsize(self.fileName) // PAGE_SIZE - 1):
+            self.assertEqual(mapped.getPage(pageNum).data, read.getPage(pageNum, readAhead=8).data, pageNum)
+        self.assertEqual(mapped.getLeafPages(b'TestTable'), read.getLeafPages(b'TestTable'))
+        self.assertEqual(self.readTable(mapped), self.readTable(read))
+        self.assertEqual(self.readTable(mapped, columns=[b'Name', b'Values']),
+                         self.readTable(read, columns=[b'Name', b'Values']))
+
+    def test_eviction(self):
+        expected = self.readTable(self.open())
+        # Room for just two pages
+        db = self.open(useMmap=False, cacheSize=2 * PAGE_SIZE)
+        self.assertEqual(self.readTable(db), expected)
+        self.assertEqual(self.readTable(db), expected)
+        stats = db.getCacheStats()
+        self.assertGreater(stats['Evictions'], 0)
+        self.assertLessEqual(stats['CachedPages'], 2)
+        self.assertEqual(stats['CachedBytes'], stats['CachedPages'] * PAGE_SIZE)
+
+        # No cache at all
+        db = self.open(useMmap=False, cacheSize=0)
+        self.assertEqual(self.readTable(db), expected)
+        self.assertEqual(db.getCacheStats()['CachedPages'], 0)
+
+
+class SidecarTests(ESETestCase):
+
+    def setUp(self):
+        ESETestCase.setUp(self)
+        self.sidecarFile = os.path.join(self.directory, 'test.edb.idx')
+
+    def test_sidecar(self):
+        db = self.open(useMmap=False, sidecarFile=self.sidecarFile)
+        # Walking the catalog
+        self.assertGreater(db.getCacheStats()['Misses'], 0)
+        leafPages = db.getLeafPages(b'TestTable')
+        self.assertEqual(db.getRowCount(b'TestTable'), self.rows)
+        expected = self.readTable(db)
+        db.close()
+        self.assertTrue(os.path.exists(self.sidecarFile))
+
+        db = self.open(useMmap=False, sidecarFile=self.sidecarFile)
+        # The catalog, the leaf pages and the row count come from the sidecar
+        self.assertEqual(db.getCacheStats()['Misses'], 0)
+        self.assertEqual(db.getLeafPages(b'TestTable'), leafPages)
+        self.assertEqual(db.getRowCount(b'TestTable'), self.rows)
+        self.assertEqual(db.getCacheStats()['Misses'], 0)
+        self.assertEqual(self.readTable(db), expected)
+        self.assertEqual(self.readTable(db, leafPages=leafPages), expected)
+
+    def test_invalidation(self):
+        db = self.open(sidecarFile=self.sidecarFile)
+        db.getLeafPages(b'TestTable')
+        db.close()
+        with open(self.sidecarFile) as f:
+            sidecar = f.read()
+
+        # Another database in the same file, the sidecar is rebuilt
+        self.writeDatabase(self.rows // 2)
+        db = self.open(useMmap=False, sidecarFile=self.sidecarFile)
+        self.assertGreater(db.getCacheStats()['Misses'], 0)
+        self.assertEqual(db.getRowCount(b'TestTable'), self.rows // 2)
+        self.assertEqual(len(self.readTable(db)), self.rows // 2)
+        self.assertEqual(len(self.readTable(db, leafPages=db.getLeafPages(b'TestTable'))), self.rows // 2)
+        db.close()
+        with open(self.sidecarFile) as f:
+            self.assertNotEqual(f.read(), sidecar)
+
+        # A corrupt one is rebuilt as well
+        with open(self.sidecarFile, 'w') as f:
+            f.write('{')
+        db = self.open(sidecarFile=self.sidecarFile)
+        self.assertEqual(db.getRowCount(b'TestTable'), self.rows // 2)
+
+
+def decodedRecord(i):
+    # What the database returns for makeRecord(i)
+    values = makeRecord(i)
+    tagged = dict((name, values[name][1] if isinstance(values.get(name), tuple) else values.get(name))
+                  for name in (b'Data', b'Values', b'Separated'))
+    return {
+        b'Id': i,
+        b'Flags': i & 0xffff,
+        b'Time': 132000000000000000 + i,
+        b'Name': 'name%d' % i,
+        b'Blob': None if values[b'Blob'] is None else hexlify(values[b'Blob']),
+        b'Title': 'Title %d' % i,
+        b'Description': values[b'Description'].decode('utf-16le') if b'Description' in values else None,
+        # Long values, multi values and separated ones come raw
+        b'Data': None if tagged[b'Data'] is None else hexlify(tagged[b'Data']),
+        b'Values': None if tagged[b'Values'] is None else hexlify(tagged[b'Values']),
+        b'Separated': None if tagged[b'Separated'] is None else hexlify(tagged[b'Separated']),
+    }
+
+
+class RecordTests(ESETestCase):
+
+    def test_records(self):
+        db = self.open()
+        records = self.readTable(db)
+        self.assertEqual(records, [decodedRecord(i) for i in range(self.rows)])
+        # Records decoded on access, same values
+        names = [column[0] for column in COLUMNS]
+        self.assertEqual(self.readTable(db, columns=names), records)
+        for record in records:
+            self.assertEqual(list(record.keys()), names)
+
+    def test_some_columns(self):
+        db = self.open()
+        records = self.readTable(db)
+        for names in ([b'Title'], [b'Blob', b'Values'], [b'Time', b'Description', b'Separated', b'Missing']):
+            expected = [dict((name, record[name]) for name in names if name in record) for record in records]
+            self.assertEqual(self.readTable(db, columns=names), expected)
+            cursor = db.openTable(b'TestTable')
+            filtered = []
+            while True:
+                record = db.getNextRow(cursor, filter_tables=names)
+                if record is None:
+                    break
+                self.assertIsInstance(record, OrderedDict)
+                filtered.append(dict(record))
+            self.assertEqual(filtered, expected)
+
+
+class IndexTests(ESETestCase):
+
+    def seek(self, db, indexName, key, high=None):
+        cursor = db.openIndex(b'TestTable', indexName)
+        if high is None:
+            db.seek(cursor, key)
+        else:
+            db.seekRange(cursor, key, high)
+        records = []
+        while True:
+            record = db.getNextRow(cursor)
+            if record is None:
+                return records
+            records.append(dict(record.items()))
+
+    def test_primary_index(self):
+        db = self.open()
+        records = self.readTable(db)
+        for i in (0, 1, 22, 23, 24, 200, self.rows - 1):
+            self.assertEqual(self.seek(db, b'IdxId', db.makeKey(b'TestTable', b'Id', i)), [records[i]])
+        self.assertEqual(self.seek(db, b'IdxId', db.makeKey(b'TestTable', b'Id', self.rows)), [])
+        self.assertEqual(self.seek(db, b'IdxId', db.makeKey(b'TestTable', b'Id', -1)), [])
+        self.assertEqual(self.seek(db, b'IdxId', db.makeKey(b'TestTable', b'Id', 40),
+                                   db.makeKey(b'TestTable', b'Id', 99)), records[40:100])
+
+    def test_secondary_index(self):
+        db = self.open()
+        records = self.readTable(db)
+        for i in range(self.rows):
+            value = makeRecord(i)[b'Blob']
+            if value is None:
+                continue
+            # Same records a full scan finds, in primary key order
+            expected = [record for record in records if record[b'Blob'] == hexlify(value)]
+            self.assertEqual(self.seek(db, b'IdxBlob', db.makeKey(b'TestTable', b'Blob', value)), expected, i)
+        self.assertEqual(self.seek(db, b'IdxBlob', db.makeKey(b'TestTable', b'Blob', b'missing')), [])
+
+    def test_make_key(self):
+        db = self.open()
+        keys = [db.makeKey(b'TestTable', b'Id', i) for i in (-2 ** 31, -5, -1, 0, 1, 5, 2 ** 31 - 1)]
+        self.assertEqual(sorted(keys), keys)
+        self.assertEqual(db.makeKey(b'TestTable', b'Blob', b'12345678abc'), binaryKey(b'12345678abc'))
+        self.assertEqual(db.makeKey(b'TestTable', b'Blob', b''), b'\x40')
+        with self.assertRaises(Exception):
+            db.makeKey(b'TestTable', b'Name', 'name')
+        self.assertIsNone(db.openIndex(b'TestTable', b'IdxMissing'))
+
+
+# NTDS.DIT datatable, the columns secretsdump reads
+BOOT_KEY = bytes(range(16))
+PEK = bytes(range(0x40, 0x50))
+DOMAIN_SID = 'S-1-5-21-1004336348-1177238915-682003330'
+NTDS_COLUMNS = [(b'DNT_col', 1, ese.JET_coltypLong, 4, 0)] + sorted(
+    [(column, 256 + i, {b'ATTj': ese.JET_coltypLong, b'ATTq': ese.JET_coltypCurrency,
+                        b'ATTm': ese.JET_coltypLongText}.get(column[:4], ese.JET_coltypLongBinary), 0,
+      ese.CODEPAGE_UNICODE if column.startswith(b'ATTm') else 0)
+     for i, column in enumerate(sorted(NTDSHashes.NAME_TO_INTERNAL.values()))], key=lambda column: column[1])
+
+
+def ntdsKey(rid):
+    return pack('>BL', ese.KEY_PREFIX_DATA, 0x80000000 ^ rid)
+
+
+def rc4Layer(key, keyMaterial, data):
+    return ARC4.new(hashlib.md5(key + keyMaterial).digest()).encrypt(data)
+
+
+def desLayer(hash, rid):
+    key1, key2 = CryptoCommon().deriveKey(rid)
+    return DES.new(key1, DES.MODE_ECB).encrypt(hash[:8]) + DES.new(key2, DES.MODE_ECB).encrypt(hash[8:])
+
+
+def encryptedHash(hashes, rid, keyMaterial):
+    # CRYPTED_HASH and CRYPTED_HISTORY, PEK number 0
+    return b'\x11\x00\x00\x00\x00\x00\x00\x00' + keyMaterial + \
+        rc4Layer(PEK, keyMaterial, b''.join(desLayer(hash, rid) for hash in hashes))
+
+
+def userSid(rid):
+    fields = [int(field) for field in ('%s-%d' % (DOMAIN_SID, rid)).split('-')[3:]]
+    return pack('>BB', 1, len(fields)) + pack('>Q', 5)[2:] + pack('>%dL' % len(fields), *fields)
+
+
+def password(rid):
+    return 'Password%d!' % rid
+
+
+def makeNTDSRecords(users):
+    column = NTDSHashes.NAME_TO_INTERNAL
+    keyMaterial = b'\x01' * 16
+    pekList = ARC4.new(hashlib.md5(BOOT_KEY + keyMaterial * 1000).digest()).encrypt(
+        b'\x00' * 32 + pack('<B3s16s', 0, b'', PEK))
+    records = [
+        {b'DNT_col': pack('<l', 2), column['name']: 'Domain'.encode('utf-16le')},
+        {b'DNT_col': pack('<l', 3), column['name']: 'PEK'.encode('utf-16le'),
+         column['pekList']: b'\x02\x00\x00\x00\x00\x00\x00\x00' + keyMaterial + pekList},
+    ]
+    for i in range(users):
+        rid = 1100 + i
+        name = 'user%d' % rid
+        nthash = ntlm.compute_nthash(password(rid))
+        values = {
+            b'DNT_col': pack('<l', rid),
+            column['name']: name.encode('utf-16le'),
+            column['sAMAccountName']: name.encode('utf-16le'),
+            column['objectSid']: userSid(rid),
+            column['sAMAccountType']: pack('<L', NTDSHashes.SAM_MACHINE_ACCOUNT if i % 10 == 9 else
+                                           NTDSHashes.SAM_NORMAL_USER_ACCOUNT),
+            column['userAccountControl']: pack('<L', 0x202 if i % 6 == 0 else 0x200),
+            column['pwdLastSet']: pack('<Q', 132000000000000000 + i * 10000000),
+            column['unicodePwd']: encryptedHash([nthash], rid, pack('>L', rid) * 4),
+        }
+        if i % 2:
+            values[column['userPrincipalName']] = ('%s@test.local' % name).encode('utf-16le')
+        if i % 3 == 0:
+            values[column['ntPwdHistory']] = encryptedHash(
+                [nthash, ntlm.compute_nthash(password(rid) + 'old')], rid, pack('<L', rid) * 4)
+            values[column['lmPwdHistory']] = encryptedHash(
+                [ntlm.compute_lmhash(password(rid)), ntlm.compute_lmhash('old')], rid, pack('<L', rid) * 4)
+        if i % 4 == 0:
+            cleartext = hexlify(password(rid).encode('utf-16le'))
+            userProperty = samr.USER_PROPERTY()
+            userProperty['NameLength'] = len('Primary:CLEARTEXT'.encode('utf-16le'))
+            userProperty['ValueLength'] = len(cleartext)
+            userProperty['PropertyName'] = 'Primary:CLEARTEXT'.encode('utf-16le')
+            userProperty['PropertyValue'] = cleartext
+            userProperties = samr.USER_PROPERTIES()
+            userProperties['Reserved4'] = b'\x00' * 96
+            userProperties['PropertyCount'] = 1
+            userProperties['UserProperties'] = userProperty.getData()
+            userProperties['Length'] = len(userProperties.getData()) - 12
+            values[column['supplementalCredentials']] = b'\x11\x00\x00\x00\x00\x00\x00\x00' + keyMaterial + \
+                rc4Layer(PEK, keyMaterial, userProperties.getData())
+        records.append(values)
+    # Something else than an account
+    records.append({b'DNT_col': pack('<l', 5000), column['name']: 'Group'.encode('utf-16le'),
+                    column['sAMAccountType']: pack('<L', 0x10000000), column['objectSid']: userSid(5000)})
+    return records
+
+
+def writeNTDS(fileName, users, perLeaf=7):
+    db = ESEDatabase()
+    objectSid = NTDSHashes.NAME_TO_INTERNAL['objectSid']
+    db.addTable(b'datatable', NTDS_COLUMNS, makeNTDSRecords(users),
+                lambda values: ntdsKey(unpack('<l', values[b'DNT_col'])[0]),
+                {b'INDEX_%08X' % int(objectSid[4:]):
+                    lambda values: binaryKey(values[objectSid]) if objectSid in values else None},
+                perLeaf=perLeaf)
+    db.write(fileName)
+
+
+class NTDSHashesTests(unittest.TestCase):
+    users = 120
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.fileName = os.path.join(self.directory, 'ntds.dit')
+        writeNTDS(self.fileName, self.users)
+
+    def dump(self, name, **kwargs):
+        secrets = []
+        outputFileName = os.path.join(self.directory, name)
+        ntds = NTDSHashes(self.fileName, BOOT_KEY, useVSSMethod=True, history=True, pwdLastSet=True,
+                          printUserStatus=True, outputFileName=outputFileName,
+                          perSecretCallback=lambda secretType, secret: secrets.append((secretType, secret)), **kwargs)
+        try:
+            ntds.dump()
+        finally:
+            ntds.finish()
+        outputs = []
+        for suffix in ('.ntds', '.ntds.kerberos', '.ntds.cleartext'):
+            with open(outputFileName + suffix) as f:
+                outputs.append(f.read())
+        return secrets, outputs
+
+    def test_serial(self):
+        secrets, outputs = self.dump('serial')
+        hashes = [secret for secretType, secret in secrets if secretType == NTDSHashes.SECRET_TYPE.NTDS]
+        # Users and machines, plus the password history of every third one
+        self.assertEqual(len(hashes), self.users + (self.users + 2) // 3)
+        self.assertEqual(outputs[0], ''.join(secret + '\n' for secret in hashes))
+        self.assertTrue(hashes[0].startswith('user1100:1100:aad3b435b51404eeaad3b435b51404ee:%s:::' %
+                                             hexlify(ntlm.compute_nthash(password(1100))).decode('utf-8')))
+        self.assertIn('status=Disabled', hashes[0])
+        self.assertTrue(hashes[1].startswith('user1100_history0:1100:'))
+        self.assertIn('test.local\\user1101:1101:', hashes[2])
+        cleartext = [secret for secretType, secret in secrets if secretType == NTDSHashes.SECRET_TYPE.NTDS_CLEARTEXT]
+        self.assertEqual(len(cleartext), (self.users + 3) // 4)
+        self.assertEqual(cleartext[0], 'user1100:CLEARTEXT:%s' % password(1100))
+
+    def test_index_file(self):
+        indexFile = os.path.join(self.directory, 'ntds.dit.idx')
+        expected = self.dump('serial')
+        self.assertEqual(self.dump('index', indexFile=indexFile), expected)
+        self.assertTrue(os.path.exists(indexFile))
+        # Catalog and leaf pages loaded from the index file
+        self.assertEqual(self.dump('indexed', indexFile=indexFile), expected)
+        self.assertEqual(self.dump('indexed-parallel', indexFile=indexFile, workers=2), expected)
+
+    def test_just_user(self):
+        expected = [secret for secret in self.dump('all')[0] if 'user1133' in secret[1]]
+        self.assertEqual(len(expected), 2)
+        # Through the objectSid index
+        with self.assertLogs(LOG, 'INFO') as logs:
+            self.assertEqual(self.dump('sid', justUser='%s-1133' % DOMAIN_SID)[0], expected)
+        self.assertFalse([message for message in logs.output if 'be patient' in message and 'user1133' in message])
+        # Names need a scan
+        with self.assertLogs(LOG, 'INFO') as logs:
+            self.assertEqual(self.dump('name', justUser='user1133')[0], expected)
+        self.assertIn('Searching for user1133, be patient', '\n'.join(logs.output))
+        self.assertEqual(self.dump('domain', justUser='TEST\\USER1133')[0], expected)
+        self.assertEqual(self.dump('missing', justUser='%s-99999' % DOMAIN_SID)[0], [])
+
+    def test_parallel(self):
+        serial = self.dump('serial')
+        for workers in (2, 3):
+            self.assertEqual(self.dump('parallel%d' % workers, workers=workers), serial)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=1)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   secretsdump's RemoteFile block cache, reading from an in memory connection
+#   that answers the SMBConnection calls RemoteFile makes.
+#
+import os
+import random
+import unittest
+
+from impacket.ese import ESENT_DB
+from impacket.examples.secretsdump import RemoteFile
+from tests.misc.test_ese import ESETestCase
+
+
+class MemoryConnection:
+    def __init__(self, files, maxReadSize):
+        self.files = files
+        self.maxReadSize = maxReadSize
+        self.reads = []
+        self.closed = []
+        self.deleted = []
+
+    def getRemoteHost(self):
+        return '127.0.0.1'
+
+    def connectTree(self, share):
+        return 1
+
+    def openFile(self, treeId, pathName, desiredAccess, shareMode):
+        return pathName
+
+    def getIOCapabilities(self):
+        return {'MaxReadSize': self.maxReadSize}
+
+    def queryInfo(self, treeId, fileId):
+        return {'EndOfFile': len(self.files[fileId])}
+
+    def readFile(self, treeId, fileId, offset, bytesToRead, singleCall=True):
+        self.reads.append((offset, bytesToRead))
+        return self.files[fileId][offset:offset + bytesToRead]
+
+    def closeFile(self, treeId, fileId):
+        self.closed.append(fileId)
+
+    def deleteFile(self, shareName, pathName):
+        self.deleted.append(pathName)
+
+
+class RemoteFileTests(unittest.TestCase):
+    data = bytes(random.Random(1).getrandbits(8) for _ in range(100000))
+
+    def open(self, maxReadSize=16384, **kwargs):
+        connection = MemoryConnection({'ntds.dit': self.data}, maxReadSize)
+        remoteFile = RemoteFile(connection, 'ntds.dit', **kwargs)
+        remoteFile.open()
+        return connection, remoteFile
+
+    def test_reads(self):
+        # Small cache, blocks come and go
+        for kwargs in ({}, {'blockSize': 4096, 'cacheSize': 3 * 4096}, {'blockSize': 1000, 'cacheSize': 0}):
+            connection, remoteFile = self.open(**kwargs)
+            rand = random.Random(2)
+            for _ in range(500):
+                offset = rand.randrange(len(self.data) + 100)
+                size = rand.choice((1, 4, 100, 999, 1000, 1001, 4095, 4096, 4097, 20000))
+                remoteFile.seek(offset, 0)
+                self.assertEqual(remoteFile.read(size), self.data[offset:offset + size], (kwargs, offset, size))
+            # Sequential reads crossing block boundaries
+            remoteFile.seek(0, 0)
+            data = b''
+            while True:
+                chunk = remoteFile.read(777)
+                if chunk == b'':
+                    break
+                data += chunk
+            self.assertEqual(data, self.data)
+            # No read is bigger than MaxReadSize
+            self.assertLessEqual(max(size for offset, size in connection.reads), connection.maxReadSize)
+
+    def test_coalesced_reads(self):
+        connection, remoteFile = self.open(blockSize=4096)
+        # Three blocks in a single round trip
+        remoteFile.seek(100, 0)
+        self.assertEqual(remoteFile.read(3 * 4096), self.data[100:100 + 3 * 4096])
+        self.assertEqual(connection.reads, [(0, 4 * 4096)])
+        # Up to MaxReadSize each
+        remoteFile.seek(8 * 4096, 0)
+        self.assertEqual(remoteFile.read(10 * 4096), self.data[8 * 4096:18 * 4096])
+        self.assertEqual(connection.reads[1:], [(8 * 4096, 4 * 4096), (12 * 4096, 4 * 4096), (16 * 4096, 2 * 4096)])
+        # Only the missing blocks are asked for
+        remoteFile.seek(2 * 4096, 0)
+        self.assertEqual(remoteFile.read(8 * 4096), self.data[2 * 4096:10 * 4096])
+        self.assertEqual(connection.reads[4:], [(4 * 4096, 4 * 4096)])
+        # Everything cached
+        remoteFile.seek(1, 0)
+        remoteFile.read(5 * 4096)
+        self.assertEqual(len(connection.reads), 5)
+
+        stats = remoteFile.getCacheStats()
+        self.assertEqual(stats['Reads'], 4)
+        self.assertEqual(stats['RoundTrips'], 5)
+        self.assertEqual(stats['BytesFetched'], 18 * 4096)
+        self.assertEqual(stats['CachedBlocks'], 18)
+
+    def test_block_size(self):
+        # Blocks are never bigger than MaxReadSize
+        connection, remoteFile = self.open(maxReadSize=1024)
+        self.assertEqual(remoteFile.read(3000), self.data[:3000])
+        self.assertEqual(connection.reads, [(0, 1024), (1024, 1024), (2048, 1024)])
+
+    def test_seek(self):
+        connection, remoteFile = self.open(blockSize=4096)
+        remoteFile.seek(-10, 2)
+        self.assertEqual(remoteFile.read(100), self.data[-10:])
+        self.assertEqual(remoteFile.read(100), b'')
+        remoteFile.seek(10, 0)
+        remoteFile.seek(5, 1)
+        self.assertEqual(remoteFile.read(5), self.data[15:20])
+        remoteFile.seek(0, 2)
+        self.assertEqual(remoteFile.read(1), b'')
+
+    def test_close(self):
+        connection, remoteFile = self.open()
+        remoteFile.read(10)
+        remoteFile.close()
+        self.assertEqual(connection.closed, ['ntds.dit'])
+        self.assertEqual(connection.deleted, ['ntds.dit'])
+        self.assertEqual(remoteFile.getCacheStats()['CachedBlocks'], 0)
+
+
+class RemoteDatabaseTests(ESETestCase):
+
+    def test_database(self):
+        expected = self.readTable(self.open())
+        with open(self.fileName, 'rb') as f:
+            connection = MemoryConnection({'test.edb': f.read()}, 65536)
+        db = ESENT_DB(RemoteFile(connection, 'test.edb', blockSize=8192, cacheSize=8 * 8192), isRemote=True)
+        self.addCleanup(db.close)
+        self.assertEqual(self.readTable(db), expected)
+        # The pages come a few blocks per round trip
+        self.assertLess(len(connection.reads), os.path.getsize(self.fileName) // 8192)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
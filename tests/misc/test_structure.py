@@ -26,13 +26,18 @@ class _StructureTest(object):
     # Subclass:
     # - must define theClass
     # - may override alignment
+    # - may override compiled (False runs the interpreted pack/unpack path)
     alignment = 0
+    compiled = True
 
     def create(self, data=None):
+        theClass = self.theClass
+        if not self.compiled:
+            theClass = type(theClass.__name__, (theClass,), {'compiledPlan': False})
         if data is not None:
-            return self.theClass(data, alignment=self.alignment)
+            return theClass(data, alignment=self.alignment)
         else:
-            return self.theClass(alignment=self.alignment)
+            return theClass(alignment=self.alignment)
 
     def test_structure(self):
         # print()
@@ -55,6 +60,14 @@ class _StructureTest(object):
         self.assertEqual(b_str, a_str,
                          "ERROR: original packed and repacked don't match")
 
+    def test_zero_copy(self):
+        a = self.create()
+        self.populate(a)
+        a_str = a.getData()
+        # Unpack from a view with an offset into a bigger buffer
+        b = self.create(memoryview(b'\xff' * 3 + a_str)[3:])
+        self.assertEqual(b.getData(), a_str)
+
     def check_data(self, a_str):
         if hasattr(self, 'hexData'):
             # Regression check
@@ -226,5 +239,90 @@ class Test_AAA(_StructureTest, unittest.TestCase):
     hexData = '02030457 a0a1a2a3 a4a5a6a7 a8a90506 0708'
 
 
+class Test_CompiledPlan(unittest.TestCase):
+    def test_plan_cached_on_class(self):
+        class Cached(Structure):
+            structure = (
+                ('len', '<H-data'),
+                ('data', ':'),
+            )
+
+        a = Cached()
+        a['data'] = b'hola'
+        self.assertEqual(a.getData(), b'\x04\x00hola')
+        plans = Cached.__dict__['_structurePlans']
+        self.assertEqual(len(plans), 1)
+        b = Cached(b'\x04\x00hola')
+        self.assertEqual(b['data'], b'hola')
+        self.assertIs(Cached.__dict__['_structurePlans'], plans)
+        self.assertEqual(len(plans), 1)
+
+    def test_plan_shared_by_per_instance_structures(self):
+        class PerInstance(Structure):
+            common = (
+                ('common', '<H=0'),
+            )
+            structure = (
+                ('len', '<H-data'),
+                ('data', ':'),
+            )
+
+            def __init__(self, withCommon, data=None):
+                if withCommon:
+                    self.structure = self.common + self.structure
+                Structure.__init__(self, data)
+
+        for i in range(200):
+            a = PerInstance(i % 2, b'\x01\x00\x04\x00hola' if i % 2 else b'\x04\x00hola')
+            self.assertEqual(a['data'], b'hola')
+        plans = PerInstance.__dict__['_structurePlans']
+        self.assertEqual(len(plans), 2)
+        for plan in plans.values():
+            self.assertIsNotNone(plan.fields)
+
+    def test_overridden_hooks_are_interpreted(self):
+        class Overridden(Structure):
+            structure = (('data', ':'),)
+
+            def unpack(self, format, data, dataClassOrCode=bytes, field=None):
+                return b'overridden'
+
+        self.assertEqual(Overridden(b'hola')['data'], b'overridden')
+        self.assertIs(Overridden.__dict__['_structurePlans'], False)
+
+
+class Test_ZeroCopy(unittest.TestCase):
+    class theClass(Structure):
+        structure = (
+            ('len', '<H-data'),
+            ('data', ':'),
+            ('name', 'z'),
+            ('tail', ':'),
+        )
+
+    def test_views(self):
+        a = self.theClass()
+        a['data'] = b'hola'
+        a['name'] = 'manola'
+        a['tail'] = b'x' * 64
+        buffer = memoryview(a.getData())
+        b = self.theClass(buffer)
+        # opaque fields are views into the buffer, the rest is materialized
+        self.assertIsInstance(b['data'], memoryview)
+        self.assertIsInstance(b['tail'], memoryview)
+        self.assertEqual(b['data'].obj, buffer.obj)
+        self.assertEqual(b['data'], b'hola')
+        self.assertEqual(b['name'], 'manola')
+        self.assertEqual(b['tail'].tobytes(), b'x' * 64)
+        self.assertEqual(b.getData(), buffer.tobytes())
+
+
+# Run every structure test against the interpreted path as well
+for _name, _test in list(globals().items()):
+    if isinstance(_test, type) and issubclass(_test, _StructureTest) and issubclass(_test, unittest.TestCase):
+        globals()[_name + '_interpreted'] = type(_name + '_interpreted', (_test,), {'compiled': False})
+del _name, _test
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=1)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+# Description:
+#   Registry tests against small hives written by Hive, checking key lookups
+#   through the key path and subkey list caches against the tree written.
+#
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from struct import pack
+
+from impacket import winregistry
+from impacket.winregistry import REG_NK, REG_REGF, REG_VK, Registry
+
+
+def lhHash(name):
+    res = 0
+    for c in name.upper():
+        res = (res * 37 + ord(c)) % 0x100000000
+    return res
+
+
+class Hive:
+    # Writes a hive with a single hbin. Keys are written before their parents, so the
+    # subkey lists can point to them
+    def __init__(self):
+        self.cells = b''
+        # Key path -> NK record data, subkey names and values
+        self.keys = {}
+
+    def cell(self, data):
+        size = (len(data) + 4 + 7) & ~7
+        # Cell offsets are relative to the first hbin, right after its 0x20 bytes header
+        offset = 0x20 + len(self.cells)
+        self.cells += pack('<l', -size) + data.ljust(size - 4, b'\x00')
+        return offset
+
+    def subKeyList(self, listType, subKeys):
+        records = b''
+        for name, offset in subKeys:
+            if listType == 'lf':
+                records += pack('<L', offset) + name[:4].encode('utf-8').ljust(4, b'\x00')
+            else:
+                records += pack('<L', offset) + pack('<L', lhHash(name))
+        if listType != 'ri':
+            return self.cell(listType.encode('utf-8') + pack('<H', len(subKeys)) + records)
+        # ri lists point to lh lists
+        lists = []
+        for i in range(0, len(subKeys), 16):
+            lists.append(self.subKeyList('lh', subKeys[i:i + 16]))
+        return self.cell(b'ri' + pack('<H', len(lists)) + b''.join(pack('<L', offset) for offset in lists))
+
+    def value(self, name, valueType, data):
+        vk = REG_VK()
+        vk['NameLength'] = len(name)
+        vk['Name'] = name.encode('utf-8')
+        vk['Flag'] = 1 if name != '' else 0
+        vk['ValueType'] = valueType
+        if isinstance(data, int):
+            # Small values go in the record itself
+            vk['DataLen'] = -0x7ffffffc
+            vk['OffsetData'] = data
+        else:
+            vk['DataLen'] = len(data)
+            vk['OffsetData'] = self.cell(data)
+        return self.cell(vk.getData())
+
+    def key(self, path, name, subKeys=(), values=(), className=None, listType='lh', root=False):
+        """ subKeys is a list of (name, spec) tuples, spec being the key() keyword arguments.
+            Returns the NK record offset
+        """
+        written = []
+        for subKeyName, spec in subKeys:
+            subKeyPath = subKeyName if path == '' else path + '\\' + subKeyName
+            written.append((subKeyName, self.key(subKeyPath, subKeyName, **spec)))
+
+        nk = REG_NK()
+        nk['Type'] = winregistry.ROOT_KEY if root else 0x20
+        nk['NumSubKeys'] = len(written)
+        nk['OffsetSubKeyLf'] = self.subKeyList(listType, written) if written else -1
+        nk['NumValues'] = len(values)
+        if values:
+            nk['OffsetValueList'] = self.cell(b''.join(pack('<l', self.value(*value)) for value in values))
+        else:
+            nk['OffsetValueList'] = -1
+        nk['OffsetSkRecord'] = -1
+        if className is not None:
+            nk['OffsetClassName'] = self.cell(className.encode('utf-16le'))
+            nk['ClassNameLength'] = len(className) * 2
+        else:
+            nk['OffsetClassName'] = -1
+        nk['NameLength'] = len(name)
+        nk['KeyName'] = name.encode('utf-8')
+        self.keys[path] = (nk.getData(), [subKeyName for subKeyName, _ in subKeys], values)
+        return self.cell(nk.getData())
+
+    def write(self, fileName, tree):
+        rootOffset = self.key('', 'ROOT', root=True, **tree)
+        hbinSize = (0x20 + len(self.cells) + 4095) & ~4095
+        hbin = b'hbin' + pack('<LLL', 0, hbinSize, hbinSize) + b'\x00' * 0x10 + self.cells
+        regf = REG_REGF()
+        regf['MajorVersion'] = 1
+        regf['MinorVersion'] = 5
+        regf['OffsetFirstRecord'] = rootOffset
+        regf['DataSize'] = hbinSize
+        with open(fileName, 'wb') as f:
+            f.write(regf.getData() + hbin.ljust(hbinSize, b'\x00'))
+
+
+def makeTree():
+    # A SYSTEM like hive: the Lsa keys with the boot key in their class names, plus keys with
+    # lots of subkeys in lf, lh and ri lists, some of them sharing prefixes
+    lsa = [(name, {'className': className}) for name, className in
+           (('JD', '8b1c3a5f'), ('Skew1', '02e6d4a9'), ('GBG', 'f0c2a88d'), ('Data', '7d34b6e1'))]
+    services = [('Service%d' % i, {'values': [('Start', winregistry.REG_DWORD, i % 5),
+                                              ('ImagePath', winregistry.REG_EXPAND_SZ,
+                                               ('system32\\svc%d.sys\x00' % i).encode('utf-16le'))],
+                                   'subKeys': [('Parameters', {'values': [('', winregistry.REG_SZ,
+                                                                           ('svc%d\x00' % i).encode('utf-16le'))]})]})
+                for i in range(40)]
+    enum = [('Dev%03d' % i, {'subKeys': [('Dev%03dChild' % i, {})] if i % 10 == 0 else []}) for i in range(40)]
+    controlSet = {
+        'subKeys': [
+            ('Control', {'subKeys': [('Lsa', {'subKeys': lsa}), ('ComputerName', {'subKeys': [
+                ('ComputerName', {'values': [('ComputerName', winregistry.REG_SZ, 'DC01\x00'.encode('utf-16le'))]})]})],
+                'values': [('CurrentUser', winregistry.REG_SZ, 'USERNAME\x00'.encode('utf-16le')),
+                           ('Blob', winregistry.REG_BINARY, bytes(range(200)))]}),
+            ('Services', {'subKeys': services, 'listType': 'ri'}),
+            ('Enum', {'subKeys': enum, 'listType': 'lf'}),
+        ],
+    }
+    return {'subKeys': [('ControlSet001', controlSet), ('Select', {'values': [('Current', winregistry.REG_DWORD, 1)]}),
+                        ('Setup', {})]}
+
+
+class RegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.fileName = os.path.join(self.directory, 'SYSTEM')
+        self.hive = Hive()
+        self.hive.write(self.fileName, makeTree())
+        self.paths = sorted(path for path in self.hive.keys if path != '')
+
+    def open(self, **kwargs):
+        registry = Registry(self.fileName, **kwargs)
+        self.addCleanup(registry.close)
+        return registry
+
+    def registries(self):
+        yield 'default', self.open()
+        yield 'no mmap', self.open(useMmap=False)
+        # Evicting all the time
+        yield 'tiny cache', self.open(cacheSize=2)
+        yield 'no cache', self.open(cacheSize=0)
+        indexed = self.open(cacheSize=2)
+        self.assertEqual(indexed.buildIndex(), len(self.paths))
+        yield 'indexed', indexed
+
+    def test_find_key(self):
+        paths = list(self.paths)
+        random.Random(1).shuffle(paths)
+        for name, registry in self.registries():
+            self.assertEqual(registry.findKey('\\').getData(), self.hive.keys[''][0])
+            # Parents first, then children first, then shuffled
+            for path in self.paths + self.paths[::-1] + paths:
+                key = registry.findKey(path)
+                self.assertIsNotNone(key, (name, path))
+                self.assertEqual(key.getData(), self.hive.keys[path][0], (name, path))
+                self.assertEqual(registry.findKey('\\' + path).getData(), key.getData())
+
+    def test_missing_keys(self):
+        missing = ['Missing', 'ControlSet001\\Missing', 'ControlSet001\\Control\\Lsa\\JD\\Missing',
+                   'ControlSet001\\Services\\Service1\\Parameters\\Missing', 'ControlSet001\\Services\\Service',
+                   'ControlSet001\\Services\\Service1000', 'ControlSet001\\Enum\\Dev00', 'ControlSet001\\Enum\\Dev0000',
+                   'ControlSet001\\Enum\\Dev001Child', 'ControlSet001\\control\\Lsa', 'Select\\Current']
+        for name, registry in self.registries():
+            for path in self.paths:
+                registry.findKey(path)
+            for path in missing:
+                self.assertIsNone(registry.findKey(path), (name, path))
+            # Nothing cached on the way
+            for path in self.paths:
+                self.assertEqual(registry.findKey(path).getData(), self.hive.keys[path][0], (name, path))
+
+    def test_enum_key(self):
+        for name, registry in self.registries():
+            for path in [''] + self.paths:
+                key = registry.findKey(path or '\\')
+                self.assertEqual(registry.enumKey(key), self.hive.keys[path][1], (name, path))
+
+    def test_values(self):
+        for name, registry in self.registries():
+            for path in self.paths:
+                for valueName, valueType, data in self.hive.keys[path][2]:
+                    self.assertEqual(registry.getValue(path, valueName or 'default'), (valueType, data),
+                                     (name, path, valueName))
+            self.assertEqual(registry.getValue('Select\\Current'), (winregistry.REG_DWORD, 1))
+            self.assertIsNone(registry.getValue('Select\\Missing'))
+            self.assertIsNone(registry.getValue('Missing\\Current'))
+            bootKey = ''
+            for key in ('JD', 'Skew1', 'GBG', 'Data'):
+                bootKey += registry.getClass('ControlSet001\\Control\\Lsa\\%s' % key)[:16].decode('utf-16le')
+            self.assertEqual(bootKey, '8b1c3a5f02e6d4a9f0c2a88d7d34b6e1')
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
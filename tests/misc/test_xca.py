@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Impacket - Collection of Python classes for working with network protocols.
+#
+# Copyright Fortra, LLC and its affiliated companies
+#
+# All rights reserved.
+#
+# This software is provided under a slightly modified version
+# of the Apache Software License. See the accompanying LICENSE file
+# for more information.
+#
+import unittest
+from random import Random
+
+from impacket import xca
+from impacket.smb3 import compressSMB, decompressSMB, SessionError
+from impacket.smb3structs import COMPRESSION_ALGORITHM_LZ77, COMPRESSION_ALGORITHM_LZ77_HUFFMAN, \
+    COMPRESSION_ALGORITHM_PATTERN_V1, SMB2_COMPRESSION_TRANSFORM_HEADER, SMB2_COMPRESSION_FLAG_CHAINED
+
+
+class XCATests(unittest.TestCase):
+
+    def setUp(self):
+        rnd = Random(1)
+        self.samples = [
+            b"",
+            b"a",
+            b"abcabcabcabc",
+            b"\x00" * 100000,
+            # Exactly one LZ77+Huffman block, and one byte more
+            b"x" * 65536,
+            b"x" * 65536 + b"y",
+            bytes(bytearray(rnd.getrandbits(8) for _ in range(5000))),
+            b"impacket " * 20000,
+            bytes(bytearray(rnd.choice(b"ab\x00") for _ in range(150000))),
+            # Long matches, they need the extra length bytes
+            bytes(bytearray(rnd.getrandbits(8) for _ in range(300))) * 1000,
+        ]
+
+    def test_lz77(self):
+        for data in self.samples:
+            compressed = xca.lz77_compress(data)
+            self.assertEqual(xca.lz77_decompress(compressed, len(data)), data)
+
+    def test_lz77huffman(self):
+        for data in self.samples:
+            compressed = xca.lz77huffman_compress(data)
+            self.assertEqual(xca.lz77huffman_decompress(compressed, len(data)), data)
+
+    def test_lz77_known(self):
+        # [MS-XCA] 3.1 example
+        data = b"abcdefghijklmnopqrstuvwxyz"
+        compressed = b"\x3f\x00\x00\x00" + data
+        self.assertEqual(xca.lz77_decompress(compressed, len(data)), data)
+        data = b"abc" * 100
+        compressed = b"\xff\xff\xff\x1f\x61\x62\x63\x17\x00\x0f\xff\x26\x01"
+        self.assertEqual(xca.lz77_decompress(compressed, len(data)), data)
+        self.assertEqual(xca.lz77_compress(data), compressed)
+
+    def test_lz77huffman_known(self):
+        # Streams laid out by hand following [MS-XCA] 2.2: 256 bytes with the 4 bits code lengths
+        # (even symbol in the low nibble), then the canonical codes in 16 bits little endian words
+        # read MSB first. 'a' to 'e' get 4 bits codes (0000 to 0100), 'f' to 'z' and EOF 5 bits
+        # ones (01010 to 11111)
+        data = b"abcdefghijklmnopqrstuvwxyz"
+        table = bytearray(256)
+        table[0x30:0x3e] = b"\x40\x44\x44" + b"\x55" * 10 + b"\x05"
+        table[0x80] = 0x05
+        compressed = bytes(table) + bytes.fromhex("23012d45738d19e1954ef1b56f9df79d00c0")
+        self.assertEqual(xca.lz77huffman_decompress(compressed, len(data)), data)
+
+        # 'a' 00, 'b' 01, 'c' 10, EOF 110 and the (offset 3, length 297) match symbol 0x11f 111.
+        # The match length goes in bytes after the words fetched so far (0xff, then 294 as a
+        # 16 bits value), its offset low bit follows in the bit stream
+        data = b"abc" * 100
+        table = bytearray(256)
+        table[0x30:0x32] = b"\x20\x22"
+        table[0x80] = 0x03
+        table[0x8f] = 0x30
+        compressed = bytes(table) + b"\xf0\x1b\x00\x00\xff\x26\x01"
+        self.assertEqual(xca.lz77huffman_decompress(compressed, len(data)), data)
+
+    def test_corrupted(self):
+        data = b"impacket " * 1000
+        with self.assertRaises(xca.XCAError):
+            xca.lz77_decompress(xca.lz77_compress(data)[:10], len(data))
+        with self.assertRaises(xca.XCAError):
+            xca.lz77huffman_decompress(xca.lz77huffman_compress(data), len(data) + 1)
+
+    def test_smb_compression(self):
+        message = bytearray(200000)
+        message[:64] = b"\xfeSMB" + b"\x01" * 60
+        message[5000:15000] = b"0123456789" * 1000
+        message = bytes(message)
+        for compressionIds, chained in (([COMPRESSION_ALGORITHM_LZ77], False),
+                                        ([COMPRESSION_ALGORITHM_LZ77_HUFFMAN], False),
+                                        ([COMPRESSION_ALGORITHM_LZ77, COMPRESSION_ALGORITHM_PATTERN_V1], True),
+                                        ([COMPRESSION_ALGORITHM_LZ77_HUFFMAN, COMPRESSION_ALGORITHM_PATTERN_V1],
+                                         True),
+                                        ([COMPRESSION_ALGORITHM_PATTERN_V1], True)):
+            compressed = compressSMB(message, compressionIds, chained)
+            self.assertLess(len(compressed), len(message) // 10)
+            self.assertEqual(compressed[:4], b"\xfcSMB")
+            header = SMB2_COMPRESSION_TRANSFORM_HEADER(compressed)
+            self.assertEqual(header["Flags"] & SMB2_COMPRESSION_FLAG_CHAINED > 0, chained)
+            self.assertEqual(decompressSMB(compressed), message)
+
+        # Not worth it
+        rnd = Random(2)
+        message = bytes(bytearray(rnd.getrandbits(8) for _ in range(10000)))
+        self.assertIsNone(compressSMB(message, [COMPRESSION_ALGORITHM_LZ77, COMPRESSION_ALGORITHM_PATTERN_V1], True))
+        self.assertIsNone(compressSMB(message, [COMPRESSION_ALGORITHM_LZ77_HUFFMAN], False))
+
+        # Messages claiming to be bigger than they are
+        compressed = bytearray(compressSMB(b"\x00" * 10000, [COMPRESSION_ALGORITHM_PATTERN_V1], True))
+        compressed[4] = 0xff
+        with self.assertRaises(SessionError):
+            decompressSMB(bytes(compressed))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)